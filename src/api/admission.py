@@ -0,0 +1,215 @@
+"""
+モデルで生成する /generate リクエストの受け付け制御 (同時実行数の上限・待ち行列・429)。
+Admission control: bounded concurrency, a per-client fair queue and 429 backpressure.
+
+上限なしに受け付けると、スパイク時にすべてのリクエストがモデルを取り合い、全員の
+p99 レイテンシが崩れる。AdmissionController は次のように受け付ける:
+
+    - 同時に生成するリクエストは max_concurrency 件まで。残りは待ち行列で待つ
+    - 待ち行列はクライアントごとに分け、空きが出るたびにクライアントを順番に回す
+      (1つのクライアントが大量に投げても、他のクライアントの順番は後回しにならない)
+    - 待ち行列全体・クライアントごとの上限を超えた場合や、max_wait_sec 待っても
+      順番が来ない場合は AdmissionRejected を送出する。API は 429 + Retry-After を返す
+
+Retry-After は、観測した1件あたりの処理時間 (指数移動平均) から求めたスループットで、
+待ち行列がはけるまでの時間を見積もった値。
+
+キャッシュから返すリクエストはモデルを使わないため、この制御の対象にしない。
+
+環境変数 (from_env):
+    ADMISSION_MAX_CONCURRENCY: 同時に生成するリクエスト数 (既定: 1, 0 で無効)。
+        API のプロセスで推論レーン (CPU_LANES) を使う場合、指定しなければレーンの数に合わせる
+        (リクエストは小節を順番に生成するため、同時実行数がレーンより少ないとレーンが余る)
+    ADMISSION_MAX_QUEUE: 待ち行列全体の上限 (既定: 16)
+    ADMISSION_MAX_QUEUE_PER_CLIENT: クライアントごとの待ち行列の上限 (既定: 4)
+    ADMISSION_MAX_WAIT_SEC: 待ち行列で待つ時間の上限 (秒, 既定: 30)
+"""
+
+from collections import OrderedDict, deque
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+import math
+import os
+import threading
+import time
+
+from src.api import metrics
+
+# 処理時間をまだ観測していない場合の Retry-After
+DEFAULT_RETRY_AFTER_SEC = 1
+MAX_RETRY_AFTER_SEC = 120
+
+
+class AdmissionRejected(Exception):
+    """
+    待ち行列が満杯、または待ち時間の上限を超えたため、リクエストを受け付けなかった。
+
+    Attributes:
+        reason: queue_full / client_limit / timeout のいずれか。
+        retry_after: 再試行までに待つべき秒数。
+    """
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(f"Too many generation requests ({reason}).")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+@dataclass(eq=False)
+class _Ticket:
+    """待ち行列の1リクエスト。順番が来たら granted を立てる。"""
+
+    enqueued_at: float
+    granted: bool = False
+
+
+class AdmissionController:
+    """
+    同時実行数の上限と、クライアントごとに公平な待ち行列。
+
+    Args:
+        max_concurrency: 同時に生成するリクエスト数。
+        max_queue: 待ち行列全体の上限。
+        max_queue_per_client: クライアントごとの待ち行列の上限。
+        max_wait_sec: 待ち行列で待つ時間の上限。
+        alpha: 処理時間の指数移動平均で、新しい観測値の重み。
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 1,
+        max_queue: int = 16,
+        max_queue_per_client: int = 4,
+        max_wait_sec: float = 30.0,
+        alpha: float = 0.2,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_queue_per_client = max_queue_per_client
+        self.max_wait_sec = max_wait_sec
+        self.alpha = alpha
+        self.service_sec: float | None = None
+        self._inflight = 0
+        self._queued = 0
+        # クライアント -> 待っているリクエスト。先頭のクライアントから順に1件ずつ通す
+        self._waiting: OrderedDict[str, deque[_Ticket]] = OrderedDict()
+        self._cond = threading.Condition()
+
+    @classmethod
+    def from_env(cls) -> "AdmissionController | None":
+        """環境変数から設定を読み込む。ADMISSION_MAX_CONCURRENCY=0 の場合は None。"""
+        max_concurrency = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "1"))
+        if max_concurrency <= 0:
+            return None
+        return cls(
+            max_concurrency,
+            max_queue=int(os.getenv("ADMISSION_MAX_QUEUE", "16")),
+            max_queue_per_client=int(os.getenv("ADMISSION_MAX_QUEUE_PER_CLIENT", "4")),
+            max_wait_sec=float(os.getenv("ADMISSION_MAX_WAIT_SEC", "30")),
+        )
+
+    def set_max_concurrency(self, max_concurrency: int) -> None:
+        """同時実行数の上限を変える。増えた枠には待ち行列のリクエストをすぐに割り当てる。"""
+        with self._cond:
+            self.max_concurrency = max_concurrency
+            self._dispatch()
+
+    @property
+    def inflight(self) -> int:
+        with self._cond:
+            return self._inflight
+
+    @property
+    def queued(self) -> int:
+        with self._cond:
+            return self._queued
+
+    def _retry_after(self) -> int:
+        # ロックを持った状態で呼ぶ。待ち行列 + 新しい1件がはけるまでの時間
+        if self.service_sec is None:
+            return DEFAULT_RETRY_AFTER_SEC
+        throughput = self.max_concurrency / max(self.service_sec, 1e-3)
+        seconds = math.ceil((self._queued + 1) / throughput)
+        return min(max(seconds, DEFAULT_RETRY_AFTER_SEC), MAX_RETRY_AFTER_SEC)
+
+    def retry_after(self) -> int:
+        """今リクエストを受け付けられなかった場合の Retry-After (秒)。"""
+        with self._cond:
+            return self._retry_after()
+
+    def _reject(self, reason: str) -> AdmissionRejected:
+        metrics.ADMISSION_REJECTIONS.inc(reason=reason)
+        return AdmissionRejected(reason, self._retry_after())
+
+    def _update_gauges(self) -> None:
+        metrics.ADMISSION_INFLIGHT.set(self._inflight)
+        metrics.ADMISSION_QUEUE_DEPTH.set(self._queued)
+        metrics.ADMISSION_QUEUED_CLIENTS.set(len(self._waiting))
+
+    def _dispatch(self) -> None:
+        # ロックを持った状態で呼ぶ。空いている枠を、クライアントを順番に回しながら割り当てる
+        while self._inflight < self.max_concurrency and self._waiting:
+            client, tickets = self._waiting.popitem(last=False)
+            ticket = tickets.popleft()
+            if tickets:
+                self._waiting[client] = tickets  # 末尾に回す
+            ticket.granted = True
+            self._queued -= 1
+            self._inflight += 1
+        self._update_gauges()
+        self._cond.notify_all()
+
+    def _remove(self, client: str, ticket: _Ticket) -> None:
+        tickets = self._waiting.get(client)
+        if tickets is not None and ticket in tickets:
+            tickets.remove(ticket)
+            self._queued -= 1
+            if not tickets:
+                del self._waiting[client]
+        self._update_gauges()
+
+    def _acquire(self, client: str) -> None:
+        with self._cond:
+            if self._inflight < self.max_concurrency and not self._waiting:
+                self._inflight += 1
+                self._update_gauges()
+                metrics.ADMISSION_WAIT.observe(0.0)
+                return
+            if self._queued >= self.max_queue:
+                raise self._reject("queue_full")
+            tickets = self._waiting.setdefault(client, deque())
+            if len(tickets) >= self.max_queue_per_client:
+                if not tickets:
+                    del self._waiting[client]
+                raise self._reject("client_limit")
+            ticket = _Ticket(time.perf_counter())
+            tickets.append(ticket)
+            self._queued += 1
+            self._update_gauges()
+            if not self._cond.wait_for(lambda: ticket.granted, timeout=self.max_wait_sec):
+                self._remove(client, ticket)
+                raise self._reject("timeout")
+            metrics.ADMISSION_WAIT.observe(time.perf_counter() - ticket.enqueued_at)
+
+    def _release(self, service_sec: float) -> None:
+        with self._cond:
+            self._inflight -= 1
+            current = self.service_sec
+            self.service_sec = (
+                service_sec if current is None else current + self.alpha * (service_sec - current)
+            )
+            self._dispatch()
+
+    @contextmanager
+    def admit(self, client: str) -> Iterator[None]:
+        """
+        順番が来るまで待ってから、囲んだ処理を実行する。受け付けられない場合は
+        AdmissionRejected を送出する。
+        """
+        self._acquire(client)
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._release(time.perf_counter() - started_at)
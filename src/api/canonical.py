@@ -0,0 +1,162 @@
+"""
+/generate のパラメータを正規化し、正規 URL・ETag・Cache-Control を決める。
+Canonical form of /generate parameters, used for redirects, ETags and cache headers.
+
+nginx は `$request_uri` をキャッシュキーにするため、`Dm7 - G7` / `Dm7-G7` / `dm7 -G7` や
+クエリの順番、`0.30` と `0.3` のような表記ゆれがそれぞれ別のキャッシュエントリになる。
+API はパラメータを次の規則で正規化し、正規形でない URL は正規 URL へリダイレクトする。
+
+    chord_progression: コードをパーサーで解析して正規の表記にし、" - " でつなぐ
+                       (静的キャッシュ dist/<md5(コード進行)>/ のキーと同じ綴り)。
+                       パーサーが解析できないコード ("C-7" など) を含む場合は、
+                       前後の空白を除いてそのまま使う
+    style:             前後の空白を除く
+    variation:         整数。静的キャッシュのパスに対応するため常にクエリに含める
+    supress_token_prob_ratio: float の最短表記 (0.30 -> 0.3)。既定値なら省略
+    instrument:        空白をつめて各単語を先頭大文字にする。既定値なら省略
+    model:             前後の空白を除く。既定のモデル (空) なら省略
+    deadline_ms:       指定された場合のみ含める (生成結果のキーには含めない)
+    format:            指定された場合のみ含める。Accept で JSON 以外を選んだ場合は、
+                       format を付けた URL へリダイレクトする (format のない URL は常に JSON)
+
+クエリは上の順番で並べる。生成結果は (正規化したパラメータ, モデル) で決まるため、
+それらから強い ETag を作り、If-None-Match が一致すれば生成せずに 304 を返せる。
+"""
+
+from dataclasses import dataclass
+import hashlib
+import os
+from urllib.parse import urlencode
+
+from src.model import bar_store
+from src.model.chord_name_parser import canonical_chord_name
+
+DEFAULT_RATIO = 0.3
+DEFAULT_INSTRUMENT = "Alto Saxophone"
+# 正規形のレスポンスとリダイレクトをキャッシュしてよい秒数
+CACHE_MAX_AGE_SEC = int(os.getenv("GENERATE_CACHE_MAX_AGE_SEC", str(30 * 24 * 60 * 60)))
+
+
+def canonical_progression(chord_progression: str) -> str:
+    """
+    コード進行を正規の表記にする (例: "dm7 -G7" -> "Dm7 - G7")。
+    解析できないコードを含む場合は、前後の空白だけを除いて返す (生成はこれまでどおり行う)。
+
+    Raises:
+        ValueError: 空の小節が含まれる場合。
+    """
+    chords = [chord.strip() for chord in chord_progression.split("-")]
+    if not all(chords):
+        raise ValueError(f"Empty chord in progression: '{chord_progression}'")
+    try:
+        return " - ".join(canonical_chord_name(chord) for chord in chords)
+    except ValueError:
+        return chord_progression.strip()
+
+
+def canonical_instrument(instrument: str) -> str:
+    """楽器名の表記をそろえる (例: " alto  saxophone" -> "Alto Saxophone")。"""
+    return " ".join(word.capitalize() for word in instrument.split())
+
+
+def canonical_ratio(ratio: float) -> str:
+    """float を最短の10進表記にする (例: 0.30 -> "0.3", 3e-1 -> "0.3")。"""
+    return repr(float(ratio))
+
+
+def static_cache_key(chord_progression: str) -> str:
+    """静的キャッシュ (dist/<key>/<style>/<variation>.json) のディレクトリ名を返す。"""
+    return hashlib.md5(canonical_progression(chord_progression).encode()).hexdigest()
+
+
+@dataclass(frozen=True)
+class CanonicalParams:
+    """正規化した /generate のパラメータ。"""
+
+    chord_progression: str
+    style: str
+    variation: int
+    supress_token_prob_ratio: float
+    instrument: str
+    model: str = ""  # MODEL_ADAPTERS のアダプタ名。空なら既定のモデル
+
+    @classmethod
+    def from_raw(
+        cls,
+        chord_progression: str,
+        style: str,
+        variation: int = 1,
+        supress_token_prob_ratio: float = DEFAULT_RATIO,
+        instrument: str = DEFAULT_INSTRUMENT,
+        model: str = "",
+    ) -> "CanonicalParams":
+        """
+        Raises:
+            ValueError: コード進行を解析できない場合。
+        """
+        return cls(
+            chord_progression=canonical_progression(chord_progression),
+            style=style.strip(),
+            variation=int(variation),
+            supress_token_prob_ratio=float(supress_token_prob_ratio),
+            instrument=canonical_instrument(instrument),
+            model=model.strip(),
+        )
+
+    @property
+    def key(self) -> tuple:
+        """生成結果のキャッシュキー。既定のモデル以外ではモデルの名前を末尾に加える。"""
+        key = (
+            self.chord_progression,
+            self.style,
+            self.variation,
+            self.supress_token_prob_ratio,
+            self.instrument,
+        )
+        return (*key, self.model) if self.model else key
+
+    def query_string(
+        self, response_format: str | None = None, deadline_ms: int | None = None
+    ) -> str:
+        """正規 URL のクエリ文字列を返す。"""
+        query = [
+            ("chord_progression", self.chord_progression),
+            ("style", self.style),
+            ("variation", str(self.variation)),
+        ]
+        if self.supress_token_prob_ratio != DEFAULT_RATIO:
+            ratio = canonical_ratio(self.supress_token_prob_ratio)
+            query.append(("supress_token_prob_ratio", ratio))
+        if self.instrument != DEFAULT_INSTRUMENT:
+            query.append(("instrument", self.instrument))
+        if self.model:
+            query.append(("model", self.model))
+        if deadline_ms:
+            query.append(("deadline_ms", str(deadline_ms)))
+        if response_format:
+            query.append(("format", response_format))
+        return urlencode(query)
+
+    def etag(self, model_fingerprint: str, response_format: str) -> str:
+        """
+        強い ETag を返す。シードが決まっているため、同じパラメータ・同じモデルなら
+        生成結果のバイト列も同じになる。形式ごとに表現が違うので形式も含める。
+        """
+        source = "\n".join([*map(str, self.key), model_fingerprint, response_format])
+        return '"' + hashlib.sha256(source.encode()).hexdigest()[:32] + '"'
+
+
+def cache_control() -> str:
+    return f"public, max-age={CACHE_MAX_AGE_SEC}"
+
+
+# ETag に含めるモデルの識別子 (小節ごとの結果の保存先と共通)
+model_fingerprint = bar_store.model_fingerprint
+
+
+def if_none_match(header: str | None, etag: str) -> bool:
+    """If-None-Match ヘッダーが etag に一致するか (`*` や複数指定、弱い比較を含む) を返す。"""
+    if not header:
+        return False
+    candidates = [candidate.strip() for candidate in header.split(",")]
+    return "*" in candidates or etag in (c.removeprefix("W/") for c in candidates)
@@ -0,0 +1,144 @@
+"""
+/generate のレイテンシ予算 (deadline) と、予算を超えそうな時の段階的な品質の引き下げ。
+Deadline-aware generation: estimate the latency of a request and pick a degradation.
+
+リクエストごとの `deadline_ms` と、サーバー全体の SLO (GENERATE_SLO_MS) の小さい方を予算とする。
+待ち時間 + 生成時間の見積もりが予算を超える場合、次の順に品質を下げる。
+
+    1. lightweight_processor: プロセッサの重い処理 (毎ステップの全文デコード・トレンド計算・
+                              ループ検出) を省き、コードスケール外の音の抑制だけを行う
+    2. reduced_tokens:        小節あたりの max_new_tokens を予算に収まるまで減らす
+    3. nearest_cached:        それでも収まらない場合、キャッシュ済みの近いバリエーションを返す
+
+見積もりは実際に生成した小節の統計 (GenerationStats) の指数移動平均から作る。
+統計がまだない (起動直後) 場合は見積もれないため、品質は下げない。
+
+見積もりは小節を1つずつ順に生成する前提のため、並列生成モード (PARALLEL_BARS=1) では
+使わない。並列生成では全小節を2回のバッチで生成し、バッチの統計は小節ごとに分けられない
+(見積もりの元になる統計も集まらない) ため、予算による品質の引き下げは行わない。
+"""
+
+from dataclasses import dataclass, field
+import os
+import threading
+
+DEFAULT_MAX_NEW_TOKENS = 128
+# これより少ないトークン数では1小節として成り立たないため、次の段階に進む
+MIN_NEW_TOKENS = int(os.getenv("DEADLINE_MIN_NEW_TOKENS", "32"))
+# サーバー全体のレイテンシ目標 (ミリ秒)。0 の場合は deadline_ms の指定があるリクエストだけ対象
+SLO_MS = int(os.getenv("GENERATE_SLO_MS", "0"))
+
+
+def budget_sec(deadline_ms: int | None, slo_ms: int = SLO_MS) -> float | None:
+    """リクエストの deadline_ms と SLO の小さい方を秒で返す。どちらもなければ None。"""
+    budgets = [ms for ms in (deadline_ms, slo_ms) if ms]
+    return min(budgets) / 1000 if budgets else None
+
+
+@dataclass(frozen=True)
+class DegradationPlan:
+    """リクエストに適用する品質の引き下げ。"""
+
+    max_new_tokens: int = DEFAULT_MAX_NEW_TOKENS
+    lightweight_processor: bool = False
+    use_cached: bool = False
+    estimated_sec: float | None = None
+    steps: tuple[str, ...] = field(default=())
+
+    @property
+    def degraded(self) -> bool:
+        return bool(self.steps)
+
+    def header(self) -> str:
+        """X-Melody-Degradation ヘッダーの値。"""
+        return ", ".join(self.steps) if self.steps else "none"
+
+
+NO_DEGRADATION = DegradationPlan()
+
+
+class LatencyModel:
+    """
+    小節ごとの生成統計の指数移動平均から、リクエストの所要時間を見積もる。
+
+    Args:
+        alpha: 新しい観測値の重み。
+    """
+
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self.prefill_sec: float | None = None
+        self.sec_per_token: float | None = None
+        self.processor_sec_per_token: float | None = None
+        self.tokens_per_bar: float | None = None
+        self._lock = threading.Lock()
+
+    def _update(self, name: str, value: float) -> None:
+        current = getattr(self, name)
+        setattr(self, name, value if current is None else current + self.alpha * (value - current))
+
+    def observe(self, stats: dict) -> None:
+        """
+        1小節分の GenerationStats.to_dict() を取り込む。プロセッサの処理時間の割合が変わるため、
+        lightweight_processor で生成した小節は渡さないこと。
+        """
+        new_tokens = stats.get("new_tokens", 0)
+        if new_tokens <= 1:
+            return
+        with self._lock:
+            self._update("prefill_sec", stats.get("prefill_sec", 0.0))
+            # decode_sec は2トークン目以降のステップの合計
+            self._update("sec_per_token", stats.get("decode_sec", 0.0) / (new_tokens - 1))
+            self._update("processor_sec_per_token", stats.get("processor_sec", 0.0) / new_tokens)
+            self._update("tokens_per_bar", new_tokens)
+
+    @property
+    def ready(self) -> bool:
+        return self.sec_per_token is not None
+
+    def bar_sec(self, max_new_tokens: int, lightweight_processor: bool = False) -> float:
+        """1小節の生成時間の見積もり。EOS で止まるため、平均トークン数より長くはならない。"""
+        tokens = min(max_new_tokens, self.tokens_per_bar)
+        per_token = self.sec_per_token
+        if lightweight_processor:
+            per_token = max(per_token - self.processor_sec_per_token, 0.0)
+        return self.prefill_sec + tokens * per_token
+
+    def plan(self, num_bars: int, queued_bars: float, budget: float | None) -> DegradationPlan:
+        """
+        num_bars 小節のリクエストを、queued_bars 小節分の待ち行列の後ろで予算内に収める計画を返す。
+        """
+        if budget is None or not self.ready:
+            return NO_DEGRADATION
+        with self._lock:
+            wait = queued_bars * self.bar_sec(DEFAULT_MAX_NEW_TOKENS)
+            full = wait + num_bars * self.bar_sec(DEFAULT_MAX_NEW_TOKENS)
+            if full <= budget:
+                return DegradationPlan(estimated_sec=full)
+
+            light = wait + num_bars * self.bar_sec(DEFAULT_MAX_NEW_TOKENS, True)
+            if light <= budget:
+                return DegradationPlan(
+                    lightweight_processor=True,
+                    estimated_sec=light,
+                    steps=("lightweight_processor",),
+                )
+
+            per_token = max(self.sec_per_token - self.processor_sec_per_token, 1e-6)
+            per_bar = (budget - wait) / num_bars
+            tokens = int((per_bar - self.prefill_sec) / per_token)
+            if tokens >= MIN_NEW_TOKENS:
+                return DegradationPlan(
+                    max_new_tokens=tokens,
+                    lightweight_processor=True,
+                    estimated_sec=wait + num_bars * self.bar_sec(tokens, True),
+                    steps=("lightweight_processor", "reduced_tokens"),
+                )
+            # キャッシュ済みの近いバリエーションがなければ、最小のトークン数で生成する
+            return DegradationPlan(
+                max_new_tokens=MIN_NEW_TOKENS,
+                lightweight_processor=True,
+                use_cached=True,
+                estimated_sec=wait + num_bars * self.bar_sec(MIN_NEW_TOKENS, True),
+                steps=("lightweight_processor", "reduced_tokens"),
+            )
@@ -0,0 +1,610 @@
+"""
+モデルを専有し、ローカルの Unix ソケット経由で小節単位の生成ジョブを受け付ける推論ワーカー。
+An out-of-process inference worker that owns the model and serves bar-generation jobs
+over a local Unix socket.
+
+API サーバー (uvicorn --workers N) の各プロセスはモデルを読み込まずに
+`InferenceWorkerClient` でジョブを投げるだけになるため、HTTP 処理を水平に増やしても
+4-bit モデルをプロセス数分読み込む必要がなくなる。
+
+プロトコル: 4バイト (big endian) の長さ + UTF-8 JSON のメッセージを1往復する。
+    {"op": "generate", "job": {...}} -> {"ok": true, "text": "...", "stats": {...}}
+    {"op": "generate_batch", "jobs": [...]} -> {"ok": true, "texts": [...], "stats": {...}}
+    {"op": "health"}                 -> {"ok": true, "health": {...}}
+キューが満杯の場合は {"ok": false, "error": "busy"} を即座に返す (バックプレッシャー)。
+
+起動例:
+    python -m src.api.inference_worker --socket_path /tmp/melody-flow.sock
+"""
+
+from collections.abc import Callable
+from concurrent.futures import Future
+from dataclasses import asdict, dataclass, field
+import json
+import os
+from pathlib import Path
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+from loguru import logger
+from src.model.cpu_lanes import (
+    LanePlan,
+    pin_current_thread,
+    plan_lanes,
+    tune_lanes,
+    validate_lane_decode_mode,
+    validate_lane_spec,
+)
+from tap import Tap
+
+DEFAULT_SOCKET_PATH = "/tmp/melody-flow-inference.sock"
+_HEADER = struct.Struct(">I")
+MAX_MESSAGE_BYTES = 16 * 1024 * 1024
+
+
+@dataclass(frozen=True)
+class BarJob:
+    """1小節分の生成ジョブ。プロセス間で受け渡せるよう、プロセッサではなく設定値を持つ。"""
+
+    prompt: str
+    chord: str
+    seed: int
+    supress_token_prob_ratio: float = 0.3
+    max_new_tokens: int = 128
+    temperature: float = 0.75
+    # 締め切りに間に合わせるため、プロセッサの重い処理を省く (src/api/deadline.py)
+    lightweight_processor: bool = False
+    # 生成に使うアダプタの名前 (MODEL_ADAPTERS、src/model/adapters.py)。空なら既定のモデル
+    adapter: str = ""
+
+
+@dataclass
+class BarResult:
+    """1小節分の生成結果。stats には GenerationStats.to_dict() の内容が入る。"""
+
+    text: str
+    stats: dict = field(default_factory=dict)
+
+
+@dataclass
+class BarBatchResult:
+    """
+    複数の小節を1回の generate でまとめて生成した結果。texts は jobs と同じ順。
+    stats にはバッチ全体の GenerationStats.to_dict() (トークン数は全行の合計) が入る。
+    """
+
+    texts: list[str]
+    stats: dict = field(default_factory=dict)
+
+
+class WorkerBusyError(RuntimeError):
+    """ワーカーのキューが満杯で、ジョブを受け付けられない。"""
+
+
+class WorkerUnavailableError(RuntimeError):
+    """ワーカーに接続できない、またはモデルの読み込みが完了していない。"""
+
+
+# --- メッセージの送受信 ---
+def send_message(sock: socket.socket, message: dict) -> None:
+    payload = json.dumps(message, ensure_ascii=False).encode("utf-8")
+    sock.sendall(_HEADER.pack(len(payload)) + payload)
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes | None:
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def recv_message(sock: socket.socket) -> dict | None:
+    """メッセージを1つ受信する。接続が閉じられた場合は None を返す。"""
+    header = _recv_exactly(sock, _HEADER.size)
+    if header is None:
+        return None
+    (length,) = _HEADER.unpack(header)
+    if length > MAX_MESSAGE_BYTES:
+        raise ValueError(f"Message too large: {length} bytes")
+    payload = _recv_exactly(sock, length)
+    if payload is None:
+        return None
+    return json.loads(payload.decode("utf-8"))
+
+
+# --- ワーカー本体 ---
+class InferenceWorker:
+    """
+    生成ジョブの有界キューと、それを処理する推論スレッド (レーン) を管理するクラス。
+
+    Args:
+        loader: 生成関数 (BarJob -> BarResult) を返す関数。モデルの読み込みはここで行う。
+            生成関数が generate_batch (list[BarJob] -> BarBatchResult) を持つ場合、
+            submit_batch のジョブはまとめて生成する。持たない場合は1件ずつ生成する。
+        max_queue: 受け付ける待機ジョブ数の上限。超えた場合は WorkerBusyError。
+        num_lanes: 同時に推論を実行するスレッド数。
+        lane_planner: 生成関数を受け取り、CPU のレーンへの割り当て (LanePlan) を返す関数。
+            指定した場合はモデルの読み込み後に呼び出し、num_lanes の代わりにその
+            レーンの数だけスレッドを起動して、それぞれを担当の CPU に固定する。
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[], Callable[[BarJob], BarResult]],
+        max_queue: int = 32,
+        num_lanes: int = 1,
+        lane_planner: Callable[[Callable[[BarJob], BarResult]], LanePlan] | None = None,
+    ):
+        self._loader = loader
+        self._queue: queue.Queue[tuple[BarJob | tuple[BarJob, ...], Future]] = queue.Queue(
+            maxsize=max_queue
+        )
+        self._generate_fn: Callable[[BarJob], BarResult] | None = None
+        self._num_lanes = num_lanes
+        self._lane_planner = lane_planner
+        self.lane_plan: LanePlan | None = None
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self._processed = 0
+        self._failed = 0
+        self._rejected = 0
+        self.status = "loading"
+        self.error: str | None = None
+        self.started_at = time.time()
+
+    def start(self, wait: bool = False) -> None:
+        """
+        モデルを読み込み、推論スレッドを起動する。wait が False ならバックグラウンドで行う。
+        """
+        if wait:
+            self._load()
+            return
+        threading.Thread(target=self._load, name="inference-loader", daemon=True).start()
+
+    def _load(self) -> None:
+        try:
+            self._generate_fn = self._loader()
+            if self._lane_planner is not None:
+                self.lane_plan = self._lane_planner(self._generate_fn)
+                self._num_lanes = self.lane_plan.num_lanes
+        except Exception as e:
+            logger.exception("Failed to load model in inference worker.")
+            self.status, self.error = "error", str(e)
+            return
+        for lane in range(self._num_lanes):
+            threading.Thread(
+                target=self._run_lane, args=(lane,), name=f"inference-lane-{lane}", daemon=True
+            ).start()
+        self.status = "ready"
+        logger.info(f"Inference worker is ready ({self._num_lanes} lane(s)).")
+
+    def _enqueue(self, work: BarJob | tuple[BarJob, ...]) -> Future:
+        if self.status != "ready":
+            raise WorkerUnavailableError(f"Inference worker is not ready: {self.status}")
+        future: Future = Future()
+        try:
+            self._queue.put_nowait((work, future))
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            raise WorkerBusyError("Inference queue is full.") from None
+        return future
+
+    def submit(self, job: BarJob) -> Future:
+        """ジョブをキューに積む。キューが満杯なら待たずに WorkerBusyError を送出する。"""
+        return self._enqueue(job)
+
+    def submit_batch(self, jobs: list[BarJob]) -> Future:
+        """複数のジョブを1件としてキューに積む。結果は BarBatchResult。"""
+        return self._enqueue(tuple(jobs))
+
+    def _generate_batch(self, jobs: tuple[BarJob, ...]) -> BarBatchResult:
+        generate_batch = getattr(self._generate_fn, "generate_batch", None)
+        if generate_batch is not None:
+            return generate_batch(list(jobs))
+        return BarBatchResult([self._generate_fn(job).text for job in jobs])
+
+    def _run_lane(self, lane: int) -> None:
+        if self.lane_plan is not None:
+            pin_current_thread(self.lane_plan.cpus[lane], self.lane_plan.threads[lane])
+        while True:
+            work, future = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            with self._lock:
+                self._inflight += 1
+            try:
+                if isinstance(work, tuple):
+                    future.set_result(self._generate_batch(work))
+                else:
+                    future.set_result(self._generate_fn(work))
+                with self._lock:
+                    self._processed += 1
+            except Exception as e:
+                future.set_exception(e)
+                with self._lock:
+                    self._failed += 1
+            finally:
+                with self._lock:
+                    self._inflight -= 1
+
+    def health(self) -> dict:
+        with self._lock:
+            return {
+                "status": self.status,
+                "error": self.error,
+                "pid": os.getpid(),
+                "uptime_sec": round(time.time() - self.started_at, 1),
+                "lanes": self._num_lanes,
+                "cpu_lanes": self.lane_plan.to_dict() if self.lane_plan is not None else None,
+                "queue_depth": self._queue.qsize(),
+                "max_queue": self._queue.maxsize,
+                "inflight": self._inflight,
+                "processed": self._processed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "memory_bytes": getattr(self._generate_fn, "memory_bytes", None),
+            }
+
+
+class _WorkerRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self) -> None:
+        worker: InferenceWorker = self.server.worker
+        while True:
+            try:
+                message = recv_message(self.request)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Dropping connection: {e}")
+                return
+            if message is None:
+                return
+            send_message(self.request, self._dispatch(worker, message))
+
+    def _dispatch(self, worker: InferenceWorker, message: dict) -> dict:
+        op = message.get("op")
+        if op == "health":
+            return {"ok": True, "health": worker.health()}
+        if op not in ("generate", "generate_batch"):
+            return {"ok": False, "error": "bad_request", "detail": f"Unknown op: {op}"}
+        try:
+            if op == "generate_batch":
+                jobs = [BarJob(**job) for job in message["jobs"]]
+                batch = worker.submit_batch(jobs).result()
+                return {"ok": True, "texts": batch.texts, "stats": batch.stats}
+            result = worker.submit(BarJob(**message["job"])).result()
+            return {"ok": True, "text": result.text, "stats": result.stats}
+        except WorkerBusyError as e:
+            return {"ok": False, "error": "busy", "detail": str(e)}
+        except WorkerUnavailableError as e:
+            return {"ok": False, "error": "unavailable", "detail": str(e)}
+        except Exception as e:
+            return {"ok": False, "error": "failed", "detail": str(e)}
+
+
+class InferenceWorkerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str | Path, worker: InferenceWorker):
+        socket_path = Path(socket_path)
+        if socket_path.exists():
+            socket_path.unlink()
+        self.worker = worker
+        super().__init__(str(socket_path), _WorkerRequestHandler)
+
+
+# --- クライアント ---
+class InferenceWorkerClient:
+    """API プロセスから推論ワーカーへジョブを投げるクライアント。呼び出しごとに接続する。"""
+
+    def __init__(self, socket_path: str | Path, timeout: float = 300.0):
+        self.socket_path = str(socket_path)
+        self.timeout = timeout
+
+    def _request(self, message: dict, timeout: float | None = None) -> dict:
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(timeout or self.timeout)
+                sock.connect(self.socket_path)
+                send_message(sock, message)
+                response = recv_message(sock)
+        except OSError as e:
+            # 接続できない場合だけでなく、応答の待ち時間切れ (socket.timeout) や
+            # ワーカーの再起動による切断も、推論ワーカーを使えないものとして扱う
+            raise WorkerUnavailableError(
+                f"Inference worker request failed ({self.socket_path}): {e}"
+            ) from e
+        if response is None:
+            raise WorkerUnavailableError("Inference worker closed the connection.")
+        return response
+
+    @staticmethod
+    def _raise_for_error(response: dict) -> None:
+        if response.get("ok"):
+            return
+        error, detail = response.get("error"), response.get("detail", "")
+        if error == "busy":
+            raise WorkerBusyError(detail)
+        if error == "unavailable":
+            raise WorkerUnavailableError(detail)
+        raise RuntimeError(f"Inference worker failed: {detail}")
+
+    def generate_bar(self, job: BarJob) -> BarResult:
+        response = self._request({"op": "generate", "job": asdict(job)})
+        self._raise_for_error(response)
+        return BarResult(text=response["text"], stats=response.get("stats", {}))
+
+    def generate_batch(self, jobs: list[BarJob]) -> BarBatchResult:
+        response = self._request({"op": "generate_batch", "jobs": [asdict(job) for job in jobs]})
+        self._raise_for_error(response)
+        return BarBatchResult(texts=response["texts"], stats=response.get("stats", {}))
+
+    def health(self, timeout: float = 5.0) -> dict:
+        return self._request({"op": "health"}, timeout=timeout)["health"]
+
+
+# --- モデルを使った生成関数 ---
+class ModelBarGenerator:
+    """
+    読み込んだモデルで BarJob を生成する関数オブジェクト。`generate_batch` で複数の小節を
+    1回の generate にまとめられる (max_new_tokens は最大値、temperature は先頭のジョブの値)。
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        note_tokenizer_helper,
+        device,
+        drafter=None,
+        num_draft_tokens=4,
+        decoder=None,
+        adapters=None,
+        prompt_encoder=None,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.note_tokenizer_helper = note_tokenizer_helper
+        self.device = device
+        # 1小節ずつの生成だけで使う (バッチの generate は投機的デコードに対応していない)
+        self.drafter = drafter
+        self.num_draft_tokens = num_draft_tokens
+        # 静的デコーダ (src.model.static_decode)。キャッシュを共有するため、レーンをまたいで
+        # 1小節ずつ順に実行される
+        self.decoder = decoder
+        # 追加のアダプタ (src.model.adapters.AdapterRegistry)。None なら既定のモデルだけ
+        self.adapters = adapters
+        # プロンプトのトークン化 (src.model.prompt_tokens.PromptEncoder)。None なら毎回全体を
+        # トークン化する
+        self.prompt_encoder = prompt_encoder
+
+    @property
+    def memory_bytes(self) -> dict[str, int] | None:
+        """ベースとアダプタごとの重みのバイト数 (アダプタを読み込んでいない場合は None)。"""
+        return self.adapters.memory_bytes() if self.adapters is not None else None
+
+    def _adapter_name(self, job: BarJob) -> str | None:
+        """ジョブのアダプタの peft 上の名前。既定のモデルなら None。"""
+        if not job.adapter:
+            return None
+        if self.adapters is None:
+            raise ValueError(f"Unknown model: {job.adapter!r} (no adapters are loaded)")
+        return self.adapters.peft_name(job.adapter)
+
+    def _batch_adapter_names(self, jobs: list[BarJob]) -> list[str] | None:
+        """バッチの行ごとの peft のアダプタ名。すべて既定のモデルなら None。"""
+        if not any(job.adapter for job in jobs):
+            return None
+        if self.adapters is None:
+            raise ValueError("Unknown model: no adapters are loaded")
+        # 既定のモデルの行にも名前を付ける (peft では名前のない行は混ぜられない)
+        return [self.adapters.peft_name(job.adapter) for job in jobs]
+
+    def _processor(self, job: BarJob):
+        from src.model.melody_processor import (
+            MelodyControlLogitsProcessor,
+            TensorMelodyControlLogitsProcessor,
+        )
+
+        # 静的デコーダは既定のモデルでだけ使う
+        processor_class = (
+            TensorMelodyControlLogitsProcessor
+            if self.decoder is not None and not job.adapter
+            else MelodyControlLogitsProcessor
+        )
+        return processor_class(
+            job.chord,
+            self.note_tokenizer_helper,
+            supress_token_prob_ratio=job.supress_token_prob_ratio,
+            lightweight=job.lightweight_processor,
+        )
+
+    def __call__(self, job: BarJob) -> BarResult:
+        from src.model.generation_stats import GenerationStats
+        from src.model.utils import generate_midi_from_model
+
+        stats = GenerationStats()
+        text = generate_midi_from_model(
+            self.model,
+            self.tokenizer,
+            self.device,
+            job.prompt,
+            self._processor(job),
+            seed=job.seed,
+            max_new_tokens=job.max_new_tokens,
+            temperature=job.temperature,
+            stats=stats,
+            drafter=self.drafter,
+            num_draft_tokens=self.num_draft_tokens,
+            decoder=self.decoder,
+            adapter_name=self._adapter_name(job),
+            prompt_encoder=self.prompt_encoder,
+        )
+        return BarResult(text=text, stats=stats.to_dict())
+
+    def generate_batch(self, jobs: list[BarJob]) -> BarBatchResult:
+        from src.model.generation_stats import GenerationStats
+        from src.model.utils import generate_midi_batch
+
+        stats = GenerationStats()
+        texts = generate_midi_batch(
+            self.model,
+            self.tokenizer,
+            self.device,
+            [job.prompt for job in jobs],
+            [self._processor(job) for job in jobs],
+            seeds=[job.seed for job in jobs],
+            max_new_tokens=max(job.max_new_tokens for job in jobs),
+            temperature=jobs[0].temperature,
+            stats=stats,
+            adapter_names=self._batch_adapter_names(jobs),
+            prompt_encoder=self.prompt_encoder,
+        )
+        return BarBatchResult(texts=texts, stats=stats.to_dict())
+
+
+def build_model_generate_fn(
+    model_name: str,
+    backend: str = "auto",
+    num_lanes: int = 1,
+    speculative_draft: str = "",
+    decode_mode: str = "eager",
+    max_seq_length: int = 4096,
+    adapters: str = "",
+) -> ModelBarGenerator:
+    """
+    モデルを読み込み、BarJob を受け取って生成結果を返す関数オブジェクトを作る。
+    CPU のバックエンドでは、CPU を推論レーンで分け合うようにスレッド数を決める。
+    decode_mode が "static" の場合は静的デコーダを作り、コンパイルまで済ませておく。
+    adapters (MODEL_ADAPTERS と同じ書式) のアダプタは、同じベースモデルに追加で読み込む。
+    """
+    from src.model.adapters import AdapterRegistry, parse_adapter_specs
+    from src.model.cpu_backend import default_num_threads
+    from src.model.prompt_context import build_bar_prompt
+    from src.model.prompt_tokens import PromptEncoder
+    from src.model.speculative import load_drafter, num_draft_tokens_from_env
+    from src.model.static_decode import StaticDecoder, validate_decode_mode
+    from src.model.utils import load_model_and_tokenizer
+
+    validate_decode_mode(decode_mode)
+
+    model, tokenizer, note_tokenizer_helper, device = load_model_and_tokenizer(
+        model_name,
+        disable_unsloth=not os.path.isdir(model_name),
+        backend=backend,
+        num_threads=default_num_threads(num_lanes),
+        max_seq_length=max_seq_length,
+    )
+    registry = None
+    if adapter_paths := parse_adapter_specs(adapters):
+        registry = AdapterRegistry.attach(model, model_name, adapter_paths)
+    drafter = load_drafter(speculative_draft, device)
+    decoder = None
+    if decode_mode == "static":
+        decoder = StaticDecoder(model)
+        prompt = build_bar_prompt("Dm7 - G7 - Cmaj7 - A7", 0, "JAZZ風", "", "Alto Saxophone")
+        try:
+            elapsed = decoder.warmup(len(tokenizer(prompt)["input_ids"]), max_new_tokens=128)
+            logger.info(f"Static decoder is ready (compiled={decoder.compiled}, {elapsed:.1f}s)")
+        except Exception as e:
+            # 静的キャッシュに対応していないモデルでは通常の generate で続ける
+            logger.warning(f"Static decoding is disabled: {e}")
+            decoder = None
+    return ModelBarGenerator(
+        model,
+        tokenizer,
+        note_tokenizer_helper,
+        device,
+        drafter,
+        num_draft_tokens_from_env(),
+        decoder,
+        registry,
+        PromptEncoder(tokenizer),
+    )
+
+
+def tuning_job() -> BarJob:
+    """レーンの数の計測で生成する、典型的な小節のジョブ。"""
+    from src.model.prompt_context import build_bar_prompt
+
+    prompt = build_bar_prompt("Dm7 - G7 - Cmaj7 - A7", 1, "JAZZ風", "", "Alto Saxophone")
+    return BarJob(prompt=prompt, chord="G7", seed=0)
+
+
+def build_lane_planner(
+    spec: str, bars_per_lane: int = 2
+) -> Callable[[Callable[[BarJob], BarResult]], LanePlan] | None:
+    """
+    CPU_LANES の値から InferenceWorker の lane_planner を作る。空なら None。
+    "auto" の場合は、読み込んだ生成関数で tuning_job を生成してレーンの数を決める。
+    """
+    if not validate_lane_spec(spec):
+        return None
+    if spec != "auto":
+        return lambda generate_fn: plan_lanes(int(spec))
+    job = tuning_job()
+    return lambda generate_fn: tune_lanes(lambda: generate_fn(job), bars_per_lane=bars_per_lane)
+
+
+class WorkerArgs(Tap):
+    """推論ワーカーの起動設定。"""
+
+    model_name: str = os.getenv("MODEL_NAME", "models/production.pth/")
+    socket_path: str = os.getenv("INFERENCE_WORKER_SOCKET", DEFAULT_SOCKET_PATH)
+    max_queue: int = 32  # 待機できるジョブ数の上限 (超えると busy を返す)
+    num_lanes: int = 1  # 同時に推論を実行するスレッド数
+    backend: str = os.getenv("MODEL_BACKEND", "auto")  # auto / cpu-bf16 / cpu-int8
+    # 投機的デコードのドラフト ("ngram:<path>" / "model:<path>"。空なら使わない)
+    speculative_draft: str = os.getenv("SPECULATIVE_DRAFT", "")
+    decode_mode: str = os.getenv("DECODE_MODE", "eager")  # eager / static
+    max_seq_length: int = int(os.getenv("MODEL_MAX_SEQ_LENGTH", "4096"))
+    # 同じベースモデルに追加で読み込む LoRA アダプタ ("name=path,...")
+    adapters: str = os.getenv("MODEL_ADAPTERS", "")
+    # CPU のコアを分けて固定する推論レーンの数 ("auto" なら計測して決める)。
+    # 指定した場合は num_lanes の代わりに使う
+    cpu_lanes: str = os.getenv("CPU_LANES", "")
+    # モデルの代わりに記録済みの小節を返す (負荷試験用、src/api/replay.py)
+    replay_source: str = os.getenv("REPLAY_SOURCE", "")
+
+
+def main():
+    args = WorkerArgs(description="Melody Flow 推論ワーカー").parse_args()
+    validate_lane_decode_mode(args.cpu_lanes, args.decode_mode)
+
+    def loader() -> Callable[[BarJob], BarResult]:
+        if args.replay_source:
+            # replay は BarJob などをこのモジュールから import するため、ここで import する
+            from src.api.replay import ReplayBarGenerator
+
+            return ReplayBarGenerator.from_env(args.replay_source)
+        return build_model_generate_fn(
+            args.model_name,
+            args.backend,
+            args.num_lanes,
+            args.speculative_draft,
+            args.decode_mode,
+            args.max_seq_length,
+            args.adapters,
+        )
+
+    worker = InferenceWorker(
+        loader=loader,
+        max_queue=args.max_queue,
+        num_lanes=args.num_lanes,
+        lane_planner=build_lane_planner(args.cpu_lanes),
+    )
+    worker.start()
+    with InferenceWorkerServer(args.socket_path, worker) as server:
+        logger.info(f"🧠 Inference worker listening on {args.socket_path}")
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,84 +1,385 @@
-import unsloth  # noqa: F401
 import base64
+from contextlib import ExitStack, asynccontextmanager
+from dataclasses import dataclass, replace
+import json
 import os
-import re
-import textwrap
+from pathlib import Path
+import threading
 import time
+from typing import TYPE_CHECKING, Annotated
 
-from fastapi import FastAPI, Query, Response
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
-from src.model.melody_processor import MelodyControlLogitsProcessor, NoteTokenizer
-import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, LogitsProcessorList
-from unsloth import FastLanguageModel
+from src.api import (
+    admission,
+    canonical,
+    deadline,
+    melody_codec,
+    metrics,
+    pregeneration,
+    profiling,
+    replay,
+)
+from src.api.inference_worker import (
+    BarBatchResult,
+    BarJob,
+    BarResult,
+    InferenceWorker,
+    InferenceWorkerClient,
+    ModelBarGenerator,
+    WorkerBusyError,
+    WorkerUnavailableError,
+    build_lane_planner,
+)
+from src.api.response_cache import ResponseCache
+from src.api.static_cache import StaticCacheHit, StaticCacheIndex
+from src.model import (
+    adapters,
+    bar_store,
+    cpu_backend,
+    cpu_lanes,
+    prompt_context,
+    prompt_tokens,
+    speculative,
+    static_decode,
+    utils,
+)
+from src.model.tracing import get_tracer, span, traced
 import uvicorn
 
-# --- 環境変数に応じてWeaveの有効/無効を切り替える ---
+if TYPE_CHECKING:
+    from src.model.generation_stats import GenerationStats
+    from src.model.melody_processor import MelodyControlLogitsProcessor
+
+# NOTE: unsloth / torch / transformers は import が重いため、モデル読み込み時に遅延 import する。
+# (generate_melody だけを利用するキャッシュ生成スクリプト等の起動を速くするため)
+
+# --- トレーシング ---
+# span の出力先とサンプリング率は環境変数 TRACE_EXPORTER / TRACE_SAMPLE_RATE で切り替える
+# (既定では開発モードは weave、本番モードは無効)。詳細は src/model/tracing.py を参照。
 APP_ENV = os.getenv("APP_ENV", "production")  # デフォルトは安全な 'production'
+if get_tracer().enabled:
+    print(f"🔭 Tracing is enabled: {type(get_tracer().exporter).__name__}")
+
 
-if APP_ENV != "production":
-    print("🚀 Running in DEVELOPMENT mode. Weave is enabled.")
+# --- モデル読み込み ---
+MODEL_NAME = os.getenv("MODEL_NAME", "models/production.pth/")
+# 推論バックエンド (auto / cpu-bf16 / cpu-int8)。GPU のない環境では cpu-int8 を使う
+MODEL_BACKEND = cpu_backend.validate_backend(os.getenv("MODEL_BACKEND", "auto"))
+# 設定されている場合はモデルを読み込まず、別プロセスの推論ワーカーにジョブを投げる
+# (uvicorn --workers N でもモデルは推論ワーカーの1つだけで済む)
+INFERENCE_WORKER_SOCKET = os.getenv("INFERENCE_WORKER_SOCKET")
+WORKER_CLIENT = InferenceWorkerClient(INFERENCE_WORKER_SOCKET) if INFERENCE_WORKER_SOCKET else None
+MODEL, TOKENIZER, NOTE_TOKENIZER_HELPER, DEVICE = None, None, None, None
+# テンプレートの固定部分のトークン化を使い回すエンコーダ (src/model/prompt_tokens.py)
+PROMPT_ENCODER = None
+# 投機的デコードのドラフト ("ngram:<path>" / "model:<path>")。出力はドラフトなしと同じ
+SPECULATIVE_DRAFT = os.getenv("SPECULATIVE_DRAFT", "")
+SPECULATIVE_TOKENS = speculative.num_draft_tokens_from_env()
+DRAFTER = None
+# デコードの方式 (eager / static)。static は静的 KV キャッシュと torch.compile した
+# デコードステップで生成する (src/model/static_decode.py)
+DECODE_MODE = static_decode.validate_decode_mode(os.getenv("DECODE_MODE", "eager"))
+STATIC_DECODER = None
+# モデルが扱う最大のトークン数 (既定は学習時と同じ 4096)
+MODEL_MAX_SEQ_LENGTH = int(os.getenv("MODEL_MAX_SEQ_LENGTH", str(utils.DEFAULT_MAX_SEQ_LENGTH)))
+# MODEL_NAME と同じベースモデルに追加で読み込む LoRA アダプタ (MODEL_ADAPTERS="name=path,...")。
+# リクエストの model パラメータで選ぶ (A/B テスト用)。省略時は MODEL_NAME で生成する
+MODEL_ADAPTERS = adapters.parse_adapter_specs(os.getenv("MODEL_ADAPTERS", ""))
+ADAPTER_REGISTRY = None
+# CPU のコアを推論レーンに分け、レーンごとに CPU を固定したスレッドで生成する
+# (CPU_LANES="" / "auto" / 整数、src/model/cpu_lanes.py)。推論ワーカーを使う場合は
+# ワーカー側の CPU_LANES で設定する
+CPU_LANES = cpu_lanes.validate_lane_spec(os.getenv("CPU_LANES", ""))
+cpu_lanes.validate_lane_decode_mode(CPU_LANES, DECODE_MODE)
+# レーンの待ち行列の上限 (超えると 503)
+CPU_LANES_MAX_QUEUE = int(os.getenv("CPU_LANES_MAX_QUEUE", "32"))
+LANE_POOL: InferenceWorker | None = None
+# 設定されている場合はモデルを読み込まず、記録済みの小節を返す (負荷試験用、src/api/replay.py)。
+# 静的キャッシュのディレクトリ (dist/) か、REPLAY_RECORD_PATH で記録したトレースを指定する
+REPLAY_SOURCE = os.getenv("REPLAY_SOURCE", "")
+REPLAY_GENERATOR: replay.ReplayBarGenerator | None = None
+# モデルで生成した小節をリプレイ用のトレースに記録する (REPLAY_RECORD_PATH)
+BAR_TRACE = replay.BarTraceRecorder.from_env()
+
+
+def _worker_queue_depth() -> float | None:
+    """スクレイプ時に推論ワーカーへ問い合わせて、待機中+実行中のジョブ数を返す。"""
     try:
-        import wandb
-        import weave
+        health = WORKER_CLIENT.health(timeout=1.0)
+    except WorkerUnavailableError:
+        return None
+    return health["queue_depth"] + health["inflight"]
 
-        weave.init("melody-flow-api-dev")
-        op = weave.op  # 開発モードでは実際のweave.opを使用
-    except ImportError:
-        print("⚠️  weave is not installed. Running without it.")
 
-        # weaveがない場合は何もしないダミーデコレータを定義
-        def op(*args, **kwargs):
-            def decorator(f):
-                return f
+def _worker_cpu_lanes() -> float | None:
+    """スクレイプ時に推論ワーカーへ問い合わせて、推論レーンの数を返す。"""
+    try:
+        return WORKER_CLIENT.health(timeout=1.0)["lanes"]
+    except WorkerUnavailableError:
+        return None
 
-            if args and callable(args[0]):
-                return decorator(args[0])
-            return decorator
 
-else:
-    print("✅ Running in PRODUCTION mode. Weave is disabled.")
+if WORKER_CLIENT is not None:
+    metrics.QUEUE_DEPTH.set_function(_worker_queue_depth)
+    metrics.CPU_LANES.set_function(_worker_cpu_lanes)
 
-    # 本番モードでは何もしないダミーデコレータを定義
-    def op(*args, **kwargs):
-        def decorator(f):
-            return f
+# 生成結果のキャッシュ。JSON / バイナリ / MIDI は同じエントリから変換する
+RESPONSE_CACHE = ResponseCache("response", int(os.getenv("RESPONSE_CACHE_SIZE", "256")))
+GENERATE_PATHS = ("/generate", "/generate.mid")
+# ETag に含めるモデルの識別子。推論ワーカー利用時など、API から MODEL_NAME のファイルを
+# 参照できない場合は MODEL_FINGERPRINT で明示する
+MODEL_FINGERPRINT = os.getenv("MODEL_FINGERPRINT") or canonical.model_fingerprint(MODEL_NAME)
+if MODEL_BACKEND != "auto":
+    # 量子化すると同じシードでも出力が変わるため、ETag を区別する
+    MODEL_FINGERPRINT = f"{MODEL_FINGERPRINT}+backend:{MODEL_BACKEND}"
+if DECODE_MODE != "eager":
+    # プロセッサの計算順序が変わり、確率の丸め誤差でサンプリングが変わりうるため区別する
+    MODEL_FINGERPRINT = f"{MODEL_FINGERPRINT}+decode:{DECODE_MODE}"
+if REPLAY_SOURCE:
+    # モデルの出力ではないため、ETag・小節の保存先のキーを区別する
+    MODEL_FINGERPRINT = f"{MODEL_FINGERPRINT}+replay:{canonical.model_fingerprint(REPLAY_SOURCE)}"
 
-        # @op と @op() の両方の構文に対応
-        if args and callable(args[0]):
-            return decorator(args[0])
-        return decorator
+# 小節ごとのプロンプトに含めるコード進行の範囲 (PROMPT_CONTEXT, 既定: full)。
+# 長い曲ではスライディングウィンドウにしてプリフィルを短くする
+PROMPT_CONTEXT = prompt_context.ContextPolicy.from_env()
+if not PROMPT_CONTEXT.is_full:
+    # プロンプトが変わると出力も変わるため、ETag を区別する
+    MODEL_FINGERPRINT = f"{MODEL_FINGERPRINT}+prompt:{PROMPT_CONTEXT}"
+    print(f"🪟 Prompt context policy: {PROMPT_CONTEXT}")
 
+# 小節ごとの生成結果の保存先 (BAR_CACHE_SIZE / BAR_CACHE_DIR)。プロンプト・設定・シード・
+# モデルが同じ小節は、別のリクエストでも生成せずに再利用する
+BAR_STORE = bar_store.BarStore.from_env()
 
-# --- モデル読み込み ---
-MODEL_NAME = os.getenv("MODEL_NAME", "models/production.pth/")
-print(f"🧠 Loading model: {MODEL_NAME}...")
-DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-print(f"🔥 Using device: {DEVICE}")
-
-try:
-    MODEL, TOKENIZER = None, None
-    if os.path.isdir(MODEL_NAME):
-        print("-> Loading as local Unsloth model (4-bit)...")
-        MODEL, TOKENIZER = FastLanguageModel.from_pretrained(
-            model_name=MODEL_NAME, max_seq_length=4096, dtype=None, load_in_4bit=True
-        )
-    else:
-        print(f"-> Loading as Hugging Face Hub model ({MODEL_NAME})...")
-        MODEL = AutoModelForCausalLM.from_pretrained(MODEL_NAME, torch_dtype=torch.bfloat16).to(
-            DEVICE
+# 並列生成モード (PARALLEL_BARS=1): 全小節を前の小節に依存せずに1バッチで生成し、
+# 2バッチ目で各小節の先頭 PARALLEL_STITCH_NOTES 音だけを前の小節につなげて生成し直す
+PARALLEL_BARS = os.getenv("PARALLEL_BARS", "0") == "1"
+PARALLEL_STITCH_NOTES = int(os.getenv("PARALLEL_STITCH_NOTES", "2"))
+# つなぎ直しの生成で、1音 ("pitch duration wait velocity instrument" 1行) に割り当てるトークン数
+STITCH_TOKENS_PER_NOTE = 16
+if PARALLEL_BARS:
+    MODEL_FINGERPRINT = f"{MODEL_FINGERPRINT}+parallel:{PARALLEL_STITCH_NOTES}"
+    print(f"🧵 Parallel bar generation: stitching {PARALLEL_STITCH_NOTES} note(s) per bar")
+    # レイテンシの見積もりは小節を順に生成する前提のため (src/api/deadline.py)
+    print("⚠️ Deadline degradation (deadline_ms / GENERATE_SLO_MS) is off with parallel bars")
+# アダプタごとの ETag・小節の保存先のキーに使う識別子
+ADAPTER_FINGERPRINTS = {
+    name: f"{MODEL_FINGERPRINT}+adapter:{canonical.model_fingerprint(path)}"
+    for name, path in MODEL_ADAPTERS.items()
+}
+if MODEL_ADAPTERS:
+    print(f"🧩 Serving adapters: {', '.join(MODEL_ADAPTERS)}")
+
+
+def model_fingerprint_for(model: str) -> str:
+    """model パラメータ (空なら既定のモデル) で生成した結果の識別子。"""
+    return ADAPTER_FINGERPRINTS[model] if model else MODEL_FINGERPRINT
+
+
+# generate_static_cache が書き出した dist/ にあるリクエストは、モデルを通さずに返す
+STATIC_CACHE = StaticCacheIndex.from_env(Path(__file__).resolve().parents[2] / "dist")
+if STATIC_CACHE is not None and len(STATIC_CACHE):
+    print(f"📦 Static cache index: {len(STATIC_CACHE)} files in {STATIC_CACHE.root}")
+# レスポンスの取得元 (static: 静的キャッシュ, memory: プロセス内キャッシュ, model: 生成)
+SOURCE_HEADER = "X-Melody-Source"
+# ブラウザにも nginx にもキャッシュさせないレスポンスのヘッダー
+# (nginx は Cache-Control を無視する設定のため、X-Accel-Expires で止める)
+NO_STORE_HEADERS = {"Cache-Control": "no-store", "X-Accel-Expires": "0"}
+
+# --- レイテンシ予算 (deadline_ms / GENERATE_SLO_MS) ---
+# 生成した小節の統計から所要時間を見積もり、予算を超えそうなら品質を下げる
+LATENCY_MODEL = deadline.LatencyModel()
+DEGRADATION_HEADER = "X-Melody-Degradation"
+SERVED_VARIATION_HEADER = "X-Melody-Variation"
+# nearest_cached で探すバリエーションの距離の上限
+NEAREST_VARIATION_DISTANCE = 8
+
+# --- 受け付け制御 (ADMISSION_MAX_CONCURRENCY など) ---
+# モデルで生成するリクエストの同時実行数を制限し、待ち行列が満杯なら 429 を返す
+ADMISSION = admission.AdmissionController.from_env()
+
+_MODEL_LOAD_ATTEMPTED = False
+_MODEL_LOAD_LOCK = threading.Lock()
+
+
+def load_model() -> bool:
+    """
+    モデルを読み込んでグローバル変数に保持する。2回目以降の呼び出しでは何もしない。
+    ローカルディレクトリの場合はUnsloth (4-bit)、それ以外はHugging Face Hubから読み込む。
+    """
+    global MODEL, TOKENIZER, NOTE_TOKENIZER_HELPER, DEVICE, DRAFTER, STATIC_DECODER
+    global ADAPTER_REGISTRY, PROMPT_ENCODER, LANE_POOL, REPLAY_GENERATOR, _MODEL_LOAD_ATTEMPTED
+    with _MODEL_LOAD_LOCK:
+        if _MODEL_LOAD_ATTEMPTED:
+            return MODEL is not None or REPLAY_GENERATOR is not None
+        _MODEL_LOAD_ATTEMPTED = True
+
+        if REPLAY_SOURCE:
+            try:
+                REPLAY_GENERATOR = replay.ReplayBarGenerator.from_env(REPLAY_SOURCE)
+            except (ValueError, OSError) as e:
+                print(f"❌ Fatal: Error loading replay source: {e}")
+                return False
+            print(f"📼 Replaying {len(REPLAY_GENERATOR.bars)} recorded bars from {REPLAY_SOURCE}")
+            return True
+
+        try:
+            MODEL, TOKENIZER, NOTE_TOKENIZER_HELPER, DEVICE = utils.load_model_and_tokenizer(
+                MODEL_NAME,
+                disable_unsloth=not os.path.isdir(MODEL_NAME),
+                backend=MODEL_BACKEND,
+                max_seq_length=MODEL_MAX_SEQ_LENGTH,
+            )
+        except Exception:
+            MODEL, TOKENIZER, NOTE_TOKENIZER_HELPER = None, None, None
+            return False
+
+        if MODEL_ADAPTERS:
+            try:
+                ADAPTER_REGISTRY = adapters.AdapterRegistry.attach(
+                    MODEL, MODEL_NAME, MODEL_ADAPTERS
+                )
+            except Exception as e:
+                # model パラメータを受け付けているため、アダプタなしでは起動しない
+                print(f"❌ Fatal: Error loading adapters: {e}")
+                MODEL, TOKENIZER, NOTE_TOKENIZER_HELPER = None, None, None
+                return False
+            for component, size in ADAPTER_REGISTRY.memory_bytes().items():
+                metrics.MODEL_MEMORY_BYTES.set(size, component=component)
+            print(f"🧩 Adapter memory: {ADAPTER_REGISTRY.memory_summary()}")
+
+        PROMPT_ENCODER = prompt_tokens.PromptEncoder(TOKENIZER)
+        try:
+            DRAFTER = speculative.load_drafter(SPECULATIVE_DRAFT, DEVICE)
+        except Exception as e:
+            # ドラフトは速度のためだけなので、読み込めなくても通常のデコードで続ける
+            print(f"⚠️ Speculative draft is disabled: {e}")
+
+        if DECODE_MODE == "static":
+            STATIC_DECODER = _build_static_decoder()
+        if CPU_LANES:
+            LANE_POOL = _start_lane_pool()
+            if LANE_POOL is not None:
+                _size_admission_to_lanes(LANE_POOL.lane_plan.num_lanes)
+        return True
+
+
+def _build_static_decoder() -> "static_decode.StaticDecoder | None":
+    """静的デコーダを作り、典型的な小節のプロンプトの長さでコンパイルまで済ませておく。"""
+    decoder = static_decode.StaticDecoder(MODEL)
+    prompt = prompt_context.build_bar_prompt(
+        "Dm7 - G7 - Cmaj7 - A7", 0, "JAZZ風", "", "Alto Saxophone"
+    )
+    try:
+        elapsed = decoder.warmup(len(TOKENIZER(prompt)["input_ids"]), max_new_tokens=128)
+    except Exception as e:
+        # 静的キャッシュに対応していないモデルでは通常の generate で続ける
+        print(f"⚠️ Static decoding is disabled: {e}")
+        return None
+    mode = "compiled" if decoder.compiled else "eager"
+    print(f"⚡ Static decoding is ready ({mode} step, warmup {elapsed:.1f}s)")
+    return decoder
+
+
+def _start_lane_pool() -> InferenceWorker | None:
+    """
+    読み込んだモデルを共有する推論レーンを起動する。CPU_LANES=auto の場合は、
+    レーンの数ごとのスループットを計測してから起動する (起動が数十秒遅くなる)。
+    """
+    generator = ModelBarGenerator(
+        MODEL,
+        TOKENIZER,
+        NOTE_TOKENIZER_HELPER,
+        DEVICE,
+        DRAFTER,
+        SPECULATIVE_TOKENS,
+        STATIC_DECODER,
+        ADAPTER_REGISTRY,
+        PROMPT_ENCODER,
+    )
+    pool = InferenceWorker(
+        loader=lambda: generator,
+        max_queue=CPU_LANES_MAX_QUEUE,
+        lane_planner=build_lane_planner(CPU_LANES),
+    )
+    pool.start(wait=True)
+    if pool.status != "ready":
+        # レーンは速度のためだけなので、使えなくてもこれまでどおり生成する
+        print(f"⚠️ CPU lanes are disabled: {pool.error}")
+        return None
+    metrics.record_lane_plan(pool.lane_plan.to_dict())
+    print(f"🧮 CPU lanes: {pool.lane_plan.num_lanes} x threads {pool.lane_plan.threads}")
+    return pool
+
+
+def _size_admission_to_lanes(num_lanes: int) -> None:
+    """
+    受け付け制御の同時実行数をレーンの数に合わせる。1つのリクエストは小節を順番に生成する
+    ため、同時実行数がレーンより少ないとレーンが余る。ADMISSION_MAX_CONCURRENCY を
+    指定した場合はその値のままにし、レーンより少なければ警告だけ出す。
+    """
+    if ADMISSION is None:
+        return
+    if "ADMISSION_MAX_CONCURRENCY" not in os.environ:
+        ADMISSION.set_max_concurrency(num_lanes)
+        print(f"🚦 Admission concurrency follows CPU lanes: {num_lanes}")
+    elif ADMISSION.max_concurrency < num_lanes:
+        print(
+            f"⚠️ ADMISSION_MAX_CONCURRENCY={ADMISSION.max_concurrency} is below the number of "
+            f"CPU lanes ({num_lanes}); some lanes will stay idle"
         )
-        TOKENIZER = AutoTokenizer.from_pretrained(MODEL_NAME)
 
-    NOTE_TOKENIZER_HELPER = NoteTokenizer(TOKENIZER)
-    print("✅ Model loaded successfully.")
-except Exception as e:
-    print(f"❌ Fatal: Error loading model: {e}")
-    MODEL, TOKENIZER, NOTE_TOKENIZER_HELPER = None, None, None
 
-app = FastAPI(title="Melody Flow Local API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # サーバー起動時にモデルを読み込んでおく (初回リクエストの待ち時間を避ける)
+    if WORKER_CLIENT is None:
+        load_model()
+    yield
+
+
+app = FastAPI(title="Melody Flow Local API", lifespan=lifespan)
+
+
+@app.middleware("http")
+async def observe_request_latency(request: Request, call_next):
+    """/generate のリクエスト全体のレイテンシをステータスコード別に記録する。"""
+    if request.url.path not in GENERATE_PATHS:
+        return await call_next(request)
+    started_at = time.perf_counter()
+    status = "500"
+    try:
+        response = await call_next(request)
+        status = str(response.status_code)
+        return response
+    finally:
+        metrics.REQUEST_LATENCY.observe(time.perf_counter() - started_at, status=status)
+
+
+@app.middleware("http")
+async def profile_generate_request(request: Request, call_next):
+    """
+    PROFILE_MODE が有効な場合、対象の /generate をプロファイルし、成果物の ID を返す。
+    キャッシュから返した場合など、生成せず成果物がない場合は ID を返さない。
+    """
+    if (
+        profiling.PROFILER is None
+        or request.url.path not in GENERATE_PATHS
+        or not profiling.PROFILER.wants_profile(request.headers)
+    ):
+        return await call_next(request)
+    profile = profiling.request_profile(profiling.new_profile_id())
+    try:
+        response = await call_next(request)
+    finally:
+        profiling.reset_request(profile)
+    if profile.written:
+        response.headers[profiling.PROFILE_ID_HEADER] = profile.profile_id
+    return response
+
 
 app.add_middleware(
     CORSMiddleware,
@@ -89,100 +390,729 @@ app.add_middleware(
 )
 
 
-# --- Weaveのデコレータを条件付きで適用 ---
-@op()  # APP_ENVに応じて本物のデコレータかダミーが使われる
 def generate_midi_from_model(
     prompt: str,
-    processor: MelodyControlLogitsProcessor,
+    processor: "MelodyControlLogitsProcessor",
     seed: int,
     max_new_tokens: int = 128,
     temperature: float = 0.75,
     do_sample: bool = True,
+    stats: "GenerationStats | None" = None,
+    adapter: str = "",
 ) -> str:
-    if not MODEL or not TOKENIZER:
+    """
+    このプロセスで読み込んだモデルで生成する。処理本体は src.model.utils と共通。
+    adapter (MODEL_ADAPTERS のアダプタ名) を指定した場合は、そのアダプタで生成する。
+    """
+    if not load_model() or MODEL is None:
         raise RuntimeError("Model is not loaded.")
-    torch.manual_seed(seed)
-    inputs = TOKENIZER(prompt, return_tensors="pt").to(DEVICE)
-    logits_processors = LogitsProcessorList([processor])
-    output = MODEL.generate(
-        **inputs,
+    return utils.generate_midi_from_model(
+        MODEL,
+        TOKENIZER,
+        DEVICE,
+        prompt,
+        processor,
+        seed,
         max_new_tokens=max_new_tokens,
         temperature=temperature,
-        pad_token_id=TOKENIZER.eos_token_id,
-        logits_processor=logits_processors,
         do_sample=do_sample,
+        stats=stats,
+        drafter=DRAFTER,
+        num_draft_tokens=SPECULATIVE_TOKENS,
+        decoder=STATIC_DECODER,
+        adapter_name=_peft_adapter_name(adapter),
+        prompt_encoder=PROMPT_ENCODER,
     )
 
-    # 開発モードの時だけWeaveに情報を記録
-    if APP_ENV != "production" and "weave" in globals():
-        wandb.summary["allowed_notes"] = processor.note_tokenizer.ids_to_string(
-            processor.allowed_token_ids
-        )
-    return TOKENIZER.decode(output[0])
+
+def _peft_adapter_name(adapter: str) -> str | None:
+    if not adapter:
+        return None
+    if ADAPTER_REGISTRY is None:
+        raise ValueError(f"Unknown model: {adapter!r} (no adapters are loaded)")
+    return ADAPTER_REGISTRY.peft_name(adapter)
+
+
+def _generate_bar_locally(job: BarJob) -> BarResult:
+    """このプロセスで読み込んだモデルを使って1小節分を生成する。"""
+    if not load_model():
+        raise RuntimeError("Model is not loaded.")
+    if REPLAY_GENERATOR is not None:
+        return REPLAY_GENERATOR(job)
+    if LANE_POOL is not None:
+        return LANE_POOL.submit(job).result()
+
+    # unsloth を先に読み込ませるため、モデル読み込み後に import する
+    from src.model.generation_stats import GenerationStats
+    from src.model.melody_processor import (
+        MelodyControlLogitsProcessor,
+        TensorMelodyControlLogitsProcessor,
+    )
+
+    # 静的デコード (既定のモデルでだけ使う) ではホストと同期しないプロセッサを使う
+    processor_class = (
+        TensorMelodyControlLogitsProcessor
+        if STATIC_DECODER is not None and not job.adapter
+        else MelodyControlLogitsProcessor
+    )
+    processor = processor_class(
+        job.chord,
+        NOTE_TOKENIZER_HELPER,
+        supress_token_prob_ratio=job.supress_token_prob_ratio,
+        lightweight=job.lightweight_processor,
+    )
+    stats = GenerationStats()
+    text = generate_midi_from_model(
+        job.prompt,
+        processor,
+        seed=job.seed,
+        max_new_tokens=job.max_new_tokens,
+        temperature=job.temperature,
+        stats=stats,
+        adapter=job.adapter,
+    )
+    return BarResult(text=text, stats=stats.to_dict())
+
+
+def _bar_key(job: BarJob) -> str:
+    return bar_store.bar_key(
+        job.prompt,
+        job.chord,
+        job.supress_token_prob_ratio,
+        job.seed,
+        model_fingerprint_for(job.adapter),
+        job.max_new_tokens,
+        job.temperature,
+        job.lightweight_processor,
+    )
+
+
+def _lookup_bar(job: BarJob) -> str | None:
+    """同じプロンプト・設定で生成済みの小節があれば、その出力テキストを返す。"""
+    if BAR_STORE is None:
+        return None
+    text = BAR_STORE.get(_bar_key(job))
+    metrics.record_cache_lookup("bar", hit=text is not None)
+    return text
+
+
+def _store_bar(job: BarJob, text: str) -> None:
+    if BAR_STORE is not None:
+        BAR_STORE.put(_bar_key(job), text)
+
+
+def generate_bar(job: BarJob) -> BarResult:
+    """
+    1小節分の生成ジョブを実行する。生成済みの小節はそのまま返し、それ以外は
+    推論ワーカーが設定されていればワーカーに投げ、そうでなければこのプロセスのモデルで生成する。
+    """
+    cached = _lookup_bar(job)
+    if cached is not None:
+        return BarResult(text=cached)
+    started_at = time.perf_counter()
+    if WORKER_CLIENT is not None:
+        result = WORKER_CLIENT.generate_bar(job)
+    else:
+        metrics.QUEUE_DEPTH.inc()
+        try:
+            result = _generate_bar_locally(job)
+        finally:
+            metrics.QUEUE_DEPTH.dec()
+    metrics.BAR_LATENCY.observe(time.perf_counter() - started_at)
+    if result.stats:
+        metrics.observe_generation(result.stats)
+        if not job.lightweight_processor:
+            LATENCY_MODEL.observe(result.stats)
+    if BAR_TRACE is not None:
+        BAR_TRACE.record(job, result.text, result.stats)
+    _store_bar(job, result.text)
+    return result
+
+
+def _generate_batch_locally(jobs: list[BarJob]) -> BarBatchResult:
+    """このプロセスで読み込んだモデルを使って、複数の小節を1回の generate で生成する。"""
+    if not load_model():
+        raise RuntimeError("Model is not loaded.")
+    if REPLAY_GENERATOR is not None:
+        return REPLAY_GENERATOR.generate_batch(jobs)
+    if LANE_POOL is not None:
+        return LANE_POOL.submit_batch(jobs).result()
+    generator = ModelBarGenerator(
+        MODEL,
+        TOKENIZER,
+        NOTE_TOKENIZER_HELPER,
+        DEVICE,
+        adapters=ADAPTER_REGISTRY,
+        prompt_encoder=PROMPT_ENCODER,
+    )
+    return generator.generate_batch(jobs)
+
+
+def generate_bars(jobs: list[BarJob]) -> BarBatchResult:
+    """
+    複数の小節の生成ジョブを、推論ワーカーまたはこのプロセスのモデルでまとめて実行する。
+    生成済みの小節はバッチから除き、残りだけを生成する。
+    """
+    texts = [_lookup_bar(job) for job in jobs]
+    missing = [i for i, text in enumerate(texts) if text is None]
+    if not missing:
+        return BarBatchResult(texts)
+    pending = [jobs[i] for i in missing]
+
+    started_at = time.perf_counter()
+    metrics.GENERATION_BATCH_SIZE.observe(len(pending))
+    if WORKER_CLIENT is not None:
+        result = WORKER_CLIENT.generate_batch(pending)
+    else:
+        metrics.QUEUE_DEPTH.inc(len(pending))
+        try:
+            result = _generate_batch_locally(pending)
+        finally:
+            metrics.QUEUE_DEPTH.dec(len(pending))
+    metrics.BATCH_LATENCY.observe(time.perf_counter() - started_at)
+    # バッチの統計は1小節あたりの時間の見積もり (LATENCY_MODEL) には使えないため、記録だけする
+    if result.stats:
+        metrics.observe_generation(result.stats)
+    for i, job, text in zip(missing, pending, result.texts, strict=True):
+        texts[i] = text
+        if BAR_TRACE is not None:
+            # バッチの統計は行ごとに分けられないため、トークン数は読み込み時に見積もる
+            BAR_TRACE.record(job, text)
+        _store_bar(job, text)
+    return BarBatchResult(texts, result.stats)
 
 
 def parse_and_pickup_notes(decoded_text: str, head_k: int = 5) -> str:
-    match = re.search(r"pitch duration wait velocity instrument\s*\n(.*)", decoded_text, re.DOTALL)
-    midi_note_data = match.group(1).strip() if match else decoded_text
+    midi_note_data = melody_codec.extract_midi_note_data(decoded_text)
     notes = [line.split(" ")[0] for line in midi_note_data.split("\n")]
     return " ".join(notes[:head_k])
 
 
 def parse_and_encode_midi(decoded_text: str) -> str:
-    match = re.search(r"pitch duration wait velocity instrument\s*\n(.*)", decoded_text, re.DOTALL)
-    midi_note_data = match.group(1).strip() if match else decoded_text
+    midi_note_data = melody_codec.extract_midi_note_data(decoded_text)
     return base64.b64encode(midi_note_data.encode("utf-8")).decode("utf-8")
 
 
-@op()  # APP_ENVに応じて本物のデコレータかダミーが使われる
-@app.get("/generate")
-def generate_melody(
-    response: Response,
-    chord_progression: str = Query(..., description="コード進行"),
-    style: str = Query(..., description="音楽スタイル"),
-    variation: int = Query(1, description="バリエーション（乱数シード）"),
-    supress_token_prob_ratio: float = Query(
-        0.3, ge=0.0, lt=1.0, description="許可されていないピッチの発生確率抑制レシオ"
-    ),
-    instrument: str = Query("Alto Saxophone", description="楽器"),
-):
-    start_time = time.time()
-    chords = [chord.strip() for chord in chord_progression.split("-")]
-    melodies = {}
-    prev_bar_notes = ""
-
-    for bars, chord in enumerate(chords):
-        processor = MelodyControlLogitsProcessor(
-            chord, NOTE_TOKENIZER_HELPER, supress_token_prob_ratio=supress_token_prob_ratio
+@traced()
+def generate_chord_melodies(
+    chord_progression: str,
+    style: str,
+    variation: int = 1,
+    supress_token_prob_ratio: float = 0.3,
+    instrument: str = "Alto Saxophone",
+    model: str = "",
+    plan: deadline.DegradationPlan = deadline.NO_DEGRADATION,
+) -> dict[str, str]:
+    """
+    コード進行の各小節のメロディーを順に生成し、コード名 -> base64 ノート列の辞書を返す。
+    model (MODEL_ADAPTERS のアダプタ名) が空なら既定のモデルで生成する。
+    """
+    chords = prompt_context.split_progression(chord_progression)
+    if PARALLEL_BARS and len(chords) > 1:
+        bar_notes = generate_bars_in_parallel(
+            chord_progression, style, variation, supress_token_prob_ratio, instrument, plan, model
+        )
+    else:
+        bar_notes = _generate_bars_sequentially(
+            chord_progression, style, variation, supress_token_prob_ratio, instrument, plan, model
         )
-        prompt = f"""
-            Act as a world-class jazz musician improvising over a chord progression.
-            Your task is to generate a single bar of a masterful melodic phrase for
-            the specific chord at the current position in the progression.
-            - Style: {style}
-            - Full Chord Progression: {chord_progression}
-            - Current Bar Number: {bars + 1}
-            - Chord for This Bar: {chord}
-            - Prev Bar Notes: {prev_bar_notes}
-            - Instrument: {instrument}
-            - Remark: Utilize a wide tonal range
-            Generate the melody for this bar only. The output format is:
-            pitch duration wait velocity instrument
-            """
-        prompt = textwrap.dedent(prompt)
-        raw_output = generate_midi_from_model(prompt, processor, seed=variation + bars)
-        encoded_midi = parse_and_encode_midi(raw_output)
-        prev_bar_notes = parse_and_pickup_notes(raw_output)
 
+    melodies = {}
+    for chord, midi_note_data in zip(chords, bar_notes, strict=True):
+        with span("base64_encode"):
+            encoded_midi = base64.b64encode(midi_note_data.encode("utf-8")).decode("utf-8")
         key = chord
         count = 2
         while key in melodies:
             key = f"{chord}_{count}"
             count += 1
         melodies[key] = encoded_midi
+    return melodies
+
+
+def _generate_bars_sequentially(
+    chord_progression: str,
+    style: str,
+    variation: int,
+    supress_token_prob_ratio: float,
+    instrument: str,
+    plan: deadline.DegradationPlan,
+    model: str = "",
+) -> list[str]:
+    """前の小節の出力をプロンプトに入れながら、1小節ずつ生成する。"""
+    chords = prompt_context.split_progression(chord_progression)
+    bar_notes = []
+    prev_bar_notes = ""
+
+    for bars, chord in enumerate(chords):
+        # 先読みジョブの場合、フォアグラウンドの生成が来ていればここで中止する
+        pregeneration.checkpoint()
+        prompt = prompt_context.build_bar_prompt(
+            chord_progression, bars, style, prev_bar_notes, instrument, PROMPT_CONTEXT
+        )
+        job = BarJob(
+            prompt=prompt,
+            chord=chord,
+            seed=variation + bars,
+            supress_token_prob_ratio=supress_token_prob_ratio,
+            max_new_tokens=plan.max_new_tokens,
+            lightweight_processor=plan.lightweight_processor,
+            adapter=model,
+        )
+        with span("bar", bar=bars + 1, chord=chord):
+            raw_output = generate_bar(job).text
+            with span("parse"):
+                midi_note_data = melody_codec.extract_midi_note_data(raw_output)
+                prev_bar_notes = parse_and_pickup_notes(midi_note_data)
+        bar_notes.append(midi_note_data)
+    return bar_notes
+
+
+def generate_bars_in_parallel(
+    chord_progression: str,
+    style: str,
+    variation: int,
+    supress_token_prob_ratio: float,
+    instrument: str,
+    plan: deadline.DegradationPlan,
+    model: str = "",
+) -> list[str]:
+    """
+    全小節をコードの情報だけで1バッチで生成し、2バッチ目で2小節目以降の先頭の音だけを
+    前の小節の出力につなげて生成し直す。小節数によらず、バッチ2回分の時間で済む。
+
+    前の小節の先頭の音も同じバッチで生成し直されるため、つなぎ直しのプロンプトには
+    前の小節のうち置き換わらない音 (先頭 PARALLEL_STITCH_NOTES 音より後) を使う。
+    こうすると、プロンプトの音は最終的な前の小節の出力に必ず含まれる。
+    """
+    chords = prompt_context.split_progression(chord_progression)
+
+    def bar_job(bars: int, prev_bar_notes: str, max_new_tokens: int) -> BarJob:
+        prompt = prompt_context.build_bar_prompt(
+            chord_progression, bars, style, prev_bar_notes, instrument, PROMPT_CONTEXT
+        )
+        return BarJob(
+            prompt=prompt,
+            chord=chords[bars],
+            seed=variation + bars,
+            supress_token_prob_ratio=supress_token_prob_ratio,
+            max_new_tokens=max_new_tokens,
+            lightweight_processor=plan.lightweight_processor,
+            adapter=model,
+        )
+
+    pregeneration.checkpoint()
+    with span("parallel_bars", bars=len(chords)):
+        batch = generate_bars([bar_job(i, "", plan.max_new_tokens) for i in range(len(chords))])
+        bar_notes = [melody_codec.extract_midi_note_data(text) for text in batch.texts]
+    if PARALLEL_STITCH_NOTES <= 0:
+        return bar_notes
+
+    pregeneration.checkpoint()
+    with span("stitch", bars=len(chords) - 1, notes=PARALLEL_STITCH_NOTES):
+        stitch_tokens = PARALLEL_STITCH_NOTES * STITCH_TOKENS_PER_NOTE
+        jobs = [
+            bar_job(
+                i,
+                parse_and_pickup_notes(
+                    melody_codec.skip_note_lines(bar_notes[i - 1], PARALLEL_STITCH_NOTES)
+                ),
+                stitch_tokens,
+            )
+            for i in range(1, len(chords))
+        ]
+        batch = generate_bars(jobs)
+        for i, text in enumerate(batch.texts, start=1):
+            head = melody_codec.extract_midi_note_data(text)
+            bar_notes[i] = melody_codec.splice_note_lines(
+                head, bar_notes[i], PARALLEL_STITCH_NOTES
+            )
+    return bar_notes
+
+
+@traced(capture_io=True)
+def generate_melody(
+    response: Response,
+    chord_progression: str,
+    style: str,
+    variation: int = 1,
+    supress_token_prob_ratio: float = 0.3,
+    instrument: str = "Alto Saxophone",
+    model: str = "",
+    plan: deadline.DegradationPlan = deadline.NO_DEGRADATION,
+) -> dict:
+    """
+    メロディーを生成し、JSON 形式 ({"chord_melodies": {コード名: base64}}) で返す。
+    /generate の本体で、キャッシュ生成スクリプトなどからも直接呼び出される。
+    plan で品質を下げて生成した結果は、キャッシュに入れない。
+    """
+    # CanonicalParams.key と同じく、既定のモデル以外ではモデルの名前を加える
+    cache_key = (chord_progression, style, variation, supress_token_prob_ratio, instrument)
+    if model:
+        cache_key = (*cache_key, model)
+    cached = RESPONSE_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+
+    start_time = time.time()
+    try:
+        with profiling.maybe_profile():
+            melodies = generate_chord_melodies(
+                chord_progression,
+                style,
+                variation,
+                supress_token_prob_ratio,
+                instrument,
+                model,
+                plan,
+            )
+    # 一時的な状態なので、nginx の proxy_cache_valid any に 503 を残させない
+    except WorkerBusyError as e:
+        # 推論ワーカーのキューが満杯 (バックプレッシャー)
+        raise HTTPException(
+            status_code=503, detail=str(e), headers={"Retry-After": "1", **NO_STORE_HEADERS}
+        ) from e
+    except WorkerUnavailableError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers=NO_STORE_HEADERS) from e
 
     print(f"Generated melody in {time.time() - start_time:.2f} seconds for variation {variation}")
-    return {"chord_melodies": melodies}
+    result = {"chord_melodies": melodies}
+    if not plan.degraded:
+        RESPONSE_CACHE.put(cache_key, result)
+    return result
+
+
+@dataclass
+class GenerateParams:
+    """/generate と /generate.mid に共通のクエリパラメータ。"""
+
+    chord_progression: str = Query(..., description="コード進行")
+    style: str = Query(..., description="音楽スタイル")
+    variation: int = Query(1, description="バリエーション（乱数シード）")
+    supress_token_prob_ratio: float = Query(
+        0.3, ge=0.0, lt=1.0, description="許可されていないピッチの発生確率抑制レシオ"
+    )
+    instrument: str = Query("Alto Saxophone", description="楽器")
+    deadline_ms: int | None = Query(
+        None, ge=1, description="レイテンシ予算 (ミリ秒)。超えそうな場合は品質を下げて返す"
+    )
+    model: str = Query("", description="生成に使うモデル (MODEL_ADAPTERS のアダプタ名)")
+
+    def canonicalize(self) -> canonical.CanonicalParams:
+        """
+        表記ゆれをそろえたパラメータを返す。コード進行に空の小節がある場合や、
+        読み込んでいないモデルを指定された場合は 422 にする。
+        """
+        try:
+            params = canonical.CanonicalParams.from_raw(
+                self.chord_progression,
+                self.style,
+                self.variation,
+                self.supress_token_prob_ratio,
+                self.instrument,
+                self.model,
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e)) from e
+        if params.model and params.model not in MODEL_ADAPTERS:
+            available = ", ".join(MODEL_ADAPTERS) or "none"
+            raise HTTPException(
+                status_code=422, detail=f"Unknown model: {params.model!r} (available: {available})"
+            )
+        return params
+
+
+def canonical_redirect(
+    request: Request,
+    params: canonical.CanonicalParams,
+    response_format: str | None = None,
+    deadline_ms: int | None = None,
+) -> RedirectResponse | None:
+    """リクエストのクエリが正規形でなければ、正規 URL へのキャッシュ可能なリダイレクトを返す。"""
+    query = params.query_string(response_format, deadline_ms)
+    if request.url.query == query:
+        return None
+    return RedirectResponse(
+        f"{request.url.path}?{query}",
+        status_code=301,
+        headers={"Cache-Control": canonical.cache_control()},
+    )
+
+
+def format_redirect(
+    request: Request,
+    params: canonical.CanonicalParams,
+    response_format: str,
+    deadline_ms: int | None = None,
+) -> RedirectResponse:
+    """
+    Accept で JSON 以外の形式を選んだリクエストを、format を明示した正規 URL へ送る。
+    nginx のキャッシュキーは URL だけで決まるため、format のない URL の内容は常に JSON にする。
+    行き先は Accept で変わるため、このリダイレクトはどのキャッシュにも残さない。
+    """
+    return RedirectResponse(
+        f"{request.url.path}?{params.query_string(response_format, deadline_ms)}",
+        status_code=307,
+        headers={**NO_STORE_HEADERS, "Vary": "Accept"},
+    )
+
+
+def _static_key(params: canonical.CanonicalParams) -> tuple[str, str, int] | None:
+    """静的キャッシュは既定の抑制レシオ・楽器・モデルで生成しているため、それ以外は探さない。"""
+    if (
+        STATIC_CACHE is None
+        or params.model
+        or params.supress_token_prob_ratio != canonical.DEFAULT_RATIO
+        or params.instrument != canonical.DEFAULT_INSTRUMENT
+    ):
+        return None
+    return canonical.static_cache_key(params.chord_progression), params.style, params.variation
+
+
+def find_static_hit(params: canonical.CanonicalParams) -> StaticCacheHit | None:
+    key = _static_key(params)
+    return STATIC_CACHE.lookup(*key) if key is not None else None
+
+
+# --- 次のバリエーションの先読み ---
+def _pregenerate(params: canonical.CanonicalParams) -> None:
+    generate_melody(None, *params.key)
+
+
+def _is_cached(params: canonical.CanonicalParams) -> bool:
+    static_key = _static_key(params)
+    return params.key in RESPONSE_CACHE or (
+        static_key is not None and STATIC_CACHE.contains(*static_key)
+    )
+
+
+def _worker_busy() -> bool:
+    # 先読みジョブの小節の合間に確認するため、0 より大きければ他のリクエストが使っている
+    depth = _worker_queue_depth()
+    return depth is None or depth > 0
+
+
+PREGENERATOR, PREGENERATE_AHEAD = pregeneration.Pregenerator.from_env(
+    _pregenerate,
+    _is_cached,
+    is_busy=_worker_busy if WORKER_CLIENT is not None else lambda: False,
+)
+
+
+def schedule_next_variations(params: canonical.CanonicalParams) -> None:
+    """UI は n の次に n+1 を聞くため、次の k 個のバリエーションを先読みジョブとして積む。"""
+    if PREGENERATOR is not None:
+        PREGENERATOR.schedule(
+            [
+                replace(params, variation=params.variation + i)
+                for i in range(1, PREGENERATE_AHEAD + 1)
+            ]
+        )
+
+
+def cache_headers(
+    params: canonical.CanonicalParams,
+    response_format: str,
+    static_hit: StaticCacheHit | None = None,
+    vary_accept: bool = True,
+) -> dict[str, str]:
+    # 静的キャッシュから返す場合は、モデルではなくファイルの内容で ETag を決める
+    fingerprint = (
+        static_hit.fingerprint if static_hit is not None else model_fingerprint_for(params.model)
+    )
+    headers = {
+        "ETag": params.etag(fingerprint, response_format),
+        "Cache-Control": canonical.cache_control(),
+    }
+    if vary_accept:
+        # 同じ URL でも Accept によって内容が変わるため、キャッシュに Vary を伝える
+        headers["Vary"] = "Accept"
+    return headers
+
+
+def _queued_bars(num_bars: int) -> float:
+    """この生成より先に処理される小節数の見積もり。受け付け待ちのリクエストも同じ長さとみなす。"""
+    if WORKER_CLIENT is not None:
+        queued = _worker_queue_depth() or 0.0
+    else:
+        queued = metrics.QUEUE_DEPTH.get()
+    if ADMISSION is not None:
+        queued += ADMISSION.queued * num_bars
+    return queued
+
+
+def client_id(request: Request) -> str:
+    """受け付け制御で公平に扱う単位。nginx 経由では X-Real-IP、直接なら接続元のアドレス。"""
+    return request.headers.get("x-real-ip") or (request.client.host if request.client else "")
+
+
+def find_nearest_cached(
+    params: canonical.CanonicalParams,
+) -> tuple[int, dict, str] | None:
+    """キャッシュ済みのうち、バリエーション番号が最も近いものを (番号, 結果, 取得元) で返す。"""
+    for distance in range(1, NEAREST_VARIATION_DISTANCE + 1):
+        for variation in (params.variation - distance, params.variation + distance):
+            if variation < 1:
+                continue
+            neighbor = replace(params, variation=variation)
+            if not _is_cached(neighbor):
+                continue
+            static_hit = find_static_hit(neighbor)
+            if static_hit is not None:
+                return variation, json.loads(static_hit.payload), "static"
+            cached = RESPONSE_CACHE.get(neighbor.key)
+            if cached is not None:
+                return variation, cached, "memory"
+    return None
+
+
+def _generate_within_budget(
+    response: Response,
+    params: canonical.CanonicalParams,
+    deadline_ms: int | None,
+    headers: dict[str, str],
+    client: str = "",
+) -> dict:
+    # 並列生成では小節を順に生成する前提の見積もりが当てはまらないため、予算を使わない
+    budget = None if PARALLEL_BARS else deadline.budget_sec(deadline_ms)
+    # 生成と同じ分け方で数える (解析できないコード進行は正規化されずに届くため)
+    num_bars = len(prompt_context.split_progression(params.chord_progression))
+    plan = LATENCY_MODEL.plan(num_bars, _queued_bars(num_bars), budget)
+    nearest = find_nearest_cached(params) if plan.use_cached else None
+    if nearest is not None:
+        variation, result, source = nearest
+        plan = replace(plan, steps=("nearest_cached",))
+        headers[SOURCE_HEADER] = source
+        headers[SERVED_VARIATION_HEADER] = str(variation)
+    else:
+        headers[SOURCE_HEADER] = "model"
+        with ExitStack() as stack:
+            if PREGENERATOR is not None:
+                # 受け付け待ちの間も含めて、先読みジョブを止める
+                stack.enter_context(PREGENERATOR.foreground())
+            if ADMISSION is not None:
+                try:
+                    stack.enter_context(ADMISSION.admit(client))
+                except admission.AdmissionRejected as e:
+                    # nginx の proxy_cache_valid any に 429 を残させない
+                    raise HTTPException(
+                        status_code=429,
+                        detail=str(e),
+                        headers={"Retry-After": str(e.retry_after), **NO_STORE_HEADERS},
+                    ) from e
+            # 待っている間に同じパラメータの生成が終わっていれば、キャッシュから返る
+            result = generate_melody(response, *params.key, plan=plan)
+
+    if budget is not None:
+        headers[DEGRADATION_HEADER] = plan.header()
+        metrics.DEGRADATIONS.inc(degradation=plan.header())
+    if plan.degraded:
+        # 品質を下げた結果は、このリクエストの負荷状況でだけ返すもの。どのキャッシュにも残さない
+        headers.pop("ETag", None)
+        headers.update(NO_STORE_HEADERS)
+    return result
+
+
+def load_melody(
+    response: Response,
+    params: canonical.CanonicalParams,
+    static_hit: StaticCacheHit | None,
+    headers: dict[str, str],
+    deadline_ms: int | None = None,
+    client: str = "",
+) -> dict:
+    """
+    静的キャッシュ・プロセス内キャッシュ・モデルの順に結果を探し、取得元を headers に書く。
+    モデルで生成する場合だけ、client ごとの受け付け制御の対象になる。
+    """
+    if static_hit is not None:
+        headers[SOURCE_HEADER] = "static"
+        result = json.loads(static_hit.payload)
+    elif (cached := RESPONSE_CACHE.get(params.key, record_miss=False)) is not None:
+        # 確認と取得を分けると、その間に追い出された場合に受け付け制御を通らずに生成するため、
+        # 1回だけ引く。見つからない場合は、受け付け後の generate_melody が引き直す
+        headers[SOURCE_HEADER] = "memory"
+        result = cached
+    else:
+        result = _generate_within_budget(response, params, deadline_ms, headers, client)
+    schedule_next_variations(params)
+    return result
+
+
+def midi_response(result: dict, instrument: str, headers: dict | None = None) -> Response:
+    bars = melody_codec.bars_from_json(result)
+    return Response(
+        melody_codec.encode_midi(bars, instrument=instrument),
+        media_type=melody_codec.MIDI_MEDIA_TYPE,
+        headers=headers,
+    )
+
+
+@app.get("/generate")
+def generate(
+    request: Request,
+    response: Response,
+    params: Annotated[GenerateParams, Depends()],
+    response_format: str | None = Query(
+        None,
+        alias="format",
+        pattern="^(json|binary|midi)$",
+        description="レスポンス形式 (json | binary | midi)。省略時は Accept ヘッダーで決める",
+    ),
+):
+    canonical_params = params.canonicalize()
+    redirect = canonical_redirect(request, canonical_params, response_format, params.deadline_ms)
+    if redirect is not None:
+        return redirect
+    negotiated = melody_codec.negotiate_format(response_format, request.headers.get("accept"))
+    if response_format is None and negotiated != "json":
+        return format_redirect(request, canonical_params, negotiated, params.deadline_ms)
+    static_hit = find_static_hit(canonical_params)
+    headers = cache_headers(canonical_params, negotiated, static_hit)
+    # 生成結果はパラメータとモデルで決まるため、ETag が一致すれば生成せずに返せる
+    if canonical.if_none_match(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    if static_hit is not None and negotiated == "json":
+        # 静的キャッシュのファイルは /generate の JSON そのものなので、パースせずに返す
+        headers[SOURCE_HEADER] = "static"
+        schedule_next_variations(canonical_params)
+        return Response(
+            static_hit.payload, media_type=melody_codec.JSON_MEDIA_TYPE, headers=headers
+        )
+
+    result = load_melody(
+        response, canonical_params, static_hit, headers, params.deadline_ms, client_id(request)
+    )
+    if negotiated == "binary":
+        bars = melody_codec.bars_from_json(result)
+        return Response(
+            melody_codec.encode_bars(bars),
+            media_type=melody_codec.BINARY_MEDIA_TYPE,
+            headers=headers,
+        )
+    if negotiated == "midi":
+        return midi_response(result, canonical_params.instrument, headers)
+    response.headers.update(headers)
+    return result
+
+
+@app.get("/generate.mid", response_class=Response)
+def generate_midi_file(
+    request: Request, response: Response, params: Annotated[GenerateParams, Depends()]
+):
+    """生成したメロディーを、全小節をつなげた Standard MIDI File として返す。"""
+    canonical_params = params.canonicalize()
+    redirect = canonical_redirect(request, canonical_params, deadline_ms=params.deadline_ms)
+    if redirect is not None:
+        return redirect
+    static_hit = find_static_hit(canonical_params)
+    headers = cache_headers(canonical_params, "midi", static_hit, vary_accept=False)
+    if canonical.if_none_match(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    result = load_melody(
+        response, canonical_params, static_hit, headers, params.deadline_ms, client_id(request)
+    )
+    return midi_response(result, canonical_params.instrument, headers)
 
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -191,6 +1121,43 @@ static_dir = os.path.join(current_dir, "..", "..", "static")
 app.mount("/static", StaticFiles(directory=static_dir), name="static")
 
 
+def _load_status(loaded: bool) -> str:
+    """このプロセスのモデル (またはリプレイ) の状態。読み込みに失敗した後は error。"""
+    if loaded:
+        return "ready"
+    # load_model は読み込みの間ロックを持つため、ロックが空いていれば読み込みは終わっている
+    if _MODEL_LOAD_ATTEMPTED and not _MODEL_LOAD_LOCK.locked():
+        return "error"
+    return "loading"
+
+
+@app.get("/health")
+def health():
+    """推論バックエンドの状態を返す。推論ワーカー利用時はワーカーのヘルス情報を含める。"""
+    if WORKER_CLIENT is None:
+        if REPLAY_SOURCE:
+            status = {"backend": "replay", "status": _load_status(REPLAY_GENERATOR is not None)}
+        else:
+            status = {"backend": "local", "status": _load_status(MODEL is not None)}
+        if LANE_POOL is not None:
+            status["cpu_lanes"] = LANE_POOL.health()["cpu_lanes"]
+        if status["status"] == "error":
+            return JSONResponse(status, status_code=503)
+        return status
+    try:
+        return {"backend": "worker", **WORKER_CLIENT.health()}
+    except WorkerUnavailableError as e:
+        return JSONResponse(
+            {"backend": "worker", "status": "unavailable", "error": str(e)}, status_code=503
+        )
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def read_metrics():
+    """Prometheus 形式のメトリクスを返す。値の集計はスクレイプ時にだけ行う。"""
+    return PlainTextResponse(metrics.render_metrics(), media_type=metrics.CONTENT_TYPE)
+
+
 @app.get("/", response_class=FileResponse)
 async def read_index():
     return FileResponse(os.path.join(static_dir, "index.html"))
@@ -0,0 +1,260 @@
+"""
+/generate のレスポンスを、JSON (base64 テキスト) とコンパクトなバイナリ形式で相互変換する。
+Codec between the JSON (/generate default) and a packed binary bar format.
+
+JSON 形式は各小節の "pitch duration wait velocity instrument" 行を base64 にしたもので、
+テキストより約33%大きく、クライアント側で文字列をパースし直す必要がある。
+バイナリ形式は小節ごとにコード名と数値配列だけを固定レイアウトで詰める。
+
+バイナリ形式 (リトルエンディアン, media type: application/vnd.melody-flow.bars):
+    ヘッダー (8 bytes):  magic "MFLW" | version u8 | reserved u8 | bar_count u16
+    小節ごと:
+        key_length u16 | note_count u16
+        key (UTF-8, key_length bytes, 偶数長になるよう 0 でパディング)
+        duration int16[note_count]  (ミリ秒)
+        wait     int16[note_count]  (ミリ秒, 次のノートまでの時間)
+        pitch    uint8[note_count]  (MIDI ノート番号)
+        velocity uint8[note_count]
+int16 配列は常に2バイト境界から始まるため、JavaScript の Int16Array で直接参照できる。
+楽器名は全ノート共通のため、バイナリ形式には含めない。
+
+MIDI 形式 (audio/midi) は全小節をつなげた SMF で、tick = ミリ秒として duration / wait を
+そのまま使う。
+"""
+
+import base64
+from dataclasses import dataclass, field
+import re
+import struct
+
+JSON_MEDIA_TYPE = "application/json"
+BINARY_MEDIA_TYPE = "application/vnd.melody-flow.bars"
+MIDI_MEDIA_TYPE = "audio/midi"
+FORMATS = {"json": JSON_MEDIA_TYPE, "binary": BINARY_MEDIA_TYPE, "midi": MIDI_MEDIA_TYPE}
+
+# SMF に書き出す時の設定。tick = ミリ秒になるよう、120 BPM で 4分音符 = 500 tick にする
+MIDI_TICKS_PER_BEAT = 500
+MIDI_TEMPO = 500000
+# 楽器名から General MIDI のプログラム番号 (0始まり) への対応。未知の楽器はピアノにする
+GM_PROGRAMS = {
+    "acoustic grand piano": 0,
+    "piano": 0,
+    "electric piano": 4,
+    "vibraphone": 11,
+    "acoustic guitar": 24,
+    "electric guitar": 26,
+    "acoustic bass": 32,
+    "violin": 40,
+    "trumpet": 56,
+    "trombone": 57,
+    "soprano saxophone": 64,
+    "alto saxophone": 65,
+    "tenor saxophone": 66,
+    "baritone saxophone": 67,
+    "clarinet": 71,
+    "flute": 73,
+}
+
+MAGIC = b"MFLW"
+VERSION = 1
+_HEADER = struct.Struct("<4sBBH")
+_BAR_HEADER = struct.Struct("<HH")
+_INT16_RANGE = (-32768, 32767)
+_UINT8_RANGE = (0, 255)
+
+
+@dataclass
+class BarNotes:
+    """1小節分のノート列。各リストの i 番目が i 番目のノートに対応する。"""
+
+    chord: str
+    pitch: list[int] = field(default_factory=list)
+    duration: list[int] = field(default_factory=list)
+    wait: list[int] = field(default_factory=list)
+    velocity: list[int] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.pitch)
+
+    def to_text(self, instrument: str = "0") -> str:
+        """API の JSON 形式と同じ "pitch duration wait velocity instrument" 行に戻す。"""
+        return "\n".join(
+            f"{p} {d} {w} {v} {instrument}"
+            for p, d, w, v in zip(self.pitch, self.duration, self.wait, self.velocity, strict=True)
+        )
+
+
+def extract_midi_note_data(decoded_text: str) -> str:
+    """生成結果から、ヘッダー行以降のノート行 (pitch duration wait velocity ...) を取り出す。"""
+    match = re.search(r"pitch duration wait velocity instrument\s*\n(.*)", decoded_text, re.DOTALL)
+    return match.group(1).strip() if match else decoded_text
+
+
+def _is_note_line(line: str, min_fields: int = 4) -> bool:
+    fields = line.split()
+    if len(fields) < min_fields:
+        return False
+    try:
+        [float(value) for value in fields[:min_fields]]
+    except ValueError:
+        return False
+    return True
+
+
+def splice_note_lines(head: str, body: str, count: int) -> str:
+    """
+    body のノート行のうち先頭 count 音を、head の先頭 count 音に置き換える。
+    head は生成を途中で打ち切った出力のため、5項目そろった行だけを使い、
+    それが count 未満の場合はその数だけ置き換える。
+    """
+    head_lines = [line for line in head.splitlines() if _is_note_line(line, 5)][:count]
+    return "\n".join(head_lines + skip_note_lines(body, len(head_lines)).splitlines())
+
+
+def skip_note_lines(body: str, count: int) -> str:
+    """body から先頭 count 音のノート行を除く。splice_note_lines で置き換わらない部分。"""
+    rest, skipped = [], 0
+    for line in body.splitlines():
+        if skipped < count and _is_note_line(line):
+            skipped += 1
+            continue
+        rest.append(line)
+    return "\n".join(rest)
+
+
+def parse_note_lines(chord: str, midi_note_data: str) -> BarNotes:
+    """
+    "pitch duration wait velocity instrument" 行をパースする。
+    モデル出力には途中で切れた行などが含まれるため、数値4つを読めない行は読み飛ばす。
+    """
+    bar = BarNotes(chord)
+    for line in midi_note_data.splitlines():
+        fields = line.split()
+        if len(fields) < 4:
+            continue
+        try:
+            pitch, duration, wait, velocity = (int(float(value)) for value in fields[:4])
+        except ValueError:
+            continue
+        bar.pitch.append(pitch)
+        bar.duration.append(duration)
+        bar.wait.append(wait)
+        bar.velocity.append(velocity)
+    return bar
+
+
+def bars_from_json(payload: dict) -> list[BarNotes]:
+    """/generate の JSON レスポンス ({"chord_melodies": {...}}) をパースする。"""
+    return [
+        parse_note_lines(chord, base64.b64decode(encoded).decode("utf-8"))
+        for chord, encoded in payload["chord_melodies"].items()
+    ]
+
+
+def bars_to_json(bars: list[BarNotes]) -> dict:
+    """BarNotes のリストを /generate の JSON 形式に変換する。"""
+    return {
+        "chord_melodies": {
+            bar.chord: base64.b64encode(bar.to_text().encode("utf-8")).decode("utf-8")
+            for bar in bars
+        }
+    }
+
+
+def _clamp(values: list[int], bounds: tuple[int, int]) -> list[int]:
+    low, high = bounds
+    return [min(max(value, low), high) for value in values]
+
+
+def encode_bars(bars: list[BarNotes]) -> bytes:
+    """BarNotes のリストをバイナリ形式にする。範囲外の値は型の範囲に丸める。"""
+    chunks = [_HEADER.pack(MAGIC, VERSION, 0, len(bars))]
+    for bar in bars:
+        key = bar.chord.encode("utf-8")
+        n = len(bar)
+        chunks.append(_BAR_HEADER.pack(len(key), n))
+        chunks.append(key + b"\0" * (len(key) % 2))
+        chunks.append(struct.pack(f"<{n}h", *_clamp(bar.duration, _INT16_RANGE)))
+        chunks.append(struct.pack(f"<{n}h", *_clamp(bar.wait, _INT16_RANGE)))
+        chunks.append(bytes(_clamp(bar.pitch, _UINT8_RANGE)))
+        chunks.append(bytes(_clamp(bar.velocity, _UINT8_RANGE)))
+    return b"".join(chunks)
+
+
+def decode_bars(data: bytes) -> list[BarNotes]:
+    """バイナリ形式を BarNotes のリストに戻す。"""
+    magic, version, _, bar_count = _HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a melody-flow binary payload.")
+    if version != VERSION:
+        raise ValueError(f"Unsupported melody-flow binary version: {version}")
+    offset = _HEADER.size
+    bars = []
+    for _ in range(bar_count):
+        key_length, n = _BAR_HEADER.unpack_from(data, offset)
+        offset += _BAR_HEADER.size
+        chord = data[offset : offset + key_length].decode("utf-8")
+        offset += key_length + key_length % 2
+        duration = list(struct.unpack_from(f"<{n}h", data, offset))
+        offset += 2 * n
+        wait = list(struct.unpack_from(f"<{n}h", data, offset))
+        offset += 2 * n
+        pitch = list(data[offset : offset + n])
+        offset += n
+        velocity = list(data[offset : offset + n])
+        offset += n
+        bars.append(BarNotes(chord, pitch, duration, wait, velocity))
+    if offset != len(data):
+        raise ValueError(f"Trailing bytes in melody-flow binary payload: {len(data) - offset}")
+    return bars
+
+
+def encode_midi(bars: list[BarNotes], instrument: str = "Alto Saxophone") -> bytes:
+    """
+    小節を順につなげた SMF (type 0) をメモリ上で作る。各ノートは前のノートの wait 後に鳴り、
+    duration だけ伸ばす。小節の先頭にはコード名をマーカーとして埋め込む。
+    """
+    import io
+
+    from src.model.audio import build_midi_file
+
+    notes, markers, bar_start = [], [], 0
+    for bar in bars:
+        markers.append((bar_start, bar.chord))
+        for pitch, duration, wait, velocity in zip(
+            bar.pitch, bar.duration, bar.wait, bar.velocity, strict=True
+        ):
+            notes.append({"note": pitch, "duration": duration, "wait": wait, "velocity": velocity})
+            bar_start += max(wait, 0)
+    mid = build_midi_file(
+        notes,
+        program=GM_PROGRAMS.get(instrument.strip().lower(), 0),
+        ticks_per_beat=MIDI_TICKS_PER_BEAT,
+        tempo=MIDI_TEMPO,
+        markers=markers,
+        track_name=instrument,
+    )
+    buffer = io.BytesIO()
+    mid.save(file=buffer)
+    return buffer.getvalue()
+
+
+def negotiate_format(requested: str | None, accept: str | None) -> str:
+    """
+    レスポンス形式を決める。`format` クエリが指定されていればそれを優先し、
+    なければ Accept ヘッダーの q 値が最も高い対応形式を選ぶ。既定は JSON。
+    """
+    if requested:
+        return requested
+    best_format, best_q = "json", 0.0
+    for entry in (accept or "").split(","):
+        media_type, *params = (part.strip() for part in entry.split(";"))
+        q = 1.0
+        for param in params:
+            match = re.fullmatch(r"q=([0-9.]+)", param)
+            if match:
+                q = float(match.group(1))
+        for name, supported in FORMATS.items():
+            if media_type == supported and q > best_q:
+                best_format, best_q = name, q
+    return best_format
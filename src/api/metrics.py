@@ -0,0 +1,406 @@
+"""
+Prometheus のテキスト形式で出力する、依存ライブラリなしの軽量メトリクス。
+Lightweight, dependency-free metrics rendered in the Prometheus text exposition format.
+
+記録側は「ラベルごとの数値を加算するだけ」にしてあり、文字列の組み立ては
+`/metrics` がスクレイプされた時にだけ行う。スクレイプされない限りのオーバーヘッドは
+ロック付きの加算のみで、推論時間に対して無視できる。
+"""
+
+from bisect import bisect_left
+from collections.abc import Callable, Sequence
+import math
+import threading
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# --- 既定のバケット ---
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+FAST_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+TOKEN_BUCKETS = (8, 16, 32, 64, 96, 128, 192, 256, 512)
+THROUGHPUT_BUCKETS = (1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 400, 1000)
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames: Sequence[str], labelvalues: Sequence[str], **extra) -> str:
+    pairs = list(zip(labelnames, labelvalues, strict=True)) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in pairs) + "}"
+
+
+class _Metric:
+    metric_type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _label_key(self, labels: dict) -> tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name}: expected labels {self.labelnames}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _header(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.metric_type}",
+        ]
+
+    def render(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """単調増加するカウンタ。"""
+
+    metric_type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def get(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._label_key(labels), 0.0)
+
+    def snapshot(self) -> dict[tuple[str, ...], float]:
+        """ラベル値のタプルをキーとした、現在値のコピーを返す。"""
+        with self._lock:
+            return dict(self._values)
+
+    def render(self) -> list[str]:
+        lines = self._header()
+        for key, value in sorted(self.snapshot().items()):
+            lines.append(
+                f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            )
+        return lines
+
+
+class Gauge(_Metric):
+    """増減する値。`set_function` を使うとスクレイプ時にだけ値を計算する。"""
+
+    metric_type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+        self._function: Callable[[], float | None] | None = None
+
+    def set(self, value: float, **labels) -> None:
+        key = self._label_key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def get(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._label_key(labels), 0.0)
+
+    def set_function(self, function: Callable[[], float | None]) -> None:
+        """ラベルなしのゲージ値を、スクレイプ時に呼び出す関数から取得するようにする。"""
+        self._function = function
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        if self._function is not None:
+            value = self._function()
+            values = {(): value} if value is not None else {}
+        lines = self._header()
+        for key, value in sorted(values.items()):
+            lines.append(
+                f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            )
+        return lines
+
+
+class Histogram(_Metric):
+    """累積バケット付きのヒストグラム。"""
+
+    metric_type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # key -> (各バケットの個数 (+Inf含む), 合計, 件数)
+        self._values: dict[tuple[str, ...], tuple[list[int], float, int]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._label_key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0, 0)
+            counts[index] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def get_count(self, **labels) -> int:
+        with self._lock:
+            entry = self._values.get(self._label_key(labels))
+        return entry[2] if entry else 0
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = {key: (list(c), s, n) for key, (c, s, n) in self._values.items()}
+        lines = self._header()
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, math.inf), counts, strict=True):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, le=_format_value(bound))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    """メトリクスの集合。`render()` で Prometheus テキスト形式の文字列を返す。"""
+
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric already registered: {metric.name}")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# --- Melody Flow API のメトリクス定義 ---
+REGISTRY = Registry()
+
+REQUEST_LATENCY = REGISTRY.histogram(
+    "melody_request_latency_seconds",
+    "Total latency of /generate requests.",
+    labelnames=("status",),
+)
+BAR_LATENCY = REGISTRY.histogram(
+    "melody_bar_latency_seconds", "Latency of generating a single bar (including IPC)."
+)
+BATCH_LATENCY = REGISTRY.histogram(
+    "melody_batch_latency_seconds", "Latency of generating a batch of bars in one generate call."
+)
+GENERATION_BATCH_SIZE = REGISTRY.histogram(
+    "melody_generation_batch_size",
+    "Number of bars generated together in one generate call.",
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+PREFILL_LATENCY = REGISTRY.histogram(
+    "melody_prefill_seconds", "Time from generate() start to the first decode step."
+)
+DECODE_LATENCY = REGISTRY.histogram(
+    "melody_decode_seconds", "Time spent in decode steps after prefill."
+)
+TOKENS_PER_BAR = REGISTRY.histogram(
+    "melody_tokens_per_bar", "Number of new tokens generated per bar.", buckets=TOKEN_BUCKETS
+)
+TOKENS_PER_SECOND = REGISTRY.histogram(
+    "melody_decode_tokens_per_second",
+    "Decode throughput per bar (new tokens / decode seconds).",
+    buckets=THROUGHPUT_BUCKETS,
+)
+PROCESSOR_LATENCY = REGISTRY.histogram(
+    "melody_logits_processor_seconds",
+    "Time spent inside MelodyControlLogitsProcessor per bar.",
+    buckets=FAST_LATENCY_BUCKETS,
+)
+PROCESSOR_STEPS = REGISTRY.counter(
+    "melody_logits_processor_steps_total", "Decode steps seen by MelodyControlLogitsProcessor."
+)
+PROCESSOR_INTERVENTIONS = REGISTRY.counter(
+    "melody_logits_processor_interventions_total",
+    "Decode steps where MelodyControlLogitsProcessor suppressed pitch tokens.",
+)
+PROCESSOR_INTERVENTION_RATIO = REGISTRY.gauge(
+    "melody_logits_processor_intervention_ratio",
+    "Fraction of decode steps where MelodyControlLogitsProcessor intervened.",
+)
+SPECULATIVE_DRAFT_TOKENS = REGISTRY.counter(
+    "melody_speculative_draft_tokens_total", "Tokens proposed by the speculative decoding draft."
+)
+SPECULATIVE_ACCEPTED_TOKENS = REGISTRY.counter(
+    "melody_speculative_accepted_tokens_total",
+    "Draft tokens accepted by the model during speculative decoding.",
+)
+SPECULATIVE_ACCEPTANCE_RATIO = REGISTRY.gauge(
+    "melody_speculative_acceptance_ratio",
+    "Fraction of speculative draft tokens accepted since startup.",
+)
+MODEL_MEMORY_BYTES = REGISTRY.gauge(
+    "melody_model_memory_bytes",
+    "Weight memory of the base model and each LoRA adapter served on it.",
+    ("component",),
+)
+QUEUE_DEPTH = REGISTRY.gauge(
+    "melody_inference_queue_depth", "Bar-generation jobs waiting for or running inference."
+)
+CACHE_REQUESTS = REGISTRY.counter(
+    "melody_cache_requests_total", "Cache lookups by cache name and result.", ("cache", "result")
+)
+CACHE_HIT_RATIO = REGISTRY.gauge(
+    "melody_cache_hit_ratio", "Hit ratio of each cache since startup.", ("cache",)
+)
+ADMISSION_INFLIGHT = REGISTRY.gauge(
+    "melody_admission_inflight", "Admitted /generate requests currently using the model."
+)
+ADMISSION_QUEUE_DEPTH = REGISTRY.gauge(
+    "melody_admission_queue_depth", "/generate requests waiting for admission."
+)
+ADMISSION_QUEUED_CLIENTS = REGISTRY.gauge(
+    "melody_admission_queued_clients", "Distinct clients with requests waiting for admission."
+)
+ADMISSION_WAIT = REGISTRY.histogram(
+    "melody_admission_wait_seconds", "Time /generate requests waited in the admission queue."
+)
+ADMISSION_REJECTIONS = REGISTRY.counter(
+    "melody_admission_rejections_total",
+    "/generate requests rejected with 429 by reason (queue_full, client_limit, timeout).",
+    ("reason",),
+)
+DEGRADATIONS = REGISTRY.counter(
+    "melody_degradations_total",
+    "Generations under a latency budget by the degradation applied (none if it fit).",
+    ("degradation",),
+)
+PREGENERATION_JOBS = REGISTRY.counter(
+    "melody_pregeneration_jobs_total",
+    "Background pregeneration jobs by result (completed, cancelled, failed, dropped).",
+    ("result",),
+)
+PREGENERATION_PENDING = REGISTRY.gauge(
+    "melody_pregeneration_pending", "Background pregeneration jobs waiting for an idle queue."
+)
+CPU_LANES = REGISTRY.gauge(
+    "melody_cpu_lanes", "Inference lanes the CPU cores are partitioned into (CPU_LANES)."
+)
+CPU_LANE_THREADS = REGISTRY.gauge(
+    "melody_cpu_lane_threads",
+    "torch intra-op threads pinned to each CPU inference lane.",
+    ("lane",),
+)
+CPU_LANE_TUNING_THROUGHPUT = REGISTRY.gauge(
+    "melody_cpu_lane_tuning_bars_per_second",
+    "Bars per second measured for each lane count when CPU_LANES=auto.",
+    ("lanes",),
+)
+
+
+def observe_generation(stats: dict) -> None:
+    """1小節分の GenerationStats (to_dict() した値) をメトリクスに記録する。"""
+    decode_sec = stats.get("decode_sec", 0.0)
+    new_tokens = stats.get("new_tokens", 0)
+    PREFILL_LATENCY.observe(stats.get("prefill_sec", 0.0))
+    DECODE_LATENCY.observe(decode_sec)
+    TOKENS_PER_BAR.observe(new_tokens)
+    if decode_sec > 0:
+        TOKENS_PER_SECOND.observe(new_tokens / decode_sec)
+    PROCESSOR_LATENCY.observe(stats.get("processor_sec", 0.0))
+    PROCESSOR_STEPS.inc(stats.get("processor_steps", 0))
+    PROCESSOR_INTERVENTIONS.inc(stats.get("processor_interventions", 0))
+    if draft_tokens := stats.get("draft_tokens", 0):
+        SPECULATIVE_DRAFT_TOKENS.inc(draft_tokens)
+        SPECULATIVE_ACCEPTED_TOKENS.inc(stats.get("accepted_draft_tokens", 0))
+
+
+def record_cache_lookup(cache: str, hit: bool) -> None:
+    """キャッシュの参照結果を記録する。ヒット率はスクレイプ時に計算する。"""
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def record_lane_plan(plan: dict) -> None:
+    """CPU の推論レーンの割り当て (LanePlan.to_dict() した値) を記録する。"""
+    CPU_LANES.set(plan["lanes"])
+    for lane, threads in enumerate(plan["threads"]):
+        CPU_LANE_THREADS.set(threads, lane=lane)
+    for lanes, throughput in plan["throughput"].items():
+        CPU_LANE_TUNING_THROUGHPUT.set(throughput, lanes=lanes)
+
+
+def _intervention_ratio() -> float | None:
+    steps = PROCESSOR_STEPS.get()
+    return PROCESSOR_INTERVENTIONS.get() / steps if steps else None
+
+
+def _acceptance_ratio() -> float | None:
+    drafted = SPECULATIVE_DRAFT_TOKENS.get()
+    return SPECULATIVE_ACCEPTED_TOKENS.get() / drafted if drafted else None
+
+
+def _update_cache_hit_ratios() -> None:
+    values = CACHE_REQUESTS.snapshot()
+    for cache in {cache for cache, _ in values}:
+        hits = values.get((cache, "hit"), 0.0)
+        total = hits + values.get((cache, "miss"), 0.0)
+        if total:
+            CACHE_HIT_RATIO.set(hits / total, cache=cache)
+
+
+PROCESSOR_INTERVENTION_RATIO.set_function(_intervention_ratio)
+SPECULATIVE_ACCEPTANCE_RATIO.set_function(_acceptance_ratio)
+
+
+def render_metrics() -> str:
+    """スクレイプ時に派生値を更新してから、全メトリクスを文字列にする。"""
+    _update_cache_hit_ratios()
+    return REGISTRY.render()
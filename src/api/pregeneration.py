@@ -0,0 +1,174 @@
+"""
+次に要求されそうなバリエーションを、推論キューが空いている間にバックグラウンドで生成しておく。
+Predictive, low-priority background pregeneration of the next variations.
+
+UI ではバリエーション n を聞いた後、ほぼ必ず n+1 を要求する。/generate が1件返すたびに、
+同じコード進行の次の k 個のバリエーションをジョブとして積み、レスポンスキャッシュに入れておく。
+
+ジョブは優先度が低く、次のように扱う:
+    - 推論キューが空いている (フォアグラウンドの生成がない) 時だけ開始する
+    - 小節の区切りごとに `checkpoint()` で負荷を確認し、フォアグラウンドの生成が来たら中止する。
+      中止したジョブは待ち行列に戻し、キューが空いたらやり直す
+    - キャッシュ済みのもの・待ち行列にあるものは積まない。待ち行列が満杯なら古いものから捨てる
+
+環境変数 (from_env):
+    PREGENERATE_AHEAD: 先読みするバリエーション数 k (既定: 2, 0 で無効)
+    PREGENERATE_MAX_PENDING: 待ち行列の上限 (既定: 16)
+"""
+
+from collections import OrderedDict
+from collections.abc import Callable, Hashable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+import os
+import threading
+import time
+
+from src.api import metrics
+
+_CANCEL_CHECK: ContextVar[Callable[[], bool] | None] = ContextVar("cancel_check", default=None)
+
+
+class PregenerationCancelled(Exception):
+    """フォアグラウンドの生成が始まったため、先読みジョブを中止した。"""
+
+
+def checkpoint() -> None:
+    """
+    先読みジョブの中であれば、負荷を確認して中止すべき場合に PregenerationCancelled を送出する。
+    フォアグラウンドのリクエストでは何もしない。生成ループの小節の区切りで呼び出す。
+    """
+    check = _CANCEL_CHECK.get()
+    if check is not None and check():
+        raise PregenerationCancelled()
+
+
+class Pregenerator[K: Hashable]:
+    """
+    先読みジョブの待ち行列と、それを処理するバックグラウンドスレッド。
+
+    Args:
+        generate: キーの結果を生成してキャッシュに入れる関数。バックグラウンドで呼ばれる。
+        is_cached: キーの結果がすでにキャッシュ (またはその他の取得元) にあるかを返す関数。
+        is_busy: フォアグラウンド以外の負荷 (推論ワーカーの他プロセスの待ち行列など) を返す関数。
+        max_pending: 待ち行列の上限。
+        poll_interval_sec: キューが空くのを待つ間の確認間隔。
+    """
+
+    def __init__(
+        self,
+        generate: Callable[[K], object],
+        is_cached: Callable[[K], bool],
+        is_busy: Callable[[], bool] = lambda: False,
+        max_pending: int = 16,
+        poll_interval_sec: float = 0.1,
+    ):
+        self.generate = generate
+        self.is_cached = is_cached
+        self.is_busy = is_busy
+        self.max_pending = max_pending
+        self.poll_interval_sec = poll_interval_sec
+        self._pending: OrderedDict[K, None] = OrderedDict()
+        self._running: K | None = None
+        self._foreground = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread: threading.Thread | None = None
+
+    @classmethod
+    def from_env(
+        cls, generate: Callable[[K], object], is_cached: Callable[[K], bool], **kwargs
+    ) -> "tuple[Pregenerator[K] | None, int]":
+        """(Pregenerator, 先読み数 k) を返す。PREGENERATE_AHEAD=0 の場合は None。"""
+        ahead = int(os.getenv("PREGENERATE_AHEAD", "2"))
+        if ahead <= 0:
+            return None, 0
+        max_pending = int(os.getenv("PREGENERATE_MAX_PENDING", "16"))
+        return cls(generate, is_cached, max_pending=max_pending, **kwargs), ahead
+
+    @contextmanager
+    def foreground(self) -> Iterator[None]:
+        """フォアグラウンドの生成を囲む。実行中は先読みジョブを開始せず、実行中のものは中止する。"""
+        with self._lock:
+            self._foreground += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._foreground -= 1
+                self._wakeup.notify_all()
+
+    def busy(self) -> bool:
+        with self._lock:
+            foreground = self._foreground
+        return foreground > 0 or self.is_busy()
+
+    def schedule(self, keys: list[K]) -> int:
+        """先読みジョブを積む。keys は優先度の高い順 (n+1, n+2, ...)。積んだ件数を返す。"""
+        uncached = [key for key in keys if not self.is_cached(key)]
+        added = 0
+        # 取り出す順序が途中で変わらないよう、まとめて積んでからスレッドに知らせる
+        with self._lock:
+            # 待ち行列は後ろから取り出すため、優先度の高いものが最後に来るよう逆順に積む
+            for key in reversed(uncached):
+                if key in self._pending or key == self._running:
+                    continue
+                self._push(key)
+                added += 1
+            if added:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name="pregeneration", daemon=True
+                    )
+                    self._thread.start()
+                self._wakeup.notify_all()
+        return added
+
+    def _push(self, key: K) -> None:
+        """待ち行列の最後 (次に取り出される位置) に積む。ロックを取って呼び出す。"""
+        self._pending[key] = None
+        self._pending.move_to_end(key)
+        while len(self._pending) > self.max_pending:
+            self._pending.popitem(last=False)
+            metrics.PREGENERATION_JOBS.inc(result="dropped")
+        metrics.PREGENERATION_PENDING.set(len(self._pending))
+
+    def pending(self) -> list[K]:
+        with self._lock:
+            return list(self._pending)
+
+    def _next_job(self) -> K:
+        with self._lock:
+            self._wakeup.wait_for(lambda: self._pending)
+            # 最後に積まれたもの (直近のリクエストの続き) を優先する。古いものは上限で捨てられる
+            key, _ = self._pending.popitem(last=True)
+            self._running = key
+            metrics.PREGENERATION_PENDING.set(len(self._pending))
+            return key
+
+    def _run(self) -> None:
+        while True:
+            key = self._next_job()
+            try:
+                # キューが空くまで待つ。待っている間に他のリクエストで生成されたら不要になる
+                while self.busy():
+                    time.sleep(self.poll_interval_sec)
+                if self.is_cached(key):
+                    continue
+                token = _CANCEL_CHECK.set(self.busy)
+                try:
+                    self.generate(key)
+                finally:
+                    _CANCEL_CHECK.reset(token)
+                metrics.PREGENERATION_JOBS.inc(result="completed")
+            except PregenerationCancelled:
+                metrics.PREGENERATION_JOBS.inc(result="cancelled")
+                # フォアグラウンドの生成が終わってからやり直す。その後に積まれたジョブが優先される
+                with self._lock:
+                    self._push(key)
+            except Exception as e:
+                metrics.PREGENERATION_JOBS.inc(result="failed")
+                print(f"⚠️  Pregeneration failed for {key}: {e}")
+            finally:
+                with self._lock:
+                    self._running = None
@@ -0,0 +1,245 @@
+"""
+/generate リクエスト単位のオプトイン・プロファイラ。
+Opt-in per-request profiling for /generate.
+
+遅いリクエストの時間がプリフィル・プロセッサの文字列デコード・正規表現パースの
+どこに使われているかを調べるため、リクエストを `torch.profiler` と Python の
+サンプリングプロファイラで包み、成果物をローカルディレクトリに書き出す。
+
+    <profile_id>.trace.json  torch.profiler の Chrome trace (chrome://tracing, Perfetto で開く)
+    <profile_id>.folded      Python スタックの collapsed 形式 (flamegraph.pl / speedscope で開く)
+
+環境変数:
+    PROFILE_MODE: off (既定) | header | always
+        header の場合は `X-Melody-Profile: 1` ヘッダー付きのリクエストだけを対象にする。
+    PROFILE_DIR: 成果物の出力先 (既定: profiles)
+    PROFILE_MAX_ARTIFACTS: 保持するプロファイル数の上限。古いものから削除する (既定: 20)
+    PROFILE_SAMPLE_INTERVAL_MS: Python スタックのサンプリング間隔 (既定: 5)
+
+PROFILE_MODE=off の場合 `PROFILER` は None になり、ミドルウェアは None 判定だけで素通りする。
+計測はモデルで生成する区間 (maybe_profile) だけなので、キャッシュから返したリクエストや 304 では
+成果物を書き出さず、X-Melody-Profile-Id も返さない。
+torch.profiler はプロセスで1つしか同時に動かせない (重ねるとインタプリタが落ちる) ため、
+他のリクエストの計測中に来たリクエストは Python スタックのサンプリングだけを行う。
+推論ワーカー (INFERENCE_WORKER_SOCKET) 利用時はモデルが別プロセスにあるため、
+API プロセスのプロファイルには IPC の待ち時間として現れる。
+"""
+
+from collections import Counter
+from collections.abc import Iterator, Mapping
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from dataclasses import dataclass, field
+import os
+from pathlib import Path
+import sys
+import threading
+import time
+import uuid
+
+PROFILE_HEADER = "X-Melody-Profile"
+PROFILE_ID_HEADER = "X-Melody-Profile-Id"
+_ARTIFACT_SUFFIXES = (".trace.json", ".folded")
+
+
+@dataclass
+class ProfileRequest:
+    """
+    プロファイル対象のリクエスト。エンドポイントはスレッドプールで実行され、ContextVar への
+    代入はミドルウェアに戻らないため、書き出したかどうかはこのオブジェクトに記録する。
+    """
+
+    profile_id: str
+    written: bool = False  # maybe_profile が成果物を書き出したかどうか
+    _token: Token | None = field(default=None, repr=False)
+
+
+_REQUESTED_PROFILE: ContextVar[ProfileRequest | None] = ContextVar(
+    "requested_profile", default=None
+)
+# torch.profiler はプロセス全体で共有されるため、同時に1つだけ動かす
+_TORCH_PROFILER_LOCK = threading.Lock()
+
+
+class StackSampler:
+    """
+    指定したスレッドのスタックを一定間隔で取得し、collapsed 形式で集計する
+    依存ライブラリなしのサンプリングプロファイラ。
+
+    Args:
+        thread_id: サンプリング対象のスレッド ID (threading.get_ident())。
+        interval_sec: サンプリング間隔 (秒)。
+    """
+
+    def __init__(self, thread_id: int, interval_sec: float = 0.005):
+        self.thread_id = thread_id
+        self.interval_sec = interval_sec
+        self.samples: Counter[str] = Counter()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_sec):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.samples[";".join(reversed(stack))] += 1
+
+    def write_folded(self, path: Path) -> None:
+        lines = [f"{stack} {count}" for stack, count in self.samples.most_common()]
+        path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+
+class RequestProfiler:
+    """
+    リクエストを torch.profiler と StackSampler で計測し、成果物を書き出すクラス。
+
+    Args:
+        output_dir: 成果物の出力先ディレクトリ。
+        mode: "header" (ヘッダー指定時のみ) または "always"。
+        max_artifacts: 保持するプロファイル数の上限。
+        interval_sec: Python スタックのサンプリング間隔 (秒)。
+        use_torch: torch.profiler を使うかどうか。
+    """
+
+    def __init__(
+        self,
+        output_dir: str | Path,
+        mode: str = "header",
+        max_artifacts: int = 20,
+        interval_sec: float = 0.005,
+        use_torch: bool = True,
+    ):
+        if mode not in ("header", "always"):
+            raise ValueError(f"Unknown profile mode: {mode}")
+        self.output_dir = Path(output_dir)
+        self.mode = mode
+        self.max_artifacts = max_artifacts
+        self.interval_sec = interval_sec
+        self.use_torch = use_torch
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "RequestProfiler | None":
+        mode = os.getenv("PROFILE_MODE", "off").lower()
+        if mode in ("", "off"):
+            return None
+        return cls(
+            output_dir=os.getenv("PROFILE_DIR", "profiles"),
+            mode=mode,
+            max_artifacts=int(os.getenv("PROFILE_MAX_ARTIFACTS", "20")),
+            interval_sec=float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5")) / 1000,
+        )
+
+    def wants_profile(self, headers: Mapping[str, str]) -> bool:
+        if self.mode == "always":
+            return True
+        return headers.get(PROFILE_HEADER, "").lower() in ("1", "true", "yes")
+
+    def _start_torch_profiler(self):
+        if not self.use_torch:
+            return None
+        try:
+            import torch
+        except ImportError:
+            return None
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        profiler = torch.profiler.profile(activities=activities)
+        profiler.__enter__()
+        return profiler
+
+    @contextmanager
+    def profile(self, profile_id: str) -> Iterator[None]:
+        """呼び出したスレッドの処理をプロファイルし、終了時に成果物を書き出す。"""
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        sampler = StackSampler(threading.get_ident(), self.interval_sec)
+        # 他のリクエストが torch.profiler を使っている間は、スタックのサンプリングだけにする
+        owns_torch = self.use_torch and _TORCH_PROFILER_LOCK.acquire(blocking=False)
+        torch_profiler = None
+        started_at = time.perf_counter()
+        try:
+            if owns_torch:
+                torch_profiler = self._start_torch_profiler()
+            sampler.start()
+            yield
+        finally:
+            sampler.stop()
+            try:
+                if torch_profiler is not None:
+                    torch_profiler.__exit__(None, None, None)
+                    torch_profiler.export_chrome_trace(
+                        str(self.output_dir / f"{profile_id}.trace.json")
+                    )
+            finally:
+                if owns_torch:
+                    _TORCH_PROFILER_LOCK.release()
+            sampler.write_folded(self.output_dir / f"{profile_id}.folded")
+            self._enforce_retention()
+            print(
+                f"🔬 Profiled request {profile_id} in {time.perf_counter() - started_at:.2f}s "
+                f"-> {self.output_dir}"
+            )
+
+    def _enforce_retention(self) -> None:
+        """プロファイル数が上限を超えた場合、古いものから成果物を削除する。"""
+        with self._lock:
+            artifacts: dict[str, list[Path]] = {}
+            for path in self.output_dir.iterdir():
+                for suffix in _ARTIFACT_SUFFIXES:
+                    if path.name.endswith(suffix):
+                        artifacts.setdefault(path.name[: -len(suffix)], []).append(path)
+            oldest_first = sorted(
+                artifacts.values(), key=lambda paths: max(p.stat().st_mtime for p in paths)
+            )
+            for paths in oldest_first[: max(len(oldest_first) - self.max_artifacts, 0)]:
+                for path in paths:
+                    path.unlink(missing_ok=True)
+
+
+PROFILER = RequestProfiler.from_env()
+
+
+def new_profile_id() -> str:
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+
+def request_profile(profile_id: str) -> ProfileRequest:
+    """現在のリクエストをプロファイル対象にする。戻り値は reset_request に渡す。"""
+    request = ProfileRequest(profile_id)
+    request._token = _REQUESTED_PROFILE.set(request)
+    return request
+
+
+def reset_request(request: ProfileRequest) -> None:
+    _REQUESTED_PROFILE.reset(request._token)
+
+
+@contextmanager
+def maybe_profile() -> Iterator[None]:
+    """現在のリクエストがプロファイル対象の場合だけ、PROFILER で計測する。"""
+    request = _REQUESTED_PROFILE.get()
+    if request is None or PROFILER is None:
+        yield
+        return
+    try:
+        with PROFILER.profile(request.profile_id):
+            yield
+    finally:
+        # 成果物は profile を抜ける時に (例外で抜けた場合も) 書き出される
+        request.written = True
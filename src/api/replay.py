@@ -0,0 +1,221 @@
+"""
+モデルの代わりに、記録済みの小節の出力を決定的に返す生成バックエンド (負荷試験用)。
+A deterministic replay backend that serves recorded bars instead of running the model.
+
+nginx・キャッシュ・API の負荷試験のたびに GPU でモデルを動かさなくて済むように、
+ReplayBarGenerator は ModelBarGenerator と同じ形 (BarJob -> BarResult、generate_batch) で
+記録済みの小節を返す。小節単位で差し替えるため、小節の保存先・バッチ・キュー・
+受け付け制御・推論ワーカー・レイテンシ予算などの処理はモデルを使う場合と同じように動く。
+
+記録の読み込み元 (REPLAY_SOURCE):
+    - 静的キャッシュのディレクトリ (generate_static_cache の dist/)。
+      各ファイルの chord_melodies の小節を、コード名ごとに集める
+    - 小節のトレース (JSON Lines)。REPLAY_RECORD_PATH を設定して実際のモデルで API を
+      動かすと、生成した小節を1行ずつ {"chord", "seed", "text", "new_tokens", ...} で書き出す
+
+同じジョブ (プロンプト・シード) には常に同じ小節を返す。ジョブのコードの小節が
+記録になければ、記録全体から選ぶ。
+
+レイテンシ (1小節あたり prefill_ms + トークン数 × token_ms) は sleep で再現する。
+concurrency は同時に「推論」できる数で、GPU 1枚なら 1 にすると、同時のリクエストが
+順番待ちになる (モデルを使う場合と同じくキューが伸びる)。
+"""
+
+import base64
+from collections.abc import Callable
+from dataclasses import dataclass
+import hashlib
+import json
+import os
+from pathlib import Path
+import re
+import threading
+import time
+
+from src.api import melody_codec
+from src.api.inference_worker import BarBatchResult, BarJob, BarResult
+
+# 静的キャッシュの小節のトークン数の見積もりに使う、1音 (1行) あたりのトークン数
+TOKENS_PER_NOTE = 16
+# 静的キャッシュの chord_melodies のキーは、同じコードが複数回出ると "Dm7_2" のようになる
+_DUPLICATE_SUFFIX = re.compile(r"_\d+$")
+
+
+@dataclass(frozen=True)
+class ReplayBar:
+    """記録済みの1小節。text は生成結果 (extract_midi_note_data で取り出せる形)。"""
+
+    chord: str
+    text: str
+    new_tokens: int
+
+
+def _note_lines(text: str) -> list[str]:
+    return [line for line in melody_codec.extract_midi_note_data(text).splitlines() if line]
+
+
+def load_static_cache_bars(root: str | Path) -> list[ReplayBar]:
+    """静的キャッシュのディレクトリ (dist/<hash>/<style>/<variation>.json) から小節を読み込む。"""
+    bars = []
+    for path in sorted(Path(root).glob("*/*/*.json")):
+        with open(path, encoding="utf-8") as f:
+            melodies = json.load(f).get("chord_melodies", {})
+        for key, encoded in melodies.items():
+            text = base64.b64decode(encoded).decode("utf-8")
+            new_tokens = len(_note_lines(text)) * TOKENS_PER_NOTE
+            bars.append(ReplayBar(_DUPLICATE_SUFFIX.sub("", key), text, new_tokens))
+    return bars
+
+
+def load_trace_bars(path: str | Path) -> list[ReplayBar]:
+    """BarTraceRecorder が書き出した JSON Lines から小節を読み込む。"""
+    bars = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            new_tokens = (
+                record.get("new_tokens") or len(_note_lines(record["text"])) * TOKENS_PER_NOTE
+            )
+            bars.append(ReplayBar(record["chord"], record["text"], new_tokens))
+    return bars
+
+
+def load_replay_bars(source: str | Path) -> list[ReplayBar]:
+    """
+    ディレクトリなら静的キャッシュ、ファイルならトレースとして読み込む。
+
+    Raises:
+        ValueError: 読み込み元が存在しない、または小節が1つもない場合。
+    """
+    source = Path(source)
+    if source.is_dir():
+        bars = load_static_cache_bars(source)
+    elif source.is_file():
+        bars = load_trace_bars(source)
+    else:
+        raise ValueError(f"Replay source not found: {source}")
+    if not bars:
+        raise ValueError(f"No recorded bars in replay source: {source}")
+    return bars
+
+
+class BarTraceRecorder:
+    """モデルで生成した小節を、リプレイ用のトレース (JSON Lines) に追記する。"""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "BarTraceRecorder | None":
+        """REPLAY_RECORD_PATH が設定されていれば、そのファイルに記録する。"""
+        path = os.getenv("REPLAY_RECORD_PATH", "")
+        return cls(path) if path else None
+
+    def record(self, job: BarJob, text: str, stats: dict | None = None) -> None:
+        stats = stats or {}
+        record = {
+            "chord": job.chord,
+            "seed": job.seed,
+            # プロンプトを除いた、生成したノートの行だけを残す
+            "text": melody_codec.extract_midi_note_data(text),
+            "new_tokens": stats.get("new_tokens", 0),
+            "prefill_sec": stats.get("prefill_sec", 0.0),
+            "decode_sec": stats.get("decode_sec", 0.0),
+        }
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+class ReplayBarGenerator:
+    """
+    記録済みの小節を、合成したレイテンシで返す生成関数オブジェクト。
+
+    Args:
+        bars: 記録済みの小節
+        token_ms: 1トークンあたりの生成時間 (ミリ秒)
+        prefill_ms: 1回の生成ごとのプリフィル時間 (ミリ秒)
+        concurrency: 同時に生成できる数。0 以下なら制限しない
+        sleep: 待ち時間の関数 (テスト用)
+    """
+
+    def __init__(
+        self,
+        bars: list[ReplayBar],
+        token_ms: float = 0.0,
+        prefill_ms: float = 0.0,
+        concurrency: int = 1,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.bars = list(bars)
+        self.token_ms = token_ms
+        self.prefill_ms = prefill_ms
+        self._by_chord: dict[str, list[ReplayBar]] = {}
+        for bar in self.bars:
+            self._by_chord.setdefault(bar.chord, []).append(bar)
+        self._slots = threading.BoundedSemaphore(concurrency) if concurrency > 0 else None
+        self._sleep = sleep
+        # ModelBarGenerator と同じ属性 (推論ワーカーの health が参照する)
+        self.memory_bytes = None
+
+    @classmethod
+    def from_env(cls, source: str | None = None) -> "ReplayBarGenerator":
+        """
+        環境変数から作る。
+
+        環境変数:
+            REPLAY_SOURCE: 静的キャッシュのディレクトリ、またはトレースのファイル
+            REPLAY_TOKEN_MS: 1トークンあたりの生成時間 (ミリ秒, 既定: 0)
+            REPLAY_PREFILL_MS: 1回の生成ごとのプリフィル時間 (ミリ秒, 既定: 0)
+            REPLAY_CONCURRENCY: 同時に生成できる数 (既定: 1。0 なら制限しない)
+        """
+        return cls(
+            load_replay_bars(source or os.environ["REPLAY_SOURCE"]),
+            token_ms=float(os.getenv("REPLAY_TOKEN_MS", "0")),
+            prefill_ms=float(os.getenv("REPLAY_PREFILL_MS", "0")),
+            concurrency=int(os.getenv("REPLAY_CONCURRENCY", "1")),
+        )
+
+    def _pick(self, job: BarJob) -> ReplayBar:
+        """プロンプトとシードから、決まった1小節を選ぶ (プロセスをまたいでも同じ)。"""
+        candidates = self._by_chord.get(job.chord) or self.bars
+        digest = hashlib.sha256(f"{job.seed}\n{job.prompt}".encode()).digest()
+        return candidates[int.from_bytes(digest[:8], "big") % len(candidates)]
+
+    @staticmethod
+    def _truncate(bar: ReplayBar, max_new_tokens: int) -> tuple[str, int]:
+        """max_new_tokens で生成が打ち切られた場合と同じく、トークン数に応じて音を減らす。"""
+        if bar.new_tokens <= max_new_tokens:
+            return bar.text, bar.new_tokens
+        lines = _note_lines(bar.text)
+        keep = len(lines) * max_new_tokens // bar.new_tokens
+        return "\n".join(lines[:keep]), max_new_tokens
+
+    def _run(self, new_tokens: int) -> dict:
+        """トークン数に応じた時間だけ待ち、GenerationStats.to_dict() と同じ形の統計を返す。"""
+        prefill_sec = self.prefill_ms / 1000
+        decode_sec = max(new_tokens - 1, 0) * self.token_ms / 1000
+        if self._slots is not None:
+            self._slots.acquire()
+        try:
+            if prefill_sec + decode_sec > 0:
+                self._sleep(prefill_sec + decode_sec)
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+        return {"new_tokens": new_tokens, "prefill_sec": prefill_sec, "decode_sec": decode_sec}
+
+    def __call__(self, job: BarJob) -> BarResult:
+        text, new_tokens = self._truncate(self._pick(job), job.max_new_tokens)
+        return BarResult(text=text, stats=self._run(new_tokens))
+
+    def generate_batch(self, jobs: list[BarJob]) -> BarBatchResult:
+        """バッチの生成は各行が同時に進むため、最も長い行のトークン数だけ待つ。"""
+        picked = [self._truncate(self._pick(job), job.max_new_tokens) for job in jobs]
+        stats = self._run(max(new_tokens for _, new_tokens in picked))
+        stats["new_tokens"] = sum(new_tokens for _, new_tokens in picked)
+        return BarBatchResult(texts=[text for text, _ in picked], stats=stats)
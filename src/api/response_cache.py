@@ -0,0 +1,63 @@
+"""
+/generate の生成結果を、プロセス内でキャッシュする LRU キャッシュ。
+An in-process LRU cache of /generate results.
+
+JSON・バイナリ・MIDI の各形式は同じ生成結果 (JSON 形式の dict) から変換するため、
+キャッシュのキーは生成パラメータだけで決まり、形式ごとに生成し直すことはない。
+"""
+
+from collections import OrderedDict
+from collections.abc import Hashable
+import threading
+
+from src.api import metrics
+
+
+class ResponseCache:
+    """
+    スレッドセーフな LRU キャッシュ。参照結果は metrics の cache_requests に記録する。
+
+    Args:
+        name: メトリクスのラベルに使うキャッシュ名。
+        max_entries: 保持する件数の上限。0 の場合はキャッシュしない。
+    """
+
+    def __init__(self, name: str, max_entries: int = 256):
+        self.name = name
+        self.max_entries = max_entries
+        self._entries: OrderedDict[Hashable, dict] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, record_miss: bool = True) -> dict | None:
+        """
+        key のエントリを返す。record_miss=False の場合、見つからなかったことは記録しない
+        (続けて同じキーを引き直す呼び出し元が、二重に数えないようにするため)。
+        """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+        if value is not None or record_miss:
+            metrics.record_cache_lookup(self.name, hit=value is not None)
+        return value
+
+    def put(self, key: Hashable, value: dict) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
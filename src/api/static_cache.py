@@ -0,0 +1,157 @@
+"""
+generate_static_cache が書き出した静的キャッシュ (dist/) を、API から直接返すためのインデックス。
+An index of the precomputed static cache so /generate can serve it without the model.
+
+静的キャッシュのレイアウト:
+    dist/<md5(正規化したコード進行)>/<style>/<variation>.json
+
+本番は CloudFront がこのファイルを返すが、ローカル・オンプレミスの API は毎回モデルを
+実行していた。StaticCacheIndex は起動時にディレクトリを走査して (キー -> ファイル) の
+インデックスをメモリに持ち、ヒットしたリクエストはモデルを通さずにファイルの中身を返す。
+
+ファイルの追加・削除はディレクトリの更新時刻でしか検出できないため、参照時に
+`reload_interval_sec` ごとにディレクトリの更新時刻だけを確認し、変わっていれば走査し直す。
+"""
+
+from dataclasses import dataclass
+import os
+from pathlib import Path
+import re
+import threading
+import time
+
+from src.api import metrics
+
+_HASH_PATTERN = re.compile(r"[0-9a-f]{32}")
+_VARIATION_PATTERN = re.compile(r"[0-9]+\.json")
+
+
+@dataclass(frozen=True)
+class StaticCacheEntry:
+    """静的キャッシュの1ファイル。"""
+
+    path: Path
+    size: int
+    mtime_ns: int
+
+
+@dataclass(frozen=True)
+class StaticCacheHit:
+    """静的キャッシュから読み込んだ /generate の JSON。"""
+
+    payload: bytes
+    fingerprint: str  # ETag に使う識別子。ファイルが書き換えられると変わる
+
+
+class StaticCacheIndex:
+    """
+    静的キャッシュディレクトリのインデックス。
+
+    Args:
+        root: 静的キャッシュのディレクトリ (generate_static_cache の OUTPUT_DIR)。
+        reload_interval_sec: ディレクトリの変更を確認する間隔。0 以下なら確認しない。
+    """
+
+    def __init__(self, root: str | Path, reload_interval_sec: float = 5.0):
+        self.root = Path(root)
+        self.reload_interval_sec = reload_interval_sec
+        self._entries: dict[tuple[str, str, int], StaticCacheEntry] = {}
+        self._signature: tuple = ()
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.reload()
+
+    @classmethod
+    def from_env(cls, default_root: str | Path) -> "StaticCacheIndex | None":
+        """
+        環境変数から設定を読み込む。STATIC_CACHE_DIR が空文字列の場合は無効 (None) にする。
+
+        環境変数:
+            STATIC_CACHE_DIR: 静的キャッシュのディレクトリ (既定: default_root)
+            STATIC_CACHE_RELOAD_SEC: 変更を確認する間隔 (秒, 既定: 5)
+        """
+        root = os.getenv("STATIC_CACHE_DIR", str(default_root))
+        if not root:
+            return None
+        return cls(root, float(os.getenv("STATIC_CACHE_RELOAD_SEC", "5")))
+
+    def _directories(self) -> list[Path]:
+        # dist/ / dist/<hash>/ / dist/<hash>/<style>/ の3階層のディレクトリ
+        directories = [self.root]
+        for prog_dir in self.root.iterdir():
+            if prog_dir.is_dir() and _HASH_PATTERN.fullmatch(prog_dir.name):
+                directories.append(prog_dir)
+                directories.extend(d for d in prog_dir.iterdir() if d.is_dir())
+        return directories
+
+    def _current_signature(self) -> tuple:
+        try:
+            return tuple((str(d), d.stat().st_mtime_ns) for d in self._directories())
+        except FileNotFoundError:
+            return ()
+
+    def _scan(self) -> dict[tuple[str, str, int], StaticCacheEntry]:
+        entries = {}
+        if not self.root.is_dir():
+            return entries
+        for path in self.root.glob("*/*/*.json"):
+            prog_hash, style = path.parts[-3], path.parts[-2]
+            if not (
+                _HASH_PATTERN.fullmatch(prog_hash) and _VARIATION_PATTERN.fullmatch(path.name)
+            ):
+                continue
+            stat = path.stat()
+            entries[(prog_hash, style, int(path.stem))] = StaticCacheEntry(
+                path, stat.st_size, stat.st_mtime_ns
+            )
+        return entries
+
+    def reload(self) -> int:
+        """ディレクトリを走査し直してインデックスを作り直す。登録されたファイル数を返す。"""
+        signature = self._current_signature()
+        entries = self._scan()
+        with self._lock:
+            self._entries = entries
+            self._signature = signature
+            self._checked_at = time.monotonic()
+        return len(entries)
+
+    def _reload_if_changed(self) -> None:
+        if self.reload_interval_sec <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if now - self._checked_at < self.reload_interval_sec:
+                return
+            self._checked_at = now
+            signature = self._signature
+        if self._current_signature() != signature:
+            count = self.reload()
+            print(f"🔄 Reloaded static cache index: {count} files in {self.root}")
+
+    def lookup(self, prog_hash: str, style: str, variation: int) -> StaticCacheHit | None:
+        """静的キャッシュにあればファイルの中身を返す。参照結果は metrics に記録する。"""
+        self._reload_if_changed()
+        with self._lock:
+            entry = self._entries.get((prog_hash, style, variation))
+        hit = None
+        if entry is not None:
+            try:
+                hit = StaticCacheHit(
+                    entry.path.read_bytes(), f"static:{entry.size}:{entry.mtime_ns}"
+                )
+            except OSError:
+                # インデックス作成後に削除された。次の参照で走査し直す
+                with self._lock:
+                    self._checked_at = 0.0
+        metrics.record_cache_lookup("static", hit=hit is not None)
+        return hit
+
+    def contains(self, prog_hash: str, style: str, variation: int) -> bool:
+        """ファイルを読まずに、インデックスに登録されているかだけを返す。"""
+        with self._lock:
+            return (prog_hash, style, variation) in self._entries
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
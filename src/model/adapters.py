@@ -0,0 +1,177 @@
+"""
+1つのベースモデルに複数の LoRA アダプタを読み込み、リクエストごとに選んで生成する。
+Serve several LoRA adapters on one base model, selected per request.
+
+dvc.yaml の train_model は同じベース (dx2102/llama-midi) から多数の LoRA
+(e2-llama-midi … base-llama-midi) を学習する。それぞれをモデルとして読み込むとベースの
+重みがモデルの数だけ必要になるため、ベースは既定のモデル (MODEL_NAME) の読み込みで
+1回だけ読み込み、他のアダプタは peft の `load_adapter` で追加する。LoRA の重みは
+ベースの 1% 程度なので、アダプタを増やしてもメモリはほとんど増えない。
+
+生成時はアダプタを `adapter_names` (peft の mixed-batch 推論) で行ごとに指定する。
+`set_adapter` でモデルの状態を書き換えないため、異なるアダプタのリクエストを並行に、
+また1つのバッチの中で混ぜて生成できる。
+
+アダプタの指定 (環境変数 MODEL_ADAPTERS、カンマ区切り):
+    "e2=models/e2-llama-midi.pth/,e5=models/e5-llama-midi.pth/"
+    名前を省略した場合はディレクトリ名から ".pth" を除いたもの ("e2-llama-midi")
+"""
+
+import json
+from pathlib import Path
+import re
+from typing import Any
+
+from loguru import logger
+
+# torch / peft は import が重いため、利用箇所で遅延 import する
+
+ADAPTER_CONFIG_FILE = "adapter_config.json"
+# peft の LoRA の重みの名前 (例: "...q_proj.lora_A.<adapter>.weight", "lora_embedding_A.<adapter>")
+_LORA_PARAMETER = re.compile(r"\.lora_[A-Za-z_]+\.([^.]+)(?:\.|$)")
+
+
+def adapter_name_from_path(path: str) -> str:
+    """ディレクトリ名から ".pth" を除いた名前 (models/e2-llama-midi.pth/ -> e2-llama-midi)。"""
+    return Path(path).name.removesuffix(".pth")
+
+
+def parse_adapter_specs(spec: str) -> dict[str, str]:
+    """
+    "name=path,path2" の形式の指定を {名前: パス} にする (順序は指定の順)。
+
+    Raises:
+        ValueError: 名前が空・重複している場合。
+    """
+    adapters: dict[str, str] = {}
+    for entry in filter(None, (entry.strip() for entry in spec.split(","))):
+        name, sep, path = entry.partition("=")
+        if not sep:
+            name, path = adapter_name_from_path(entry), entry
+        name, path = name.strip(), path.strip()
+        if not name or not path:
+            raise ValueError(f"Invalid adapter spec: {entry!r}")
+        if name in adapters:
+            raise ValueError(f"Duplicate adapter name: {name!r}")
+        adapters[name] = path
+    return adapters
+
+
+def read_base_model(path: str) -> str | None:
+    """アダプタのディレクトリの adapter_config.json から、ベースモデルの名前を返す。"""
+    config_path = Path(path) / ADAPTER_CONFIG_FILE
+    if not config_path.is_file():
+        return None
+    with open(config_path, encoding="utf-8") as f:
+        return json.load(f).get("base_model_name_or_path")
+
+
+def check_same_base(paths: list[str]) -> str:
+    """
+    すべてのアダプタが同じベースモデルから学習されていることを確かめ、ベースの名前を返す。
+
+    Raises:
+        ValueError: アダプタでないパスや、ベースの異なるアダプタが含まれる場合。
+    """
+    bases = {path: read_base_model(path) for path in paths}
+    missing = [path for path, base in bases.items() if base is None]
+    if missing:
+        raise ValueError(f"Not a LoRA adapter directory: {', '.join(missing)}")
+    if len(set(bases.values())) > 1:
+        details = ", ".join(f"{path} ({base})" for path, base in bases.items())
+        raise ValueError(f"Adapters must share one base model: {details}")
+    return next(iter(bases.values()))
+
+
+def adapter_memory_bytes(model: Any) -> dict[str, int]:
+    """peft のアダプタ名ごとの、LoRA の重みのバイト数を返す。"""
+    sizes: dict[str, int] = {}
+    for name, parameter in model.named_parameters():
+        match = _LORA_PARAMETER.search(name)
+        if match:
+            size = parameter.numel() * parameter.element_size()
+            sizes[match.group(1)] = sizes.get(match.group(1), 0) + size
+    return sizes
+
+
+def model_memory_bytes(model: Any) -> int:
+    """モデルの重みとバッファの合計バイト数を返す。"""
+    tensors = [*model.parameters(), *model.buffers()]
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+class AdapterRegistry:
+    """
+    既定のモデル (PeftModel) に追加したアダプタの名前と、peft 上のアダプタ名の対応。
+    名前 "" は既定のモデルのアダプタを表す。
+
+    Args:
+        model: 既定のモデルのアダプタを読み込んだ peft.PeftModel
+        default_adapter: 既定のモデルの peft 上のアダプタ名 (unsloth では "default")
+        paths: 追加したアダプタの {名前: パス}
+    """
+
+    def __init__(self, model: Any, default_adapter: str, paths: dict[str, str]):
+        self.model = model
+        self.default_adapter = default_adapter
+        self.paths = dict(paths)
+
+    @classmethod
+    def attach(cls, model: Any, default_path: str, paths: dict[str, str]) -> "AdapterRegistry":
+        """
+        既定のモデルに paths のアダプタを追加で読み込む。
+
+        Raises:
+            ValueError: 既定のモデルが LoRA アダプタでない場合 (マージ済み・量子化済みなど) や、
+                ベースモデルが異なる場合。
+        """
+        from peft import PeftModel
+
+        if not isinstance(model, PeftModel):
+            raise ValueError(
+                "Multi-adapter serving needs the default model to be loaded as a LoRA adapter."
+            )
+        base = check_same_base([default_path, *paths.values()])
+        default_adapter = model.active_adapter
+        for name, path in paths.items():
+            # memory_bytes のキーと重なる名前は使えない
+            if name in (default_adapter, "base", "default"):
+                raise ValueError(f"Adapter name {name!r} is reserved.")
+            model.load_adapter(path, adapter_name=name, is_trainable=False)
+        model.set_adapter(default_adapter)
+        registry = cls(model, default_adapter, paths)
+        logger.info(f"Loaded {len(paths)} adapter(s) on {base}: {registry.memory_summary()}")
+        return registry
+
+    @property
+    def names(self) -> list[str]:
+        return list(self.paths)
+
+    def peft_name(self, name: str) -> str:
+        """
+        リクエストのアダプタ名を、peft 上のアダプタ名にする。
+
+        Raises:
+            ValueError: 読み込んでいないアダプタの場合。
+        """
+        if not name:
+            return self.default_adapter
+        if name not in self.paths:
+            raise ValueError(f"Unknown model: {name!r} (available: {', '.join(self.paths)})")
+        return name
+
+    def memory_bytes(self) -> dict[str, int]:
+        """
+        {"base": ベースの重み, "default": 既定のアダプタ, <名前>: 追加したアダプタ} のバイト数。
+        """
+        per_adapter = adapter_memory_bytes(self.model)
+        memory = {"base": model_memory_bytes(self.model) - sum(per_adapter.values())}
+        memory["default"] = per_adapter.get(self.default_adapter, 0)
+        for name in self.paths:
+            memory[name] = per_adapter.get(name, 0)
+        return memory
+
+    def memory_summary(self) -> str:
+        return ", ".join(
+            f"{name}={size / 1024**2:.1f}MiB" for name, size in self.memory_bytes().items()
+        )
@@ -1,14 +1,75 @@
 from pathlib import Path
 import subprocess
+from typing import TYPE_CHECKING
 
 from loguru import logger
-import mido
-from pydub import AudioSegment
 
+# mido / pydub は import が重いため、利用するメソッド内で遅延 import する
+if TYPE_CHECKING:
+    import mido
+
+
+def build_midi_file(
+    notes: list[dict[str, int]],
+    program: int = 1,
+    ticks_per_beat: int = 480,
+    tempo: int = 500000,
+    markers: list[tuple[int, str]] | None = None,
+    track_name: str | None = None,
+) -> "mido.MidiFile":
+    """
+    ノート情報のリストからメモリ上に MIDI ファイル (SMF type 0) を組み立てます。
+
+    Args:
+        notes: ノート情報を格納した辞書のリスト。
+            - 'note' (int): MIDIノート番号。必須。
+            - 'duration' (int): 音の長さ (tick単位)。必須。
+            - 'velocity' (int, optional): 音の強さ (0-127)。デフォルトは64。
+            - 'wait' (int, optional): 次のノートの開始までの時間 (tick単位)。
+              省略時は duration (前のノートが終わってから次のノートを鳴らす)。
+        program: 楽器のプログラム番号。
+        ticks_per_beat: 4分音符あたりの tick 数。
+        tempo: 4分音符あたりのマイクロ秒数。
+        markers: (tick, テキスト) のリスト。コード名などをマーカーとして埋め込む。
+        track_name: トラック名。
+
+    Returns:
+        mido.MidiFile。`save(file=...)` でファイルやバッファに書き出せます。
+    """
+    import mido
+
+    # 絶対時刻のイベント列を作り、同時刻では note_off を note_on より先に並べる
+    events: list[tuple[int, int, mido.Message | mido.MetaMessage]] = []
+    for tick, text in markers or []:
+        events.append((tick, 0, mido.MetaMessage("marker", text=text)))
+    current = 0
+    for note_info in notes:
+        note = min(max(note_info["note"], 0), 127)
+        velocity = min(max(note_info.get("velocity", 64), 0), 127)
+        duration = max(note_info["duration"], 0)
+        events.append((current, 2, mido.Message("note_on", note=note, velocity=velocity)))
+        events.append(
+            (current + duration, 1, mido.Message("note_off", note=note, velocity=velocity))
+        )
+        current += max(note_info.get("wait", duration), 0)
+    events.sort(key=lambda event: (event[0], event[1]))
+
+    mid = mido.MidiFile(type=0, ticks_per_beat=ticks_per_beat)
+    track = mido.MidiTrack()
+    mid.tracks.append(track)
+    if track_name:
+        track.append(mido.MetaMessage("track_name", name=track_name, time=0))
+    track.append(mido.MetaMessage("set_tempo", tempo=tempo, time=0))
+    track.append(mido.Message("program_change", program=program, time=0))
+    previous = 0
+    for tick, _, message in events:
+        track.append(message.copy(time=tick - previous))
+        previous = tick
+    track.append(mido.MetaMessage("end_of_track", time=0))
+    return mid
 
-class AudioUtility:
-    # __init__ と create_midi_file は変更なし
 
+class AudioUtility:
     def __init__(self, soundfont_path: str | Path):
         """AudioUtilityのインスタンスを初期化します。"""
         self.soundfont = Path(soundfont_path)
@@ -29,39 +90,20 @@ class AudioUtility:
                 - 'note' (int): MIDIノート番号 (例: 60 = C4)。必須。
                 - 'duration' (int): 音の長さ (tick単位)。必須。
                 - 'velocity' (int, optional): 音の強さ (0-127)。デフォルトは64。
+                - 'wait' (int, optional): 次のノートの開始までの時間 (tick単位)。
+                  省略時は duration。
             output_path: 出力MIDIファイルのパス。
             program: 使用する楽器のプログラム番号 (デフォルト: 1, ピアノ)。
 
         Returns:
             作成されたMIDIファイルのパス。
         """
-        # (このメソッドの実装は変更なし)
         output_path = Path(output_path)
         if output_path.is_file():
             logger.warning(f"ファイルが既に存在するため上書きします: '{output_path}'")
 
         output_path.parent.mkdir(parents=True, exist_ok=True)
-        mid = mido.MidiFile()
-        track = mido.MidiTrack()
-        mid.tracks.append(track)
-        track.append(mido.Message("program_change", program=program, time=0))
-        for note_info in notes:
-            track.append(
-                mido.Message(
-                    "note_on",
-                    note=note_info["note"],
-                    velocity=note_info.get("velocity", 64),
-                    time=0,
-                )
-            )
-            track.append(
-                mido.Message(
-                    "note_off",
-                    note=note_info["note"],
-                    velocity=note_info.get("velocity", 64),
-                    time=note_info["duration"],
-                )
-            )
+        mid = build_midi_file(notes, program=program)
         mid.save(str(output_path))
 
         if not output_path.is_file():
@@ -132,6 +174,8 @@ class AudioUtility:
         if output_path.is_file():
             logger.warning(f"ファイルが既に存在するため上書きします: '{output_path}'")
 
+        from pydub import AudioSegment
+
         sound = AudioSegment.from_wav(wav_path)
         if volume_change_db != 0.0:
             sound += volume_change_db
@@ -0,0 +1,145 @@
+"""
+小節ごとの生成結果 (モデルの出力テキスト) を、プロンプトなどのハッシュをキーに保存する。
+A bar-level result store keyed by a hash of everything that determines a bar's output.
+
+k 小節目の出力は、プロンプト・プロセッサの設定 (コード・抑制レシオ・軽量モード)・
+シード・生成パラメータ・モデルだけで決まる (サンプリングはリクエストごとの
+torch.Generator で行うため)。そこでこれらのハッシュをキーに出力テキストを保存しておき、
+別のリクエストや評価の実行でも、同じプロンプトになる小節は生成せずに再利用する。
+
+小節は前の小節の出力をプロンプトに含めて順に生成するため、最初に異なる小節より前は
+すべて再利用でき、そこから先だけを生成することになる。
+
+保存先はメモリの LRU と、任意でディレクトリ (<directory>/<key[:2]>/<key>.txt)。
+ディレクトリは複数のプロセス (uvicorn --workers N、評価スクリプト) で共有できる。
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+from pathlib import Path
+import tempfile
+import threading
+
+
+def model_fingerprint(model_name: str) -> str:
+    """
+    モデルを識別する文字列を返す。ローカルディレクトリの場合は、中のファイルの名前・サイズ・
+    更新時刻も含めるため、同じパスでアダプタを差し替えると値が変わる。
+    """
+    digest = hashlib.sha256(model_name.encode())
+    path = Path(model_name)
+    if path.is_dir():
+        for file in sorted(p for p in path.rglob("*") if p.is_file()):
+            stat = file.stat()
+            digest.update(f"{file.relative_to(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()[:16]
+
+
+def bar_key(
+    prompt: str,
+    chord: str,
+    supress_token_prob_ratio: float,
+    seed: int,
+    model_fingerprint: str,
+    max_new_tokens: int = 128,
+    temperature: float = 0.75,
+    lightweight_processor: bool = False,
+) -> str:
+    """1小節の出力を決めるすべての値のハッシュ。"""
+    payload = json.dumps(
+        [
+            prompt,
+            chord,
+            supress_token_prob_ratio,
+            seed,
+            model_fingerprint,
+            max_new_tokens,
+            temperature,
+            lightweight_processor,
+        ],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class BarStore:
+    """
+    小節ごとの出力テキストの保存先。スレッドセーフ。
+
+    Args:
+        max_entries: メモリに保持する件数の上限。0 の場合はメモリには保持しない。
+        directory: 指定した場合、ディレクトリにも保存し、メモリになければそこから読む。
+    """
+
+    def __init__(self, max_entries: int = 4096, directory: str | Path | None = None):
+        self.max_entries = max_entries
+        self.directory = Path(directory) if directory else None
+        self._entries: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls) -> "BarStore | None":
+        """
+        環境変数から設定を読み込む。メモリ・ディレクトリのどちらも無効なら None。
+
+        環境変数:
+            BAR_CACHE_SIZE: メモリに保持する件数 (既定: 4096)
+            BAR_CACHE_DIR: 保存先のディレクトリ (既定: なし)
+        """
+        max_entries = int(os.getenv("BAR_CACHE_SIZE", "4096"))
+        directory = os.getenv("BAR_CACHE_DIR") or None
+        if max_entries <= 0 and directory is None:
+            return None
+        return cls(max_entries, directory)
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.txt"
+
+    def _remember(self, key: str, text: str) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = text
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            text = self._entries.get(key)
+            if text is not None:
+                self._entries.move_to_end(key)
+        if text is None and self.directory is not None:
+            try:
+                text = self._path(key).read_text(encoding="utf-8")
+            except FileNotFoundError:
+                pass
+            else:
+                self._remember(key, text)
+        with self._lock:
+            if text is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return text
+
+    def put(self, key: str, text: str) -> None:
+        self._remember(key, text)
+        if self.directory is None:
+            return
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # 他のプロセスが書きかけのファイルを読まないよう、一時ファイルから置き換える
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", dir=path.parent, suffix=".tmp", delete=False
+        ) as f:
+            f.write(text)
+        os.replace(f.name, path)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
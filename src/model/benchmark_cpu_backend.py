@@ -0,0 +1,150 @@
+"""
+CPU の推論バックエンド (bf16 / int8 動的量子化) ごとに、1小節の生成時間と出力を比べる。
+Compare per-bar latency and note output of the CPU inference backends (bf16 vs int8).
+
+API と同じく前の小節のノートをプロンプトに含めて全小節を順に生成し、読み込み時間・
+1小節あたりの時間・プリフィル / デコードの内訳・出力のノート数とスケール内の割合を記録する。
+
+実行例:
+    python -m src.model.benchmark_cpu_backend models/production.pth/ \\
+        --backends cpu-bf16 cpu-int8 --output_path cpu_backend_benchmark.csv
+"""
+
+import csv
+from dataclasses import asdict, dataclass, fields
+from pathlib import Path
+import time
+
+from loguru import logger
+from src.model.cpu_backend import (
+    CompatibilityReport,
+    check_processor_compatibility,
+    validate_backend,
+)
+from src.model.prompt_context import build_bar_prompt, split_progression
+from tap import Tap
+
+# torch / transformers は import が重いため、利用箇所で遅延 import する
+
+
+class Args(Tap):
+    """CPU バックエンドのベンチマーク設定。"""
+
+    model_path: str  # モデルのパス (アダプタ・int8 エクスポートのディレクトリ、または Hub)
+    backends: list[str] = ["cpu-bf16", "cpu-int8"]  # 比較するバックエンド
+    chord_progression: str = "Dm7 - G7 - Cmaj7 - A7"
+    seeds: list[int] = [1, 42]  # バリエーション (シード) ごとに全小節を生成する
+    num_threads: int | None = None  # 既定は CPU_NUM_THREADS またはこのプロセスの CPU 数
+    output_path: Path | None = None  # 結果を CSV で保存する
+
+    def configure(self):
+        self.add_argument("model_path")
+
+
+@dataclass
+class BackendRow:
+    """1つのバックエンドの計測結果。時間は秒。"""
+
+    backend: str
+    load_sec: float
+    bars: int
+    bar_sec: float  # 1小節あたりの生成時間 (平均)
+    prefill_sec: float  # 1小節あたりのプリフィル時間 (平均)
+    tokens_per_sec: float  # デコードのスループット
+    note_lines: int  # 全小節で出力されたノート行の数
+    in_scale_ratio: float  # ノートのうち、その小節のコードのスケール内の割合
+    compatible: bool  # 互換性チェック (check_processor_compatibility) の結果
+
+
+def run_bars(model, tokenizer, note_helper, device, chord_progression: str, seed: int) -> dict:
+    """API と同じ手順で全小節を生成し、計測値の合計を返す。"""
+    from src.model.generation_stats import GenerationStats
+    from src.model.melody_processor import MelodyControlLogitsProcessor
+    from src.model.utils import generate_midi_from_model
+
+    totals = {"bar_sec": 0.0, "prefill_sec": 0.0, "decode_sec": 0.0, "new_tokens": 0}
+    notes = {"note_lines": 0, "in_scale_notes": 0}
+    prev_bar_notes = ""
+    for bar_index, chord in enumerate(split_progression(chord_progression)):
+        prompt = build_bar_prompt(
+            chord_progression, bar_index, "JAZZ風", prev_bar_notes, "Alto Saxophone"
+        )
+        processor = MelodyControlLogitsProcessor(chord, note_helper)
+        stats = GenerationStats()
+        started_at = time.perf_counter()
+        text = generate_midi_from_model(
+            model, tokenizer, device, prompt, processor, seed=seed, stats=stats
+        )
+        totals["bar_sec"] += time.perf_counter() - started_at
+        totals["prefill_sec"] += stats.prefill_sec
+        totals["decode_sec"] += stats.decode_sec
+        totals["new_tokens"] += stats.new_tokens
+        report = CompatibilityReport.from_output(text, processor, note_helper)
+        notes["note_lines"] += report.note_lines
+        notes["in_scale_notes"] += report.in_scale_notes
+        prev_bar_notes = " ".join(line.split()[0] for line in report.note_texts[:5])
+    return {**totals, **notes}
+
+
+def _ratio(numerator: float, denominator: float) -> float:
+    return numerator / denominator if denominator else 0.0
+
+
+def benchmark_backend(model_path: str, backend: str, args: Args) -> BackendRow:
+    from src.model.utils import load_model_and_tokenizer
+
+    started_at = time.perf_counter()
+    model, tokenizer, note_helper, device = load_model_and_tokenizer(
+        model_path, backend=backend, num_threads=args.num_threads
+    )
+    # cpu-int8 の読み込み時間には、読み込み時の互換性チェックの1小節も含まれる
+    load_sec = time.perf_counter() - started_at
+    compatible = check_processor_compatibility(model, tokenizer, note_helper, device).ok
+
+    results = [
+        run_bars(model, tokenizer, note_helper, device, args.chord_progression, seed)
+        for seed in args.seeds
+    ]
+    total = {key: sum(result[key] for result in results) for key in results[0]}
+    bars = len(split_progression(args.chord_progression)) * len(args.seeds)
+    return BackendRow(
+        backend=backend,
+        load_sec=load_sec,
+        bars=bars,
+        bar_sec=total["bar_sec"] / bars,
+        prefill_sec=total["prefill_sec"] / bars,
+        tokens_per_sec=_ratio(total["new_tokens"], total["decode_sec"]),
+        note_lines=total["note_lines"],
+        in_scale_ratio=_ratio(total["in_scale_notes"], total["note_lines"]),
+        compatible=compatible,
+    )
+
+
+def main():
+    args = Args(description="CPU の推論バックエンドのベンチマーク").parse_args()
+    for backend in args.backends:
+        validate_backend(backend)
+
+    rows = []
+    for backend in args.backends:
+        row = benchmark_backend(args.model_path, backend, args)
+        rows.append(row)
+        speedup = _ratio(rows[0].bar_sec, row.bar_sec)
+        logger.info(
+            f"{row.backend:<9} load={row.load_sec:.1f}s bar={row.bar_sec * 1000:.0f}ms "
+            f"(x{speedup:.2f} vs {rows[0].backend}) prefill={row.prefill_sec * 1000:.0f}ms "
+            f"decode={row.tokens_per_sec:.1f} tok/s notes={row.note_lines} "
+            f"in_scale={row.in_scale_ratio:.0%} compatible={row.compatible}"
+        )
+
+    if args.output_path is not None:
+        with open(args.output_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=[field.name for field in fields(BackendRow)])
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(asdict(row))
+        logger.info(f"Saved benchmark results to {args.output_path}")
+
+
+if __name__ == "__main__":
+    main()
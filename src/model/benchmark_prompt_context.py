@@ -0,0 +1,163 @@
+"""
+コンテキストポリシーごとに、コード進行の長さとプリフィル (トークン数・時間) の関係を測る。
+Benchmark prefill tokens and latency vs. progression length for each prompt context policy.
+
+各小節のプロンプトだけを入力し、1トークンだけ生成してプリフィル時間を計測する
+(前の小節のノートは固定値)。`--tokens_only` の場合はトークナイザーだけを読み込み、
+GPU なしでプロンプトのトークン数だけを数える。
+
+実行例:
+    python -m src.model.benchmark_prompt_context models/production.pth/ \\
+        --policies full window=2 --bars 4 8 16 32 64 --output_path bench.csv
+"""
+
+from collections.abc import Callable
+import csv
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+from loguru import logger
+from src.model.prompt_context import ContextPolicy, build_bar_prompt, split_progression
+from tap import Tap
+
+# torch / transformers / unsloth は import が重いため、利用箇所で遅延 import する
+
+# プロンプトの長さを実際の生成時と同程度にするための、前の小節のノート
+PREV_BAR_NOTES = "62 65 69 72 71"
+
+
+class Args(Tap):
+    """コンテキストポリシーのプリフィルのベンチマーク設定。"""
+
+    model_path: str  # モデルのパス (ローカルの Unsloth モデル、または Hugging Face Hub)
+    policies: list[str] = ["full", "window=2"]  # 比較するポリシー (PROMPT_CONTEXT と同じ書式)
+    bars: list[int] = [4, 8, 16, 32, 64]  # 計測するコード進行の長さ
+    base_progression: str = "Dm7 - G7 - Cmaj7 - A7 - Dm7 - G7 - Em7 - A7"  # 繰り返して使う
+    style: str = "JAZZ風"
+    instrument: str = "Alto Saxophone"
+    tokens_only: bool = False  # モデルを読み込まず、トークン数だけを数える
+    disable_unsloth: bool = False
+    output_path: Path | None = None  # 結果を CSV で保存する
+
+    def configure(self):
+        self.add_argument("model_path")
+
+
+@dataclass
+class BenchmarkRow:
+    """1つのポリシー・長さの計測結果。プリフィル時間は tokens_only の場合 0。"""
+
+    policy: str
+    bars: int
+    total_prompt_tokens: int
+    max_prompt_tokens: int
+    total_prefill_sec: float = 0.0
+
+    @property
+    def prefill_sec_per_bar(self) -> float:
+        return self.total_prefill_sec / self.bars
+
+
+def repeat_progression(base_progression: str, bars: int) -> str:
+    """base_progression を繰り返して、bars 小節のコード進行を作る。"""
+    base = split_progression(base_progression)
+    return " - ".join(base[i % len(base)] for i in range(bars))
+
+
+def bar_prompts(progression: str, policy: ContextPolicy, style: str, instrument: str) -> list[str]:
+    return [
+        build_bar_prompt(progression, i, style, PREV_BAR_NOTES, instrument, policy)
+        for i in range(len(split_progression(progression)))
+    ]
+
+
+def measure(
+    progression: str,
+    policy: ContextPolicy,
+    count_tokens: Callable[[str], int],
+    prefill: Callable[[str, str], float] | None = None,
+    style: str = "JAZZ風",
+    instrument: str = "Alto Saxophone",
+) -> BenchmarkRow:
+    """
+    コード進行の全小節のプロンプトについて、トークン数と (prefill があれば) プリフィル時間を測る。
+    prefill はプロンプトとその小節のコードを受け取り、プリフィル時間 (秒) を返す関数。
+    """
+    chords = split_progression(progression)
+    prompts = bar_prompts(progression, policy, style, instrument)
+    tokens = [count_tokens(prompt) for prompt in prompts]
+    prefill_sec = 0.0
+    if prefill is not None:
+        prefill_sec = sum(
+            prefill(prompt, chord) for prompt, chord in zip(prompts, chords, strict=True)
+        )
+    return BenchmarkRow(str(policy), len(chords), sum(tokens), max(tokens), prefill_sec)
+
+
+def _model_prefill(model_path: str, disable_unsloth: bool):
+    """モデルを読み込み、(トークン数を数える関数, プリフィル時間を測る関数) を返す。"""
+    from src.model.generation_stats import GenerationStats
+    from src.model.melody_processor import MelodyControlLogitsProcessor
+    from src.model.utils import generate_midi_from_model, load_model_and_tokenizer
+
+    model, tokenizer, note_helper, device = load_model_and_tokenizer(
+        model_path, disable_unsloth=disable_unsloth
+    )
+
+    def count_tokens(prompt: str) -> int:
+        return len(tokenizer(prompt)["input_ids"])
+
+    def prefill(prompt: str, chord: str) -> float:
+        stats = GenerationStats()
+        processor = MelodyControlLogitsProcessor(chord, note_helper)
+        generate_midi_from_model(
+            model, tokenizer, device, prompt, processor, seed=1, max_new_tokens=1, stats=stats
+        )
+        return stats.prefill_sec
+
+    # 最初の呼び出しは CUDA の初期化などを含むため、計測から外す
+    prefill(build_bar_prompt("C", 0, "JAZZ風", "", "Alto Saxophone"), "C")
+    return count_tokens, prefill
+
+
+def main():
+    args = Args(description="プロンプトのコンテキストポリシーのベンチマーク").parse_args()
+    policies = [ContextPolicy.parse(spec) for spec in args.policies]
+
+    if args.tokens_only:
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(args.model_path)
+
+        def count_tokens(prompt: str) -> int:
+            return len(tokenizer(prompt)["input_ids"])
+
+        prefill = None
+    else:
+        count_tokens, prefill = _model_prefill(args.model_path, args.disable_unsloth)
+
+    rows = []
+    for bars in args.bars:
+        progression = repeat_progression(args.base_progression, bars)
+        for policy in policies:
+            row = measure(progression, policy, count_tokens, prefill, args.style, args.instrument)
+            rows.append(row)
+            logger.info(
+                f"{row.policy:<40} bars={row.bars:>3} "
+                f"prompt_tokens={row.total_prompt_tokens:>6} (max {row.max_prompt_tokens:>4}) "
+                f"prefill={row.total_prefill_sec:.3f}s "
+                f"({row.prefill_sec_per_bar * 1000:.1f} ms/bar)"
+            )
+
+    if args.output_path is not None:
+        with open(args.output_path, "w", newline="") as f:
+            fieldnames = [*BenchmarkRow.__dataclass_fields__, "prefill_sec_per_bar"]
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            for row in rows:
+                writer.writerow({**asdict(row), "prefill_sec_per_bar": row.prefill_sec_per_bar})
+        logger.info(f"Saved benchmark results to {args.output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+投機的デコードのドラフトと提案数ごとに、受理率と1小節あたりの生成時間の短縮を測る。
+Benchmark acceptance rate and per-bar speedup of speculative decoding drafts.
+
+API と同じく前の小節のノートをプロンプトに含めて全小節を順に生成する。ドラフトなしの
+結果を基準に、1小節あたりの時間・速度比・受理率・出力が基準と一致した小節の割合を記録する。
+
+実行例:
+    python -m src.model.speculative --output_path models/ngram_draft.json
+    python -m src.model.benchmark_speculative models/production.pth/ \\
+        --drafts ngram:models/ngram_draft.json --num_draft_tokens 2 4 8
+"""
+
+import csv
+from dataclasses import asdict, dataclass, fields
+from pathlib import Path
+import time
+
+from loguru import logger
+from src.model.prompt_context import build_bar_prompt, split_progression
+from tap import Tap
+
+# torch / transformers / unsloth は import が重いため、利用箇所で遅延 import する
+
+
+class Args(Tap):
+    """投機的デコードのベンチマーク設定。"""
+
+    model_path: str  # 本体のモデルのパス
+    drafts: list[str] = ["ngram:models/ngram_draft.json"]  # SPECULATIVE_DRAFT と同じ書式
+    num_draft_tokens: list[int] = [2, 4, 8]  # 1回に提案させるトークン数
+    chord_progressions: list[str] = ["Dm7 - G7 - Cmaj7 - A7", "Am - G - C - F"]
+    seeds: list[int] = [1, 42]
+    backend: str = "auto"  # auto / cpu-bf16 / cpu-int8
+    disable_unsloth: bool = False
+    output_path: Path | None = None  # 結果を CSV で保存する
+
+    def configure(self):
+        self.add_argument("model_path")
+
+
+@dataclass
+class SpeculativeRow:
+    """1つのドラフト・提案数の計測結果。"""
+
+    draft: str
+    num_draft_tokens: int
+    bars: int
+    bar_sec: float  # 1小節あたりの生成時間 (平均)
+    speedup: float  # ドラフトなしに対する速度比
+    acceptance_rate: float  # 提案のうち受理された割合
+    tokens_per_forward: float  # 本体のモデルの forward 1回あたりに出力したトークン数
+    identical_ratio: float  # 出力がドラフトなしと一致した小節の割合
+
+
+@dataclass
+class RunResult:
+    texts: list[str]
+    elapsed_sec: float
+    new_tokens: int
+    draft_tokens: int
+    accepted_draft_tokens: int
+
+
+def run(model, tokenizer, note_helper, device, args: Args, drafter, num_draft_tokens: int):
+    """全コード進行・シードの全小節を生成する。"""
+    from src.model.generation_stats import GenerationStats
+    from src.model.melody_processor import MelodyControlLogitsProcessor
+    from src.model.utils import generate_midi_from_model
+
+    result = RunResult([], 0.0, 0, 0, 0)
+    for progression in args.chord_progressions:
+        for seed in args.seeds:
+            prev_bar_notes = ""
+            for bar_index, chord in enumerate(split_progression(progression)):
+                prompt = build_bar_prompt(
+                    progression, bar_index, "JAZZ風", prev_bar_notes, "Alto Saxophone"
+                )
+                stats = GenerationStats()
+                started_at = time.perf_counter()
+                text = generate_midi_from_model(
+                    model,
+                    tokenizer,
+                    device,
+                    prompt,
+                    MelodyControlLogitsProcessor(chord, note_helper),
+                    seed=seed,
+                    stats=stats,
+                    drafter=drafter,
+                    num_draft_tokens=num_draft_tokens,
+                )
+                result.elapsed_sec += time.perf_counter() - started_at
+                result.texts.append(text)
+                result.new_tokens += stats.new_tokens
+                result.draft_tokens += stats.draft_tokens
+                result.accepted_draft_tokens += stats.accepted_draft_tokens
+                _, _, notes = text.partition("pitch duration wait velocity instrument")
+                pitches = [line.split()[0] for line in notes.splitlines() if line.strip()]
+                prev_bar_notes = " ".join(pitches[:5])
+    return result
+
+
+def summarize(draft: str, num_draft_tokens: int, run_result: RunResult, baseline: RunResult):
+    bars = len(run_result.texts)
+    # 1回の forward で、受理された提案 + プロセッサが選んだ1トークンを出力する
+    forwards = run_result.new_tokens - run_result.accepted_draft_tokens
+    identical = sum(
+        text == base for text, base in zip(run_result.texts, baseline.texts, strict=True)
+    )
+    return SpeculativeRow(
+        draft=draft,
+        num_draft_tokens=num_draft_tokens,
+        bars=bars,
+        bar_sec=run_result.elapsed_sec / bars,
+        speedup=baseline.elapsed_sec / run_result.elapsed_sec if run_result.elapsed_sec else 0.0,
+        acceptance_rate=(
+            run_result.accepted_draft_tokens / run_result.draft_tokens
+            if run_result.draft_tokens
+            else 0.0
+        ),
+        tokens_per_forward=run_result.new_tokens / forwards if forwards else 0.0,
+        identical_ratio=identical / bars,
+    )
+
+
+def main():
+    from src.model.speculative import load_drafter
+    from src.model.utils import load_model_and_tokenizer
+
+    args = Args(description="投機的デコードのベンチマーク").parse_args()
+    model, tokenizer, note_helper, device = load_model_and_tokenizer(
+        args.model_path, disable_unsloth=args.disable_unsloth, backend=args.backend
+    )
+    # 最初の呼び出しは CUDA の初期化などを含むため、基準の計測の前に1回捨てる
+    run(model, tokenizer, note_helper, device, args, None, 0)
+    baseline = run(model, tokenizer, note_helper, device, args, None, 0)
+    rows = [summarize("none", 0, baseline, baseline)]
+    for draft in args.drafts:
+        drafter = load_drafter(draft, device)
+        for num_draft_tokens in args.num_draft_tokens:
+            result = run(model, tokenizer, note_helper, device, args, drafter, num_draft_tokens)
+            rows.append(summarize(draft, num_draft_tokens, result, baseline))
+
+    for row in rows:
+        logger.info(
+            f"{row.draft:<40} k={row.num_draft_tokens} bar={row.bar_sec * 1000:.0f}ms "
+            f"x{row.speedup:.2f} acceptance={row.acceptance_rate:.0%} "
+            f"tokens/forward={row.tokens_per_forward:.2f} identical={row.identical_ratio:.0%}"
+        )
+
+    if args.output_path is not None:
+        with open(args.output_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=[field.name for field in fields(SpeculativeRow)])
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(asdict(row))
+        logger.info(f"Saved benchmark results to {args.output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+起動時のモデル読み込み (LoRA のマージ・量子化) と、マージ済みエクスポートの mmap 読み込みの比較。
+Compare cold-start time of loading the LoRA adapter against the merged fast-load export.
+
+読み込みの方法ごとに新しいプロセスを起動し (spawn)、torch などの import・
+load_model_and_tokenizer・最初の1小節の生成までの時間と、プロセスの最大メモリ使用量を記録する。
+同じプロセスで続けて計測すると、2回目以降は import やベースモデルの読み込みが
+キャッシュされて速く見えるため、1回ごとにプロセスを分ける
+(ファイルのページキャッシュは共有されるので、最初の1回は捨てるか repeats を増やす)。
+
+実行例:
+    python -m src.model.benchmark_startup models/production.pth/ \\
+        --targets models/production.pth/ models/production.merged/ \\
+        --output_path startup_benchmark.csv
+"""
+
+import csv
+from dataclasses import asdict, dataclass, fields
+import multiprocessing
+from pathlib import Path
+import statistics
+import time
+
+from loguru import logger
+from src.model.cpu_backend import validate_backend
+from tap import Tap
+
+# torch / transformers は計測するプロセスの中で import する
+
+
+class Args(Tap):
+    """起動時間のベンチマーク設定。"""
+
+    model_path: str  # 比較の基準 (train_model の出力の LoRA アダプタのディレクトリ)
+    targets: list[str] = []  # 比較する読み込み先 (fast_load のエクスポートなど)
+    backend: str = "auto"  # load_model_and_tokenizer の backend (エクスポートは auto で読む)
+    repeats: int = 3  # 読み込み先ごとの計測回数 (中央値を記録する)
+    chord_progression: str = "Dm7 - G7 - Cmaj7"
+    output_path: Path | None = None  # 結果を CSV で保存する
+
+    def configure(self):
+        self.add_argument("model_path")
+
+
+@dataclass
+class StartupRow:
+    """1つの読み込み先の計測結果 (repeats 回の中央値)。時間は秒。"""
+
+    target: str
+    backend: str
+    import_sec: float  # torch / transformers の import
+    load_sec: float  # load_model_and_tokenizer
+    first_bar_sec: float  # 読み込み後の最初の1小節の生成
+    total_sec: float  # プロセスの起動から最初の1小節まで
+    peak_rss_mb: float  # プロセスの最大メモリ使用量
+
+
+def measure_startup(target: str, backend: str, chord_progression: str, queue) -> None:
+    """新しいプロセスで読み込みと最初の1小節の生成を行い、計測値を queue に入れる。"""
+    import resource
+
+    started_at = time.perf_counter()
+    import torch  # noqa: F401
+    import transformers  # noqa: F401
+
+    imported_at = time.perf_counter()
+    from src.model.cpu_backend import check_processor_compatibility
+    from src.model.utils import load_model_and_tokenizer
+
+    model, tokenizer, note_helper, device = load_model_and_tokenizer(target, backend=backend)
+    loaded_at = time.perf_counter()
+    check_processor_compatibility(
+        model, tokenizer, note_helper, device, chord_progression=chord_progression
+    )
+    finished_at = time.perf_counter()
+    queue.put(
+        {
+            "import_sec": imported_at - started_at,
+            "load_sec": loaded_at - imported_at,
+            "first_bar_sec": finished_at - loaded_at,
+            "total_sec": finished_at - started_at,
+            # Linux の ru_maxrss は KiB
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+    )
+
+
+def benchmark_target(target: str, args: Args) -> StartupRow:
+    # fork では親プロセスの import が引き継がれるため、spawn で毎回まっさらなプロセスを作る
+    context = multiprocessing.get_context("spawn")
+    backend = "auto" if target != args.model_path else args.backend
+    results = []
+    for _ in range(args.repeats):
+        queue = context.Queue()
+        process = context.Process(
+            target=measure_startup, args=(target, backend, args.chord_progression, queue)
+        )
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f"Startup benchmark failed for {target} (exit {process.exitcode})")
+        results.append(queue.get())
+    medians = {key: statistics.median(result[key] for result in results) for key in results[0]}
+    return StartupRow(target=target, backend=backend, **medians)
+
+
+def main():
+    args = Args(description="モデルの起動時間のベンチマーク").parse_args()
+    validate_backend(args.backend)
+
+    rows = []
+    for target in [args.model_path, *args.targets]:
+        row = benchmark_target(target, args)
+        rows.append(row)
+        speedup = rows[0].total_sec / row.total_sec if row.total_sec else 0.0
+        logger.info(
+            f"{row.target} ({row.backend}) total={row.total_sec:.1f}s "
+            f"(x{speedup:.2f} vs {rows[0].target}) import={row.import_sec:.1f}s "
+            f"load={row.load_sec:.1f}s first_bar={row.first_bar_sec:.2f}s "
+            f"peak_rss={row.peak_rss_mb:.0f}MiB"
+        )
+
+    if args.output_path is not None:
+        with open(args.output_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=[field.name for field in fields(StartupRow)])
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(asdict(row))
+        logger.info(f"Saved benchmark results to {args.output_path}")
+
+
+if __name__ == "__main__":
+    main()
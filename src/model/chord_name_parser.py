@@ -119,16 +119,16 @@ CHORD_DEFINITIONS = {
 }
 
 
-def parse_chord_name(chord_name: str) -> dict:
+def split_chord_name(chord_name: str) -> tuple[str, str]:
     """
-    コードネーム文字列を解析し、ルート、構成音、利用可能なスケールを返します。
+    コードネーム文字列をルート音の表記とコード種別に分解します。
 
     Args:
-        chord_name (str): 解析するコードネーム (例: "C", "Dm7", "G7(b9,b13)")
+        chord_name (str): 解析するコードネーム (例: "c#m7", "Dbmaj7", "G7(b9,b13)")
 
     Returns:
-        dict: 解析結果を含む辞書。
-              {'root': int, 'code_tone': list[int], 'scales': dict}
+        tuple[str, str]: (ルート音, コード種別)。ルート音は "C#" や "Db" のように
+            1文字目を大文字、変化記号を小文字にそろえ、コード種別は CHORD_DEFINITIONS のキー。
 
     Raises:
         ValueError: 解析不可能なコードネームが指定された場合。
@@ -144,16 +144,13 @@ def parse_chord_name(chord_name: str) -> dict:
 
     # 1. ルート音を特定する (Find the root note)
     root_note_str = None
-    root_val = -1
 
     # 2文字のルート音から先にチェック (Check for two-character root notes first)
     if len(s) > 1 and s[:2].upper() in NOTE_MAP:
         root_note_str = s[:2]
-        root_val = NOTE_MAP[s[:2].upper()]
     # 1文字のルート音をチェック (Then check for one-character root notes)
-    elif s[0].upper() in NOTE_MAP:
+    elif s and s[0].upper() in NOTE_MAP:
         root_note_str = s[0]
-        root_val = NOTE_MAP[s[0].upper()]
 
     if root_note_str is None:
         raise ValueError(f"Invalid root note found in '{chord_name}'")
@@ -178,15 +175,49 @@ def parse_chord_name(chord_name: str) -> dict:
     if chord_type_str not in CHORD_DEFINITIONS:
         raise ValueError(f"Invalid chord type '{chord_type_str}' in '{chord_name}'")
 
+    return root_note_str[0].upper() + root_note_str[1:].lower(), chord_type_str
+
+
+def parse_chord_name(chord_name: str) -> dict:
+    """
+    コードネーム文字列を解析し、ルート、構成音、利用可能なスケールを返します。
+
+    Args:
+        chord_name (str): 解析するコードネーム (例: "C", "Dm7", "G7(b9,b13)")
+
+    Returns:
+        dict: 解析結果を含む辞書。
+              {'root': int, 'code_tone': list[int], 'scales': dict}
+
+    Raises:
+        ValueError: 解析不可能なコードネームが指定された場合。
+    """
+    root_note_str, chord_type_str = split_chord_name(chord_name)
     chord_info = CHORD_DEFINITIONS[chord_type_str]
 
     return {
-        "root": root_val,
+        "root": NOTE_MAP[root_note_str.upper()],
         "code_tone": chord_info["code_tone"],
         "scales": chord_info["scales"],
     }
 
 
+def canonical_chord_name(chord_name: str) -> str:
+    """
+    コードネームを正規の表記に直します (例: "dbmaj7" -> "DbM7", " c# min" -> "C#m")。
+    ルート音の # / b の綴りやテンションの書き方 (G7b9 / G7(b9)) は変えません。
+
+    Raises:
+        ValueError: 解析不可能なコードネームが指定された場合。
+    """
+    root_note_str, chord_type_str = split_chord_name(chord_name)
+    suffix = chord_name.replace(" ", "")[len(root_note_str) :]
+    # maj7 / min / minor などの別名だけをそろえる
+    if chord_type_str in ("M7", "m"):
+        suffix = chord_type_str
+    return root_note_str + suffix
+
+
 # --- 使用例 (Example Usage) ---
 if __name__ == "__main__":
     test_chords = [
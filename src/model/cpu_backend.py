@@ -0,0 +1,174 @@
+"""
+CPU だけのノード向けの推論バックエンド (int8 動的量子化・スレッド設定・互換性チェック)。
+CPU inference backend: int8 dynamic quantization, thread settings and a processor check.
+
+Unsloth の 4-bit 読み込みは GPU が必要なため、CPU では bf16 の AutoModelForCausalLM に
+フォールバックしていた。AMX / AVX512-BF16 のない CPU では bf16 の行列積は遅く、
+batch=1 のデコードは重みの読み出し量で律速されるため、CPU では int8 の重みが有利になる。
+
+バックエンド (load_model_and_tokenizer の backend / 環境変数 MODEL_BACKEND):
+    auto:     これまでどおり (ローカルディレクトリは Unsloth 4-bit、それ以外は bf16)
+    cpu-bf16: CPU で bf16 (これまでの CPU でのフォールバックと同じ。比較用)
+    cpu-int8: CPU で fp32 で読み込み、nn.Linear を int8 の動的量子化 (重みは int8、
+              活性化は実行時に量子化) に置き換える。LoRA アダプタはマージしてから量子化する
+
+量子化済みのモデルは src.model.fast_load (--quantization int8) でエクスポートでき、
+そのディレクトリを auto / cpu-int8 で読み込むと、ベースモデルの読み込み・マージ・量子化を省ける。
+"""
+
+import contextlib
+from dataclasses import dataclass
+import os
+from pathlib import Path
+import re
+from typing import Any
+
+from loguru import logger
+
+# torch / transformers / peft は import が重いため、利用箇所で遅延 import する
+
+BACKENDS = ("auto", "cpu-bf16", "cpu-int8")
+# 互換性チェックで生成するコード進行 (最後の小節を生成する)
+CHECK_PROGRESSION = "Dm7 - G7 - Cmaj7"
+
+_NOTE_LINE = re.compile(r"^\s*(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+\S+\s*$")
+
+
+def validate_backend(backend: str) -> str:
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown model backend: {backend!r} (choose from {', '.join(BACKENDS)})")
+    return backend
+
+
+def default_num_threads(lanes: int = 1) -> int:
+    """
+    推論に使うスレッド数。CPU_NUM_THREADS があればそれを、なければこのプロセスが使える
+    CPU 数 (コンテナの cpuset を反映する) を推論レーン数で割った値を使う。
+    """
+    if value := os.getenv("CPU_NUM_THREADS"):
+        return max(int(value), 1)
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    return max(cpus // max(lanes, 1), 1)
+
+
+def configure_threads(num_threads: int | None = None, lanes: int = 1) -> int:
+    """
+    torch のスレッド数を設定し、設定した値を返す。演算内の並列 (intra-op) だけを使い、
+    batch=1 のデコードでは効果のない演算間の並列 (inter-op) は1スレッドにする。
+    """
+    import torch
+
+    num_threads = num_threads or default_num_threads(lanes)
+    torch.set_num_threads(num_threads)
+    # 既に並列処理が始まった後は変更できない (2回目の読み込みなど)
+    with contextlib.suppress(RuntimeError):
+        torch.set_num_interop_threads(1)
+    return num_threads
+
+
+def quantize_int8(model: Any) -> Any:
+    """fp32 のモデルの nn.Linear を int8 の動的量子化に置き換える。"""
+    import torch
+
+    return torch.ao.quantization.quantize_dynamic(
+        model.float().eval(), {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def _load_fp32(model_path: str) -> Any:
+    """fp32 で読み込む。LoRA アダプタのディレクトリの場合はベースモデルにマージする。"""
+    import torch
+
+    if (Path(model_path) / "adapter_config.json").is_file():
+        from peft import AutoPeftModelForCausalLM
+
+        model = AutoPeftModelForCausalLM.from_pretrained(model_path, torch_dtype=torch.float32)
+        return model.merge_and_unload()
+    from transformers import AutoModelForCausalLM
+
+    return AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=torch.float32)
+
+
+def load_cpu_model(model_path: str, backend: str) -> Any:
+    """backend (cpu-bf16 / cpu-int8) に従って、CPU で推論するモデルを読み込む。"""
+    import torch
+
+    if backend == "cpu-bf16":
+        from transformers import AutoModelForCausalLM
+
+        return AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=torch.bfloat16)
+    logger.info("Quantizing model to int8 (dynamic)...")
+    return quantize_int8(_load_fp32(model_path))
+
+
+@dataclass
+class CompatibilityReport:
+    """生成した小節の出力が、ノート行として読めてプロセッサが効いているかの結果。"""
+
+    note_texts: list[str]  # 出力のノート行 ("pitch duration wait velocity instrument")
+    in_scale_notes: int
+    processor_steps: int
+    processor_interventions: int
+
+    @classmethod
+    def from_output(
+        cls, text: str, processor: Any, note_tokenizer_helper: Any
+    ) -> "CompatibilityReport":
+        """生成結果のテキストと、生成に使った MelodyControlLogitsProcessor から作る。"""
+        _, _, notes = text.partition("pitch duration wait velocity instrument")
+        note_texts = [line.strip() for line in notes.splitlines() if _NOTE_LINE.match(line)]
+        allowed_pitch_classes = {
+            pitch % 12
+            for pitch in range(128)
+            if note_tokenizer_helper.pitch_to_token_id(pitch) in processor.allowed_token_ids
+        }
+        return cls(
+            note_texts=note_texts,
+            in_scale_notes=sum(
+                int(line.split()[0]) % 12 in allowed_pitch_classes for line in note_texts
+            ),
+            processor_steps=processor.steps,
+            processor_interventions=processor.interventions,
+        )
+
+    @property
+    def note_lines(self) -> int:
+        return len(self.note_texts)
+
+    @property
+    def in_scale_ratio(self) -> float:
+        return self.in_scale_notes / self.note_lines if self.note_lines else 0.0
+
+    @property
+    def ok(self) -> bool:
+        """ノート行を出力し、プロセッサがこのモデルの logits に対して確率を操作したこと。"""
+        return self.note_lines > 0 and self.processor_interventions > 0
+
+
+def check_processor_compatibility(
+    model: Any,
+    tokenizer: Any,
+    note_tokenizer_helper: Any,
+    device: Any,
+    chord_progression: str = CHECK_PROGRESSION,
+    seed: int = 1,
+    max_new_tokens: int = 64,
+) -> CompatibilityReport:
+    """
+    MelodyControlLogitsProcessor を付けてコード進行の最後の小節を生成し、出力がノート行として
+    読めるか、プロセッサがこのモデルの logits (dtype・語彙サイズ) で動くかを確かめる。
+    """
+    from src.model.melody_processor import MelodyControlLogitsProcessor
+    from src.model.prompt_context import build_bar_prompt, split_progression
+    from src.model.utils import generate_midi_from_model
+
+    chords = split_progression(chord_progression)
+    processor = MelodyControlLogitsProcessor(chords[-1], note_tokenizer_helper)
+    prompt = build_bar_prompt(chord_progression, len(chords) - 1, "JAZZ風", "", "Alto Saxophone")
+    text = generate_midi_from_model(
+        model, tokenizer, device, prompt, processor, seed=seed, max_new_tokens=max_new_tokens
+    )
+    return CompatibilityReport.from_output(text, processor, note_tokenizer_helper)
@@ -0,0 +1,251 @@
+"""
+CPU の物理コアを推論レーンに分け、レーンごとに CPU を固定してスレッド数を割り当てる。
+Partition physical CPU cores into pinned inference lanes, with an auto-tuned lane count.
+
+CPU で複数の /generate を同時に処理すると、それぞれの generate が torch の既定の
+スレッド数 (全コア) で行列積を並列化するため、コア数を大きく超えるスレッドが奪い合い、
+全体のスループットが落ちる。このモジュールはコアを K 個のレーンに分け、推論スレッド
+(InferenceWorker のレーン) が自分の担当のコアだけを使うようにする:
+
+    - 同じ物理コアの論理 CPU (ハイパースレッド) は同じレーンに入れ、コアを連続して割り当てる
+      (同じソケット・L2 を共有するコアがまとまる)
+    - レーンのスレッドを os.sched_setaffinity で担当の CPU に固定し、torch.set_num_threads で
+      担当の物理コア数を設定する。OpenMP のスレッド数はスレッドごとの設定なので、
+      レーンごとに別の値を持てる (OpenMP のワーカーは固定した CPU を引き継ぐ)
+    - 演算間の並列 (inter-op) は cpu_backend.configure_threads と同じく1スレッドのまま
+
+K は tune_lanes で、候補ごとに K 本のレーンで同時に小節を生成してスループット
+(小節/秒) を測り、最大のものを選ぶ (差が tolerance 以内なら、1小節の待ち時間が短い
+小さい K を選ぶ)。
+
+レーン数の指定 (環境変数 CPU_LANES): 空なら使わない、"auto" なら計測して決める、整数ならその数。
+DECODE_MODE=static とは組み合わせられない (静的デコーダは1つの KV キャッシュをロックで
+順番に使うため、レーンを分けても生成は1本ずつしか進まない)。
+"""
+
+import contextlib
+from collections.abc import Callable
+from dataclasses import dataclass, field
+import os
+from pathlib import Path
+import threading
+import time
+
+from loguru import logger
+
+# torch は import が重いため、利用箇所で遅延 import する
+
+_TOPOLOGY_DIR = Path("/sys/devices/system/cpu")
+# 計測で、レーンの数が大きいほうを選ぶのに必要なスループットの向上の割合
+DEFAULT_TOLERANCE = 0.05
+
+
+def validate_lane_spec(spec: str) -> str:
+    """CPU_LANES の値 ("" / "auto" / 正の整数) を確かめる。"""
+    if spec in ("", "auto") or (spec.isdigit() and int(spec) > 0):
+        return spec
+    raise ValueError(f"Invalid CPU_LANES: {spec!r} (use '', 'auto' or a positive integer)")
+
+
+def validate_lane_decode_mode(spec: str, decode_mode: str) -> None:
+    """推論レーンと静的デコード (DECODE_MODE=static) が同時に指定されていないか確かめる。"""
+    if spec and decode_mode == "static":
+        raise ValueError(
+            "CPU_LANES cannot be combined with DECODE_MODE=static: the static decoder serializes "
+            "generation, so the lanes would run one at a time"
+        )
+
+
+def available_cpus() -> list[int]:
+    """このプロセスが使える CPU の番号 (コンテナの cpuset を反映する)。"""
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def read_core_ids(cpus: list[int], topology_dir: Path = _TOPOLOGY_DIR) -> dict[int, tuple]:
+    """
+    CPU ごとの物理コアの識別子 (ソケット, コア) を返す。
+    sysfs のトポロジーが読めない CPU は、それぞれを1つのコアとみなす。
+    """
+    core_ids = {}
+    for cpu in cpus:
+        topology = topology_dir / f"cpu{cpu}" / "topology"
+        try:
+            package = int((topology / "physical_package_id").read_text())
+            core = int((topology / "core_id").read_text())
+        except (OSError, ValueError):
+            core_ids[cpu] = ("cpu", cpu)
+            continue
+        core_ids[cpu] = (package, core)
+    return core_ids
+
+
+def group_physical_cores(cpus: list[int], core_ids: dict[int, tuple]) -> list[list[int]]:
+    """CPU を物理コアごとにまとめる。コアは最小の CPU 番号の順に並べる。"""
+    cores: dict[tuple, list[int]] = {}
+    for cpu in sorted(cpus):
+        cores.setdefault(core_ids[cpu], []).append(cpu)
+    return sorted(cores.values())
+
+
+def partition_cores(cores: list[list[int]], lanes: int) -> list[list[list[int]]]:
+    """
+    物理コアの列を lanes 個に、連続した範囲でできるだけ均等に分ける。
+    コアの数よりレーンが多い場合は、論理 CPU を1つずつのコアとみなして分ける。
+
+    Raises:
+        ValueError: レーンの数が論理 CPU の数を超える場合。
+    """
+    if lanes < 1:
+        raise ValueError(f"lanes must be positive: {lanes}")
+    if lanes > len(cores):
+        cores = [[cpu] for core in cores for cpu in core]
+    if lanes > len(cores):
+        raise ValueError(f"Cannot split {len(cores)} CPU(s) into {lanes} lanes")
+    size, extra = divmod(len(cores), lanes)
+    partitions, start = [], 0
+    for lane in range(lanes):
+        end = start + size + (lane < extra)
+        partitions.append(cores[start:end])
+        start = end
+    return partitions
+
+
+@dataclass
+class LanePlan:
+    """
+    推論レーンへの CPU の割り当て。
+
+    Attributes:
+        cpus: レーンごとの、固定する CPU の番号
+        threads: レーンごとの torch のスレッド数 (担当の物理コア数)
+        throughput: tune_lanes で計測した、レーンの数ごとのスループット (小節/秒)
+    """
+
+    cpus: list[list[int]]
+    threads: list[int]
+    throughput: dict[int, float] = field(default_factory=dict)
+
+    @property
+    def num_lanes(self) -> int:
+        return len(self.cpus)
+
+    def to_dict(self) -> dict:
+        return {
+            "lanes": self.num_lanes,
+            "cpus": self.cpus,
+            "threads": self.threads,
+            # JSON のキーは文字列になるため、あらかじめ文字列にしておく
+            "throughput": {
+                str(lanes): round(value, 3) for lanes, value in self.throughput.items()
+            },
+        }
+
+
+def plan_lanes(
+    lanes: int, cpus: list[int] | None = None, core_ids: dict[int, tuple] | None = None
+) -> LanePlan:
+    """使える CPU を lanes 個のレーンに分けた LanePlan を作る。"""
+    cpus = cpus if cpus is not None else available_cpus()
+    core_ids = core_ids if core_ids is not None else read_core_ids(cpus)
+    partitions = partition_cores(group_physical_cores(cpus, core_ids), lanes)
+    return LanePlan(
+        cpus=[[cpu for core in partition for cpu in core] for partition in partitions],
+        threads=[len(partition) for partition in partitions],
+    )
+
+
+def candidate_lane_counts(num_cores: int) -> list[int]:
+    """計測するレーンの数の候補 (1, 2, 4, ... と物理コア数)。"""
+    candidates, lanes = [], 1
+    while lanes < num_cores:
+        candidates.append(lanes)
+        lanes *= 2
+    return [*candidates, max(num_cores, 1)]
+
+
+def pin_current_thread(cpus: list[int], num_threads: int) -> None:
+    """
+    呼び出したスレッドを cpus に固定し、torch のスレッド数を num_threads にする。
+    CPU の固定ができない環境 (Linux 以外) ではスレッド数だけを設定する。
+    """
+    import torch
+
+    # sched_setaffinity(0) は呼び出したスレッドだけに効く
+    with contextlib.suppress(AttributeError, OSError):
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(num_threads)
+
+
+def measure_throughput(plan: LanePlan, run_bar: Callable[[], object], bars_per_lane: int) -> float:
+    """plan のレーンで同時に bars_per_lane 小節ずつ生成し、全体のスループット (小節/秒) を返す。"""
+    errors: list[BaseException] = []
+    barrier = threading.Barrier(plan.num_lanes + 1)
+
+    def run_lane(lane: int) -> None:
+        try:
+            pin_current_thread(plan.cpus[lane], plan.threads[lane])
+            # 初回の生成 (メモリの確保など) は計測に含めない
+            run_bar()
+        except Exception as e:
+            errors.append(e)
+        barrier.wait()
+        if errors:
+            return
+        try:
+            for _ in range(bars_per_lane):
+                run_bar()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [
+        threading.Thread(target=run_lane, args=(lane,), name=f"lane-tuning-{lane}", daemon=True)
+        for lane in range(plan.num_lanes)
+    ]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    started_at = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started_at
+    if errors:
+        raise errors[0]
+    return plan.num_lanes * bars_per_lane / max(elapsed, 1e-9)
+
+
+def select_lane_count(throughput: dict[int, float], tolerance: float = DEFAULT_TOLERANCE) -> int:
+    """スループットが最大の tolerance 以内に入る、最も小さいレーンの数を返す。"""
+    best = max(throughput.values())
+    return min(lanes for lanes, value in throughput.items() if value >= best * (1 - tolerance))
+
+
+def tune_lanes(
+    run_bar: Callable[[], object],
+    candidates: list[int] | None = None,
+    bars_per_lane: int = 2,
+    tolerance: float = DEFAULT_TOLERANCE,
+    cpus: list[int] | None = None,
+    core_ids: dict[int, tuple] | None = None,
+) -> LanePlan:
+    """
+    レーンの数の候補ごとにスループットを計測し、最も良い LanePlan を返す。
+    run_bar は1小節を生成する関数で、複数のスレッドから同時に呼ばれる。
+    """
+    cpus = cpus if cpus is not None else available_cpus()
+    core_ids = core_ids if core_ids is not None else read_core_ids(cpus)
+    if candidates is None:
+        candidates = candidate_lane_counts(len(group_physical_cores(cpus, core_ids)))
+    plans = {lanes: plan_lanes(lanes, cpus, core_ids) for lanes in candidates}
+    throughput = {}
+    for lanes, plan in plans.items():
+        throughput[lanes] = measure_throughput(plan, run_bar, bars_per_lane)
+        logger.info(
+            f"CPU lanes={lanes} (threads={plan.threads}): {throughput[lanes]:.2f} bars/sec"
+        )
+    selected = plans[select_lane_count(throughput, tolerance)]
+    selected.throughput = throughput
+    logger.info(f"Selected {selected.num_lanes} CPU lane(s): {selected.cpus}")
+    return selected
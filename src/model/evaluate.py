@@ -1,4 +1,3 @@
-import unsloth  # noqa: F401
 import os
 from pathlib import Path
 import re
@@ -7,14 +6,14 @@ import textwrap
 from typing import Any
 
 from loguru import logger
+from src.model.adapters import AdapterRegistry, check_same_base
 from src.model.audio import AudioUtility
-from src.model.melody_processor import MelodyControlLogitsProcessor
+from src.model.bar_store import BarStore, bar_key, model_fingerprint
 from src.model.utils import generate_midi_from_model, load_model_and_tokenizer
 from src.model.visualize import create_pianoroll_image
 from tap import Tap
-from tqdm import tqdm
-import wandb
-import weave
+
+# torch / transformers / weave / wandb は import が重いため、利用箇所で遅延 import する
 
 
 class MelodyGenerator:
@@ -25,12 +24,20 @@ class MelodyGenerator:
         note_tokenizer_helper: Any,
         device: Any,
         soundfont_path: str,
+        bar_store: BarStore | None = None,
+        model_fingerprint: str = "",
+        adapter_name: str | None = None,
     ):
         self.model = model
         self.tokenizer = tokenizer
         self.note_tokenizer_helper = note_tokenizer_helper
         self.device = device
         self.audio_util = AudioUtility(soundfont_path=soundfont_path)
+        # 同じプロンプト・シードの小節は、前回の評価の出力を再利用する
+        self.bar_store = bar_store
+        self.model_fingerprint = model_fingerprint
+        # ベースを共有して読み込んだ場合の peft のアダプタ名 (src.model.adapters)
+        self.adapter_name = adapter_name
 
     def _parse_and_pickup_notes(self, decoded_text: str, head_k: int = 5) -> str:
         """main.pyから移植: 生成されたテキストからノート部分だけを抽出し、次のプロンプトに渡す"""
@@ -95,7 +102,12 @@ class MelodyGenerator:
             return None
 
         utility_notes = [
-            {"note": n["pitch"], "duration": n["duration"], "velocity": n["velocity"]}
+            {
+                "note": n["pitch"],
+                "duration": n["duration"],
+                "wait": n["wait"],
+                "velocity": n["velocity"],
+            }
             for n in parsed_notes
         ]
 
@@ -119,6 +131,30 @@ class MelodyGenerator:
                 os.remove(os.path.join(temp_dir, f))
             os.rmdir(temp_dir)
 
+    def _generate_bar(
+        self,
+        prompt: str,
+        chord: str,
+        processor: Any,
+        supress_token_prob_ratio: float,
+        variation: int,
+    ) -> str:
+        key = bar_key(prompt, chord, supress_token_prob_ratio, variation, self.model_fingerprint)
+        if self.bar_store is not None and (raw_output := self.bar_store.get(key)) is not None:
+            return raw_output
+        raw_output = generate_midi_from_model(
+            self.model,
+            self.tokenizer,
+            self.device,
+            prompt,
+            processor,
+            seed=variation,
+            adapter_name=self.adapter_name,
+        )
+        if self.bar_store is not None:
+            self.bar_store.put(key, raw_output)
+        return raw_output
+
     def run_single_prediction(
         self,
         chord_progression: str,
@@ -127,6 +163,8 @@ class MelodyGenerator:
         supress_token_prob_ratio: float = 0.3,
         instrument: str = "Alto Saxophone",  # main.pyから移植
     ) -> dict[str, Any]:
+        from src.model.melody_processor import MelodyControlLogitsProcessor
+
         logger.info(f"Running prediction for: {style} - {chord_progression} - var{variation}")
         all_notes_text = ""
         allowed_pitches_union = set()
@@ -163,8 +201,8 @@ class MelodyGenerator:
                 if decoded.strip().isdigit():
                     allowed_pitches_union.add(int(decoded.strip()) % 12)
 
-            raw_output = generate_midi_from_model(
-                self.model, self.tokenizer, self.device, prompt, processor, seed=variation
+            raw_output = self._generate_bar(
+                prompt, chord, processor, supress_token_prob_ratio, variation
             )
 
             # ▼▼▼ 【変更点】main.pyのロジックを移植 ▼▼▼
@@ -188,6 +226,8 @@ class MelodyGenerator:
 
         results = {"output_text": all_notes_text.strip(), "scores": metrics}
         if wav_data:
+            import weave
+
             results["audio"] = weave.Audio(wav_data, format="wav")
         if pianoroll_image:
             results["pianoroll"] = pianoroll_image
@@ -200,9 +240,34 @@ class Args(Tap):
     wandb_project: str = "melody-flow-model-manage"
     evaluation_name: str = "default-evaluation"
     soundfont_path: str = "data/raw/FluidR3_GM.sf2"
+    bar_cache_dir: str | None = None  # 小節ごとの生成結果を保存し、次回以降の評価で再利用する
+    # 既定では、同じベースモデルの LoRA アダプタはベースを1回だけ読み込み、アダプタを
+    # 切り替えて評価する。True の場合はモデルごとに読み込み直す
+    separate_models: bool = False
+
+
+def load_shared_base(model_paths: list[str]) -> tuple[tuple, AdapterRegistry] | None:
+    """
+    model_paths がすべて同じベースモデルの LoRA アダプタなら、ベースを1回だけ読み込み、
+    2つ目以降を peft のアダプタ "adapter<i>" として追加する。そうでなければ None を返す。
+    """
+    if len(model_paths) < 2:
+        return None
+    try:
+        check_same_base(model_paths)
+    except ValueError as e:
+        logger.info(f"Loading each model separately: {e}")
+        return None
+    loaded = load_model_and_tokenizer(model_paths[0], disable_unsloth=False)
+    paths = {f"adapter{i}": path for i, path in enumerate(model_paths[1:], start=1)}
+    return loaded, AdapterRegistry.attach(loaded[0], model_paths[0], paths)
 
 
 def main():
+    from tqdm import tqdm
+    import wandb
+    import weave
+
     args = Args().parse_args()
     weave.init(args.wandb_project)
     base_evaluation_set = [
@@ -222,13 +287,19 @@ def main():
         {**case, "variation": var} for case in base_evaluation_set for var in variations
     ]
 
-    for model_path in tqdm(args.model_paths, desc="Evaluating Models"):
+    shared = None if args.separate_models else load_shared_base(args.model_paths)
+    for index, model_path in enumerate(tqdm(args.model_paths, desc="Evaluating Models")):
         model_name_safe = Path(model_path).name
         logger.info(f"--- Evaluating Model: {model_name_safe} ---")
 
-        model, tokenizer, note_helper, device = load_model_and_tokenizer(
-            model_path, disable_unsloth=False
-        )
+        adapter_name = None
+        if shared is not None:
+            (model, tokenizer, note_helper, device), registry = shared
+            adapter_name = registry.peft_name(f"adapter{index}" if index else "")
+        else:
+            model, tokenizer, note_helper, device = load_model_and_tokenizer(
+                model_path, disable_unsloth=False
+            )
 
         if model is None:
             logger.info(f"Skipping model {model_path} due to loading error.")
@@ -240,6 +311,9 @@ def main():
             note_tokenizer_helper=note_helper,
             device=device,
             soundfont_path=args.soundfont_path,
+            bar_store=BarStore(directory=args.bar_cache_dir) if args.bar_cache_dir else None,
+            model_fingerprint=model_fingerprint(model_path),
+            adapter_name=adapter_name,
         )
 
         evaluation_name = f"{args.evaluation_name}-{model_name_safe}"
@@ -0,0 +1,293 @@
+"""
+LoRA をマージし (必要なら量子化まで済ませ) た、推論用の safetensors のエクスポート。
+Merged, inference-ready safetensors export that loads by memory-mapping, without merging.
+
+models/<name>.pth/ (LoRA アダプタ) を Unsloth で読み込むと、起動のたびにベースモデルの
+ダウンロード確認・読み込み・LoRA の適用・4-bit 量子化が走り、コンテナのコールドスタートの
+大半を占める。学習後に一度だけマージ・量子化して保存しておけば、起動時は safetensors を
+mmap して重みを割り当てるだけで済む。
+
+量子化 (--quantization):
+    bf16:     LoRA をマージした bf16 の重み (save_pretrained の model.safetensors)。
+              GPU でも CPU でも読み込める
+    int8:     CPU 向けの int8 動的量子化 (cpu_backend.quantize_int8) 済みの重み。nn.Linear は
+              int8 の重みとスケール、それ以外は fp32 で INT8_WEIGHTS_FILE に保存する
+    bnb-4bit: GPU 向けの bitsandbytes 4-bit (Unsloth の load_in_4bit と同じ nf4) 済みの重み。
+              エクスポートにも読み込みにも CUDA が必要
+
+エクスポートしたディレクトリは load_model_and_tokenizer にそのまま渡せる (EXPORT_CONFIG_FILE で
+判定する)。int8 では量子化後の互換性チェックをエクスポート時に行い、起動時には省く。
+
+実行例:
+    python -m src.model.fast_load models/production.pth/ models/production.merged/ \\
+        --quantization int8
+"""
+
+import json
+from pathlib import Path
+import time
+from typing import Any
+
+from loguru import logger
+from tap import Tap
+
+# torch / transformers / peft / safetensors は import が重いため、利用箇所で遅延 import する
+
+QUANTIZATIONS = ("bf16", "int8", "bnb-4bit")
+# エクスポートの設定 (量子化の種類・元のモデル)。このファイルがあればエクスポートとして読み込む
+EXPORT_CONFIG_FILE = "fast_load.json"
+# int8 の重み (nn.Linear は "<name>.weight" が int8、"<name>.weight_scale" などが量子化パラメータ)
+INT8_WEIGHTS_FILE = "model_int8.safetensors"
+
+
+def validate_quantization(quantization: str) -> str:
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(
+            f"Unknown quantization: {quantization!r} (choose from {', '.join(QUANTIZATIONS)})"
+        )
+    return quantization
+
+
+def read_export_config(model_path: str) -> dict | None:
+    """エクスポートのディレクトリなら設定を、そうでなければ None を返す。"""
+    config_path = Path(model_path) / EXPORT_CONFIG_FILE
+    if not config_path.is_file():
+        return None
+    with open(config_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def is_export(model_path: str) -> bool:
+    return read_export_config(model_path) is not None
+
+
+def export_device(model_path: str) -> str:
+    """エクスポートを読み込むデバイス (int8 は CPU、bnb-4bit は CUDA、bf16 は使える方)。"""
+    import torch
+
+    quantization = read_export_config(model_path)["quantization"]
+    if quantization == "int8":
+        return "cpu"
+    if quantization == "bnb-4bit" and not torch.cuda.is_available():
+        raise RuntimeError(f"{model_path} is a bnb-4bit export and needs a CUDA device.")
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def _quantized_linears(model: Any) -> dict[str, Any]:
+    """int8 動的量子化した nn.Linear を {名前: モジュール} で返す。"""
+    from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+
+    return {
+        name: module
+        for name, module in model.named_modules()
+        if isinstance(module, DynamicQuantizedLinear)
+    }
+
+
+def _int8_tensors(model: Any) -> dict[str, Any]:
+    """int8 動的量子化済みのモデルを、safetensors に保存できるテンソルの辞書にする。"""
+    import torch
+
+    quantized = _quantized_linears(model)
+    # 量子化していない層 (埋め込み・正規化層など) のパラメータとバッファはそのまま保存する
+    tensors = {
+        name: tensor.detach().contiguous()
+        for name, tensor in [*model.named_parameters(), *model.named_buffers()]
+    }
+    for name, module in quantized.items():
+        weight, bias = module._weight_bias()
+        if weight.qscheme() == torch.per_tensor_affine:
+            scale = torch.tensor([weight.q_scale()], dtype=torch.float64)
+            zero_point = torch.tensor([weight.q_zero_point()], dtype=torch.int64)
+        else:
+            scale = weight.q_per_channel_scales().to(torch.float64)
+            zero_point = weight.q_per_channel_zero_points().to(torch.int64)
+        tensors[f"{name}.weight"] = weight.int_repr().contiguous()
+        tensors[f"{name}.weight_scale"] = scale
+        tensors[f"{name}.weight_zero_point"] = zero_point
+        if bias is not None:
+            tensors[f"{name}.bias"] = bias.detach().contiguous()
+    return tensors
+
+
+def _load_int8(model_path: str) -> Any:
+    """INT8_WEIGHTS_FILE を mmap して、int8 動的量子化済みのモデルに割り当てる。"""
+    import torch
+    from safetensors.torch import load_file
+    from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+    from transformers import AutoConfig, AutoModelForCausalLM
+
+    config = AutoConfig.from_pretrained(model_path)
+    # 重みはすべてファイルから割り当てるため、meta デバイスに (メモリを確保せずに) 構造だけ作り、
+    # nn.Linear は量子化済みの層に置き換える (quantize_int8 と違い、重みの量子化を行わない)
+    with torch.device("meta"):
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=torch.float32)
+    for name, module in list(model.named_modules()):
+        if type(module) is torch.nn.Linear:
+            parent_name, _, child_name = name.rpartition(".")
+            # コンストラクタはゼロの重みを pack するため、1x1 で作って重みの読み込み時に
+            # 1回だけ pack する (pack は読み込み時間の大半を占める)
+            quantized = DynamicQuantizedLinear(
+                1, 1, bias_=module.bias is not None, dtype=torch.qint8
+            )
+            quantized.in_features, quantized.out_features = module.in_features, module.out_features
+            setattr(model.get_submodule(parent_name), child_name, quantized)
+
+    # load_file は safetensors のファイルを mmap して読む (pickle の復元がない)
+    tensors = load_file(Path(model_path) / INT8_WEIGHTS_FILE, device="cpu")
+    for name, module in _quantized_linears(model).items():
+        int_repr = tensors.pop(f"{name}.weight")
+        scale = tensors.pop(f"{name}.weight_scale")
+        zero_point = tensors.pop(f"{name}.weight_zero_point")
+        if scale.numel() == 1:
+            weight = torch._make_per_tensor_quantized_tensor(
+                int_repr, scale.item(), int(zero_point.item())
+            )
+        else:
+            weight = torch._make_per_channel_quantized_tensor(int_repr, scale, zero_point, 0)
+        module.set_weight_bias(weight, tensors.pop(f"{name}.bias", None))
+
+    # 残りはコピーせずに割り当てる。量子化した層の load_state_dict は int8 の重みを
+    # 受け付けないため、model.load_state_dict ではなくモジュールごとに差し替える
+    expected = {name for name, _ in [*model.named_parameters(), *model.named_buffers()]}
+    if set(tensors) != expected:
+        raise RuntimeError(
+            "int8 export does not match the model: "
+            f"missing={sorted(expected - set(tensors))}, "
+            f"unexpected={sorted(set(tensors) - expected)}"
+        )
+    for name, tensor in tensors.items():
+        module_name, _, attribute = name.rpartition(".")
+        module = model.get_submodule(module_name)
+        if attribute in module._parameters:
+            module._parameters[attribute] = torch.nn.Parameter(tensor, requires_grad=False)
+        else:
+            module._buffers[attribute] = tensor
+    return model.eval()
+
+
+def load_export(model_path: str, device: str) -> Any:
+    """エクスポートのディレクトリからモデルを読み込む (マージ・量子化は行わない)。"""
+    import torch
+    from transformers import AutoModelForCausalLM
+
+    quantization = read_export_config(model_path)["quantization"]
+    if quantization == "int8":
+        return _load_int8(model_path)
+    if quantization == "bnb-4bit":
+        # 量子化の設定は config.json の quantization_config から読まれる
+        return AutoModelForCausalLM.from_pretrained(model_path, device_map=device).eval()
+    # safetensors は mmap して読み込まれる
+    model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=torch.bfloat16)
+    return model.to(device).eval()
+
+
+def _merge_for_export(model_path: str, quantization: str) -> Any:
+    """LoRA をマージしたモデルを、quantization の形式で読み込む。"""
+    import torch
+    from src.model.cpu_backend import _load_fp32, quantize_int8
+
+    if quantization == "int8":
+        return quantize_int8(_load_fp32(model_path))
+    if quantization == "bf16":
+        return _load_fp32(model_path).to(torch.bfloat16)
+
+    import tempfile
+
+    from transformers import AutoModelForCausalLM, BitsAndBytesConfig
+
+    # マージは量子化前の重みで行い、マージ済みの重みを bitsandbytes で読み込み直して量子化する
+    with tempfile.TemporaryDirectory() as merged_dir:
+        _load_fp32(model_path).to(torch.bfloat16).save_pretrained(merged_dir)
+        return AutoModelForCausalLM.from_pretrained(
+            merged_dir,
+            device_map="cuda",
+            quantization_config=BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=torch.bfloat16,
+            ),
+        )
+
+
+def save_export(
+    model: Any, tokenizer: Any, output_dir: str | Path, quantization: str, **metadata: Any
+) -> Path:
+    """
+    マージ (・量子化) 済みのモデルを、load_model_and_tokenizer で mmap して読み込める
+    ディレクトリに保存する。metadata は EXPORT_CONFIG_FILE に記録する。
+    """
+    from safetensors.torch import save_file
+
+    validate_quantization(quantization)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if quantization == "int8":
+        model.config.save_pretrained(output_dir)
+        save_file(_int8_tensors(model), output_dir / INT8_WEIGHTS_FILE)
+    else:
+        model.save_pretrained(output_dir, safe_serialization=True)
+    tokenizer.save_pretrained(output_dir)
+    # 最後に書くことで、途中で失敗したディレクトリをエクスポートとして読み込まないようにする
+    with open(output_dir / EXPORT_CONFIG_FILE, "w", encoding="utf-8") as f:
+        json.dump({"quantization": quantization, **metadata}, f, ensure_ascii=False, indent=2)
+    return output_dir
+
+
+def export_model(model_path: str, output_dir: str | Path, quantization: str = "bf16") -> Path:
+    """
+    model_path (LoRA アダプタのディレクトリ、またはマージ済みのモデル) をマージ・量子化して
+    エクスポートする。
+
+    Raises:
+        RuntimeError: int8 に量子化したモデルの出力が MelodyControlLogitsProcessor と
+            互換でない場合。
+    """
+    from src.model.cpu_backend import check_processor_compatibility
+    from src.model.melody_processor import NoteTokenizer
+    from transformers import AutoTokenizer
+
+    validate_quantization(quantization)
+    logger.info(f"Merging {model_path} for a {quantization} export...")
+    model = _merge_for_export(model_path, quantization)
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+
+    metadata = {"source": str(model_path)}
+    if quantization == "int8":
+        report = check_processor_compatibility(
+            model, tokenizer, NoteTokenizer(tokenizer), device="cpu"
+        )
+        if not report.ok:
+            raise RuntimeError(
+                "int8 model output is not compatible with MelodyControlLogitsProcessor: "
+                f"{report.note_lines} note lines, "
+                f"{report.processor_interventions} processor interventions"
+            )
+        metadata["in_scale_ratio"] = report.in_scale_ratio
+    return save_export(model, tokenizer, output_dir, quantization, **metadata)
+
+
+class Args(Tap):
+    """推論用のマージ済みエクスポートの設定。"""
+
+    model_path: str  # LoRA アダプタのディレクトリ (train_model の出力)
+    output_dir: str  # エクスポート先 (load_model_and_tokenizer / MODEL_NAME に渡す)
+    quantization: str = "bf16"  # bf16 / int8 (CPU) / bnb-4bit (GPU)
+
+    def configure(self):
+        self.add_argument("model_path")
+        self.add_argument("output_dir")
+
+
+def main():
+    args = Args(description="LoRA をマージした推論用の safetensors のエクスポート").parse_args()
+    started_at = time.perf_counter()
+    output_dir = export_model(args.model_path, args.output_dir, args.quantization)
+    logger.success(
+        f"Exported {args.quantization} model to {output_dir} "
+        f"in {time.perf_counter() - started_at:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
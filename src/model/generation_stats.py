@@ -0,0 +1,95 @@
+"""
+1回の `generate` 呼び出し (1小節) の処理時間やトークン数を集計するためのヘルパー。
+Helpers for collecting timing and token statistics of a single generation call.
+
+プリフィル時間は `generate` 開始から最初のデコードステップ (最初の LogitsProcessor
+呼び出し) までの時間、デコード時間はそれ以降から終了までの時間として計測する。
+CUDA ではカーネルが非同期に実行されるため、最初のステップで1回だけ同期してから時刻を取る
+(同期しないとプリフィルのカーネルの起動時間しか測れず、残りがデコード時間に入る)。
+"""
+
+from dataclasses import asdict, dataclass
+import time
+
+import torch
+from transformers import LogitsProcessor
+
+
+@dataclass
+class GenerationStats:
+    """1回の生成に関する計測値。プロセス間で受け渡せるよう dict に変換できる。"""
+
+    prompt_tokens: int = 0
+    new_tokens: int = 0
+    tokenize_sec: float = 0.0
+    prefill_sec: float = 0.0
+    decode_sec: float = 0.0
+    processor_sec: float = 0.0
+    processor_steps: int = 0
+    processor_interventions: int = 0
+    # 投機的デコード (src.model.speculative) の提案数と受理数。ドラフトなしでは 0
+    draft_tokens: int = 0
+    accepted_draft_tokens: int = 0
+
+    @property
+    def acceptance_rate(self) -> float:
+        """ドラフトの提案のうち、本体のモデルの出力と一致して受理された割合。"""
+        if self.draft_tokens == 0:
+            return 0.0
+        return self.accepted_draft_tokens / self.draft_tokens
+
+    @property
+    def tokens_per_sec(self) -> float:
+        """デコード区間での生成スループット (トークン/秒)。"""
+        if self.decode_sec <= 0.0:
+            return 0.0
+        return self.new_tokens / self.decode_sec
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "GenerationStats":
+        return cls(**{k: v for k, v in data.items() if k in cls.__dataclass_fields__})
+
+
+class StepTimerLogitsProcessor(LogitsProcessor):
+    """
+    スコアを変更せず、最初のデコードステップの時刻だけを記録するプロセッサ。
+    LogitsProcessorList の先頭に置き、`start()` の後に `generate` を呼ぶ。
+    """
+
+    def __init__(self):
+        self.started_at = 0.0
+        self.first_step_at: float | None = None
+        self.finished_at: float | None = None
+
+    def start(self) -> None:
+        self.started_at = time.perf_counter()
+        self.first_step_at = None
+        self.finished_at = None
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        if self.first_step_at is None:
+            if scores.is_cuda:
+                # プリフィルの計算が終わるまで待つ (1小節に1回だけ)
+                torch.cuda.synchronize(scores.device)
+            self.first_step_at = time.perf_counter()
+        return scores
+
+    def finish(self, stats: GenerationStats) -> None:
+        """`generate` 終了後に呼び出し、プリフィル/デコード時間を stats に書き込む。"""
+        self.finished_at = time.perf_counter()
+        if self.first_step_at is None:
+            self.first_step_at = self.finished_at
+        stats.prefill_sec = self.first_step_at - self.started_at
+        stats.decode_sec = self.finished_at - self.first_step_at
+
+
+def record_processor_stats(stats: GenerationStats, processor: LogitsProcessor) -> None:
+    """MelodyControlLogitsProcessor が集計した統計を stats に書き写す。"""
+    stats.processor_sec = getattr(processor, "elapsed_sec", 0.0)
+    stats.processor_steps = getattr(processor, "steps", 0)
+    stats.processor_interventions = getattr(processor, "interventions", 0)
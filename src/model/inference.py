@@ -3,11 +3,8 @@ import sys
 
 from loguru import logger
 from tap import Tap
-import torch
-import transformers
-from unsloth import FastLanguageModel
 
-from .melody_processor import MelodyControlLogitsProcessor, NoteTokenizer
+# torch / transformers / unsloth は import が重いため、利用箇所で遅延 import する
 
 
 class InferenceArgs(Tap):
@@ -22,6 +19,7 @@ class InferenceArgs(Tap):
     max_new_tokens: int = 1024
     temperature: float = 0.8
     top_p: float = 0.9
+    max_seq_length: int = 4096  # 学習時 (train_model の max_seq_length) と同じ値を設定
 
     def configure(self):
         """引数を必須の位置引数として設定します。"""
@@ -34,21 +32,27 @@ class MidiGenerator:
     ファインチューニングされたモデルを使ってMIDIテキストを生成するクラス。
     """
 
-    def __init__(self, model_path: str):
+    def __init__(self, model_path: str, max_seq_length: int = 4096):
         """
         モデルとトークナイザーを初期化してロードします。
 
         Args:
             model_path (str): ファインチューニング済みモデルのパス。
+            max_seq_length (int): 扱う最大のトークン数 (プロンプト + 生成)。
         """
         self._setup_logging()
         logger.info(f"モデルを '{model_path}' から読み込んでいます...")
 
+        # Unsloth は transformers より先に import する必要がある
+        from unsloth import FastLanguageModel
+        import torch
+        import transformers
+
         # 学習済みLoRAモデルをロード
         # Unslothが自動でベースモデルとアダプターを結合します
         self.model, self.tokenizer = FastLanguageModel.from_pretrained(
             model_name=model_path,
-            max_seq_length=4096,  # 学習時と同じ値を設定
+            max_seq_length=max_seq_length,
             dtype=None,
             load_in_4bit=True,  # 学習時と同じ量子化設定を使用
         )
@@ -97,6 +101,8 @@ class MidiGenerator:
             )
             chord_progression = None
 
+        from .melody_processor import MelodyControlLogitsProcessor, NoteTokenizer
+
         # LogitsProcessorを準備
         processors = []
         if chord_progression:
@@ -137,7 +143,7 @@ def main():
         description="ファインチューニング済みモデルでMIDIを生成するスクリプト"
     ).parse_args()
 
-    generator = MidiGenerator(model_path=args.model_path)
+    generator = MidiGenerator(model_path=args.model_path, max_seq_length=args.max_seq_length)
 
     generated_midi = generator.generate(
         prompt=args.prompt,
@@ -5,7 +5,8 @@ from pathlib import Path
 import sqlite3
 
 import pandas as pd
-import wandb
+
+# wandb は import が重いため、アップロード時に遅延 import する
 
 
 def get_all_melids(con: sqlite3.Connection) -> list[int]:
@@ -149,6 +150,8 @@ def main(db_path: Path, output_path: Path):
 
     print("Logging dataset to WandB Artifacts...")
     try:
+        import wandb
+
         # 1. WandBのRunを初期化します。
         #    - project: プロジェクト名を指定します。
         #    - job_type: このRunが何をするものかを示します。
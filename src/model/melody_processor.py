@@ -1,4 +1,6 @@
+from collections.abc import Sequence
 import re
+import time
 from typing import ClassVar, Final
 
 from loguru import logger
@@ -79,6 +81,7 @@ class NoteTokenizer:
         self.token_id_to_pitch_cache: dict[int, int] = {}
         self.all_pitch_token_ids: set[int] = set()
         self._pitch_token_id_mask: list[int] = []
+        self._token_tables: dict[tuple[int, str], tuple[torch.Tensor, ...]] = {}
         self._build_pitch_cache()
 
     def _build_pitch_cache(self) -> None:
@@ -113,6 +116,31 @@ class NoteTokenizer:
         """
         return scores[:, self._pitch_token_id_mask]
 
+    def token_tables(
+        self, vocab_size: int, device: torch.device | str
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        語彙全体についての表 (pitch, newline, blank) をデバイス上に作って返す。
+            pitch:   トークンが表すMIDIピッチ。ピッチのトークンでなければ -1
+            newline: デコードした文字列が改行で終わるか
+            blank:   デコードした文字列が空白だけか
+        全トークンを1回ずつデコードするため、(語彙サイズ, デバイス) ごとにキャッシュする。
+        """
+        key = (vocab_size, str(device))
+        if key not in self._token_tables:
+            # モデルの語彙がトークナイザーより大きい場合 (埋め込みのパディング) の余りは空とする
+            known = min(vocab_size, len(self.tokenizer))
+            texts = self.tokenizer.batch_decode([[token_id] for token_id in range(known)])
+            texts += [""] * (vocab_size - known)
+            pitch = torch.full((vocab_size,), -1, dtype=torch.long)
+            for token_id, value in self.token_id_to_pitch_cache.items():
+                if token_id < vocab_size:
+                    pitch[token_id] = value
+            newline = torch.tensor([text.endswith("\n") for text in texts])
+            blank = torch.tensor([not text.strip() for text in texts])
+            self._token_tables[key] = (pitch.to(device), newline.to(device), blank.to(device))
+        return self._token_tables[key]
+
     def ids_to_string(self, ids: list[int]) -> str:
         """トークンIDのリストを、ソートされたピッチの文字列に変換する。"""
         pitches = [self.token_id_to_pitch_cache.get(token_id) for token_id in ids]
@@ -141,11 +169,21 @@ class MelodyControlLogitsProcessor(LogitsProcessor):
         note_tokenizer: NoteTokenizer,
         penalty_ratio: float = 1.0,  # スコアの標準偏差に対するペナルティの倍率
         supress_token_prob_ratio: float = 0.3,  # 許可リストにないトークンの発生確率への乗数
+        lightweight: bool = False,  # True の場合、コードスケール外の音の抑制だけを行う
     ):
         self.note_tokenizer = note_tokenizer
         self.allowed_token_ids = self._get_allowed_token_ids_for_chord(chord)
         self.penalty_ratio = penalty_ratio
         self.supress_token_prob_ratio = supress_token_prob_ratio
+        # 軽量モード: 毎ステップの全文デコード・トレンド計算・ループ検出を省く (締め切りが近い時用)
+        self.lightweight = lightweight
+        self._scale_suppressed_ids = list(
+            self.note_tokenizer.all_pitch_token_ids - self.allowed_token_ids
+        )
+        # --- 計測用の統計 (メトリクス出力用。加算のみなのでオーバーヘッドは無視できる) ---
+        self.steps = 0  # 呼び出された (行 x ステップ) の数
+        self.interventions = 0  # 実際に確率を操作した (行 x ステップ) の数
+        self.elapsed_sec = 0.0  # __call__ 内で費やした時間の合計
 
     def _get_allowed_token_ids_for_chord(self, chord: str) -> set[int]:
         """コード名から利用可能なスケール音を特定し、対応するトークンIDのセットを返す。"""
@@ -234,18 +272,8 @@ class MelodyControlLogitsProcessor(LogitsProcessor):
         # 前の周期のピッチを返す
         return pitches[-loop_period]
 
-    def __call__(
-        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
-    ) -> torch.FloatTensor:
-        """
-        LogitsProcessorの本体。次のトークンが音名の場合に確率を操作する。
-        """
-        sequence = self.note_tokenizer.tokenizer.decode(input_ids[0])
-
-        # 次に生成するのが音名 (pitch) のタイミング（改行の直後）で介入
-        if not sequence.endswith("\n"):
-            return scores
-
+    def _get_suppressed_pitch_ids(self, sequence: str) -> list[int]:
+        """生成シーケンスから、次の音名として確率を抑制すべきトークンIDのリストを返す。"""
         # 1. メロディトレンドを計算
         trend_pitch, last_pitch = self._calculate_pitch_trend(sequence)
 
@@ -272,15 +300,233 @@ class MelodyControlLogitsProcessor(LogitsProcessor):
             effective_allowed_ids = effective_allowed_ids - {loop_pitch_id}
 
         # 5. 許可リストにない音をリストアップ
-        suppressed_pitch_ids = list(
-            self.note_tokenizer.all_pitch_token_ids - effective_allowed_ids
+        return list(self.note_tokenizer.all_pitch_token_ids - effective_allowed_ids)
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        """
+        LogitsProcessorの本体。次のトークンが音名の場合に確率を操作する。
+        バッチの各行 (異なるシードのバリエーション等) を独立に処理する。
+        """
+        started_at = time.perf_counter()
+        self.steps += input_ids.shape[0]
+        for row in range(input_ids.shape[0]):
+            if self.lightweight:
+                # 直前のトークンだけをデコードして改行の直後かを判定し、履歴は見ない
+                if not self.note_tokenizer.tokenizer.decode(input_ids[row, -1:]).endswith("\n"):
+                    continue
+                suppressed_pitch_ids = self._scale_suppressed_ids
+            else:
+                sequence = self.note_tokenizer.tokenizer.decode(input_ids[row])
+
+                # 次に生成するのが音名 (pitch) のタイミング（改行の直後）で介入
+                if not sequence.endswith("\n"):
+                    continue
+
+                suppressed_pitch_ids = self._get_suppressed_pitch_ids(sequence)
+
+            # 6. 許可リストにないピッチの発生確率を抑制
+            if suppressed_pitch_ids:
+                scores[row : row + 1] = decrease_tokens_probability(
+                    scores[row : row + 1],
+                    token_ids=suppressed_pitch_ids,
+                    factor=self.supress_token_prob_ratio,
+                )
+                self.interventions += 1
+        self.elapsed_sec += time.perf_counter() - started_at
+        return scores
+
+
+class TensorMelodyControlLogitsProcessor(MelodyControlLogitsProcessor):
+    """
+    MelodyControlLogitsProcessor と同じ抑制を、デバイス上のテンソル演算だけで行うプロセッサ。
+    A MelodyControlLogitsProcessor that keeps its state on device and never syncs with the host.
+
+    元のプロセッサは毎ステップ系列全体をデコードしてピッチの履歴を読み直すため、
+    デコードのたびに GPU からホストへの同期が入る。こちらは行頭かどうか・直近の
+    TREND_HISTORY_COUNT 行の先頭のピッチ・書きかけの行の先頭のピッチを状態として持ち、
+    新しいトークン1つ分だけ更新する。初回の呼び出しだけはプロンプトをデコードして状態を作る。
+
+    行の先頭のフィールドは、行の最初の空白でないトークンがピッチのトークン ("60" など)
+    の場合だけピッチとして扱う (元のプロセッサは文字列を分割して読むため、複数のトークンに
+    分かれた数値も読める)。モデルの出力の行は "pitch duration ..." の形式なので、
+    通常の出力では同じ結果になる。
+
+    interventions は読み出した時にだけホストに転送する。許可するスケールの音の表は
+    デバイスごとに1回だけ作る (毎ステップのホストからの転送を避ける)。
+    """
+
+    def __init__(self, *args, **kwargs):
+        # 親クラスの __init__ が interventions に 0 を代入するため、先に作っておく
+        self._interventions: torch.Tensor | None = None
+        super().__init__(*args, **kwargs)
+        self._length = 0
+        self._state: dict[str, torch.Tensor] | None = None
+        self._scale_masks: dict[str, torch.Tensor] = {}
+
+    @property
+    def interventions(self) -> int:
+        counted = 0 if self._interventions is None else int(self._interventions.item())
+        return self._interventions_base + counted
+
+    @interventions.setter
+    def interventions(self, value: int) -> None:
+        # 代入した値から数え直す。デバイス上のカウンタは次の呼び出しで作り直す
+        self._interventions_base = value
+        self._interventions = None
+
+    def _line_pitch(self, line: str) -> int:
+        fields = line.strip().split(" ")
+        pitch = self._parse_pitch_from_string(fields[0]) if fields[0] else None
+        return -1 if pitch is None else pitch
+
+    def _init_state(self, input_ids: torch.LongTensor, device: torch.device) -> None:
+        """プロンプト (と生成済みのトークン) をデコードして状態を作る。"""
+        history, line_first, line_empty, at_line_start = [], [], [], []
+        for row in range(input_ids.shape[0]):
+            sequence = self.note_tokenizer.tokenizer.decode(input_ids[row])
+            *complete, partial = sequence.split("\n")
+            lines = [line for line in complete if line.strip()][-self.TREND_HISTORY_COUNT :]
+            pitches = [self._line_pitch(line) for line in lines]
+            history.append([-1] * (self.TREND_HISTORY_COUNT - len(pitches)) + pitches)
+            line_first.append(self._line_pitch(partial) if partial.strip() else -1)
+            line_empty.append(not partial.strip())
+            at_line_start.append(sequence.endswith("\n"))
+        self._state = {
+            "history": torch.tensor(history, dtype=torch.long, device=device),
+            "line_first": torch.tensor(line_first, dtype=torch.long, device=device),
+            "line_empty": torch.tensor(line_empty, device=device),
+            "at_line_start": torch.tensor(at_line_start, device=device),
+        }
+
+    def _advance(self, tokens: torch.LongTensor, tables: tuple[torch.Tensor, ...]) -> None:
+        """追加された1トークン (バッチの各行) で状態を更新する。"""
+        pitch_table, newline_table, blank_table = tables
+        state = self._state
+        is_newline = newline_table[tokens]
+        has_content = ~blank_table[tokens]
+        line_first = torch.where(
+            state["line_empty"] & has_content, pitch_table[tokens], state["line_first"]
+        )
+        line_empty = state["line_empty"] & ~has_content
+        # 空でない行が終わったら、その行の先頭のピッチを履歴に入れる
+        push = is_newline & ~line_empty
+        shifted = torch.cat([state["history"][:, 1:], line_first.unsqueeze(-1)], dim=-1)
+        state["history"] = torch.where(push.unsqueeze(-1), shifted, state["history"])
+        state["line_first"] = torch.where(is_newline, -1, line_first)
+        state["line_empty"] = is_newline | line_empty
+        state["at_line_start"] = is_newline
+
+    def _allowed_pitches(self, device: torch.device) -> torch.Tensor:
+        """_get_suppressed_pitch_ids と同じ規則で、各行で許可するピッチ (行, 128) を返す。"""
+        history = self._state["history"]
+        pitches = torch.arange(MIDI_PITCH_RANGE, device=device)
+        allowed = self._scale_allowed_pitches(device).unsqueeze(0).expand(history.shape[0], -1)
+        if self.lightweight:
+            return allowed
+
+        valid = history >= 0
+        count = valid.sum(dim=-1)
+        trend = (history.clamp(min=0) * valid).sum(dim=-1) // count.clamp(min=1)
+        order = torch.arange(1, history.shape[1] + 1, device=device)
+        last = history.gather(1, (valid * order).argmax(dim=-1, keepdim=True)).squeeze(-1)
+        in_trend = (
+            (pitches >= (trend - self.TREND_PITCH_RANGE).unsqueeze(-1))
+            & (pitches < (trend + self.TREND_PITCH_RANGE).unsqueeze(-1))
+            & (pitches != last.unsqueeze(-1))
         )
+        allowed = allowed & (in_trend | (count == 0).unsqueeze(-1))
+
+        # 周期2のループ (a b a b) の次は、前の周期と同じ音 (a) を避ける
+        loop = (
+            valid.all(dim=-1)
+            & (history[:, -1] == history[:, -3])
+            & (history[:, -2] == history[:, -4])
+            & (history[:, -2] > 0)
+        )
+        return allowed & ~(loop.unsqueeze(-1) & (pitches == history[:, -2].unsqueeze(-1)))
+
+    def _scale_allowed_pitches(self, device: torch.device) -> torch.Tensor:
+        """コードのスケールで許可するピッチ (128,)。デバイスごとに1回だけ作って転送する。"""
+        key = str(device)
+        if key not in self._scale_masks:
+            allowed = torch.zeros(MIDI_PITCH_RANGE, dtype=torch.bool)
+            for token_id in self.allowed_token_ids:
+                allowed[self.note_tokenizer.token_id_to_pitch_cache[token_id]] = True
+            self._scale_masks[key] = allowed.to(device)
+        return self._scale_masks[key]
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        started_at = time.perf_counter()
+        self.steps += input_ids.shape[0]
+        device = scores.device
+        tables = self.note_tokenizer.token_tables(scores.shape[-1], device)
+        if self._state is None or input_ids.shape[1] != self._length + 1:
+            self._init_state(input_ids, device)
+            if self._interventions is None:
+                self._interventions = torch.zeros((), dtype=torch.long, device=device)
+        else:
+            self._advance(input_ids[:, -1], tables)
+        self._length = input_ids.shape[1]
+
+        pitch_table = tables[0]
+        is_pitch_token = pitch_table >= 0
+        allowed = self._allowed_pitches(device)
+        # (行, 語彙) の抑制するトークンのマスク
+        suppressed = is_pitch_token & ~allowed[:, pitch_table.clamp(min=0)]
+        apply = self._state["at_line_start"] & suppressed.any(dim=-1)
+
+        # decrease_tokens_probability と同じ計算を、トークンIDのリストの代わりにマスクで行う
+        probs = F.softmax(scores, dim=-1)
+        target_sum = (probs * suppressed).sum(dim=-1, keepdim=True)
+        scale = (1.0 - target_sum * self.supress_token_prob_ratio) / torch.clamp(
+            1.0 - target_sum, min=1e-9
+        )
+        probs = torch.where(suppressed, probs * self.supress_token_prob_ratio, probs * scale)
+        scores = torch.where(apply.unsqueeze(-1), torch.log(probs + 1e-9), scores)
+        self._interventions += apply.sum()
+        self.elapsed_sec += time.perf_counter() - started_at
+        return scores
 
-        # 6. 許可リストにないピッチの発生確率を抑制
-        if suppressed_pitch_ids:
-            scores = decrease_tokens_probability(
-                scores,
-                token_ids=suppressed_pitch_ids,
-                factor=self.supress_token_prob_ratio,
+
+class PerRowLogitsProcessor(LogitsProcessor):
+    """
+    バッチの行ごとに別のプロセッサ (小節ごとに異なるコードの MelodyControlLogitsProcessor 等) を
+    適用するプロセッサ。複数の小節を1回の generate でまとめて生成する時に使う。
+    A processor that applies a different processor to each row of the batch.
+
+    計測用の統計 (steps / interventions / elapsed_sec) は各行のプロセッサの合計を返す。
+    """
+
+    def __init__(self, processors: Sequence[LogitsProcessor]):
+        self.processors = list(processors)
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        if input_ids.shape[0] != len(self.processors):
+            raise ValueError(
+                f"プロセッサ数 ({len(self.processors)}) とバッチサイズ ({input_ids.shape[0]}) "
+                "が一致しません。"
             )
+        for row, processor in enumerate(self.processors):
+            scores[row : row + 1] = processor(input_ids[row : row + 1], scores[row : row + 1])
         return scores
+
+    def _total(self, name: str) -> float:
+        return sum(getattr(processor, name, 0) for processor in self.processors)
+
+    @property
+    def steps(self) -> int:
+        return self._total("steps")
+
+    @property
+    def interventions(self) -> int:
+        return self._total("interventions")
+
+    @property
+    def elapsed_sec(self) -> float:
+        return self._total("elapsed_sec")
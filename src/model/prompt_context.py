@@ -0,0 +1,186 @@
+"""
+小節ごとのプロンプトに、コード進行のどこまでを含めるかの方針 (コンテキストポリシー)。
+Context policies for the per-bar prompt: the full progression or a sliding window.
+
+これまでのプロンプトは各小節にコード進行全体を埋め込むため、N 小節の曲では
+プロンプトが N に比例して長くなり、全小節のプリフィルの合計は O(N²) で増える。
+32〜64 小節の曲では、これが生成時間の大半を占める。
+
+    full:     コード進行全体を埋め込む (これまでと同じプロンプト。既定)
+    window=K: 現在の小節の前後 K 小節のコードと、曲の構成の要約
+              (phrase_bars 小節ごとのフレーズに A/B/... のラベルを付けたもの) だけを埋め込む
+
+`min_bars` を指定すると、それ以下の長さのコード進行には full を使う。短い曲の出力
+(と静的キャッシュ・ETag) を変えずに、長い曲だけプロンプトを短くできる。
+
+仕様の文字列 (環境変数 PROMPT_CONTEXT):
+    "full" / "window=2" / "window=2,min_bars=16,phrase_bars=4"
+"""
+
+from dataclasses import dataclass
+import os
+import textwrap
+
+# これまでの generate_chord_melodies のプロンプト (full の場合はこのまま使う)
+_FULL_TEMPLATE = """
+            Act as a world-class jazz musician improvising over a chord progression.
+            Your task is to generate a single bar of a masterful melodic phrase for
+            the specific chord at the current position in the progression.
+            - Style: {style}
+            - Full Chord Progression: {chord_progression}
+            - Current Bar Number: {bar_number}
+            - Chord for This Bar: {chord}
+            - Prev Bar Notes: {prev_bar_notes}
+            - Instrument: {instrument}
+            - Remark: Utilize a wide tonal range
+            Generate the melody for this bar only. The output format is:
+            pitch duration wait velocity instrument
+            """
+
+_WINDOW_TEMPLATE = """
+            Act as a world-class jazz musician improvising over a chord progression.
+            Your task is to generate a single bar of a masterful melodic phrase for
+            the specific chord at the current position in the progression.
+            - Style: {style}
+            - Form: {form}
+            - Current Phrase: {phrase}
+            - Nearby Chords (bars {first_bar}-{last_bar}): {nearby_chords}
+            - Current Bar Number: {bar_number}
+            - Chord for This Bar: {chord}
+            - Prev Bar Notes: {prev_bar_notes}
+            - Instrument: {instrument}
+            - Remark: Utilize a wide tonal range
+            Generate the melody for this bar only. The output format is:
+            pitch duration wait velocity instrument
+            """
+
+# プロンプトの固定部分 (フィールド以外) の取り出し用 (src.model.prompt_tokens)。build_bar_prompt は
+# format の後で dedent するが、値に改行を含まない限り、dedent してから format したものと同じ
+TEMPLATES = (textwrap.dedent(_FULL_TEMPLATE), textwrap.dedent(_WINDOW_TEMPLATE))
+
+
+def split_progression(chord_progression: str) -> list[str]:
+    """コード進行の文字列 ("Dm7 - G7 - Cmaj7") をコード名のリストにする。"""
+    return [chord.strip() for chord in chord_progression.split("-")]
+
+
+def _phrase_label(index: int) -> str:
+    return chr(ord("A") + index) if index < 26 else f"P{index + 1}"
+
+
+def phrase_labels(chords: list[str], phrase_bars: int = 4) -> list[str]:
+    """phrase_bars 小節ごとのフレーズに、同じコードの並びなら同じラベルを付ける。"""
+    labels: dict[tuple[str, ...], str] = {}
+    result = []
+    for start in range(0, len(chords), phrase_bars):
+        phrase = tuple(chords[start : start + phrase_bars])
+        if phrase not in labels:
+            labels[phrase] = _phrase_label(len(labels))
+        result.append(labels[phrase])
+    return result
+
+
+def summarize_form(chords: list[str], phrase_bars: int = 4) -> str:
+    """曲の構成の要約。"32 bars, 4-bar phrases: A x2 B A" のように連続するラベルをまとめる。"""
+    runs: list[list] = []
+    for label in phrase_labels(chords, phrase_bars):
+        if runs and runs[-1][0] == label:
+            runs[-1][1] += 1
+        else:
+            runs.append([label, 1])
+    form = " ".join(label if count == 1 else f"{label} x{count}" for label, count in runs)
+    return f"{len(chords)} bars, {phrase_bars}-bar phrases: {form}"
+
+
+@dataclass(frozen=True)
+class ContextPolicy:
+    """
+    プロンプトに含めるコード進行の範囲。
+
+    Args:
+        window: 現在の小節の前後に含める小節数。None の場合はコード進行全体 (full)。
+        min_bars: この小節数以下のコード進行には full を使う。
+        phrase_bars: 構成の要約で1フレーズとみなす小節数。
+    """
+
+    window: int | None = None
+    min_bars: int = 0
+    phrase_bars: int = 4
+
+    @classmethod
+    def parse(cls, spec: str) -> "ContextPolicy":
+        """仕様の文字列 ("full" または "window=K[,min_bars=N][,phrase_bars=P]") を解析する。"""
+        spec = spec.strip()
+        if spec in ("", "full"):
+            return cls()
+        values = {}
+        for item in spec.split(","):
+            name, sep, value = item.partition("=")
+            name = name.strip()
+            if not sep or name not in ("window", "min_bars", "phrase_bars"):
+                raise ValueError(f"Invalid prompt context policy: {spec!r}")
+            values[name] = int(value)
+        if "window" not in values or values["window"] < 0 or values.get("phrase_bars", 4) < 1:
+            raise ValueError(f"Invalid prompt context policy: {spec!r}")
+        return cls(**values)
+
+    @classmethod
+    def from_env(cls) -> "ContextPolicy":
+        return cls.parse(os.getenv("PROMPT_CONTEXT", "full"))
+
+    @property
+    def is_full(self) -> bool:
+        return self.window is None
+
+    def uses_window(self, num_bars: int) -> bool:
+        return self.window is not None and num_bars > self.min_bars
+
+    def __str__(self) -> str:
+        if self.window is None:
+            return "full"
+        return f"window={self.window},min_bars={self.min_bars},phrase_bars={self.phrase_bars}"
+
+
+FULL_CONTEXT = ContextPolicy()
+
+
+def build_bar_prompt(
+    chord_progression: str,
+    bar_index: int,
+    style: str,
+    prev_bar_notes: str,
+    instrument: str,
+    policy: ContextPolicy = FULL_CONTEXT,
+) -> str:
+    """bar_index (0 始まり) 小節目を生成するプロンプトを、policy に従って組み立てる。"""
+    chords = split_progression(chord_progression)
+    chord = chords[bar_index]
+    if not policy.uses_window(len(chords)):
+        prompt = _FULL_TEMPLATE.format(
+            style=style,
+            chord_progression=chord_progression,
+            bar_number=bar_index + 1,
+            chord=chord,
+            prev_bar_notes=prev_bar_notes,
+            instrument=instrument,
+        )
+        return textwrap.dedent(prompt)
+
+    first = max(bar_index - policy.window, 0)
+    last = min(bar_index + policy.window, len(chords) - 1)
+    phrase_index, bar_in_phrase = divmod(bar_index, policy.phrase_bars)
+    phrase_length = min(policy.phrase_bars, len(chords) - phrase_index * policy.phrase_bars)
+    labels = phrase_labels(chords, policy.phrase_bars)
+    prompt = _WINDOW_TEMPLATE.format(
+        style=style,
+        form=summarize_form(chords, policy.phrase_bars),
+        phrase=f"{labels[phrase_index]} (bar {bar_in_phrase + 1} of {phrase_length})",
+        first_bar=first + 1,
+        last_bar=last + 1,
+        nearby_chords=" - ".join(chords[first : last + 1]),
+        bar_number=bar_index + 1,
+        chord=chord,
+        prev_bar_notes=prev_bar_notes,
+        instrument=instrument,
+    )
+    return textwrap.dedent(prompt)
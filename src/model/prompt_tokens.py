@@ -0,0 +1,232 @@
+"""
+小節のプロンプトのトークン化で、テンプレートの固定部分のトークン ID を使い回す。
+Pre-tokenized prompt templates: only the variable fields are tokenized per bar.
+
+小節のプロンプト (prompt_context.build_bar_prompt) は十数行のテンプレートで、小節ごとに
+変わるのは小節番号・コード・前の小節のノートなど数か所だけである。PromptEncoder は
+プロンプトをテンプレートの固定部分と値 (フィールド) に分け、固定部分はトークン化済みの ID を、
+値だけをその都度トークン化して連結する。入力のテンソルはデバイス上に直接作る。
+
+BPE は分割した位置をまたいでトークンをまとめることがあるため (例えば "Style:" の後ろの
+空白と値の先頭の単語)、次の対策で、連結した ID が全体をトークン化した ID と同じになるようにする:
+
+    - 固定部分の末尾の空白は値の側に移す (空白は後ろの単語と1つのトークンになる)。
+      値が空の場合は前後の固定部分とつないで1つの固定部分にする
+    - 分割した位置の前後 boundary_chars 文字を、まとめてトークン化した結果と別々に
+      トークン化した結果が一致するかを確かめる。一致しなければ全体をトークン化する
+    - テンプレートごとに最初の1回は全体のトークン化と比べ、一致しなければ
+      (先頭に空白を補うトークナイザーなど) そのテンプレートでは使わない
+
+テンプレートに当てはまらないプロンプトは、これまでどおり全体をトークン化する。
+"""
+
+from collections import OrderedDict
+import string
+import threading
+from typing import Any
+
+from loguru import logger
+from src.model.prompt_context import TEMPLATES
+
+# torch は import が重いため、利用箇所で遅延 import する
+
+# 分割した位置の前後で、まとめてトークン化して確かめる文字数
+BOUNDARY_CHARS = 8
+# 値のトークン化と境界の確認の結果を、それぞれ最大でいくつ覚えておくか
+MAX_CACHED_ENTRIES = 4096
+
+
+def template_literals(template: str) -> list[str]:
+    """テンプレートの固定部分 (フィールドの前後の文字列)。フィールドの数 + 1 個。"""
+    parsed = list(string.Formatter().parse(template))
+    literals = [literal for literal, _, _, _ in parsed]
+    if parsed and parsed[-1][1] is not None:
+        # テンプレートがフィールドで終わる場合
+        literals.append("")
+    return literals
+
+
+def split_prompt(prompt: str, literals: list[str]) -> list[tuple[str, bool]] | None:
+    """
+    prompt をテンプレートの固定部分 literals で分け、(文字列, 固定部分か) の列を返す。
+    当てはまらない場合は None。
+    """
+    if not prompt.startswith(literals[0]) or not prompt.endswith(literals[-1]):
+        return None
+    end = len(prompt) - len(literals[-1])
+    parts = [(literals[0], True)]
+    position = len(literals[0])
+    for literal in literals[1:-1]:
+        found = prompt.find(literal, position, end)
+        if found < 0:
+            return None
+        parts += [(prompt[position:found], False), (literal, True)]
+        position = found + len(literal)
+    if position > end:
+        return None
+    parts += [(prompt[position:end], False), (literals[-1], True)]
+    return _normalize(parts)
+
+
+def _normalize(parts: list[tuple[str, bool]]) -> list[tuple[str, bool]]:
+    """固定部分の末尾の空白を値の側に移し、空白だけの値は前後の固定部分とつなぐ。"""
+    moved = []
+    for i, (text, static) in enumerate(parts):
+        if static and i + 1 < len(parts):
+            stripped = text.rstrip(" ")
+            moved += [(stripped, True), (text[len(stripped) :], False)]
+        elif not static:
+            # 直前に移した空白と値をつなぐ
+            moved[-1] = (moved[-1][0] + text, False)
+        else:
+            moved.append((text, True))
+    segments: list[tuple[str, bool]] = []
+    for text, static in moved:
+        static = static or not text.strip()
+        if not text:
+            continue
+        if segments and static and segments[-1][1]:
+            segments[-1] = (segments[-1][0] + text, True)
+        else:
+            segments.append((text, static))
+    return segments
+
+
+class _BoundedCache(OrderedDict):
+    """古いものから捨てる、大きさに上限のある辞書。"""
+
+    def __init__(self, max_entries: int):
+        super().__init__()
+        self.max_entries = max_entries
+
+    def put(self, key: Any, value: Any) -> Any:
+        self[key] = value
+        if len(self) > self.max_entries:
+            self.popitem(last=False)
+        return value
+
+
+class PromptEncoder:
+    """
+    tokenizer(prompt)["input_ids"] と同じ ID を、テンプレートの固定部分のトークン化を
+    使い回して作る。
+
+    Args:
+        tokenizer: モデルのトークナイザー (transformers)
+        templates: 固定部分を取り出すテンプレート (既定は小節のプロンプトのテンプレート)
+        boundary_chars: 分割した位置の前後で、トークンがまとまらないことを確かめる文字数
+    """
+
+    def __init__(
+        self,
+        tokenizer: Any,
+        templates: tuple[str, ...] = TEMPLATES,
+        boundary_chars: int = BOUNDARY_CHARS,
+    ):
+        self.tokenizer = tokenizer
+        self.boundary_chars = boundary_chars
+        self._literals = [template_literals(template) for template in templates]
+        # BOS など、tokenizer(prompt) が先頭に付ける特殊トークン
+        self._special_ids = tokenizer("")["input_ids"]
+        self._static_ids: dict[str, list[int]] = {}
+        self._field_ids = _BoundedCache(MAX_CACHED_ENTRIES)
+        self._boundaries = _BoundedCache(MAX_CACHED_ENTRIES)
+        # テンプレートごとに、最初のプロンプトで全体のトークン化と一致したか
+        self._verified: dict[int, bool] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.fallbacks = 0
+        # 固定部分は先にトークン化しておく (値が空の場合につないだものは初回に作る)
+        for literals in self._literals:
+            for literal in literals[:-1]:
+                self._static(literal.rstrip(" "))
+            self._static(literals[-1])
+
+    def _encode(self, text: str) -> list[int]:
+        return self.tokenizer.encode(text, add_special_tokens=False)
+
+    def _static(self, text: str) -> list[int]:
+        ids = self._static_ids.get(text)
+        if ids is None:
+            ids = self._static_ids[text] = self._encode(text)
+        return ids
+
+    def _field(self, text: str) -> list[int]:
+        with self._lock:
+            ids = self._field_ids.get(text)
+        if ids is None:
+            ids = self._encode(text)
+            with self._lock:
+                self._field_ids.put(text, ids)
+        return ids
+
+    def _boundary_ok(self, left: str, right: str) -> bool:
+        """left と right の境界で、トークンがまとまらない (別々にトークン化してよい) か。"""
+        key = (left[-self.boundary_chars :], right[: self.boundary_chars])
+        with self._lock:
+            ok = self._boundaries.get(key)
+        if ok is None:
+            tail, head = key
+            ok = self._encode(tail + head) == self._encode(tail) + self._encode(head)
+            with self._lock:
+                self._boundaries.put(key, ok)
+        return ok
+
+    def _encode_segments(self, segments: list[tuple[str, bool]]) -> list[int] | None:
+        ids = list(self._special_ids)
+        previous = None
+        for text, static in segments:
+            if previous is not None and not self._boundary_ok(previous, text):
+                return None
+            ids += self._static(text) if static else self._field(text)
+            previous = text
+        return ids
+
+    def encode(self, prompt: str) -> list[int]:
+        """tokenizer(prompt)["input_ids"] と同じ ID を返す。"""
+        for index, literals in enumerate(self._literals):
+            if self._verified.get(index) is False:
+                continue
+            segments = split_prompt(prompt, literals)
+            if segments is None:
+                continue
+            ids = self._encode_segments(segments)
+            if ids is None:
+                break
+            if index not in self._verified:
+                self._verified[index] = ids == self.tokenizer(prompt)["input_ids"]
+                if not self._verified[index]:
+                    logger.warning(
+                        f"Prompt template {index} does not tokenize segment-wise; "
+                        "falling back to full tokenization"
+                    )
+                    break
+            self.hits += 1
+            return ids
+        self.fallbacks += 1
+        return self.tokenizer(prompt)["input_ids"]
+
+    def model_inputs(self, prompt: str, device: Any) -> dict[str, Any]:
+        """generate に渡す input_ids / attention_mask (1, L) を、デバイス上に直接作る。"""
+        import torch
+
+        input_ids = torch.tensor([self.encode(prompt)], dtype=torch.long, device=device)
+        return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+
+    def batch_model_inputs(self, prompts: list[str], device: Any, pad_token_id: int) -> dict:
+        """左詰めでパディングした input_ids / attention_mask (B, L) を、デバイス上に直接作る。"""
+        import torch
+
+        rows = [self.encode(prompt) for prompt in prompts]
+        length = max(len(ids) for ids in rows)
+        input_ids = torch.tensor(
+            [[pad_token_id] * (length - len(ids)) + ids for ids in rows],
+            dtype=torch.long,
+            device=device,
+        )
+        attention_mask = torch.tensor(
+            [[0] * (length - len(ids)) + [1] * len(ids) for ids in rows],
+            dtype=torch.long,
+            device=device,
+        )
+        return {"input_ids": input_ids, "attention_mask": attention_mask}
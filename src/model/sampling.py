@@ -0,0 +1,90 @@
+"""
+リクエスト (バッチの行) ごとの torch.Generator を使って次トークンをサンプリングする仕組み。
+Seeded sampling with a per-request / per-row torch.Generator.
+
+`model.generate` は torch.Generator を受け取れず、`torch.manual_seed` で
+グローバルな乱数状態を書き換えるしかない。スレッドプールで並行にリクエストを
+処理すると乱数状態を取り合って再現性が失われるため、サンプリング自体を
+LogitsProcessor として実装し、`generate` は greedy (do_sample=False) で呼び出す。
+サンプリング済みのトークン以外のスコアを -inf にして返すので、greedy の argmax が
+そのトークンを選ぶ。
+"""
+
+from collections.abc import Sequence
+from typing import Final
+
+import torch
+import torch.nn.functional as F
+from transformers import LogitsProcessor
+from transformers.generation.logits_process import TopKLogitsWarper, TopPLogitsWarper
+
+# transformers の GenerationConfig と同じデフォルト値
+DEFAULT_TOP_K: Final[int] = 50
+DEFAULT_TOP_P: Final[float] = 1.0
+
+
+def make_generator(seed: int, device: str | torch.device = "cpu") -> torch.Generator:
+    """指定したシードで初期化した、デバイスごとの torch.Generator を返す。"""
+    generator = torch.Generator(device=device)
+    generator.manual_seed(seed)
+    return generator
+
+
+class SeededSamplingLogitsProcessor(LogitsProcessor):
+    """
+    行ごとに独立した torch.Generator でサンプリングし、選んだトークンだけを残すプロセッサ。
+    A processor that samples the next token per row with its own torch.Generator and
+    masks every other token, so that greedy decoding picks the sampled token.
+
+    LogitsProcessorList の最後に置き、`generate(do_sample=False)` と組み合わせて使う。
+    """
+
+    def __init__(
+        self,
+        seeds: int | Sequence[int],
+        temperature: float = 0.75,
+        top_k: int = DEFAULT_TOP_K,
+        top_p: float = DEFAULT_TOP_P,
+    ):
+        if temperature <= 0.0:
+            raise ValueError("temperature は 0 より大きい必要があります。")
+        self.seeds = [seeds] if isinstance(seeds, int) else list(seeds)
+        self.temperature = temperature
+        self.warpers = []
+        if top_k > 0:
+            self.warpers.append(TopKLogitsWarper(top_k=top_k))
+        if top_p < 1.0:
+            self.warpers.append(TopPLogitsWarper(top_p=top_p))
+        # Generator はスコアのデバイスが分かる初回呼び出し時に作成する
+        self._generators: list[torch.Generator] | None = None
+
+    def _get_generators(self, batch_size: int, device: torch.device) -> list[torch.Generator]:
+        if self._generators is None:
+            if len(self.seeds) != batch_size:
+                raise ValueError(
+                    f"シード数 ({len(self.seeds)}) とバッチサイズ ({batch_size}) が一致しません。"
+                )
+            self._generators = [make_generator(seed, device) for seed in self.seeds]
+        return self._generators
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        generators = self._get_generators(scores.shape[0], scores.device)
+
+        scores = scores.float() / self.temperature
+        for warper in self.warpers:
+            scores = warper(input_ids, scores)
+        probs = F.softmax(scores, dim=-1)
+
+        next_tokens = torch.cat(
+            [
+                torch.multinomial(probs[row], num_samples=1, generator=generator)
+                for row, generator in enumerate(generators)
+            ]
+        )
+
+        # サンプリングしたトークン以外を -inf にして、greedy の argmax に選ばせる
+        masked = torch.full_like(scores, -float("inf"))
+        masked.scatter_(1, next_tokens.unsqueeze(-1), 0.0)
+        return masked
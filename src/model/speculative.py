@@ -0,0 +1,264 @@
+"""
+ドラフト (n-gram / 小さなモデル) が提案したトークンを本体のモデルで検証する投機的デコード。
+Speculative decoding: tokens proposed by an n-gram or small-model draft, verified by the model.
+
+ノート行 ("62 250 0 80 65") は楽器 ID・よく使う音長・ベロシティの繰り返しが多く、
+次の数トークンを安く当てやすい。ドラフトが k トークンを提案し、本体のモデルは
+[直前のトークン + 提案] を1回の forward で評価して、各位置の logits をまとめて得る。
+
+検証では、通常のデコードと同じ LogitsProcessorList (MelodyControlLogitsProcessor と
+SeededSamplingLogitsProcessor) を位置ごとに順に適用し、選ばれたトークンが提案と一致する間だけ
+受理する。最初に一致しなかった位置ではプロセッサが選んだトークンを採用して打ち切るため、
+プロセッサは出力する1トークンにつきちょうど1回、通常のデコードと同じ入力で呼ばれる。
+乱数の消費も同じになるので、同じシードからはドラフトなしと同じ出力が得られる
+(rejection sampling 方式より受理率は下がるが、シードと出力の対応を保つことを優先する)。
+
+前提:
+    - バッチサイズは1 (generate_midi_from_model と同じ)
+    - モデルの generation_config に、generate が自動で追加するプロセッサ
+      (repetition_penalty など) が設定されていないこと
+    - ドラフトと本体のモデルは同じトークナイザーを使うこと
+
+ドラフトの仕様の文字列 (環境変数 SPECULATIVE_DRAFT):
+    "ngram:<path>"  save で保存した n-gram ドラフト (make_dataset の出力から作る)
+    "model:<path>"  同じトークナイザーで学習した小さな causal LM
+"""
+
+from collections import Counter, defaultdict
+from collections.abc import Iterable
+import json
+import os
+from pathlib import Path
+from typing import Any, Protocol
+
+from loguru import logger
+from tap import Tap
+
+# torch / transformers は import が重いため、利用箇所で遅延 import する
+
+DEFAULT_NUM_DRAFT_TOKENS = 4
+
+
+class Drafter(Protocol):
+    def propose(self, token_ids: list[int], k: int) -> list[int]:
+        """token_ids の続きとして、最大 k 個のトークンを提案する。"""
+        ...
+
+
+class NgramDrafter:
+    """
+    n-gram による提案。現在の系列の中で末尾と同じ並びが直前に現れていればその続きを
+    (前の小節や同じ小節のノート行の繰り返し)、なければコーパスで最も多い続きを提案する。
+
+    Args:
+        n: 文脈のトークン数 + 1。文脈は長いものから順に探す。
+        table: 文脈 (1〜n-1 トークン) から、最も多く続いたトークンへの対応。
+    """
+
+    def __init__(self, n: int = 4, table: dict[tuple[int, ...], int] | None = None):
+        self.n = n
+        self.table = table or {}
+
+    @classmethod
+    def fit(cls, sequences: Iterable[list[int]], n: int = 4, min_count: int = 2) -> "NgramDrafter":
+        """トークン列のコーパスから、min_count 回以上現れた続きだけを表にする。"""
+        counts: defaultdict[tuple[int, ...], Counter] = defaultdict(Counter)
+        for ids in sequences:
+            for i in range(1, len(ids)):
+                for order in range(1, min(n, i + 1)):
+                    counts[tuple(ids[i - order : i])][ids[i]] += 1
+        table = {}
+        for context, next_counts in counts.items():
+            token, count = next_counts.most_common(1)[0]
+            if count >= min_count:
+                table[context] = token
+        return cls(n, table)
+
+    @classmethod
+    def from_dataset(
+        cls, dataset_path: str | Path, tokenizer: Any, n: int = 4, min_count: int = 2
+    ) -> "NgramDrafter":
+        """make_dataset の出力 ([{"text": ...}, ...] の JSON) から作る。"""
+        with open(dataset_path, encoding="utf-8") as f:
+            records = json.load(f)
+        sequences = (tokenizer(record["text"])["input_ids"] for record in records)
+        return cls.fit(sequences, n, min_count)
+
+    def save(self, path: str | Path) -> None:
+        entries = [[*context, token] for context, token in self.table.items()]
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"n": self.n, "entries": entries}, f)
+
+    @classmethod
+    def load(cls, path: str | Path) -> "NgramDrafter":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["n"], {tuple(entry[:-1]): entry[-1] for entry in data["entries"]})
+
+    def _lookup_sequence(self, ids: list[int], order: int) -> int | None:
+        """末尾 order トークンと同じ並びを系列の中から後ろ向きに探し、その続きを返す。"""
+        suffix = ids[-order:]
+        for start in range(len(ids) - order - 1, -1, -1):
+            if ids[start : start + order] == suffix:
+                return ids[start + order]
+        return None
+
+    def _next(self, ids: list[int]) -> int | None:
+        for order in range(min(self.n - 1, len(ids)), 0, -1):
+            # 1トークンだけの一致は系列内では当てにならないため、コーパスの表だけを使う
+            if order >= 2 and (token := self._lookup_sequence(ids, order)) is not None:
+                return token
+            if (token := self.table.get(tuple(ids[-order:]))) is not None:
+                return token
+        return None
+
+    def propose(self, token_ids: list[int], k: int) -> list[int]:
+        ids = list(token_ids)
+        proposal = []
+        for _ in range(k):
+            token = self._next(ids)
+            if token is None:
+                break
+            proposal.append(token)
+            ids.append(token)
+        return proposal
+
+
+class ModelDrafter:
+    """
+    小さな causal LM (本体と同じトークナイザー) の greedy な続きを提案する。
+    ドラフトのキャッシュは提案ごとに作り直す (小さなモデル向け)。
+    """
+
+    def __init__(self, model: Any, device: Any):
+        self.model = model
+        self.device = device
+
+    @classmethod
+    def load(cls, model_path: str, device: Any) -> "ModelDrafter":
+        from transformers import AutoModelForCausalLM
+
+        model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype="auto")
+        return cls(model.to(device).eval(), device)
+
+    def propose(self, token_ids: list[int], k: int) -> list[int]:
+        import torch
+
+        input_ids = torch.tensor([token_ids], device=self.device)
+        output = self.model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_new_tokens=k,
+            do_sample=False,
+            pad_token_id=self.model.config.eos_token_id,
+        )
+        return output[0, len(token_ids) :].tolist()
+
+
+def load_drafter(spec: str, device: Any) -> Drafter | None:
+    """仕様の文字列 ("ngram:<path>" / "model:<path>") からドラフトを読み込む。空なら None。"""
+    if not spec:
+        return None
+    kind, sep, path = spec.partition(":")
+    if not sep or kind not in ("ngram", "model"):
+        raise ValueError(f"Invalid speculative draft: {spec!r}")
+    logger.info(f"Loading {kind} draft from {path}")
+    if kind == "ngram":
+        return NgramDrafter.load(path)
+    return ModelDrafter.load(path, device)
+
+
+def num_draft_tokens_from_env() -> int:
+    return int(os.getenv("SPECULATIVE_TOKENS", str(DEFAULT_NUM_DRAFT_TOKENS)))
+
+
+def speculative_generate(
+    model: Any,
+    input_ids: Any,
+    logits_processor: Any,
+    drafter: Drafter,
+    max_new_tokens: int,
+    eos_token_id: int | list[int] | None,
+    num_draft_tokens: int = DEFAULT_NUM_DRAFT_TOKENS,
+    stats: Any = None,
+) -> Any:
+    """
+    `model.generate(input_ids, do_sample=False, logits_processor=...)` と同じ出力を、
+    ドラフトの提案をまとめて検証しながら生成する。プロンプトを含むトークン列 (1, L) を返す。
+    eos_token_id には generate と同じく、モデルの generation_config の値を渡す。
+    stats (GenerationStats) を渡した場合は、提案数と受理数を書き込む。
+    """
+    import torch
+
+    if eos_token_id is None:
+        eos_token_ids = set()
+    elif isinstance(eos_token_id, int):
+        eos_token_ids = {eos_token_id}
+    else:
+        eos_token_ids = set(eos_token_id)
+
+    if input_ids.shape[0] != 1:
+        raise ValueError("speculative_generate supports batch size 1 only.")
+    ids = input_ids
+    prompt_length = ids.shape[1]
+    draft_tokens = accepted_tokens = 0
+    with torch.inference_mode():
+        # キャッシュには最後のトークン以外を入れておき、最後のトークンは提案と一緒に評価する
+        past_key_values = None
+        if prompt_length > 1:
+            past_key_values = model(ids[:, :-1], use_cache=True).past_key_values
+        while ids.shape[1] - prompt_length < max_new_tokens:
+            remaining = max_new_tokens - (ids.shape[1] - prompt_length)
+            draft = drafter.propose(ids[0].tolist(), min(num_draft_tokens, remaining - 1))
+            cached_length = ids.shape[1] - 1
+            step_input = torch.tensor([[ids[0, -1].item(), *draft]], device=ids.device)
+            output = model(step_input, past_key_values=past_key_values, use_cache=True)
+            past_key_values = output.past_key_values
+
+            accepted, finished = 0, False
+            for position in range(len(draft) + 1):
+                logits = output.logits[:, position, :].to(copy=True, dtype=torch.float32)
+                scores = logits_processor(ids, logits)
+                token = scores.argmax(dim=-1, keepdim=True)
+                ids = torch.cat([ids, token], dim=-1)
+                finished = token.item() in eos_token_ids
+                matched = position < len(draft) and token.item() == draft[position]
+                accepted += matched
+                if finished or not matched:
+                    break
+            draft_tokens += len(draft)
+            accepted_tokens += accepted
+            if finished:
+                break
+            # 受理されなかった提案をキャッシュから除く (最後に選んだトークンは次の回で評価する)
+            past_key_values.crop(cached_length + 1 + accepted)
+
+    if stats is not None:
+        stats.draft_tokens = draft_tokens
+        stats.accepted_draft_tokens = accepted_tokens
+    return ids
+
+
+class BuildArgs(Tap):
+    """n-gram ドラフトの作成設定。"""
+
+    dataset_path: str = "data/interim/train.json"  # make_dataset の出力
+    tokenizer_path: str = "models/production.pth/"  # 本体のモデルと同じトークナイザー
+    output_path: str = "models/ngram_draft.json"
+    n: int = 4
+    min_count: int = 2
+
+
+def main():
+    from transformers import AutoTokenizer
+
+    args = BuildArgs(description="n-gram ドラフトの作成").parse_args()
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+    drafter = NgramDrafter.from_dataset(args.dataset_path, tokenizer, args.n, args.min_count)
+    Path(args.output_path).parent.mkdir(parents=True, exist_ok=True)
+    drafter.save(args.output_path)
+    logger.info(f"Saved n-gram draft with {len(drafter.table)} contexts to {args.output_path}")
+
+
+if __name__ == "__main__":
+    main()
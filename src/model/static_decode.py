@@ -0,0 +1,199 @@
+"""
+プロンプト長 + 生成トークン数に合わせた静的 KV キャッシュと、torch.compile したデコードステップ。
+Static KV cache sized from the prompt length plus budget, and a torch.compile'd decode step.
+
+`model.generate` は動的キャッシュ (ステップごとに伸びる KV テンソル) を使い、1ステップごとに
+Python 側で停止条件を確かめるため、デコード中にホストとデバイスの同期が毎回入る。
+StaticDecoder は次のように生成する:
+
+    - KV キャッシュ (transformers.StaticCache) を「プロンプト長 + max_new_tokens」を
+      bucket 単位に切り上げた長さで確保し、同じ長さのキャッシュは reset して使い回す
+      (小節のプロンプトは数百トークンなので、学習時の max_seq_length=4096 分は確保しない)
+    - 1トークンのデコードステップを torch.compile する (CUDA では CUDA Graphs を使う
+      "reduce-overhead"、CPU では既定のモード)。形状はキャッシュの長さごとに固定なので、
+      bucket ごとに1回だけコンパイルされる。コンパイルできない環境では eager で続ける
+    - 出力のトークン列をあらかじめ確保して書き込み、EOS の判定は sync_interval ステップごとに
+      まとめて行う。EOS の後に生成したトークンは pad で置き換え、最後に切り詰める
+
+LogitsProcessor がホストと同期すると (例えば毎ステップのデコード) 効果が薄れるため、
+MelodyControlLogitsProcessor の代わりに TensorMelodyControlLogitsProcessor を使う。
+出力は `model.generate(do_sample=False, logits_processor=...)` と同じトークン列になる。
+
+前提:
+    - バッチサイズは1 (generate_midi_from_model と同じ)
+    - モデルの generation_config に、generate が自動で追加するプロセッサ
+      (repetition_penalty など) が設定されていないこと
+"""
+
+import threading
+from typing import Any
+
+from loguru import logger
+
+# torch / transformers は import が重いため、利用箇所で遅延 import する
+
+DECODE_MODES = ("eager", "static")
+# キャッシュの長さの切り上げ単位。長さごとにコンパイルされるため、種類を増やしすぎない
+DEFAULT_BUCKET = 256
+# 何ステップごとに EOS の判定のためにホストと同期するか
+DEFAULT_SYNC_INTERVAL = 8
+
+
+def validate_decode_mode(decode_mode: str) -> str:
+    if decode_mode not in DECODE_MODES:
+        raise ValueError(f"Unknown decode mode: {decode_mode!r} (choose from {DECODE_MODES})")
+    return decode_mode
+
+
+def cache_length(prompt_length: int, max_new_tokens: int, bucket: int = DEFAULT_BUCKET) -> int:
+    """プロンプト長 + 生成トークン数を bucket の倍数に切り上げた、KV キャッシュの長さ。"""
+    needed = prompt_length + max_new_tokens
+    return -(-needed // bucket) * bucket
+
+
+class StaticDecoder:
+    """
+    静的 KV キャッシュと torch.compile したデコードステップで生成する。
+    キャッシュはこのインスタンスで共有するため、generate はロックで1つずつ実行する。
+
+    Args:
+        model: causal LM (transformers)
+        compile_step: デコードステップを torch.compile するか
+        bucket: キャッシュの長さの切り上げ単位
+        sync_interval: EOS の判定のためにホストと同期する間隔 (ステップ数)
+    """
+
+    def __init__(
+        self,
+        model: Any,
+        compile_step: bool = True,
+        bucket: int = DEFAULT_BUCKET,
+        sync_interval: int = DEFAULT_SYNC_INTERVAL,
+    ):
+        self.model = model
+        self.bucket = bucket
+        self.sync_interval = sync_interval
+        self._caches: dict[int, Any] = {}
+        self._lock = threading.Lock()
+        self._step = self._forward
+        if compile_step:
+            import torch
+
+            mode = "reduce-overhead" if model.device.type == "cuda" else None
+            self._step = torch.compile(self._forward, mode=mode, dynamic=False)
+        self.compiled = compile_step
+
+    def _forward(self, input_ids: Any, cache_position: Any, cache: Any) -> Any:
+        output = self.model(
+            input_ids=input_ids,
+            cache_position=cache_position,
+            past_key_values=cache,
+            use_cache=True,
+            logits_to_keep=1,
+        )
+        return output.logits[:, -1, :]
+
+    def _decode_step(self, input_ids: Any, cache_position: Any, cache: Any) -> Any:
+        if not self.compiled:
+            return self._forward(input_ids, cache_position, cache)
+        try:
+            return self._step(input_ids, cache_position, cache)
+        except Exception as e:
+            # コンパイラが使えない環境 (C コンパイラがない等) では eager で続ける
+            logger.warning(f"torch.compile failed, falling back to eager decode: {e}")
+            self._step, self.compiled = self._forward, False
+            return self._forward(input_ids, cache_position, cache)
+
+    def _cache(self, length: int) -> Any:
+        """長さ length の静的キャッシュを返す。作成済みなら中身を消して使い回す。"""
+        from transformers import StaticCache
+
+        cache = self._caches.get(length)
+        if cache is None:
+            cache = StaticCache(
+                config=self.model.config,
+                max_batch_size=1,
+                max_cache_len=length,
+                device=self.model.device,
+                dtype=self.model.dtype,
+            )
+            self._caches[length] = cache
+        else:
+            cache.reset()
+        return cache
+
+    def warmup(self, prompt_length: int, max_new_tokens: int) -> float:
+        """
+        その長さのキャッシュを作り、デコードステップをコンパイルしておく (CPU では数十秒かかる)。
+        かかった秒数を返す。
+        """
+        import time
+
+        import torch
+
+        started_at = time.perf_counter()
+        input_ids = torch.zeros((1, prompt_length), dtype=torch.long, device=self.model.device)
+        self.generate(input_ids, lambda ids, scores: scores, max_new_tokens, eos_token_id=None)
+        return time.perf_counter() - started_at
+
+    def generate(
+        self,
+        input_ids: Any,
+        logits_processor: Any,
+        max_new_tokens: int,
+        eos_token_id: int | list[int] | None,
+        pad_token_id: int | None = None,
+    ) -> Any:
+        """
+        `model.generate(input_ids, do_sample=False, logits_processor=...)` と同じ出力を生成し、
+        プロンプトを含むトークン列 (1, L) を返す。eos_token_id にはモデルの
+        generation_config の値を渡す。
+        """
+        import torch
+
+        if input_ids.shape[0] != 1:
+            raise ValueError("StaticDecoder supports batch size 1 only.")
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        device = input_ids.device
+        eos_ids = torch.tensor(eos_token_id, device=device) if eos_token_id else None
+        pad = pad_token_id if pad_token_id is not None else (eos_token_id or [0])[0]
+
+        prompt_length = input_ids.shape[1]
+        output = torch.full(
+            (1, prompt_length + max_new_tokens), pad, dtype=input_ids.dtype, device=device
+        )
+        output[:, :prompt_length] = input_ids
+        positions = torch.arange(prompt_length + max_new_tokens, device=device)
+        done = torch.zeros(1, dtype=torch.bool, device=device)
+        steps = max_new_tokens
+        with self._lock, torch.inference_mode():
+            cache = self._cache(cache_length(prompt_length, max_new_tokens, self.bucket))
+            logits = self._forward(input_ids, positions[:prompt_length], cache)
+            for step in range(max_new_tokens):
+                length = prompt_length + step
+                # コンパイルした関数の出力バッファは次の呼び出しで上書きされるためコピーする
+                scores = logits_processor(
+                    output[:, :length], logits.to(copy=True, dtype=torch.float32)
+                )
+                token = scores.argmax(dim=-1)
+                if eos_ids is not None:
+                    token = torch.where(done, pad, token)
+                    done |= torch.isin(token, eos_ids)
+                output[:, length] = token
+                if step + 1 == max_new_tokens:
+                    break
+                if eos_ids is not None and (step + 1) % self.sync_interval == 0 and done.item():
+                    steps = step + 1
+                    break
+                logits = self._decode_step(
+                    token.unsqueeze(-1), positions[length : length + 1], cache
+                )
+
+        generated = output[:, prompt_length : prompt_length + steps]
+        if eos_ids is not None:
+            # 最初の EOS まで (EOS を含む) に切り詰める
+            is_eos = torch.isin(generated[0], eos_ids)
+            if is_eos.any():
+                steps = int(is_eos.int().argmax()) + 1
+        return output[:, : prompt_length + steps]
@@ -0,0 +1,160 @@
+"""
+テレメトリ (weave / wandb への記録) をリクエストパスから切り離す、バックグラウンドの送信キュー。
+A background exporter that moves telemetry round-trips off the request path.
+
+`submit()` はサンプリングの抽選とキューへの投入だけを行い、すぐに戻る。
+送信はバックグラウンドスレッドがまとめて (バッチで) 行い、キューが満杯の場合は
+呼び出し元を待たせずにイベントを捨てる (drop-on-overflow)。そのため開発モードや
+キャッシュ生成のスループットが、テレメトリの往復時間に律速されなくなる。
+
+環境変数 (from_env):
+    TELEMETRY_MAX_QUEUE: キューに溜められるイベント数の上限 (既定: 1000)
+    TELEMETRY_BATCH_SIZE: 1回の送信でまとめるイベント数の上限 (既定: 32)
+    TELEMETRY_FLUSH_INTERVAL_SEC: バッチが揃わなくても送信するまでの待ち時間 (既定: 1.0)
+    TELEMETRY_SAMPLE_RATE: イベントを送信する確率 (0.0〜1.0, 既定: 1.0)
+"""
+
+import atexit
+from collections.abc import Callable
+import os
+import queue
+import random
+import threading
+import time
+
+
+class AsyncBatchExporter[T]:
+    """
+    イベントを有界キューに積み、バックグラウンドスレッドでバッチ送信するクラス。
+
+    Args:
+        handler: イベントのリストを受け取って送信する関数。バックグラウンドスレッドで呼ばれる。
+        max_queue: キューに溜められるイベント数の上限。超えたイベントは捨てる。
+        batch_size: 1回の handler 呼び出しに渡すイベント数の上限。
+        flush_interval_sec: 最初のイベントから、バッチが揃うのを待つ最大時間。
+        sample_rate: submit されたイベントを送信対象にする確率。
+        name: ログやスレッド名に使う名前。
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[list[T]], None],
+        max_queue: int = 1000,
+        batch_size: int = 32,
+        flush_interval_sec: float = 1.0,
+        sample_rate: float = 1.0,
+        name: str = "telemetry",
+    ):
+        if not 0.0 <= sample_rate <= 1.0:
+            raise ValueError(f"sample_rate must be between 0 and 1: {sample_rate}")
+        self.handler = handler
+        self.batch_size = batch_size
+        self.flush_interval_sec = flush_interval_sec
+        self.sample_rate = sample_rate
+        self.name = name
+        self._queue: queue.Queue[T] = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = 0  # キュー内 + 送信中のイベント数
+        self._thread: threading.Thread | None = None
+        self._closed = False
+        self._warned = False
+        self.submitted = 0
+        self.sampled_out = 0
+        self.dropped = 0
+        self.exported = 0
+        self.failed = 0
+
+    @classmethod
+    def from_env(
+        cls, handler: Callable[[list[T]], None], name: str = "telemetry", **overrides
+    ) -> "AsyncBatchExporter[T]":
+        """環境変数 TELEMETRY_* から設定を読み込む。overrides で個別に上書きできる。"""
+        options = {
+            "max_queue": int(os.getenv("TELEMETRY_MAX_QUEUE", "1000")),
+            "batch_size": int(os.getenv("TELEMETRY_BATCH_SIZE", "32")),
+            "flush_interval_sec": float(os.getenv("TELEMETRY_FLUSH_INTERVAL_SEC", "1.0")),
+            "sample_rate": float(os.getenv("TELEMETRY_SAMPLE_RATE", "1.0")),
+        }
+        return cls(handler, name=name, **{**options, **overrides})
+
+    def submit(self, event: T) -> bool:
+        """イベントを送信キューに積む。抽選に外れた場合やキューが満杯の場合は False を返す。"""
+        with self._lock:
+            if self._closed:
+                return False
+            self.submitted += 1
+            if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+                self.sampled_out += 1
+                return False
+            try:
+                self._queue.put_nowait(event)
+            except queue.Full:
+                self.dropped += 1
+                return False
+            self._pending += 1
+            if self._thread is None:
+                self._start()
+        return True
+
+    def _start(self) -> None:
+        # スレッドは最初のイベントが来た時に起動する (import しただけではスレッドを作らない)
+        self._thread = threading.Thread(target=self._run, name=f"{self.name}-export", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _next_batch(self) -> list[T]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval_sec
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            try:
+                self.handler(batch)
+                succeeded = True
+            except Exception as e:
+                succeeded = False
+                # テレメトリの失敗で処理を止めない。警告は1回だけ出す。
+                if not self._warned:
+                    self._warned = True
+                    print(f"⚠️  Failed to export {self.name} events: {e}")
+            with self._lock:
+                if succeeded:
+                    self.exported += len(batch)
+                else:
+                    self.failed += len(batch)
+                self._pending -= len(batch)
+                if self._pending == 0:
+                    self._idle.notify_all()
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """キュー内のイベントが全て送信されるまで待つ。タイムアウトした場合は False を返す。"""
+        with self._lock:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout=timeout)
+
+    def close(self, timeout: float | None = 10.0) -> bool:
+        """新しいイベントの受け付けを止め、残りのイベントを送信する。"""
+        with self._lock:
+            self._closed = True
+        return self.flush(timeout)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "submitted": self.submitted,
+                "sampled_out": self.sampled_out,
+                "dropped": self.dropped,
+                "exported": self.exported,
+                "failed": self.failed,
+                "queue_depth": self._queue.qsize(),
+            }
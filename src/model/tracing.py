@@ -0,0 +1,393 @@
+"""
+推論パスの処理区間 (span) を計測する、低オーバーヘッドなトレーシング。
+Low-overhead tracing spans for the inference hot path.
+
+`main.py` / `utils.py` にあった `op` シムを置き換える共通のデコレータ層。
+トークナイズ・プリフィル・デコード・LogitsProcessor・デコード結果の文字列化・パース・
+base64 エンコードなどの区間を span として記録し、設定されたエクスポーターに渡す。
+
+サンプリングはトレース (ルート span) 単位で行い、抽選に外れたトレースや
+エクスポーターが無効な場合は、各 span は contextvar を1回参照するだけの no-op になる。
+そのため本番環境でも低いサンプリング率で常時有効にしておける。
+
+環境変数:
+    TRACE_EXPORTER: none | stdout | file | weave
+        (既定: APP_ENV=production では none、それ以外では weave)
+    TRACE_SAMPLE_RATE: 0.0〜1.0。ルート span を記録する確率 (既定: 1.0)
+    TRACE_FILE: file エクスポーターの出力先 (既定: traces/spans.jsonl)
+    TRACE_WEAVE_PROJECT: weave エクスポーターのプロジェクト名
+        (既定: WANDB_PROJECT、未設定なら melody-flow-api-dev)
+    TRACE_ASYNC: 0 以外ならバックグラウンドでバッチ送信する (既定: 1)。
+        キューの設定は src/model/telemetry.py の TELEMETRY_* を参照。
+
+使い方:
+    @traced()
+    def generate(...): ...
+
+    with span("parse", bar=3) as s:
+        ...
+        s.set("notes", 12)
+"""
+
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+import functools
+import importlib.util
+import inspect
+import json
+import os
+from pathlib import Path
+import random
+import sys
+import threading
+import time
+from typing import Any
+
+# perf_counter の値を壁時計 (UNIX 時刻) に変換するためのオフセット
+_WALL_CLOCK_OFFSET = time.time() - time.perf_counter()
+_MAX_ATTRIBUTE_CHARS = 1000
+
+
+class Span:
+    """記録中の1区間。開始・終了時刻は time.perf_counter() の値で持つ。"""
+
+    recording = True
+
+    def __init__(self, name: str, trace_id: str, parent_id: str | None, attributes: dict):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.started_at = time.perf_counter()
+        self.finished_at: float | None = None
+        self.error: str | None = None
+
+    def set(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    @property
+    def duration_sec(self) -> float:
+        return (self.finished_at or time.perf_counter()) - self.started_at
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time": self.started_at + _WALL_CLOCK_OFFSET,
+            "duration_ms": round(self.duration_sec * 1000, 3),
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class _NoopSpan:
+    """記録しないトレース用の span。属性の設定は捨てる。"""
+
+    recording = False
+    name = trace_id = span_id = parent_id = None
+
+    def set(self, key: str, value: Any) -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+_CURRENT_SPAN: ContextVar["Span | _NoopSpan | None"] = ContextVar("current_span", default=None)
+
+
+# --- エクスポーター ---
+class SpanExporter:
+    """終了した span を受け取って出力するクラスの基底クラス。"""
+
+    def export(self, span: Span) -> None:
+        raise NotImplementedError
+
+    def export_batch(self, spans: list[Span]) -> None:
+        for span in spans:
+            self.export(span)
+
+
+class StdoutExporter(SpanExporter):
+    """span を1行の JSON として標準出力に書き出す。"""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        line = json.dumps(span.to_dict(), ensure_ascii=False, default=str)
+        with self._lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+
+class FileExporter(SpanExporter):
+    """span を JSON Lines 形式でローカルファイルに追記する。"""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        line = json.dumps(span.to_dict(), ensure_ascii=False, default=str)
+        with self._lock, self.path.open("a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    def export_batch(self, spans: list[Span]) -> None:
+        lines = [json.dumps(span.to_dict(), ensure_ascii=False, default=str) for span in spans]
+        with self._lock, self.path.open("a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+class WeaveExporter(SpanExporter):
+    """
+    span を weave の call として記録する。weave は最初の export 時に遅延 import する。
+    span は終了後にまとめて送るため、weave 上の時刻は実際の計測値と一致しない。
+    計測値は output の duration_ms を参照すること。
+    """
+
+    def __init__(self, project: str):
+        self.project = project
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        with self._lock:
+            if self._client is None:
+                import weave
+
+                self._client = weave.init(self.project)
+            return self._client
+
+    def export(self, span: Span) -> None:
+        client = self._get_client()
+        data = span.to_dict()
+        call = client.create_call(
+            span.name,
+            inputs={
+                "trace_id": span.trace_id,
+                "parent_id": span.parent_id,
+                **span.attributes,
+            },
+        )
+        client.finish_call(call, output={"duration_ms": data["duration_ms"], "error": span.error})
+
+
+class AsyncExporter(SpanExporter):
+    """
+    別のエクスポーターへの出力をバックグラウンドスレッドでバッチ送信するラッパー。
+    キューが満杯の場合、span は捨てられる (リクエストを待たせない)。
+    サンプリングはトレース単位で行い済みのため、ここでは抽選しない。
+    """
+
+    def __init__(self, inner: SpanExporter):
+        from src.model.telemetry import AsyncBatchExporter
+
+        self.inner = inner
+        self.queue = AsyncBatchExporter.from_env(inner.export_batch, name="trace", sample_rate=1.0)
+
+    def export(self, span: Span) -> None:
+        self.queue.submit(span)
+
+    def flush(self, timeout: float | None = None) -> bool:
+        return self.queue.flush(timeout)
+
+
+# --- トレーサー ---
+class Tracer:
+    """
+    span を生成し、サンプリングされたトレースの span をエクスポーターに渡すクラス。
+
+    Args:
+        exporter: 出力先。None の場合は何も記録しない。
+        sample_rate: ルート span を記録する確率 (0.0〜1.0)。
+    """
+
+    def __init__(self, exporter: SpanExporter | None = None, sample_rate: float = 1.0):
+        if not 0.0 <= sample_rate <= 1.0:
+            raise ValueError(f"sample_rate must be between 0 and 1: {sample_rate}")
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self._export_failed = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None and self.sample_rate > 0.0
+
+    def _should_sample(self) -> bool:
+        return self.enabled and (self.sample_rate >= 1.0 or random.random() < self.sample_rate)
+
+    def _export(self, span: Span) -> None:
+        try:
+            self.exporter.export(span)
+        except Exception as e:
+            # トレースの失敗でリクエストを失敗させない。警告は1回だけ出す。
+            if not self._export_failed:
+                self._export_failed = True
+                print(f"⚠️  Failed to export trace span '{span.name}': {e}")
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator["Span | _NoopSpan"]:
+        parent = _CURRENT_SPAN.get()
+        if parent is None:
+            if not self._should_sample():
+                # 子 span が再抽選しないよう、トレース全体を no-op として扱う
+                token = _CURRENT_SPAN.set(NOOP_SPAN)
+                try:
+                    yield NOOP_SPAN
+                finally:
+                    _CURRENT_SPAN.reset(token)
+                return
+            current = Span(name, f"{random.getrandbits(128):032x}", None, attributes)
+        elif not parent.recording:
+            yield NOOP_SPAN
+            return
+        else:
+            current = Span(name, parent.trace_id, parent.span_id, attributes)
+
+        token = _CURRENT_SPAN.set(current)
+        try:
+            yield current
+        except BaseException as e:
+            current.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            current.finished_at = time.perf_counter()
+            _CURRENT_SPAN.reset(token)
+            self._export(current)
+
+    def record_span(self, name: str, started_at: float, finished_at: float, **attributes) -> None:
+        """
+        別の方法で計測済みの区間 (perf_counter の値) を、現在の span の子として記録する。
+        generate() 内部のプリフィル/デコードのように、コードで囲めない区間に使う。
+        """
+        parent = _CURRENT_SPAN.get()
+        if parent is None or not parent.recording:
+            return
+        recorded = Span(name, parent.trace_id, parent.span_id, attributes)
+        recorded.started_at, recorded.finished_at = started_at, finished_at
+        self._export(recorded)
+
+
+def _exporter_from_env() -> SpanExporter | None:
+    app_env = os.getenv("APP_ENV", "production")
+    name = os.getenv("TRACE_EXPORTER", "none" if app_env == "production" else "weave").lower()
+    if name in ("", "none"):
+        return None
+    if name == "stdout":
+        return StdoutExporter()
+    if name == "file":
+        return FileExporter(os.getenv("TRACE_FILE", "traces/spans.jsonl"))
+    if name == "weave":
+        if importlib.util.find_spec("weave") is None:
+            print("⚠️  weave is not installed. Running without tracing.")
+            return None
+        project = os.getenv("TRACE_WEAVE_PROJECT") or os.getenv(
+            "WANDB_PROJECT", "melody-flow-api-dev"
+        )
+        return WeaveExporter(project)
+    raise ValueError(f"Unknown TRACE_EXPORTER: {name}")
+
+
+def tracer_from_env() -> Tracer:
+    """
+    環境変数 TRACE_EXPORTER / TRACE_SAMPLE_RATE からトレーサーを作る。
+    TRACE_ASYNC=0 でない限り、出力はバックグラウンドの AsyncExporter 経由で行う。
+    """
+    exporter = _exporter_from_env()
+    if exporter is not None and os.getenv("TRACE_ASYNC", "1") != "0":
+        exporter = AsyncExporter(exporter)
+    return Tracer(exporter, float(os.getenv("TRACE_SAMPLE_RATE", "1.0")))
+
+
+_TRACER = tracer_from_env()
+
+
+def get_tracer() -> Tracer:
+    return _TRACER
+
+
+def configure(exporter: SpanExporter | None = None, sample_rate: float = 1.0) -> Tracer:
+    """グローバルなトレーサーを差し替える (テストやスクリプトからの設定用)。"""
+    global _TRACER
+    _TRACER = Tracer(exporter, sample_rate)
+    return _TRACER
+
+
+def span(name: str, **attributes):
+    """`with span("name"):` で区間を計測する。"""
+    return _TRACER.span(name, **attributes)
+
+
+def record_span(name: str, started_at: float, finished_at: float, **attributes) -> None:
+    _TRACER.record_span(name, started_at, finished_at, **attributes)
+
+
+def current_span() -> "Span | _NoopSpan":
+    """現在の span を返す。トレース外や記録しないトレースでは no-op の span を返す。"""
+    return _CURRENT_SPAN.get() or NOOP_SPAN
+
+
+def _summarize(value: Any) -> Any:
+    """span の属性に入れられるよう、値を短い JSON 互換の形にする。"""
+    if value is None or isinstance(value, bool | int | float):
+        return value
+    if isinstance(value, str):
+        if len(value) > _MAX_ATTRIBUTE_CHARS:
+            return value[:_MAX_ATTRIBUTE_CHARS] + "..."
+        return value
+    return type(value).__name__
+
+
+def traced(name: str | Callable | None = None, capture_io: bool = False):
+    """
+    関数呼び出しを span として記録するデコレータ。`@traced` と `@traced()` の両方に対応する。
+
+    Args:
+        name: span 名。省略時は関数の修飾名。
+        capture_io: True の場合、記録するトレースでは引数と戻り値を属性に含める。
+    """
+    if callable(name):
+        return traced()(name)
+
+    def decorator(func: Callable) -> Callable:
+        span_name = name or func.__qualname__
+        signature = inspect.signature(func) if capture_io else None
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _TRACER.span(span_name) as current:
+                if capture_io and current.recording:
+                    bound = signature.bind_partial(*args, **kwargs)
+                    current.set("inputs", {k: _summarize(v) for k, v in bound.arguments.items()})
+                result = func(*args, **kwargs)
+                if capture_io and current.recording:
+                    current.set("output", _summarize(result))
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+def weave_op(func: Callable) -> Callable:
+    """
+    初回呼び出し時に weave.op() でラップするデコレータ。評価やキャッシュ生成など、
+    weave に必ず記録するツール用。import 時には weave を読み込まない。
+    """
+    wrapped = None
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        nonlocal wrapped
+        if wrapped is None:
+            import weave
+
+            wrapped = weave.op()(func)
+        return wrapped(*args, **kwargs)
+
+    return wrapper
@@ -1,17 +1,15 @@
-import unsloth  # noqa: F401
 import sys
 
-from datasets import load_dataset
 from loguru import logger
 
+from src.model.fast_load import export_model, validate_quantization
+
 # 共通のモデル読み込み関数をインポート
 from src.model.utils import load_model_and_tokenizer
 from tap import Tap
-import torch
-from transformers import TrainingArguments
-from trl import SFTTrainer
-from unsloth import FastLanguageModel
-import wandb
+
+# unsloth / torch / transformers / trl / datasets / wandb は import が重いため、
+# 利用するメソッド内で遅延 import する (unsloth は load_model_and_tokenizer 内で先に読み込まれる)
 
 
 class MidiFinetuningExperiment:
@@ -51,6 +49,8 @@ class MidiFinetuningExperiment:
         """
         モデルにLoRAを適用します。
         """
+        from unsloth import FastLanguageModel
+
         logger.info("モデルにLoRAアダプターを適用しています...")
         lora_config = self.config["lora"]
         self.model = FastLanguageModel.get_peft_model(
@@ -69,6 +69,8 @@ class MidiFinetuningExperiment:
         """
         学習用データセットを読み込みます。
         """
+        from datasets import load_dataset
+
         logger.info(f"データセットを '{self.config['input_data_path']}' から読み込んでいます...")
         try:
             dataset = load_dataset(
@@ -84,6 +86,11 @@ class MidiFinetuningExperiment:
         """
         SFTTrainerを使用してモデルのトレーニングを実行します。
         """
+        import torch
+        from transformers import TrainingArguments
+        from trl import SFTTrainer
+        import wandb
+
         try:
             dataset_artifact = run.use_artifact(
                 f"{self.config['dataset_artifact_name']}:latest", type="dataset"
@@ -128,6 +135,8 @@ class MidiFinetuningExperiment:
         """
         ファインチューニングされたモデルを保存し、WandB Artifactとして登録します。
         """
+        import wandb
+
         output_path = self.config["output_model_path"]
         logger.info(f"モデルを '{output_path}' に保存しています...")
         self.model.save_pretrained(output_path)
@@ -145,10 +154,24 @@ class MidiFinetuningExperiment:
         run.log_artifact(model_artifact)
         logger.success("WandB Artifactの登録が完了しました。")
 
+    def _export_model(self):
+        """
+        保存したLoRAアダプターをベースモデルにマージし、推論用のエクスポートを作成します。
+        (src.model.fast_load。推論サーバーの起動時のマージ・量子化を省くため)
+        """
+        export_path = self.config["export_path"]
+        logger.info(f"推論用のエクスポートを '{export_path}' に作成しています...")
+        export_model(
+            self.config["output_model_path"], export_path, self.config["export_quantization"]
+        )
+        logger.success("推論用のエクスポートが完了しました。")
+
     def run(self):
         """
         実験の全工程を実行します。
         """
+        import wandb
+
         run = wandb.init(
             project=self.config.get("wandb_project", "melody-flow"),
             config=self.config,
@@ -162,6 +185,8 @@ class MidiFinetuningExperiment:
             train_dataset = self._load_dataset()
             self._run_training(train_dataset, run)
             self._save_model(run)
+            if self.config.get("export_path"):
+                self._export_model()
             logger.info("実験は正常に終了しました。")
         finally:
             if run:
@@ -192,6 +217,10 @@ class Args(Tap):
     output_dir: str = "outputs"
     seed: int = 42
 
+    # --- 推論用のエクスポート (src.model.fast_load) ---
+    export_path: str | None = None  # 指定した場合、学習後にマージ済みのモデルを保存する
+    export_quantization: str = "bf16"  # bf16 / int8 (CPU) / bnb-4bit (GPU)
+
     # --- WandB設定 ---
     wandb_project: str = "melody-flow-model-manage"
     dataset_artifact_name: str = "wjazzd-sft-dataset"
@@ -203,7 +232,11 @@ class Args(Tap):
 
 
 def main():
+    import torch
+
     args = Args(description="LLMをLoRAでファインチューニングするスクリプト").parse_args()
+    # 学習の後で失敗しないよう、エクスポートの設定は先に確かめる
+    validate_quantization(args.export_quantization)
 
     config = {
         "input_data_path": args.input_data_path,
@@ -212,6 +245,8 @@ def main():
         "max_seq_length": args.max_seq_length,
         "load_in_4bit": args.load_in_4bit,
         "seed": args.seed,
+        "export_path": args.export_path,
+        "export_quantization": args.export_quantization,
         "wandb_project": args.wandb_project,
         "dataset_artifact_name": args.dataset_artifact_name,
         "output_model_artifact_name": args.output_model_artifact_name,
@@ -1,65 +1,103 @@
-import unsloth  # noqa: F401
-import os
+from src.model import cpu_backend
+from src.model.tracing import current_span, record_span, span, traced
 
-from src.model.melody_processor import NoteTokenizer
-import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, LogitsProcessorList
-from unsloth import FastLanguageModel
+# NOTE: torch / transformers / unsloth は起動時間が非常に重いため、モジュールの
+# トップレベルでは import せず、実際に必要になった関数内で遅延 import する。
+# (chord_name_parser や AudioUtility だけを使うツールの起動を速くするため)
 
+# 学習時 (train_model の max_seq_length) と同じ既定値。小節の生成はプロンプト + 128 トークンの
+# 数百トークンなので、API では MODEL_MAX_SEQ_LENGTH で小さくできる
+DEFAULT_MAX_SEQ_LENGTH = 4096
 
-def _get_op_decorator():
-    """環境変数に応じて、weave.opまたは何もしないダミーデコレータを返す"""
-    if os.getenv("APP_ENV", "production") != "production":
-        try:
-            import weave
 
-            return weave.op
-        except ImportError:
-            print("⚠️  weave is not installed. Running without it.")
-
-    # 本番モード、またはweaveがインストールされていない場合はダミーを返す
-    def dummy_op(*args, **kwargs):
-        def decorator(f):
-            return f
-
-        if args and callable(args[0]):
-            return decorator(args[0])
-        return decorator
-
-    return dummy_op
-
-
-# --- グローバル変数としてデコレータを定義 ---
-op = _get_op_decorator()
-APP_ENV = os.getenv("APP_ENV", "production")
-
-
-def load_model_and_tokenizer(model_path: str | None, disable_unsloth: bool = False):
+def load_model_and_tokenizer(
+    model_path: str | None,
+    disable_unsloth: bool = False,
+    backend: str = "auto",
+    num_threads: int | None = None,
+    max_seq_length: int = DEFAULT_MAX_SEQ_LENGTH,
+):
     """
     モデルとトークナイザーをパスから読み込みます。
     ローカルパスの場合はUnslothを、Hubのパスの場合はTransformersを使用します。
+    `backend` に "cpu-int8" / "cpu-bf16" を指定した場合は CPU 向けに読み込み
+    (src.model.cpu_backend)、int8 では MelodyControlLogitsProcessor との互換性を確かめます。
+    マージ済みのエクスポート (src.model.fast_load) のディレクトリは、backend が "auto" なら
+    マージ・量子化を行わずに safetensors を mmap して読み込みます。int8 のエクスポートは
+    "cpu-int8" でも同じように読み込みます (互換性チェックはエクスポート時に済んでいます)。
     """
     if model_path is None:
         model_path = "models/production.pth/"
     print(f"🧠 Loading model: {model_path}...")
-    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    from src.model import fast_load
+    import torch
+
+    cpu_backend.validate_backend(backend)
+    export_config = fast_load.read_export_config(model_path)
+    fast_export = export_config is not None and (
+        backend == "auto" or (backend == "cpu-int8" and export_config["quantization"] == "int8")
+    )
+    if fast_export:
+        device = fast_load.export_device(model_path)
+    else:
+        device = "cuda" if backend == "auto" and torch.cuda.is_available() else "cpu"
     print(f"🔥 Using device: {device}")
 
     try:
         model, tokenizer = None, None
-        if disable_unsloth is False:
+        if fast_export:
+            print("-> Loading merged export (memory-mapped safetensors)...")
+            if device == "cpu":
+                cpu_backend.configure_threads(num_threads)
+            from transformers import AutoTokenizer
+
+            model = fast_load.load_export(model_path, device)
+            tokenizer = AutoTokenizer.from_pretrained(model_path)
+        elif backend != "auto":
+            threads = cpu_backend.configure_threads(num_threads)
+            print(f"-> Loading for CPU inference ({backend}, {threads} threads)...")
+            from transformers import AutoTokenizer
+
+            model = cpu_backend.load_cpu_model(model_path, backend)
+            tokenizer = AutoTokenizer.from_pretrained(model_path)
+        elif disable_unsloth is False:
             print("-> Loading as local Unsloth model (4-bit)...")
+            # Unsloth は transformers より先に import する必要がある
+            from unsloth import FastLanguageModel
+
             model, tokenizer = FastLanguageModel.from_pretrained(
-                model_name=model_path, max_seq_length=4096, dtype=None, load_in_4bit=True
+                model_name=model_path,
+                max_seq_length=max_seq_length,
+                dtype=None,
+                load_in_4bit=True,
             )
         else:
             print(f"-> Loading as Hugging Face Hub model ({model_path})...")
+            from transformers import AutoModelForCausalLM, AutoTokenizer
+
             model = AutoModelForCausalLM.from_pretrained(
                 model_path, torch_dtype=torch.bfloat16
             ).to(device)
             tokenizer = AutoTokenizer.from_pretrained(model_path)
 
+        from src.model.melody_processor import NoteTokenizer
+
         note_tokenizer_helper = NoteTokenizer(tokenizer)
+        if backend == "cpu-int8" and not fast_export:
+            report = cpu_backend.check_processor_compatibility(
+                model, tokenizer, note_tokenizer_helper, device
+            )
+            if not report.ok:
+                raise RuntimeError(
+                    "int8 model output is not compatible with MelodyControlLogitsProcessor: "
+                    f"{report.note_lines} note lines, "
+                    f"{report.processor_interventions} processor interventions"
+                )
+            print(
+                f"✅ int8 compatibility check: {report.note_lines} notes, "
+                f"{report.in_scale_ratio:.0%} in scale"
+            )
         print("✅ Model loaded successfully.")
         return model, tokenizer, note_tokenizer_helper, device
     except Exception as e:
@@ -67,33 +105,226 @@ def load_model_and_tokenizer(model_path: str | None, disable_unsloth: bool = Fal
         raise e
 
 
-@op()
-def generate_midi_from_model(model, tokenizer, device, prompt: str, processor, seed: int) -> str:
+@traced(capture_io=True)
+def generate_midi_from_model(
+    model,
+    tokenizer,
+    device,
+    prompt: str,
+    processor,
+    seed: int,
+    max_new_tokens: int = 128,
+    temperature: float = 0.75,
+    do_sample: bool = True,
+    stats=None,
+    drafter=None,
+    num_draft_tokens: int = 4,
+    decoder=None,
+    adapter_name: str | None = None,
+    prompt_encoder=None,
+) -> str:
     """
     プロンプトとLogitsProcessorを使用してMIDIテキストを生成します。
+    乱数はリクエストごとの torch.Generator を使うため、並行に呼び出しても
+    同じ seed からは同じ出力が得られます。`do_sample=False` の場合は greedy で生成します。
+    `stats` (GenerationStats) を渡した場合は、処理時間やトークン数を書き込みます。
+    `drafter` (src.model.speculative) を渡した場合は投機的デコードで生成します
+    (出力はドラフトなしの場合と同じです)。
+    `decoder` (src.model.static_decode.StaticDecoder) を渡した場合は、静的 KV キャッシュと
+    コンパイルしたデコードステップで生成します (ドラフトが優先されます)。
+    `adapter_name` (peft のアダプタ名、src.model.adapters) を渡した場合は、そのアダプタで
+    generate を呼びます (ドラフトと静的デコーダは既定のアダプタでだけ使います)。
+    `prompt_encoder` (src.model.prompt_tokens.PromptEncoder) を渡した場合は、テンプレートの
+    固定部分のトークン化を使い回して、入力をデバイス上に直接作ります。
     """
-    torch.manual_seed(seed)
-    inputs = tokenizer(prompt, return_tensors="pt").to(device)
+    import time
+
+    from src.model.generation_stats import (
+        GenerationStats,
+        StepTimerLogitsProcessor,
+        record_processor_stats,
+    )
+    from src.model.sampling import SeededSamplingLogitsProcessor
+    from transformers import LogitsProcessorList
+
+    stats = stats if stats is not None else GenerationStats()
+
+    tokenize_started_at = time.perf_counter()
+    with span("tokenize"):
+        if prompt_encoder is not None:
+            inputs = prompt_encoder.model_inputs(prompt, device)
+        else:
+            inputs = tokenizer(prompt, return_tensors="pt").to(device)
+    stats.tokenize_sec = time.perf_counter() - tokenize_started_at
+    logits_processors = LogitsProcessorList([processor])
+    if do_sample:
+        # サンプリングはグローバル乱数を使わない専用プロセッサで行い、generate は greedy で呼ぶ
+        logits_processors.append(SeededSamplingLogitsProcessor(seed, temperature=temperature))
+    # プリフィル/デコード時間を計測するため、先頭にタイマーを置く
+    step_timer = StepTimerLogitsProcessor()
+    logits_processors.insert(0, step_timer)
+    step_timer.start()
+    if adapter_name is not None:
+        output = model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            pad_token_id=tokenizer.eos_token_id,
+            logits_processor=logits_processors,
+            adapter_names=[adapter_name],
+        )
+    elif drafter is not None:
+        from src.model.speculative import speculative_generate
+
+        output = speculative_generate(
+            model,
+            inputs["input_ids"],
+            logits_processors,
+            drafter,
+            max_new_tokens=max_new_tokens,
+            # generate と同じく、モデルの generation_config の EOS で止める
+            eos_token_id=model.generation_config.eos_token_id or tokenizer.eos_token_id,
+            num_draft_tokens=num_draft_tokens,
+            stats=stats,
+        )
+    elif decoder is not None:
+        output = decoder.generate(
+            inputs["input_ids"],
+            logits_processors,
+            max_new_tokens=max_new_tokens,
+            eos_token_id=model.generation_config.eos_token_id or tokenizer.eos_token_id,
+            pad_token_id=tokenizer.eos_token_id,
+        )
+    else:
+        output = model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            pad_token_id=tokenizer.eos_token_id,
+            logits_processor=logits_processors,
+        )
+    step_timer.finish(stats)
+    stats.prompt_tokens = inputs["input_ids"].shape[1]
+    stats.new_tokens = output.shape[1] - stats.prompt_tokens
+    record_processor_stats(stats, processor)
+
+    # generate() の内部はコードで囲めないため、計測済みの区間を span として記録する
+    record_span(
+        "prefill",
+        step_timer.started_at,
+        step_timer.first_step_at,
+        prompt_tokens=stats.prompt_tokens,
+    )
+    record_span(
+        "decode", step_timer.first_step_at, step_timer.finished_at, new_tokens=stats.new_tokens
+    )
+    # LogitsProcessor の時間はデコード区間に分散しているため、合計時間として記録する
+    record_span(
+        "logits_processing",
+        step_timer.first_step_at,
+        step_timer.first_step_at + stats.processor_sec,
+        steps=stats.processor_steps,
+        interventions=stats.processor_interventions,
+    )
+    trace = current_span()
+    if trace.recording and hasattr(processor, "allowed_token_ids"):
+        trace.set(
+            "allowed_notes",
+            processor.note_tokenizer.ids_to_string(processor.allowed_token_ids),
+        )
+
+    with span("decode_to_text"):
+        return tokenizer.decode(output[0])
+
+
+@traced()
+def generate_midi_batch(
+    model,
+    tokenizer,
+    device,
+    prompts: list[str],
+    processors: list,
+    seeds: list[int],
+    max_new_tokens: int = 128,
+    temperature: float = 0.75,
+    do_sample: bool = True,
+    stats=None,
+    adapter_names: list[str] | None = None,
+    prompt_encoder=None,
+) -> list[str]:
+    """
+    複数のプロンプトを1回の `generate` でまとめて生成し、行ごとのテキストを返します。
+    プロンプトは左詰めでパディングし、行ごとに processors[i] と seeds[i] を使います。
+    返すテキストは generate_midi_from_model と同じく、プロンプトを含み最初の EOS までです。
+    `stats` (GenerationStats) にはバッチ全体の処理時間と、全行の合計トークン数を書き込みます。
+    `adapter_names` を渡した場合は、行ごとにその peft のアダプタで生成します。
+    `prompt_encoder` を渡した場合は、generate_midi_from_model と同じくそれでトークン化します。
+    """
+    import time
+
+    from src.model.generation_stats import (
+        GenerationStats,
+        StepTimerLogitsProcessor,
+        record_processor_stats,
+    )
+    from src.model.melody_processor import PerRowLogitsProcessor
+    from src.model.sampling import SeededSamplingLogitsProcessor
+    from transformers import LogitsProcessorList
+
+    stats = stats if stats is not None else GenerationStats()
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    tokenize_started_at = time.perf_counter()
+    with span("tokenize", batch_size=len(prompts)):
+        if prompt_encoder is not None:
+            inputs = prompt_encoder.batch_model_inputs(prompts, device, tokenizer.pad_token_id)
+        else:
+            inputs = tokenizer(prompts, return_tensors="pt", padding=True, padding_side="left").to(
+                device
+            )
+    stats.tokenize_sec = time.perf_counter() - tokenize_started_at
+    processor = PerRowLogitsProcessor(processors)
     logits_processors = LogitsProcessorList([processor])
+    if do_sample:
+        logits_processors.append(SeededSamplingLogitsProcessor(seeds, temperature=temperature))
+    step_timer = StepTimerLogitsProcessor()
+    logits_processors.insert(0, step_timer)
+    step_timer.start()
+    # adapter_names は peft のモデルだけが受け付けるため、指定された場合だけ渡す
+    adapter_kwargs = {"adapter_names": adapter_names} if adapter_names is not None else {}
     output = model.generate(
         **inputs,
-        max_new_tokens=128,
-        temperature=0.75,
-        pad_token_id=tokenizer.eos_token_id,
+        max_new_tokens=max_new_tokens,
+        do_sample=False,
+        pad_token_id=tokenizer.pad_token_id,
         logits_processor=logits_processors,
+        **adapter_kwargs,
     )
-    if APP_ENV != "production":
-        # 'weave'がインポートされている場合のみ実行
-        try:
-            import weave
-
-            weave.summary(
-                {
-                    "allowed_notes": processor.note_tokenizer.ids_to_string(
-                        processor.allowed_token_ids
-                    )
-                }
-            )
-        except ImportError:
-            pass  # weaveがなければ何もしない
-    return tokenizer.decode(output[0])
+    step_timer.finish(stats)
+
+    padded_length = inputs["input_ids"].shape[1]
+    prompt_lengths = inputs["attention_mask"].sum(dim=1).tolist()
+    texts = []
+    stats.prompt_tokens, stats.new_tokens = sum(prompt_lengths), 0
+    with span("decode_to_text"):
+        for row, prompt_length in enumerate(prompt_lengths):
+            generated = output[row, padded_length:].tolist()
+            # 先に終わった行は EOS の後ろがパディングで埋まっている
+            if tokenizer.eos_token_id in generated:
+                generated = generated[: generated.index(tokenizer.eos_token_id) + 1]
+            stats.new_tokens += len(generated)
+            prompt_ids = output[row, padded_length - prompt_length : padded_length].tolist()
+            texts.append(tokenizer.decode(prompt_ids + generated))
+    record_processor_stats(stats, processor)
+    record_span(
+        "prefill",
+        step_timer.started_at,
+        step_timer.first_step_at,
+        prompt_tokens=stats.prompt_tokens,
+        batch_size=len(prompts),
+    )
+    record_span(
+        "decode", step_timer.first_step_at, step_timer.finished_at, new_tokens=stats.new_tokens
+    )
+    return texts
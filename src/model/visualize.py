@@ -1,22 +1,26 @@
 import base64
 import io
-from typing import Any
+from typing import TYPE_CHECKING, Any
 
-import matplotlib.pyplot as plt
-from matplotlib.ticker import MultipleLocator
-from PIL import Image
-import pretty_midi
-import weave
+from src.model.tracing import weave_op
 
+# matplotlib / pretty_midi / PIL / weave は import が重いため、各関数内で遅延 import する
+if TYPE_CHECKING:
+    from PIL import Image
 
-@weave.op()
-def create_pianoroll_image(parsed_notes: list[dict[str, Any]]) -> Image.Image | None:
+
+@weave_op
+def create_pianoroll_image(parsed_notes: list[dict[str, Any]]) -> "Image.Image | None":
     """
     パースされたノート情報からピアノロール画像を生成し、Pillow Imageオブジェクトとして返す。
     """
     if not parsed_notes:
         return None
 
+    import matplotlib.pyplot as plt
+    from PIL import Image
+    import pretty_midi
+
     pm = pretty_midi.PrettyMIDI()
     instrument = pretty_midi.Instrument(program=0)
 
@@ -66,6 +70,9 @@ def plot_melodies(cache: dict):
     ノートをプロットする関数。
     x軸を非表示にし、y軸に12間隔の補助線を追加します。
     """
+    import matplotlib.pyplot as plt
+    from matplotlib.ticker import MultipleLocator
+
     chord_melodies = cache.get("chord_melodies", {})
 
     # プロットの準備
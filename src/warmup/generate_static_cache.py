@@ -1,5 +1,3 @@
-import unsloth  # noqa: F401
-import hashlib
 import io
 import itertools
 import json
@@ -7,19 +5,21 @@ import os
 from pathlib import Path
 import re
 import sys
+from typing import TYPE_CHECKING
 
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
-from fastapi import Response
 from loguru import logger
-import matplotlib.pyplot as plt
-from PIL import Image
-from src.api.main import generate_melody
-from src.model.utils import load_model_and_tokenizer  # 共通関数をインポート
+from src.api.canonical import canonical_progression, static_cache_key
+from src.model.telemetry import AsyncBatchExporter
+from src.model.tracing import weave_op
 from src.model.visualize import plot_melodies
-from tqdm import tqdm
-import wandb
-import weave
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+# NOTE: unsloth / torch / matplotlib / weave / wandb や API モジュールは import が重いため、
+# main() 内で遅延 import する。移調ロジックなどを import するだけのツールの起動を速くするため。
 
 load_dotenv()
 
@@ -28,8 +28,6 @@ logger.remove()
 # 標準出力にINFOレベル以上を出力するハンドラを追加
 logger.add(sys.stdout, level="INFO")
 
-run = wandb.init(entity=os.environ["WANDB_ENTITY"], project=os.environ["WANDB_PROJECT"])
-
 
 # --- パス設定 ---
 PROJECT_ROOT = Path(__file__).resolve().parents[2]
@@ -147,8 +145,11 @@ def get_chord_progressions_from_html(file_path: Path) -> list[dict]:
         return []
 
 
-@weave.op()
-def plot_melodies_weave(response, **kwargs):
+def render_melodies_image(response) -> "Image.Image":
+    """生成結果のピアノロールを描画して Pillow Image として返す。"""
+    import matplotlib.pyplot as plt
+    from PIL import Image
+
     fig = plot_melodies(response)
     buf = io.BytesIO()
     plt.savefig(buf, format="png")
@@ -158,17 +159,39 @@ def plot_melodies_weave(response, **kwargs):
     return Image.open(buf)
 
 
+@weave_op
+def log_melodies_plot(response, image, **kwargs) -> None:
+    """生成結果とピアノロール画像を weave に記録する (バックグラウンドスレッドから呼ばれる)。"""
+
+
+def _upload_melodies_plots(batch: list[tuple[dict, "Image.Image", dict]]) -> None:
+    for response, image, generate_options in batch:
+        log_melodies_plot(response, image, **generate_options)
+
+
 # --- メイン処理 ---
 def main(
     supress_token_prob_ratio: float = 0.3,
     instrument: str = "Alto Saxophone",
 ):
+    from fastapi import Response
+    from tqdm import tqdm
+    import wandb
+    import weave
+
+    from src.api.main import generate_melody, load_model
+
+    wandb.init(entity=os.environ["WANDB_ENTITY"], project=os.environ["WANDB_PROJECT"])
+
     # Weaveを初期化
     weave.init(os.environ["WANDB_PROJECT"])
 
-    # 共通関数でモデルを読み込む
-    model, tokenizer, note_tokenizer_helper, device = load_model_and_tokenizer(MODEL_NAME)
-    if not model:
+    # weave へのアップロードはバックグラウンドで行い、生成ループを待たせない
+    # (TELEMETRY_SAMPLE_RATE で間引き、キューが満杯なら捨てる)
+    plot_uploader = AsyncBatchExporter.from_env(_upload_melodies_plots, name="melody-plot")
+
+    # API モジュールと同じモデル (環境変数 MODEL_NAME) を一度だけ読み込む
+    if not load_model():
         return
 
     # APP HTML からコード進行を読み込む
@@ -192,8 +215,11 @@ def main(
             # 変数を作成
             original_prog = prog_info["progression"]
             original_key = prog_info["original_key"]
-            transposed_prog = transpose_progression(original_prog, original_key, target_key)
-            prog_hash = hashlib.md5(transposed_prog.encode()).hexdigest()
+            # API と同じ正規表記にそろえる (フロントエンドは md5(コード進行) でパスを作る)
+            transposed_prog = canonical_progression(
+                transpose_progression(original_prog, original_key, target_key)
+            )
+            prog_hash = static_cache_key(transposed_prog)
 
             # プログレスバーを更新
             pbar.set_description(f"Hash: {prog_hash}, Style: {style}, Variation: {var}")
@@ -225,11 +251,16 @@ def main(
             try:
                 with open(output_file, "w", encoding="utf-8") as fo:
                     json.dump(response, fo)
-                plot_melodies_weave(response, **generate_options).save(png_file)
+                image = render_melodies_image(response)
+                image.save(png_file)
+                plot_uploader.submit((response, image, generate_options))
 
             except Exception as e:
                 tqdm.write(f"❌ FAILED to generate {output_file}: {e}")
 
+    logger.info("⏳ Waiting for telemetry uploads...")
+    plot_uploader.close(timeout=None)
+    logger.info(f"📡 Telemetry: {plot_uploader.stats()}")
     logger.info("🎉 Static cache generation finished!")
 
 
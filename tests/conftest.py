@@ -0,0 +1,22 @@
+import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+# tiny_model の語彙数 (MockTokenizer のピッチ 0〜127 + 改行 + EOS など)
+VOCAB_SIZE = 130
+
+
+@pytest.fixture(scope="module")
+def tiny_model():
+    """乱数初期化された小さな Llama モデル (generate・量子化・エクスポートの確認用)"""
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=VOCAB_SIZE,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        max_position_embeddings=256,
+    )
+    return LlamaForCausalLM(config).eval()
@@ -0,0 +1,79 @@
+import json
+
+import pytest
+from src.model.adapters import (
+    AdapterRegistry,
+    adapter_memory_bytes,
+    check_same_base,
+    parse_adapter_specs,
+)
+from torch import nn
+
+
+class LoraLinear(nn.Module):
+    """peft の LoRA 層と同じ名前の付け方 (lora_A.<アダプタ名>.weight) の層。"""
+
+    def __init__(self, adapters):
+        super().__init__()
+        self.base_layer = nn.Linear(8, 8, bias=False)
+        self.lora_A = nn.ModuleDict({name: nn.Linear(8, 2, bias=False) for name in adapters})
+        self.lora_B = nn.ModuleDict({name: nn.Linear(2, 8, bias=False) for name in adapters})
+
+
+class TinyPeftModel(nn.Module):
+    def __init__(self, adapters):
+        super().__init__()
+        self.q_proj = LoraLinear(adapters)
+        self.v_proj = LoraLinear(adapters)
+
+
+def write_adapter(path, base):
+    path.mkdir()
+    (path / "adapter_config.json").write_text(json.dumps({"base_model_name_or_path": base}))
+    return str(path)
+
+
+def test_parse_adapter_specs():
+    specs = parse_adapter_specs(" e2=models/e2-llama-midi.pth/, models/e5-llama-midi.pth/ ,")
+    assert specs == {
+        "e2": "models/e2-llama-midi.pth/",
+        "e5-llama-midi": "models/e5-llama-midi.pth/",
+    }
+    assert list(specs) == ["e2", "e5-llama-midi"]
+    assert parse_adapter_specs("") == {}
+
+
+@pytest.mark.parametrize("spec", ["e2=a,e2=b", "=models/a", "e2="])
+def test_parse_adapter_specs_rejects_invalid(spec):
+    with pytest.raises(ValueError):
+        parse_adapter_specs(spec)
+
+
+def test_check_same_base(tmp_path):
+    a = write_adapter(tmp_path / "a", "dx2102/llama-midi")
+    b = write_adapter(tmp_path / "b", "dx2102/llama-midi")
+    other = write_adapter(tmp_path / "other", "meta-llama/Llama-3.2-1B")
+    assert check_same_base([a, b]) == "dx2102/llama-midi"
+    with pytest.raises(ValueError, match="share one base"):
+        check_same_base([a, other])
+    with pytest.raises(ValueError, match="Not a LoRA adapter"):
+        check_same_base([a, str(tmp_path)])
+
+
+def test_memory_bytes_splits_base_and_adapters():
+    model = TinyPeftModel(["default", "e2"])
+    # 1層あたり A (2x8) + B (8x2) = 32 パラメータ、2層 × float32
+    assert adapter_memory_bytes(model) == {"default": 256, "e2": 256}
+    registry = AdapterRegistry(model, "default", {"e2": "models/e2-llama-midi.pth/"})
+    assert registry.memory_bytes() == {"base": 2 * 64 * 4, "default": 256, "e2": 256}
+    model.half()
+    assert registry.memory_bytes()["e2"] == 128
+
+
+def test_peft_name():
+    registry = AdapterRegistry(TinyPeftModel(["default"]), "default", {"e2": "a"})
+    assert registry.names == ["e2"]
+    assert registry.peft_name("") == "default"
+    assert registry.peft_name("e2") == "e2"
+    with pytest.raises(ValueError, match="Unknown model"):
+        registry.peft_name("e9")
@@ -0,0 +1,141 @@
+import threading
+import time
+
+import pytest
+from src.api import metrics
+from src.api.admission import AdmissionController, AdmissionRejected
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.005)
+    return False
+
+
+class Holder:
+    """admit() の中で release が立つまで待つスレッド。"""
+
+    def __init__(self, controller, client, order):
+        self.release = threading.Event()
+        self.error = None
+
+        def run():
+            try:
+                with controller.admit(client):
+                    order.append(client)
+                    self.release.wait(2.0)
+            except AdmissionRejected as e:
+                self.error = e
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+
+def test_admits_up_to_max_concurrency():
+    controller = AdmissionController(max_concurrency=2)
+    order = []
+    holders = [Holder(controller, f"c{i}", order) for i in range(3)]
+    assert wait_until(lambda: controller.inflight == 2 and controller.queued == 1)
+    assert metrics.ADMISSION_INFLIGHT.get() == 2
+    for holder in holders:
+        holder.release.set()
+    assert wait_until(lambda: len(order) == 3 and controller.inflight == 0)
+
+
+def test_round_robin_across_clients():
+    controller = AdmissionController(max_concurrency=1)
+    order = []
+    first = Holder(controller, "busy", order)
+    assert wait_until(lambda: controller.inflight == 1)
+    waiting = []
+    for count, client in enumerate(("busy", "busy", "busy", "other"), start=1):
+        waiting.append(Holder(controller, client, order))
+        assert wait_until(lambda count=count: controller.queued == count)
+    for holder in [first, *waiting]:
+        holder.release.set()
+    assert wait_until(lambda: len(order) == 5)
+    # 後から来た other は、busy の残りより先に通る
+    assert order == ["busy", "busy", "other", "busy", "busy"]
+
+
+def test_rejects_when_client_queue_is_full():
+    controller = AdmissionController(max_concurrency=1, max_queue_per_client=1)
+    order = []
+    holders = [Holder(controller, "a", order), Holder(controller, "a", order)]
+    assert wait_until(lambda: controller.queued == 1)
+    before = metrics.ADMISSION_REJECTIONS.get(reason="client_limit")
+    with pytest.raises(AdmissionRejected) as excinfo, controller.admit("a"):
+        pass
+    assert excinfo.value.reason == "client_limit"
+    assert metrics.ADMISSION_REJECTIONS.get(reason="client_limit") == before + 1
+    # 他のクライアントはまだ待ち行列に入れる
+    holders.append(Holder(controller, "b", order))
+    assert wait_until(lambda: controller.queued == 2)
+    for holder in holders:
+        holder.release.set()
+    assert wait_until(lambda: len(order) == 3)
+
+
+def test_rejects_when_queue_is_full():
+    controller = AdmissionController(max_concurrency=1, max_queue=1)
+    order = []
+    holders = [Holder(controller, "a", order), Holder(controller, "b", order)]
+    assert wait_until(lambda: controller.queued == 1)
+    with pytest.raises(AdmissionRejected) as excinfo, controller.admit("c"):
+        pass
+    assert excinfo.value.reason == "queue_full"
+    for holder in holders:
+        holder.release.set()
+
+
+def test_rejects_after_max_wait():
+    controller = AdmissionController(max_concurrency=1, max_wait_sec=0.05)
+    order = []
+    holder = Holder(controller, "a", order)
+    assert wait_until(lambda: controller.inflight == 1)
+    with pytest.raises(AdmissionRejected) as excinfo, controller.admit("b"):
+        pass
+    assert excinfo.value.reason == "timeout"
+    assert controller.queued == 0
+    holder.release.set()
+
+
+def test_retry_after_from_observed_throughput():
+    controller = AdmissionController(max_concurrency=2)
+    assert controller.retry_after() == 1
+    controller.service_sec = 4.0
+    # 2件同時に4秒 = 0.5件/秒。新しい1件がはけるまで2秒
+    assert controller.retry_after() == 2
+    controller._queued = 5
+    assert controller.retry_after() == 12
+
+
+def test_raising_max_concurrency_admits_waiting_requests():
+    controller = AdmissionController(max_concurrency=1)
+    order = []
+    holders = [Holder(controller, f"c{i}", order) for i in range(3)]
+    assert wait_until(lambda: controller.inflight == 1 and controller.queued == 2)
+    controller.set_max_concurrency(3)
+    assert wait_until(lambda: controller.inflight == 3 and controller.queued == 0)
+    for holder in holders:
+        holder.release.set()
+    assert wait_until(lambda: len(order) == 3 and controller.inflight == 0)
+
+
+def test_observes_service_time():
+    controller = AdmissionController()
+    with controller.admit("a"):
+        time.sleep(0.02)
+    assert controller.service_sec >= 0.02
+
+
+def test_from_env(monkeypatch):
+    monkeypatch.setenv("ADMISSION_MAX_CONCURRENCY", "0")
+    assert AdmissionController.from_env() is None
+    monkeypatch.setenv("ADMISSION_MAX_CONCURRENCY", "3")
+    monkeypatch.setenv("ADMISSION_MAX_QUEUE_PER_CLIENT", "2")
+    controller = AdmissionController.from_env()
+    assert (controller.max_concurrency, controller.max_queue_per_client) == (3, 2)
@@ -0,0 +1,70 @@
+import pytest
+from src.model.bar_store import BarStore, bar_key, model_fingerprint
+
+
+def key(**overrides):
+    values = {
+        "prompt": "prompt",
+        "chord": "Dm7",
+        "supress_token_prob_ratio": 0.3,
+        "seed": 1,
+        "model_fingerprint": "model",
+    }
+    return bar_key(**{**values, **overrides})
+
+
+@pytest.mark.parametrize(
+    "overrides",
+    [
+        {"prompt": "other prompt"},
+        {"chord": "G7"},
+        {"supress_token_prob_ratio": 0.5},
+        {"seed": 2},
+        {"model_fingerprint": "other"},
+        {"max_new_tokens": 64},
+        {"temperature": 1.0},
+        {"lightweight_processor": True},
+    ],
+)
+def test_key_depends_on_every_input(overrides):
+    assert key() == key()
+    assert key(**overrides) != key()
+
+
+def test_memory_store_evicts_least_recently_used():
+    store = BarStore(max_entries=2)
+    store.put("a", "A")
+    store.put("b", "B")
+    assert store.get("a") == "A"
+    store.put("c", "C")
+    assert store.get("b") is None
+    assert (store.get("a"), store.get("c")) == ("A", "C")
+    assert len(store) == 2
+    assert (store.hits, store.misses) == (3, 1)
+
+
+def test_directory_is_shared_between_instances(tmp_path):
+    key_ = key()
+    BarStore(directory=tmp_path).put(key_, "60 480 0 100 0\n")
+    assert (tmp_path / key_[:2] / f"{key_}.txt").exists()
+    other = BarStore(max_entries=0, directory=tmp_path)
+    assert other.get(key_) == "60 480 0 100 0\n"
+    assert other.get(key(seed=2)) is None
+    assert len(other) == 0
+
+
+def test_model_fingerprint_changes_with_directory_contents(tmp_path):
+    (tmp_path / "adapter_config.json").write_text("{}")
+    before = model_fingerprint(str(tmp_path))
+    (tmp_path / "adapter_model.safetensors").write_bytes(b"weights")
+    assert model_fingerprint(str(tmp_path)) != before
+    assert model_fingerprint("org/model") == model_fingerprint("org/model")
+
+
+def test_from_env(monkeypatch, tmp_path):
+    monkeypatch.setenv("BAR_CACHE_SIZE", "0")
+    monkeypatch.delenv("BAR_CACHE_DIR", raising=False)
+    assert BarStore.from_env() is None
+    monkeypatch.setenv("BAR_CACHE_DIR", str(tmp_path))
+    store = BarStore.from_env()
+    assert (store.max_entries, store.directory) == (0, tmp_path)
@@ -0,0 +1,102 @@
+import hashlib
+from urllib.parse import parse_qsl
+
+import pytest
+from src.api import canonical
+from src.warmup.generate_static_cache import (
+    ALL_KEYS,
+    APP_HTML_PATH,
+    get_chord_progressions_from_html,
+    transpose_progression,
+)
+
+
+@pytest.mark.parametrize("spelling", ["Dm7 - G7", "Dm7-G7", "dm7 -G7", " Dm7  -  g7 "])
+def test_progression_spellings_share_one_canonical_form(spelling):
+    assert canonical.canonical_progression(spelling) == "Dm7 - G7"
+    assert canonical.static_cache_key(spelling) == hashlib.md5(b"Dm7 - G7").hexdigest()
+
+
+@pytest.mark.parametrize("progression", ["Dm7 - ", ""])
+def test_empty_chord_raises(progression):
+    with pytest.raises(ValueError):
+        canonical.canonical_progression(progression)
+
+
+@pytest.mark.parametrize(
+    ("progression", "expected"),
+    [(" C-7 - F7 ", "C-7 - F7"), ("Dm7 - Hm7", "Dm7 - Hm7")],
+)
+def test_unparseable_progression_passes_through(progression, expected):
+    assert canonical.canonical_progression(progression) == expected
+    params = canonical.CanonicalParams.from_raw(progression, "JAZZ風")
+    assert params.chord_progression == expected
+
+
+def test_app_progressions_are_already_canonical():
+    """フロントエンドは md5(コード進行) で静的キャッシュを引くため、正規形である必要がある。"""
+    progressions = get_chord_progressions_from_html(APP_HTML_PATH)
+    assert progressions
+    for info in progressions:
+        for key in ALL_KEYS:
+            transposed = transpose_progression(info["progression"], info["original_key"], key)
+            assert canonical.canonical_progression(transposed) == transposed
+
+
+def test_query_string_orders_fields_and_omits_defaults():
+    params = canonical.CanonicalParams.from_raw("dm7-G7", " JAZZ風 ", 2, 0.30, "alto  saxophone")
+    assert params.key == ("Dm7 - G7", "JAZZ風", 2, 0.3, "Alto Saxophone")
+    assert parse_qsl(params.query_string()) == [
+        ("chord_progression", "Dm7 - G7"),
+        ("style", "JAZZ風"),
+        ("variation", "2"),
+    ]
+    custom = canonical.CanonicalParams.from_raw("Dm7", "JAZZ風", 1, 0.25, "flute")
+    assert parse_qsl(custom.query_string("midi")) == [
+        ("chord_progression", "Dm7"),
+        ("style", "JAZZ風"),
+        ("variation", "1"),
+        ("supress_token_prob_ratio", "0.25"),
+        ("instrument", "Flute"),
+        ("format", "midi"),
+    ]
+
+
+def test_model_parameter_extends_key_and_query_string():
+    default = canonical.CanonicalParams.from_raw("Dm7", "JAZZ風")
+    adapter = canonical.CanonicalParams.from_raw("Dm7", "JAZZ風", model=" e2 ")
+    assert adapter.key == (*default.key, "e2")
+    assert parse_qsl(adapter.query_string())[-1] == ("model", "e2")
+    assert adapter.etag("model-1", "json") != default.etag("model-1", "json")
+
+
+def test_etag_depends_on_canonical_key_model_and_format():
+    a = canonical.CanonicalParams.from_raw("Dm7 - G7", "JAZZ風")
+    b = canonical.CanonicalParams.from_raw("dm7-g7", "JAZZ風")
+    assert a.etag("model-1", "json") == b.etag("model-1", "json")
+    assert a.etag("model-1", "json").startswith('"')
+    assert a.etag("model-1", "json") != a.etag("model-2", "json")
+    assert a.etag("model-1", "json") != a.etag("model-1", "midi")
+
+
+def test_model_fingerprint_changes_when_files_change(tmp_path):
+    (tmp_path / "adapter_config.json").write_text("{}")
+    before = canonical.model_fingerprint(str(tmp_path))
+    assert canonical.model_fingerprint(str(tmp_path)) == before
+    (tmp_path / "adapter_model.safetensors").write_bytes(b"weights")
+    assert canonical.model_fingerprint(str(tmp_path)) != before
+
+
+@pytest.mark.parametrize(
+    "header, expected",
+    [
+        (None, False),
+        ('"abc"', True),
+        ('W/"abc"', True),
+        ('"x", "abc"', True),
+        ("*", True),
+        ('"x"', False),
+    ],
+)
+def test_if_none_match(header, expected):
+    assert canonical.if_none_match(header, '"abc"') is expected
@@ -1,5 +1,5 @@
 import pytest
-from src.model.chord_name_parser import parse_chord_name
+from src.model.chord_name_parser import canonical_chord_name, parse_chord_name
 
 
 # --- 正常系のテストケース ---
@@ -52,3 +52,24 @@ def test_parse_chord_name_invalid(invalid_chord_name):
     """
     with pytest.raises(ValueError):
         parse_chord_name(invalid_chord_name)
+
+
+# --- 正規表記のテストケース ---
+@pytest.mark.parametrize(
+    "chord_name, expected",
+    [
+        ("Dm7", "Dm7"),
+        ("dm7", "Dm7"),
+        (" D m7 ", "Dm7"),
+        ("Cmaj7", "CM7"),
+        ("DBmaj7", "DbM7"),
+        ("c#min", "C#m"),
+        ("C7b9", "C7b9"),
+        ("C7(b9)", "C7(b9)"),
+        ("G7(b9, b13)", "G7(b9,b13)"),
+    ],
+)
+def test_canonical_chord_name(chord_name, expected):
+    assert canonical_chord_name(chord_name) == expected
+    # 正規表記は解析結果を変えない
+    assert parse_chord_name(canonical_chord_name(chord_name)) == parse_chord_name(chord_name)
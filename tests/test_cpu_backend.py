@@ -0,0 +1,66 @@
+from unittest.mock import MagicMock
+
+import pytest
+from src.model import cpu_backend
+from src.model.melody_processor import NoteTokenizer
+import torch
+
+from tests.test_melody_processor import MockTokenizer
+
+
+@pytest.fixture(scope="module")
+def note_tokenizer():
+    return NoteTokenizer(MockTokenizer())
+
+
+def test_validate_backend():
+    assert cpu_backend.validate_backend("cpu-int8") == "cpu-int8"
+    with pytest.raises(ValueError):
+        cpu_backend.validate_backend("gpu-int4")
+
+
+def test_default_num_threads(monkeypatch):
+    monkeypatch.setenv("CPU_NUM_THREADS", "3")
+    assert cpu_backend.default_num_threads(lanes=2) == 3
+    monkeypatch.delenv("CPU_NUM_THREADS")
+    monkeypatch.setattr(cpu_backend.os, "sched_getaffinity", lambda pid: set(range(8)))
+    assert cpu_backend.default_num_threads() == 8
+    assert cpu_backend.default_num_threads(lanes=3) == 2
+    assert cpu_backend.default_num_threads(lanes=16) == 1
+
+
+def test_quantize_int8_replaces_linear_layers(tiny_model):
+    model = cpu_backend.quantize_int8(tiny_model)
+    assert not any(type(module) is torch.nn.Linear for module in model.modules())
+    logits = model(torch.tensor([[1, 2, 3]])).logits
+    assert logits.dtype == torch.float32
+    assert logits.shape[-1] == 130
+
+
+def test_compatibility_report_from_output(note_tokenizer):
+    processor = MagicMock(steps=10, interventions=4)
+    # C のスケール (C, E, G) だけを許可する
+    processor.allowed_token_ids = {
+        note_tokenizer.pitch_to_token_id(pitch) for pitch in (60, 64, 67)
+    }
+    text = (
+        "prompt\npitch duration wait velocity instrument\n"
+        "60 250 250 80 65\n61 250 250 80 65\n67 250 0 80 65\n72 250"
+    )
+    report = cpu_backend.CompatibilityReport.from_output(text, processor, note_tokenizer)
+    assert report.note_texts == ["60 250 250 80 65", "61 250 250 80 65", "67 250 0 80 65"]
+    assert report.in_scale_notes == 2
+    assert report.ok
+
+
+def test_check_processor_compatibility_fails_without_notes(monkeypatch, note_tokenizer):
+    def fake_generate(model, tokenizer, device, prompt, processor, seed, max_new_tokens):
+        scores = torch.zeros(1, 130)
+        processor(torch.tensor([[62, 66]]), scores)
+        return prompt + "not a melody"
+
+    monkeypatch.setattr("src.model.utils.generate_midi_from_model", fake_generate)
+    report = cpu_backend.check_processor_compatibility(None, None, note_tokenizer, "cpu")
+    assert report.processor_steps == 1
+    assert report.note_lines == 0
+    assert not report.ok
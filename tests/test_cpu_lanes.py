@@ -0,0 +1,145 @@
+import threading
+import time
+
+import pytest
+from src.api.inference_worker import BarJob, BarResult, InferenceWorker, build_lane_planner
+from src.model import cpu_lanes
+import torch
+
+# 2ソケット x 2コア x 2スレッド (ハイパースレッドの兄弟は cpu n と n+4)
+CPUS = list(range(8))
+CORE_IDS = {cpu: (cpu % 4 // 2, cpu % 2) for cpu in CPUS}
+
+
+def test_validate_lane_spec():
+    for spec in ("", "auto", "1", "4"):
+        assert cpu_lanes.validate_lane_spec(spec) == spec
+    for spec in ("0", "-1", "two", "auto2"):
+        with pytest.raises(ValueError):
+            cpu_lanes.validate_lane_spec(spec)
+
+
+def test_lanes_reject_static_decode():
+    cpu_lanes.validate_lane_decode_mode("auto", "eager")
+    cpu_lanes.validate_lane_decode_mode("", "static")
+    with pytest.raises(ValueError):
+        cpu_lanes.validate_lane_decode_mode("2", "static")
+
+
+def test_read_core_ids_from_sysfs(tmp_path):
+    for cpu, (package, core) in {0: (0, 0), 1: (0, 1), 2: (0, 0)}.items():
+        topology = tmp_path / f"cpu{cpu}" / "topology"
+        topology.mkdir(parents=True)
+        (topology / "physical_package_id").write_text(f"{package}\n")
+        (topology / "core_id").write_text(f"{core}\n")
+    core_ids = cpu_lanes.read_core_ids([0, 1, 2, 3], topology_dir=tmp_path)
+    assert core_ids[0] == core_ids[2] == (0, 0)
+    assert core_ids[1] == (0, 1)
+    # トポロジーが読めない CPU は単独のコア
+    assert core_ids[3] == ("cpu", 3)
+
+
+def test_plan_keeps_hyperthreads_and_sockets_together():
+    plan = cpu_lanes.plan_lanes(2, CPUS, CORE_IDS)
+    assert plan.cpus == [[0, 4, 1, 5], [2, 6, 3, 7]]
+    assert plan.threads == [2, 2]
+
+    plan = cpu_lanes.plan_lanes(3, CPUS, CORE_IDS)
+    assert plan.cpus == [[0, 4, 1, 5], [2, 6], [3, 7]]
+    assert plan.threads == [2, 1, 1]
+
+
+def test_plan_splits_logical_cpus_when_lanes_exceed_cores():
+    plan = cpu_lanes.plan_lanes(8, CPUS, CORE_IDS)
+    assert sorted(cpu for lane in plan.cpus for cpu in lane) == CPUS
+    assert plan.threads == [1] * 8
+    with pytest.raises(ValueError):
+        cpu_lanes.plan_lanes(9, CPUS, CORE_IDS)
+
+
+def test_candidate_lane_counts():
+    assert cpu_lanes.candidate_lane_counts(1) == [1]
+    assert cpu_lanes.candidate_lane_counts(4) == [1, 2, 4]
+    assert cpu_lanes.candidate_lane_counts(6) == [1, 2, 4, 6]
+
+
+def test_select_lane_count_prefers_fewer_lanes_within_tolerance():
+    assert cpu_lanes.select_lane_count({1: 2.0, 2: 3.9, 4: 4.0}) == 2
+    assert cpu_lanes.select_lane_count({1: 2.0, 2: 3.0, 4: 4.0}) == 4
+    assert cpu_lanes.select_lane_count({1: 4.0, 2: 3.0}) == 1
+
+
+def test_tune_lanes_measures_each_candidate(monkeypatch):
+    pinned = []
+    monkeypatch.setattr(cpu_lanes, "pin_current_thread", lambda cpus, n: pinned.append(cpus))
+    # 1小節 10ms。同時に2本までは並列に進むが、それ以上はコアを奪い合って遅くなる
+    lock = threading.Lock()
+    active = [0]
+
+    def run_bar():
+        with lock:
+            active[0] += 1
+            concurrency = active[0]
+        time.sleep(0.01 * max(1, concurrency - 1))
+        with lock:
+            active[0] -= 1
+
+    plan = cpu_lanes.tune_lanes(
+        run_bar, candidates=[1, 2, 4], bars_per_lane=3, cpus=CPUS, core_ids=CORE_IDS
+    )
+    assert plan.num_lanes == 2
+    assert set(plan.throughput) == {1, 2, 4}
+    assert plan.throughput[2] > plan.throughput[1] * 1.5
+    assert len(pinned) == 1 + 2 + 4
+    assert plan.to_dict()["throughput"].keys() == {"1", "2", "4"}
+
+
+def test_pin_current_thread_sets_affinity_and_threads(monkeypatch):
+    calls = {}
+    monkeypatch.setattr(
+        cpu_lanes.os, "sched_setaffinity", lambda pid, cpus: calls.update(cpus=cpus)
+    )
+    previous = torch.get_num_threads()
+
+    def pin():
+        cpu_lanes.pin_current_thread([0], 1)
+        calls["threads"] = torch.get_num_threads()
+
+    thread = threading.Thread(target=pin)
+    thread.start()
+    thread.join()
+    assert calls == {"cpus": [0], "threads": 1}
+    # torch のスレッド数はスレッドごとの設定なので、呼び出し元は変わらない
+    assert torch.get_num_threads() == previous
+
+
+def test_worker_starts_one_pinned_thread_per_planned_lane(monkeypatch):
+    pinned = []
+    monkeypatch.setattr(
+        "src.api.inference_worker.pin_current_thread", lambda cpus, n: pinned.append((cpus, n))
+    )
+    plan = cpu_lanes.plan_lanes(2, CPUS, CORE_IDS)
+    worker = InferenceWorker(
+        loader=lambda: lambda job: BarResult(f"{job.chord}:{threading.current_thread().name}"),
+        num_lanes=1,
+        lane_planner=lambda generate_fn: plan,
+    )
+    worker.start(wait=True)
+    assert worker.status == "ready"
+    text = worker.submit(BarJob(prompt="p", chord="Dm7", seed=0)).result(timeout=5).text
+    assert text.startswith("Dm7:inference-lane-")
+    deadline = time.time() + 5
+    while len(pinned) < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    assert sorted(pinned) == sorted(zip(plan.cpus, plan.threads, strict=True))
+    health = worker.health()
+    assert health["lanes"] == 2
+    assert health["cpu_lanes"]["cpus"] == plan.cpus
+
+
+def test_build_lane_planner():
+    assert build_lane_planner("") is None
+    generate_fn = lambda job: BarResult("")  # noqa: E731
+    assert build_lane_planner("1")(generate_fn).num_lanes == 1
+    with pytest.raises(ValueError):
+        build_lane_planner("zero")
@@ -0,0 +1,70 @@
+import pytest
+from src.api.deadline import (
+    DEFAULT_MAX_NEW_TOKENS,
+    MIN_NEW_TOKENS,
+    NO_DEGRADATION,
+    LatencyModel,
+    budget_sec,
+)
+
+
+@pytest.fixture
+def model():
+    # 1小節 = prefill 0.1s + 101 トークン x 0.01s (うちプロセッサ 0.004s) = 1.11s
+    latency = LatencyModel()
+    latency.observe(
+        {"new_tokens": 101, "prefill_sec": 0.1, "decode_sec": 1.0, "processor_sec": 0.404}
+    )
+    return latency
+
+
+@pytest.mark.parametrize(
+    "deadline_ms, slo_ms, expected",
+    [(None, 0, None), (500, 0, 0.5), (None, 2000, 2.0), (500, 2000, 0.5), (3000, 2000, 2.0)],
+)
+def test_budget_is_the_tighter_of_deadline_and_slo(deadline_ms, slo_ms, expected):
+    assert budget_sec(deadline_ms, slo_ms) == expected
+
+
+def test_no_degradation_without_budget_or_observations(model):
+    assert model.plan(num_bars=4, queued_bars=0, budget=None) is NO_DEGRADATION
+    assert LatencyModel().plan(num_bars=4, queued_bars=0, budget=0.001) is NO_DEGRADATION
+
+
+def test_fits_within_budget(model):
+    plan = model.plan(num_bars=2, queued_bars=0, budget=5.0)
+    assert not plan.degraded
+    assert plan.header() == "none"
+    assert plan.estimated_sec == pytest.approx(2.22)
+
+
+def test_lightweight_processor_first(model):
+    plan = model.plan(num_bars=2, queued_bars=0, budget=1.5)
+    assert plan.steps == ("lightweight_processor",)
+    assert plan.lightweight_processor
+    assert plan.max_new_tokens == DEFAULT_MAX_NEW_TOKENS
+
+
+def test_queue_wait_counts_against_budget(model):
+    assert not model.plan(num_bars=1, queued_bars=0, budget=2.0).degraded
+    assert model.plan(num_bars=1, queued_bars=2, budget=2.0).degraded
+
+
+def test_reduces_tokens_to_fit(model):
+    plan = model.plan(num_bars=2, queued_bars=0, budget=0.9)
+    assert plan.steps == ("lightweight_processor", "reduced_tokens")
+    assert MIN_NEW_TOKENS <= plan.max_new_tokens < 100
+    assert plan.estimated_sec <= 0.9
+    assert not plan.use_cached
+
+
+def test_falls_back_to_cached_variation(model):
+    plan = model.plan(num_bars=2, queued_bars=0, budget=0.3)
+    assert plan.use_cached
+    assert plan.max_new_tokens == MIN_NEW_TOKENS
+
+
+def test_ignores_bars_without_decode_steps():
+    latency = LatencyModel()
+    latency.observe({"new_tokens": 1, "prefill_sec": 0.1, "decode_sec": 0.0})
+    assert not latency.ready
@@ -0,0 +1,75 @@
+import copy
+from unittest.mock import MagicMock
+
+import pytest
+from src.model import cpu_backend, fast_load
+from src.model.utils import load_model_and_tokenizer
+import torch
+
+from tests.test_melody_processor import MockTokenizer
+
+
+INPUT_IDS = torch.tensor([[5, 6, 7, 8]])
+
+
+def test_validate_quantization():
+    assert fast_load.validate_quantization("int8") == "int8"
+    with pytest.raises(ValueError):
+        fast_load.validate_quantization("gptq")
+
+
+def test_bf16_export_roundtrip(tiny_model, tmp_path):
+    model = copy.deepcopy(tiny_model).to(torch.bfloat16)
+    fast_load.save_export(model, MagicMock(), tmp_path, "bf16", source="models/tiny.pth/")
+    assert (tmp_path / "model.safetensors").is_file()
+    assert fast_load.read_export_config(str(tmp_path)) == {
+        "quantization": "bf16",
+        "source": "models/tiny.pth/",
+    }
+
+    loaded = fast_load.load_export(str(tmp_path), "cpu")
+    assert loaded.dtype == torch.bfloat16
+    torch.testing.assert_close(loaded(INPUT_IDS).logits, model(INPUT_IDS).logits)
+
+
+def test_int8_export_roundtrip(tiny_model, tmp_path):
+    model = cpu_backend.quantize_int8(tiny_model)
+    fast_load.save_export(model, MagicMock(), tmp_path, "int8")
+    assert fast_load.is_export(str(tmp_path))
+    assert fast_load.export_device(str(tmp_path)) == "cpu"
+
+    loaded = fast_load.load_export(str(tmp_path), "cpu")
+    assert not any(type(module) is torch.nn.Linear for module in loaded.modules())
+    # 量子化済みの重みをそのまま読み込むため、出力は量子化したモデルと一致する
+    assert torch.equal(loaded(INPUT_IDS).logits, model(INPUT_IDS).logits)
+
+
+def test_load_model_and_tokenizer_uses_export(tiny_model, tmp_path, monkeypatch):
+    fast_load.save_export(cpu_backend.quantize_int8(tiny_model), MagicMock(), tmp_path, "int8")
+    monkeypatch.setattr("transformers.AutoTokenizer.from_pretrained", lambda path: MockTokenizer())
+    # エクスポートの読み込みではマージ・量子化・互換性チェックを行わない
+    monkeypatch.setattr(cpu_backend, "quantize_int8", MagicMock(wraps=cpu_backend.quantize_int8))
+    monkeypatch.setattr(cpu_backend, "check_processor_compatibility", MagicMock())
+
+    model, _, _, device = load_model_and_tokenizer(str(tmp_path))
+    assert device == "cpu"
+    assert model(INPUT_IDS).logits.shape[-1] == 130
+    cpu_backend.check_processor_compatibility.assert_not_called()
+
+
+def test_cpu_int8_backend_uses_int8_export(tiny_model, tmp_path, monkeypatch):
+    model = cpu_backend.quantize_int8(tiny_model)
+    fast_load.save_export(model, MagicMock(), tmp_path, "int8")
+    monkeypatch.setattr("transformers.AutoTokenizer.from_pretrained", lambda path: MockTokenizer())
+    monkeypatch.setattr(cpu_backend, "_load_fp32", MagicMock())
+    monkeypatch.setattr(cpu_backend, "check_processor_compatibility", MagicMock())
+
+    loaded, _, _, device = load_model_and_tokenizer(str(tmp_path), backend="cpu-int8")
+    assert device == "cpu"
+    assert torch.equal(loaded(INPUT_IDS).logits, model(INPUT_IDS).logits)
+    cpu_backend._load_fp32.assert_not_called()
+    cpu_backend.check_processor_compatibility.assert_not_called()
+
+
+def test_non_export_directory(tmp_path):
+    assert not fast_load.is_export(str(tmp_path))
@@ -0,0 +1,30 @@
+from unittest.mock import MagicMock
+
+from src.model import generation_stats
+from src.model.generation_stats import GenerationStats, StepTimerLogitsProcessor
+import torch
+
+
+def test_step_timer_splits_prefill_and_decode():
+    timer = StepTimerLogitsProcessor()
+    timer.start()
+    scores = torch.zeros(1, 4)
+    assert timer(torch.zeros(1, 2, dtype=torch.long), scores) is scores
+    first_step_at = timer.first_step_at
+    timer(torch.zeros(1, 3, dtype=torch.long), scores)
+    assert timer.first_step_at == first_step_at
+    stats = GenerationStats()
+    timer.finish(stats)
+    assert stats.prefill_sec >= 0.0
+    assert stats.decode_sec >= 0.0
+
+
+def test_step_timer_synchronizes_cuda_once(monkeypatch):
+    synchronize = MagicMock()
+    monkeypatch.setattr(generation_stats.torch.cuda, "synchronize", synchronize)
+    scores = MagicMock(is_cuda=True, device="cuda:0")
+    timer = StepTimerLogitsProcessor()
+    timer.start()
+    for _ in range(3):
+        timer(None, scores)
+    synchronize.assert_called_once_with("cuda:0")
@@ -0,0 +1,81 @@
+"""
+軽量モジュールの import コストを `python -X importtime` で計測し、予算超過を検出するテスト。
+"""
+
+import os
+from pathlib import Path
+import subprocess
+import sys
+
+import pytest
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+
+# 軽量モジュールの import で読み込まれてはいけない重い依存ライブラリ
+HEAVY_MODULES = (
+    "unsloth",
+    "torch",
+    "transformers",
+    "weave",
+    "wandb",
+    "matplotlib",
+    "mido",
+    "pydub",
+)
+
+# モジュールごとの import 時間の予算 (ミリ秒, 累積)。
+# CI 環境の揺らぎを考慮して余裕を持たせ、環境変数で倍率を調整できるようにする。
+IMPORT_BUDGET_MS = {
+    "src.model.chord_name_parser": 50,
+    "src.model.audio": 300,
+    "src.model.visualize": 300,
+    "src.model.utils": 300,
+    "src.model.tracing": 50,
+    "src.model.telemetry": 50,
+    "src.warmup.generate_static_cache": 1000,
+}
+BUDGET_SCALE = float(os.getenv("IMPORT_BUDGET_SCALE", "1.0"))
+
+
+def measure_import(module: str) -> dict[str, int]:
+    """
+    サブプロセスで `python -X importtime -c "import <module>"` を実行し、
+    読み込まれたモジュール名と累積 import 時間 (マイクロ秒) の対応を返す。
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=PROJECT_ROOT,
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if result.returncode != 0:
+        pytest.skip(f"cannot import {module} in this environment: {result.stderr[-300:]}")
+
+    timings = {}
+    for line in result.stderr.splitlines():
+        # 形式: "import time:       self [us] |  cumulative | imported package"
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:") :].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        timings[fields[2].strip()] = int(fields[1])
+    return timings
+
+
+@pytest.mark.parametrize("module", sorted(IMPORT_BUDGET_MS))
+def test_light_module_does_not_import_heavy_dependencies(module):
+    timings = measure_import(module)
+    loaded_heavy = sorted(
+        name for name in timings if name.split(".")[0] in HEAVY_MODULES and "." not in name
+    )
+    assert loaded_heavy == [], f"{module} imports heavy dependencies: {loaded_heavy}"
+
+
+@pytest.mark.parametrize("module", sorted(IMPORT_BUDGET_MS))
+def test_light_module_import_time_within_budget(module):
+    timings = measure_import(module)
+    elapsed_ms = timings[module] / 1000
+    budget_ms = IMPORT_BUDGET_MS[module] * BUDGET_SCALE
+    assert elapsed_ms <= budget_ms, f"{module} took {elapsed_ms:.1f} ms (budget {budget_ms} ms)"
@@ -0,0 +1,154 @@
+from pathlib import Path
+import socket
+import tempfile
+import threading
+import time
+
+import pytest
+from src.api.inference_worker import (
+    BarBatchResult,
+    BarJob,
+    BarResult,
+    InferenceWorker,
+    InferenceWorkerClient,
+    InferenceWorkerServer,
+    WorkerBusyError,
+    WorkerUnavailableError,
+)
+
+
+def _wait_until(predicate, timeout: float = 5.0):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise TimeoutError("condition not met")
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def socket_path():
+    # Unix ソケットのパス長制限を避けるため、短い一時ディレクトリを使う
+    with tempfile.TemporaryDirectory(dir="/tmp") as tmp:
+        yield Path(tmp) / "worker.sock"
+
+
+@pytest.fixture
+def running_worker(socket_path):
+    """ジョブ内容をそのまま返す生成関数を持つワーカーをソケットで起動する"""
+    worker = InferenceWorker(
+        loader=lambda: lambda job: BarResult(f"{job.chord}:{job.seed}", {"new_tokens": 3}),
+        max_queue=4,
+        num_lanes=2,
+    )
+    worker.start()
+    _wait_until(lambda: worker.status == "ready")
+    server = InferenceWorkerServer(socket_path, worker)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield worker, InferenceWorkerClient(socket_path, timeout=5.0)
+    server.shutdown()
+    server.server_close()
+
+
+def test_generate_roundtrip(running_worker):
+    worker, client = running_worker
+    result = client.generate_bar(BarJob(prompt="p", chord="Dm7", seed=3))
+    assert result.text == "Dm7:3"
+    assert result.stats == {"new_tokens": 3}
+    health = client.health()
+    assert health["status"] == "ready"
+    assert health["processed"] == 1
+    assert health["lanes"] == 2
+
+
+def test_generate_batch_roundtrip(running_worker):
+    worker, client = running_worker
+    jobs = [BarJob(prompt="p", chord="Dm7", seed=1), BarJob(prompt="p", chord="G7", seed=2)]
+    # generate_batch を持たない生成関数の場合は、1件ずつ生成してまとめる
+    result = client.generate_batch(jobs)
+    assert result.texts == ["Dm7:1", "G7:2"]
+    assert client.health()["processed"] == 1
+
+
+def test_generate_batch_uses_batched_generate_fn(socket_path):
+    class BatchGenerator:
+        def __call__(self, job):
+            raise AssertionError("should generate as a batch")
+
+        def generate_batch(self, jobs):
+            return BarBatchResult([job.chord for job in jobs], {"new_tokens": len(jobs)})
+
+    worker = InferenceWorker(loader=BatchGenerator)
+    worker.start()
+    _wait_until(lambda: worker.status == "ready")
+    with InferenceWorkerServer(socket_path, worker) as server:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        result = InferenceWorkerClient(socket_path).generate_batch(
+            [BarJob("p", "C", 1), BarJob("p", "F", 2)]
+        )
+        server.shutdown()
+    assert result.texts == ["C", "F"]
+    assert result.stats == {"new_tokens": 2}
+
+
+def test_generation_error_is_reported(socket_path):
+    def failing_generate(job):
+        raise ValueError("boom")
+
+    worker = InferenceWorker(loader=lambda: failing_generate)
+    worker.start()
+    _wait_until(lambda: worker.status == "ready")
+    with InferenceWorkerServer(socket_path, worker) as server:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        with pytest.raises(RuntimeError, match="boom"):
+            InferenceWorkerClient(socket_path).generate_bar(BarJob("p", "C", 1))
+        server.shutdown()
+
+
+def test_full_queue_rejects_jobs():
+    release = threading.Event()
+
+    def blocking_generate(job):
+        release.wait(timeout=5)
+        return BarResult("done")
+
+    worker = InferenceWorker(loader=lambda: blocking_generate, max_queue=1, num_lanes=1)
+    worker.start()
+    _wait_until(lambda: worker.status == "ready")
+
+    running = worker.submit(BarJob("p", "C", 1))
+    _wait_until(lambda: worker.health()["inflight"] == 1)
+    queued = worker.submit(BarJob("p", "C", 2))
+    with pytest.raises(WorkerBusyError):
+        worker.submit(BarJob("p", "C", 3))
+    assert worker.health()["rejected"] == 1
+
+    release.set()
+    assert running.result(timeout=5).text == "done"
+    assert queued.result(timeout=5).text == "done"
+
+
+def test_loader_failure_marks_worker_unhealthy():
+    def broken_loader():
+        raise OSError("model not found")
+
+    worker = InferenceWorker(loader=broken_loader)
+    worker.start()
+    _wait_until(lambda: worker.status != "loading")
+    assert worker.health()["status"] == "error"
+    with pytest.raises(WorkerUnavailableError):
+        worker.submit(BarJob("p", "C", 1))
+
+
+def test_client_without_worker_is_unavailable(socket_path):
+    with pytest.raises(WorkerUnavailableError):
+        InferenceWorkerClient(socket_path).health()
+
+
+def test_client_timeout_is_unavailable(socket_path):
+    # 接続は受け付けるが応答しないワーカー
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(str(socket_path))
+        server.listen()
+        with pytest.raises(WorkerUnavailableError):
+            InferenceWorkerClient(socket_path, timeout=0.1).health(timeout=0.1)
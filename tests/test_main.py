@@ -0,0 +1,125 @@
+import json
+
+from fastapi import HTTPException, Response
+from fastapi.testclient import TestClient
+import pytest
+from src.api import canonical, main
+from src.api.inference_worker import WorkerBusyError, WorkerUnavailableError
+from src.api.response_cache import ResponseCache
+
+
+@pytest.mark.parametrize(
+    ("accept", "expected"),
+    [
+        ("audio/midi, application/vnd.melody-flow.bars;q=0.5", "midi"),
+        ("application/vnd.melody-flow.bars", "binary"),
+    ],
+)
+def test_accept_redirects_to_the_format_url(accept, expected):
+    params = canonical.CanonicalParams.from_raw("Dm7 - G7", "JAZZ風")
+    client = TestClient(main.app)
+    response = client.get(
+        f"/generate?{params.query_string()}", headers={"Accept": accept}, follow_redirects=False
+    )
+    assert response.status_code == 307
+    assert response.headers["location"] == f"/generate?{params.query_string(expected)}"
+    # 行き先は Accept で変わるため、nginx にもブラウザにもキャッシュさせない
+    assert response.headers["cache-control"] == "no-store"
+    assert response.headers["x-accel-expires"] == "0"
+
+
+@pytest.mark.parametrize(
+    "error", [WorkerBusyError("queue is full"), WorkerUnavailableError("down")]
+)
+def test_worker_errors_are_not_cached(monkeypatch, error):
+    def generate_chord_melodies(*args):
+        raise error
+
+    monkeypatch.setattr(main, "RESPONSE_CACHE", ResponseCache("test-worker-errors"))
+    monkeypatch.setattr(main, "generate_chord_melodies", generate_chord_melodies)
+    with pytest.raises(HTTPException) as raised:
+        main.generate_melody(Response(), "Dm7 - G7", "JAZZ風")
+    assert raised.value.status_code == 503
+    # 一時的な 503 を nginx が1分間返し続けないようにする
+    assert raised.value.headers["Cache-Control"] == "no-store"
+    assert raised.value.headers["X-Accel-Expires"] == "0"
+
+
+def test_budget_counts_bars_like_generation(monkeypatch):
+    planned = []
+
+    def plan(num_bars, queued_bars, budget):
+        planned.append(num_bars)
+        return main.deadline.NO_DEGRADATION
+
+    monkeypatch.setattr(main.LATENCY_MODEL, "plan", plan)
+    monkeypatch.setattr(main, "ADMISSION", None)
+    monkeypatch.setattr(main, "generate_melody", lambda *args, **kwargs: {"chord_melodies": {}})
+    # 解析できないコード進行は " - " でつながれずにそのまま届く
+    params = canonical.CanonicalParams.from_raw("Dm7-Xyz-C", "JAZZ風")
+    assert params.chord_progression == "Dm7-Xyz-C"
+    main._generate_within_budget(Response(), params, None, {})
+    assert planned == [3]
+
+
+def test_parallel_bars_skip_deadline_degradation(monkeypatch):
+    monkeypatch.setattr(main, "PARALLEL_BARS", True)
+    monkeypatch.setattr(main, "ADMISSION", None)
+    monkeypatch.setattr(main, "generate_melody", lambda *args, **kwargs: {"chord_melodies": {}})
+    # 小節を順に生成した統計があっても、並列生成のリクエストには当てはめない
+    latency_model = main.deadline.LatencyModel()
+    latency_model.observe({"new_tokens": 100, "prefill_sec": 1.0, "decode_sec": 9.9})
+    monkeypatch.setattr(main, "LATENCY_MODEL", latency_model)
+    headers = {}
+    params = canonical.CanonicalParams.from_raw("Dm7 - G7", "JAZZ風")
+    main._generate_within_budget(Response(), params, 100, headers)
+    assert main.DEGRADATION_HEADER not in headers
+    assert headers.get("Cache-Control") != "no-store"
+
+
+def test_health_reports_failed_model_load(monkeypatch):
+    monkeypatch.setattr(main, "WORKER_CLIENT", None)
+    monkeypatch.setattr(main, "REPLAY_SOURCE", "")
+    monkeypatch.setattr(main, "MODEL", None)
+    monkeypatch.setattr(main, "_MODEL_LOAD_ATTEMPTED", False)
+    assert main.health()["status"] == "loading"
+
+    monkeypatch.setattr(main, "_MODEL_LOAD_ATTEMPTED", True)
+    # 読み込み中 (load_model がロックを持っている間) は loading のまま
+    with main._MODEL_LOAD_LOCK:
+        assert main.health()["status"] == "loading"
+    response = main.health()
+    assert response.status_code == 503
+    assert json.loads(response.body) == {"backend": "local", "status": "error"}
+
+    monkeypatch.setattr(main, "REPLAY_SOURCE", "dist/")
+    monkeypatch.setattr(main, "REPLAY_GENERATOR", None)
+    assert json.loads(main.health().body)["status"] == "error"
+
+
+def test_load_melody_reads_the_memory_cache_once(monkeypatch):
+    cache = ResponseCache("test-load-melody")
+    monkeypatch.setattr(main, "RESPONSE_CACHE", cache)
+    monkeypatch.setattr(main, "schedule_next_variations", lambda params: None)
+    generated = []
+
+    def generate_within_budget(response, params, deadline_ms, headers, client):
+        generated.append(params.key)
+        return {"chord_melodies": {}}
+
+    monkeypatch.setattr(main, "_generate_within_budget", generate_within_budget)
+    params = canonical.CanonicalParams.from_raw("Dm7 - G7", "JAZZ風")
+    cached = {"chord_melodies": {"Dm7": ""}}
+    cache.put(params.key, cached)
+
+    headers = {}
+    assert main.load_melody(Response(), params, None, headers) is cached
+    assert headers[main.SOURCE_HEADER] == "memory"
+    assert generated == []
+
+    # 追い出された後は、受け付け制御を通る生成の経路に進む
+    cache.clear()
+    headers = {}
+    main.load_melody(Response(), params, None, headers)
+    assert generated == [params.key]
+    assert main.SOURCE_HEADER not in headers
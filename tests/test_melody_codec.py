@@ -0,0 +1,115 @@
+import base64
+import io
+
+import mido
+import pytest
+from src.api import melody_codec
+from src.api.melody_codec import BarNotes
+
+RAW_OUTPUT = """Generate the melody for this bar only. The output format is:
+pitch duration wait velocity instrument
+60 250 250 80 0
+64 500 480 96 0
+67 40000 -5 300 0
+72 12"""
+
+
+def test_parse_skips_truncated_lines():
+    bar = melody_codec.parse_note_lines("Cmaj7", melody_codec.extract_midi_note_data(RAW_OUTPUT))
+    assert bar.pitch == [60, 64, 67]
+    assert bar.duration == [250, 500, 40000]
+    assert bar.wait == [250, 480, -5]
+    assert bar.velocity == [80, 96, 300]
+
+
+def test_binary_roundtrip_keeps_keys_and_int16_alignment():
+    bars = [
+        BarNotes("Dm7", [62, 65], [250, 250], [250, 250], [80, 90]),
+        BarNotes("G7_2", [67], [500], [500], [100]),
+        BarNotes("C△7", [], [], [], []),
+    ]
+    data = melody_codec.encode_bars(bars)
+    assert melody_codec.decode_bars(data) == bars
+    # 3バイトのキー ("Dm7") の後ろは int16 配列のために偶数境界へパディングされる
+    assert data[8 + 4 + 3] == 0
+    assert len(data) % 2 == 0
+
+
+def test_binary_clamps_out_of_range_values():
+    bar = melody_codec.parse_note_lines("C", melody_codec.extract_midi_note_data(RAW_OUTPUT))
+    (decoded,) = melody_codec.decode_bars(melody_codec.encode_bars([bar]))
+    assert decoded.duration[2] == 32767
+    assert decoded.velocity[2] == 255
+
+
+def test_binary_is_smaller_than_json():
+    bar = BarNotes("Cmaj7", [60 + i for i in range(16)], [250] * 16, [250] * 16, [80] * 16)
+    payload = melody_codec.bars_to_json([bar])
+    assert melody_codec.bars_from_json(payload) == [bar]
+    json_size = len(payload["chord_melodies"]["Cmaj7"])
+    assert len(melody_codec.encode_bars([bar])) < json_size / 2
+
+
+def test_decode_rejects_foreign_payload():
+    with pytest.raises(ValueError):
+        melody_codec.decode_bars(b"PK\x03\x04" + bytes(4))
+
+
+@pytest.mark.parametrize(
+    ("requested", "accept", "expected"),
+    [
+        (None, None, "json"),
+        (None, "*/*", "json"),
+        (None, melody_codec.BINARY_MEDIA_TYPE, "binary"),
+        (None, f"application/json;q=0.5, {melody_codec.BINARY_MEDIA_TYPE}", "binary"),
+        (None, f"application/json, {melody_codec.BINARY_MEDIA_TYPE};q=0.1", "json"),
+        ("json", melody_codec.BINARY_MEDIA_TYPE, "json"),
+    ],
+)
+def test_negotiate_format(requested, accept, expected):
+    assert melody_codec.negotiate_format(requested, accept) == expected
+
+
+def test_json_payload_decodes_with_base64_helper():
+    encoded = base64.b64encode(b"60 250 250 80 0").decode()
+    (bar,) = melody_codec.bars_from_json({"chord_melodies": {"C": encoded}})
+    assert bar == BarNotes("C", [60], [250], [250], [80])
+
+
+def test_midi_uses_wait_for_onsets_and_marks_bars():
+    bars = [
+        BarNotes("Dm7", [62, 65], [250, 500], [250, 480], [80, 90]),
+        BarNotes("G7", [67], [300], [300], [100]),
+    ]
+    mid = mido.MidiFile(file=io.BytesIO(melody_codec.encode_midi(bars, "Alto Saxophone")))
+    assert mid.ticks_per_beat == melody_codec.MIDI_TICKS_PER_BEAT
+
+    now, onsets, offsets, markers = 0, [], [], []
+    for message in mid.tracks[0]:
+        now += message.time
+        if message.type == "note_on":
+            onsets.append((now, message.note))
+        elif message.type == "note_off":
+            offsets.append((now, message.note))
+        elif message.type == "marker":
+            markers.append((now, message.text))
+        elif message.type == "program_change":
+            assert message.program == melody_codec.GM_PROGRAMS["alto saxophone"]
+    assert onsets == [(0, 62), (250, 65), (730, 67)]
+    assert offsets == [(250, 62), (750, 65), (1030, 67)]
+    assert markers == [(0, "Dm7"), (730, "G7")]
+
+
+def test_splice_note_lines_replaces_only_the_head():
+    body = "60 250 250 80 65\n62 250 250 80 65\n64 250 250 80 65"
+    head = "70 100 100 90 65\n72 100 100 90 65\n74 100"
+    spliced = melody_codec.splice_note_lines(head, body, 2)
+    assert spliced == "70 100 100 90 65\n72 100 100 90 65\n64 250 250 80 65"
+    # 途中で切れた行は使わず、そろった行の数だけ置き換える
+    assert melody_codec.splice_note_lines("70 100 100 90 65\n72 1", body, 2).splitlines() == [
+        "70 100 100 90 65",
+        "62 250 250 80 65",
+        "64 250 250 80 65",
+    ]
+    assert melody_codec.skip_note_lines(body, 2) == "64 250 250 80 65"
+    assert melody_codec.skip_note_lines(body, 5) == ""
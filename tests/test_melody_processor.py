@@ -2,6 +2,7 @@ import pytest
 from src.model.melody_processor import (
     MelodyControlLogitsProcessor,
     NoteTokenizer,
+    PerRowLogitsProcessor,
 )
 import torch
 import torch.nn.functional as F
@@ -164,3 +165,63 @@ class TestMelodyControlLogitsProcessor:
             else:
                 # 許可されなかったトークンは確率が下がる
                 assert new_probs[0, token_id] < original_probs[0, token_id]
+
+    def test_call_counts_steps_and_interventions(self, note_tokenizer):
+        processor = MelodyControlLogitsProcessor("C", note_tokenizer)
+        vocab_size = note_tokenizer.tokenizer.vocab_size
+        token_id_60 = note_tokenizer.pitch_to_token_id(60)
+        processor(torch.LongTensor([[token_id_60]]), torch.zeros(1, vocab_size))
+        sequence = "60 1 1\n62 1 1\n64 1 1\n"
+        input_ids = torch.LongTensor(
+            [note_tokenizer.tokenizer.encode(sequence, add_special_tokens=False)]
+        )
+        processor(input_ids, torch.zeros(1, vocab_size))
+        assert processor.steps == 2
+        assert processor.interventions == 1
+        assert processor.elapsed_sec > 0.0
+
+    def test_lightweight_call_suppresses_only_out_of_scale_pitches(self, note_tokenizer):
+        processor = MelodyControlLogitsProcessor("C", note_tokenizer, lightweight=True)
+        sequence = "60 1 1\n62 1 1\n64 1 1\n"
+        input_ids = torch.LongTensor(
+            [note_tokenizer.tokenizer.encode(sequence, add_special_tokens=False)]
+        )
+        scores = torch.zeros(1, note_tokenizer.tokenizer.vocab_size)
+        new_probs = F.softmax(processor(input_ids, scores.clone()), dim=-1)
+        original_probs = F.softmax(scores, dim=-1)
+
+        # トレンドや直前の音 (64) に関係なく、コードスケール内の音はすべて許可される
+        for pitch in (48, 64, 79):
+            token_id = note_tokenizer.pitch_to_token_id(pitch)
+            assert new_probs[0, token_id] > original_probs[0, token_id]
+        token_id_61 = note_tokenizer.pitch_to_token_id(61)
+        assert new_probs[0, token_id_61] < original_probs[0, token_id_61]
+        assert processor.interventions == 1
+
+        # 改行の直後でなければ介入しない
+        token_id_60 = note_tokenizer.pitch_to_token_id(60)
+        untouched = torch.zeros(1, note_tokenizer.tokenizer.vocab_size)
+        assert torch.equal(
+            processor(torch.LongTensor([[token_id_60]]), untouched.clone()), untouched
+        )
+
+
+def test_per_row_processor_applies_each_chord_to_its_row(note_tokenizer, mock_tokenizer):
+    processors = [
+        MelodyControlLogitsProcessor("C", note_tokenizer, supress_token_prob_ratio=0.0),
+        MelodyControlLogitsProcessor("F#", note_tokenizer, supress_token_prob_ratio=0.0),
+    ]
+    processor = PerRowLogitsProcessor(processors)
+    newline = mock_tokenizer.vocab["\n"]
+    input_ids = torch.tensor([[newline], [newline]])
+    scores = torch.zeros(2, mock_tokenizer.vocab_size)
+
+    scores = processor(input_ids, scores)
+
+    c_natural = note_tokenizer.pitch_to_token_id(60)
+    # C のスケールでは C は許可され、F# のスケールでは抑制される
+    assert scores[0, c_natural] > scores[1, c_natural]
+    assert processor.steps == 2
+    assert processor.interventions == 2
+    with pytest.raises(ValueError):
+        processor(input_ids[:1], scores[:1])
@@ -0,0 +1,87 @@
+import pytest
+from src.api import metrics
+from src.api.metrics import Registry
+
+
+@pytest.fixture
+def registry():
+    return Registry()
+
+
+def test_counter_renders_labels(registry):
+    counter = registry.counter("demo_total", "Demo counter.", ("cache",))
+    counter.inc(cache="bar")
+    counter.inc(2, cache="bar")
+    counter.inc(cache='we"ird')
+    text = registry.render()
+    assert "# TYPE demo_total counter" in text
+    assert 'demo_total{cache="bar"} 3' in text
+    assert 'demo_total{cache="we\\"ird"} 1' in text
+
+
+def test_counter_rejects_unknown_labels(registry):
+    counter = registry.counter("demo_total", "Demo counter.", ("cache",))
+    with pytest.raises(ValueError):
+        counter.inc(other="x")
+
+
+def test_histogram_buckets_are_cumulative(registry):
+    histogram = registry.histogram("demo_seconds", "Demo histogram.", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5.0):
+        histogram.observe(value)
+    lines = registry.render().splitlines()
+    assert 'demo_seconds_bucket{le="0.1"} 1' in lines
+    assert 'demo_seconds_bucket{le="1"} 3' in lines
+    assert 'demo_seconds_bucket{le="+Inf"} 4' in lines
+    assert "demo_seconds_sum 6.05" in lines
+    assert "demo_seconds_count 4" in lines
+
+
+def test_gauge_function_is_evaluated_on_render(registry):
+    gauge = registry.gauge("demo_depth", "Demo gauge.")
+    calls = []
+    gauge.set_function(lambda: calls.append(1) or 7)
+    assert calls == []
+    assert "demo_depth 7" in registry.render()
+    assert calls == [1]
+
+
+def test_duplicate_registration_fails(registry):
+    registry.counter("demo_total", "Demo counter.")
+    with pytest.raises(ValueError):
+        registry.counter("demo_total", "Demo counter.")
+
+
+def test_generation_and_cache_metrics_are_exposed():
+    metrics.observe_generation(
+        {
+            "prefill_sec": 0.2,
+            "decode_sec": 2.0,
+            "new_tokens": 100,
+            "processor_sec": 0.01,
+            "processor_steps": 100,
+            "processor_interventions": 25,
+        }
+    )
+    metrics.record_cache_lookup("demo", hit=True)
+    metrics.record_cache_lookup("demo", hit=False)
+    text = metrics.render_metrics()
+    assert "melody_prefill_seconds_count" in text
+    assert 'melody_decode_tokens_per_second_bucket{le="60"}' in text
+    assert 'melody_cache_hit_ratio{cache="demo"} 0.5' in text
+    assert "melody_logits_processor_intervention_ratio" in text
+
+
+def test_lane_plan_metrics_are_exposed():
+    metrics.record_lane_plan(
+        {
+            "lanes": 2,
+            "cpus": [[0, 1], [2, 3]],
+            "threads": [2, 2],
+            "throughput": {"1": 1.5, "2": 2.5},
+        }
+    )
+    text = metrics.render_metrics()
+    assert "melody_cpu_lanes 2" in text
+    assert 'melody_cpu_lane_threads{lane="1"} 2' in text
+    assert 'melody_cpu_lane_tuning_bars_per_second{lanes="2"} 2.5' in text
@@ -4,7 +4,7 @@ import pytest
 import torch
 
 
-@patch("src.model.utils.FastLanguageModel.from_pretrained")
+@patch("unsloth.FastLanguageModel.from_pretrained")
 def test_load_model_and_tokenizer_local_unsloth_success(mock_from_pretrained):
     """
     ローカルパスからUnslothモデルが正常に読み込まれることをテストする
@@ -26,8 +26,8 @@ def test_load_model_and_tokenizer_local_unsloth_success(mock_from_pretrained):
     assert device is not None
 
 
-@patch("src.model.utils.AutoTokenizer.from_pretrained")
-@patch("src.model.utils.AutoModelForCausalLM.from_pretrained")
+@patch("transformers.AutoTokenizer.from_pretrained")
+@patch("transformers.AutoModelForCausalLM.from_pretrained")
 def test_load_model_and_tokenizer_hub_success(mock_model_loader, mock_tokenizer_loader):
     """
     Hugging Face Hubからモデルが正常に読み込まれることをテストする
@@ -52,7 +52,7 @@ def test_load_model_and_tokenizer_hub_success(mock_model_loader, mock_tokenizer_
     assert tokenizer is mock_tokenizer
 
 
-@patch("src.model.utils.FastLanguageModel.from_pretrained")
+@patch("unsloth.FastLanguageModel.from_pretrained")
 def test_load_model_and_tokenizer_load_error(mock_from_pretrained):
     """
     モデル読み込み中に例外が発生した場合に、その例外が再送出されることをテストする
@@ -104,3 +104,44 @@ def test_generate_midi_from_model():
     mock_model.generate.assert_called_once()
     generate_kwargs = mock_model.generate.call_args.kwargs
     assert "logits_processor" in generate_kwargs
+
+
+def test_generate_midi_batch_strips_padding_and_stops_at_eos():
+    """
+    generate_midi_batchが左詰めのパディングと、先に終わった行のEOS以降を取り除くことをテストする
+    """
+    from src.model import utils
+    from src.model.generation_stats import GenerationStats
+    from transformers import BatchEncoding
+
+    mock_model = MagicMock()
+    mock_tokenizer = MagicMock()
+    mock_tokenizer.return_value = BatchEncoding(
+        {
+            "input_ids": torch.tensor([[0, 5, 6, 7], [5, 6, 7, 8]]),
+            "attention_mask": torch.tensor([[0, 1, 1, 1], [1, 1, 1, 1]]),
+        }
+    )
+    mock_tokenizer.eos_token_id = 0
+    mock_tokenizer.decode.side_effect = lambda ids: " ".join(map(str, ids))
+    # 1行目は2トークン目で EOS、以降はパディング
+    mock_model.generate.return_value = torch.tensor(
+        [[0, 5, 6, 7, 11, 0, 0], [5, 6, 7, 8, 12, 13, 14]]
+    )
+    stats = GenerationStats()
+
+    texts = utils.generate_midi_batch(
+        mock_model,
+        mock_tokenizer,
+        "cpu",
+        ["short", "longer prompt"],
+        [object(), object()],
+        seeds=[1, 2],
+        stats=stats,
+    )
+
+    assert texts == ["5 6 7 11 0", "5 6 7 8 12 13 14"]
+    assert (stats.prompt_tokens, stats.new_tokens) == (7, 5)
+    assert mock_tokenizer.call_args.kwargs["padding_side"] == "left"
+    generate_kwargs = mock_model.generate.call_args.kwargs
+    assert generate_kwargs["do_sample"] is False
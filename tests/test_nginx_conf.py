@@ -0,0 +1,60 @@
+from pathlib import Path
+import re
+
+import pytest
+from src.api import melody_codec
+
+NGINX_DIR = Path(__file__).resolve().parents[1] / "nginx"
+CONFIGS = sorted(NGINX_DIR.glob("*.conf"))
+ACCEPTS = [
+    None,
+    "*/*",
+    "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    melody_codec.BINARY_MEDIA_TYPE,
+    melody_codec.MIDI_MEDIA_TYPE,
+    f"application/json;q=0.5, {melody_codec.BINARY_MEDIA_TYPE}",
+    f"audio/midi, {melody_codec.BINARY_MEDIA_TYPE};q=0.5",
+    f"application/json, {melody_codec.BINARY_MEDIA_TYPE};q=0.1",
+    f"{melody_codec.BINARY_MEDIA_TYPE};q=0",
+    "AUDIO/MIDI",
+]
+
+
+def read_negotiate_map(path: Path) -> tuple[str, list[tuple[re.Pattern, str]]]:
+    """nginx の $melody_negotiate の map を (既定値, [(正規表現, 値)]) で返す。"""
+    block = re.search(
+        r'map "\$arg_format\|\$http_accept" \$melody_negotiate \{(.*?)\n\}', path.read_text(), re.S
+    )
+    assert block, f"{path.name} has no $melody_negotiate map"
+    default, rules = None, []
+    for line in block[1].strip().splitlines():
+        key, value = line.strip().rstrip(";").rsplit(" ", 1)
+        if key == "default":
+            default = value
+            continue
+        pattern = key.strip('"')
+        flags = re.I if pattern.startswith("~*") else 0
+        rules.append((re.compile(pattern.lstrip("~*"), flags), value))
+    return default, rules
+
+
+def map_value(path: Path, arg_format: str, accept: str | None) -> str:
+    default, rules = read_negotiate_map(path)
+    source = f"{arg_format}|{accept or ''}"
+    return next((value for pattern, value in rules if pattern.search(source)), default)
+
+
+def test_all_configs_share_the_map():
+    assert len(CONFIGS) == 4
+    maps = {str(read_negotiate_map(path)) for path in CONFIGS}
+    assert len(maps) == 1
+
+
+@pytest.mark.parametrize("path", CONFIGS, ids=lambda path: path.name)
+@pytest.mark.parametrize("accept", ACCEPTS)
+def test_cached_requests_are_always_json(path, accept):
+    # nginx がキャッシュを使う (0) リクエストには、API は format のない URL の JSON を返す
+    if map_value(path, "", accept) == "0":
+        assert melody_codec.negotiate_format(None, accept) == "json"
+    # format を明示した URL は URL だけで内容が決まるため、常にキャッシュを使う
+    assert map_value(path, "binary", accept) == "0"
@@ -0,0 +1,50 @@
+import re
+
+from src.api import main
+from src.api.deadline import NO_DEGRADATION
+from src.api.inference_worker import BarBatchResult
+
+HEADER = "pitch duration wait velocity instrument\n"
+PROGRESSION = "Dm7 - G7 - Cmaj7 - A7"
+
+
+def fake_generate_bars(stitch_jobs):
+    """1バッチ目は各小節 6 音、つなぎ直しは先頭 2 音を小節ごとに違うピッチで返す。"""
+
+    def generate_bars(jobs):
+        bars = [int(re.search(r"Current Bar Number: (\d+)", job.prompt)[1]) for job in jobs]
+        if jobs[0].max_new_tokens == NO_DEGRADATION.max_new_tokens:
+            notes = [[40 + bar * 10 + k for k in range(6)] for bar in bars]
+        else:
+            stitch_jobs.extend(jobs)
+            notes = [[100 + bar * 2, 101 + bar * 2] for bar in bars]
+        return BarBatchResult(
+            [HEADER + "\n".join(f"{pitch} 250 250 80 65" for pitch in row) for row in notes]
+        )
+
+    return generate_bars
+
+
+def test_stitch_prompt_uses_notes_present_in_the_final_bars(monkeypatch):
+    stitch_jobs = []
+    monkeypatch.setattr(main, "generate_bars", fake_generate_bars(stitch_jobs))
+    monkeypatch.setattr(main, "PARALLEL_STITCH_NOTES", 2)
+    monkeypatch.setattr(main, "PROMPT_CONTEXT", main.prompt_context.ContextPolicy())
+
+    bar_notes = main.generate_bars_in_parallel(
+        PROGRESSION, "JAZZ風", 1, 0.3, "Alto Saxophone", NO_DEGRADATION
+    )
+    assert len(stitch_jobs) == 3
+    for i, job in enumerate(stitch_jobs, start=1):
+        prompt_pitches = re.search(r"Prev Bar Notes: (.*)", job.prompt)[1].split()
+        final_pitches = [line.split()[0] for line in bar_notes[i - 1].splitlines()]
+        assert prompt_pitches
+        # プロンプトの音は、つなぎ直した後の前の小節に連続して含まれる
+        start = final_pitches.index(prompt_pitches[0])
+        assert final_pitches[start : start + len(prompt_pitches)] == prompt_pitches
+    # つなぎ直した小節は、生成し直した先頭 2 音と元の残りの音からなる
+    assert [line.split()[0] for line in bar_notes[1].splitlines()] == [
+        "104",
+        "105",
+        *(str(60 + k) for k in range(2, 6)),
+    ]
@@ -0,0 +1,97 @@
+import threading
+import time
+
+import pytest
+from src.api import metrics, pregeneration
+from src.api.pregeneration import Pregenerator
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.005)
+    return False
+
+
+def test_generates_next_variations_in_order_and_skips_cached():
+    cache = {2}
+    generated = []
+    pregen = Pregenerator(generated.append, lambda key: key in cache, poll_interval_sec=0.001)
+    assert pregen.schedule([2, 3, 4]) == 2
+    assert wait_until(lambda: len(generated) == 2)
+    assert generated == [3, 4]
+
+
+def test_waits_for_foreground_generation():
+    generated = []
+    pregen = Pregenerator(generated.append, lambda key: False, poll_interval_sec=0.001)
+    with pregen.foreground():
+        pregen.schedule([1])
+        time.sleep(0.05)
+        assert generated == []
+    assert wait_until(lambda: generated == [1])
+
+
+def test_cancelled_when_foreground_generation_starts():
+    started, release = threading.Event(), threading.Event()
+    before = metrics.PREGENERATION_JOBS.get(result="cancelled")
+    completed = []
+
+    def generate(key):
+        started.set()
+        release.wait(timeout=2.0)
+        pregeneration.checkpoint()  # 小節の区切り
+        completed.append(key)
+
+    pregen = Pregenerator(generate, lambda key: False, poll_interval_sec=0.001)
+    pregen.schedule([1])
+    assert started.wait(timeout=2.0)
+    with pregen.foreground():
+        release.set()
+        assert wait_until(lambda: metrics.PREGENERATION_JOBS.get(result="cancelled") == before + 1)
+        # 中止したジョブは待ち行列に戻り、フォアグラウンドの生成が終わるまで待つ
+        time.sleep(0.05)
+        assert completed == []
+    assert wait_until(lambda: completed == [1])
+
+
+def test_schedule_pushes_a_batch_atomically():
+    """スレッドがまとめて積まれる前に取り出しても、優先度の順に生成される。"""
+    generated = []
+    for _ in range(20):
+        generated.clear()
+        pregen = Pregenerator(generated.append, lambda key: False, poll_interval_sec=0.001)
+        pregen.schedule([1, 2, 3, 4])
+        assert wait_until(lambda: len(generated) == 4)
+        assert generated == [1, 2, 3, 4]
+
+
+def test_pending_queue_drops_oldest():
+    block = threading.Event()
+    pregen = Pregenerator(lambda key: block.wait(timeout=2.0), lambda key: False, max_pending=2)
+    with pregen.foreground():
+        pregen.schedule([1])
+        assert wait_until(lambda: pregen.pending() == [])  # 1 は取り出されて待機中
+        pregen.schedule([2, 3])
+        pregen.schedule([4])
+        assert pregen.pending() == [2, 4]
+    block.set()
+
+
+def test_checkpoint_is_noop_outside_pregeneration():
+    pregeneration.checkpoint()
+
+
+def test_from_env_disabled(monkeypatch):
+    monkeypatch.setenv("PREGENERATE_AHEAD", "0")
+    assert Pregenerator.from_env(lambda key: None, lambda key: False) == (None, 0)
+
+
+@pytest.mark.parametrize("ahead", ["1", "3"])
+def test_from_env_reads_ahead(monkeypatch, ahead):
+    monkeypatch.setenv("PREGENERATE_AHEAD", ahead)
+    pregen, k = Pregenerator.from_env(lambda key: None, lambda key: False)
+    assert pregen is not None
+    assert k == int(ahead)
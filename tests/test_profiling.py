@@ -0,0 +1,145 @@
+import os
+from pathlib import Path
+import threading
+import time
+
+import pytest
+from src.api import profiling
+from src.api.profiling import PROFILE_HEADER, RequestProfiler
+
+
+def busy_loop(seconds: float) -> None:
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        sum(range(100))
+
+
+@pytest.fixture
+def profiler(tmp_path, monkeypatch):
+    profiler = RequestProfiler(tmp_path, max_artifacts=2, interval_sec=0.001, use_torch=False)
+    monkeypatch.setattr(profiling, "PROFILER", profiler)
+    return profiler
+
+
+def test_profile_writes_folded_stacks(profiler):
+    with profiler.profile("req-1"):
+        busy_loop(0.05)
+    folded = (profiler.output_dir / "req-1.folded").read_text(encoding="utf-8")
+    assert "busy_loop (test_profiling.py" in folded
+    stack, count = folded.splitlines()[0].rsplit(" ", 1)
+    assert int(count) > 0
+
+
+def test_retention_keeps_newest_profiles(profiler):
+    for index in range(4):
+        with profiler.profile(f"req-{index}"):
+            pass
+        # mtime の解像度に依存しないよう、更新時刻を明示的にずらす
+        path = profiler.output_dir / f"req-{index}.folded"
+        os.utime(path, (index, index))
+    profiler._enforce_retention()
+    remaining = sorted(path.name for path in profiler.output_dir.iterdir())
+    assert remaining == ["req-2.folded", "req-3.folded"]
+
+
+def test_maybe_profile_only_runs_for_requested_requests(profiler):
+    with profiling.maybe_profile():
+        pass
+    assert list(profiler.output_dir.iterdir()) == []
+
+    request = profiling.request_profile("req-x")
+    try:
+        assert not request.written
+        with profiling.maybe_profile():
+            pass
+    finally:
+        profiling.reset_request(request)
+    assert request.written
+    assert (profiler.output_dir / "req-x.folded").exists()
+
+
+def test_cache_hit_returns_no_profile_id(profiler, monkeypatch):
+    """キャッシュから返したリクエストは計測しないため、成果物の ID も返さない。"""
+    from fastapi.testclient import TestClient
+    from src.api import canonical, main
+    from src.api.response_cache import ResponseCache
+
+    params = canonical.CanonicalParams.from_raw("Dm7 - G7", "JAZZ風")
+    cache = ResponseCache("test-profile-cache-hit")
+    cache.put(params.key, {"chord_melodies": {"Dm7": "", "G7": ""}})
+    monkeypatch.setattr(main, "RESPONSE_CACHE", cache)
+    monkeypatch.setattr(main, "STATIC_CACHE", None)
+    monkeypatch.setattr(main, "schedule_next_variations", lambda params: None)
+
+    response = TestClient(main.app).get(
+        f"/generate?{params.query_string()}", headers={PROFILE_HEADER: "1"}
+    )
+    assert response.status_code == 200
+    assert response.headers[main.SOURCE_HEADER] == "memory"
+    assert profiling.PROFILE_ID_HEADER not in response.headers
+    assert list(profiler.output_dir.iterdir()) == []
+
+    # 生成した場合は、書き出した成果物の ID を返す
+    monkeypatch.setattr(main, "generate_chord_melodies", lambda *args: {"Dm7": "", "G7": ""})
+    monkeypatch.setattr(main, "ADMISSION", None)
+    cache.clear()
+    response = TestClient(main.app).get(
+        f"/generate?{params.query_string()}", headers={PROFILE_HEADER: "1"}
+    )
+    profile_id = response.headers[profiling.PROFILE_ID_HEADER]
+    assert (profiler.output_dir / f"{profile_id}.folded").exists()
+
+
+def test_header_mode_requires_header(tmp_path):
+    profiler = RequestProfiler(tmp_path, mode="header")
+    assert not profiler.wants_profile({})
+    assert profiler.wants_profile({PROFILE_HEADER: "1"})
+    assert RequestProfiler(tmp_path, mode="always").wants_profile({})
+
+
+def test_profiler_is_disabled_by_default(monkeypatch):
+    monkeypatch.delenv("PROFILE_MODE", raising=False)
+    assert RequestProfiler.from_env() is None
+
+
+def test_concurrent_requests_share_one_torch_profiler(tmp_path, monkeypatch):
+    """torch.profiler は同時に1つだけ動かし、重なったリクエストはスタックだけを記録する。"""
+    profiler = RequestProfiler(tmp_path, interval_sec=0.001, use_torch=True)
+    active, peak = [0], [0]
+    lock = threading.Lock()
+
+    class FakeTorchProfiler:
+        def __exit__(self, *args):
+            with lock:
+                active[0] -= 1
+
+        def export_chrome_trace(self, path):
+            Path(path).write_text("{}", encoding="utf-8")
+
+    def start_torch_profiler():
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        return FakeTorchProfiler()
+
+    monkeypatch.setattr(profiler, "_start_torch_profiler", start_torch_profiler)
+    barrier = threading.Barrier(4)
+
+    def request(index):
+        with profiler.profile(f"req-{index}"):
+            barrier.wait()
+            busy_loop(0.02)
+
+    threads = [threading.Thread(target=request, args=(index,)) for index in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert peak[0] == 1
+    assert len(list(tmp_path.glob("*.trace.json"))) == 1
+    assert len(list(tmp_path.glob("*.folded"))) == 4
+
+    # 計測が終われば、次のリクエストは再び torch.profiler を使える
+    with profiler.profile("req-next"):
+        pass
+    assert (tmp_path / "req-next.trace.json").exists()
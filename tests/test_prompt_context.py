@@ -0,0 +1,99 @@
+import textwrap
+
+import pytest
+from src.model.benchmark_prompt_context import measure, repeat_progression
+from src.model.prompt_context import (
+    ContextPolicy,
+    build_bar_prompt,
+    phrase_labels,
+    summarize_form,
+)
+
+
+def legacy_prompt(style, chord_progression, bars, chord, prev_bar_notes, instrument):
+    # これまで generate_chord_melodies に直接書かれていたプロンプト
+    prompt = f"""
+            Act as a world-class jazz musician improvising over a chord progression.
+            Your task is to generate a single bar of a masterful melodic phrase for
+            the specific chord at the current position in the progression.
+            - Style: {style}
+            - Full Chord Progression: {chord_progression}
+            - Current Bar Number: {bars + 1}
+            - Chord for This Bar: {chord}
+            - Prev Bar Notes: {prev_bar_notes}
+            - Instrument: {instrument}
+            - Remark: Utilize a wide tonal range
+            Generate the melody for this bar only. The output format is:
+            pitch duration wait velocity instrument
+            """
+    return textwrap.dedent(prompt)
+
+
+@pytest.mark.parametrize("policy", ["full", "window=1,min_bars=8"])
+def test_full_policy_keeps_legacy_prompt(policy):
+    progression = "Dm7 - G7 - Cmaj7"
+    prompt = build_bar_prompt(
+        progression, 1, "JAZZ風", "62 65", "Alto Saxophone", ContextPolicy.parse(policy)
+    )
+    assert prompt == legacy_prompt("JAZZ風", progression, 1, "G7", "62 65", "Alto Saxophone")
+
+
+def test_window_prompt_contains_only_nearby_chords():
+    progression = repeat_progression("C - Am - F - G - E7 - Am - D7 - G7", 32)
+    prompt = build_bar_prompt(progression, 9, "JAZZ風", "60", "Piano", ContextPolicy(window=1))
+    assert "Full Chord Progression" not in prompt
+    assert "- Nearby Chords (bars 9-11): C - Am - F\n" in prompt
+    assert "- Chord for This Bar: Am\n" in prompt
+    assert "- Form: 32 bars, 4-bar phrases: A B A B A B A B\n" in prompt
+    assert "- Current Phrase: A (bar 2 of 4)\n" in prompt
+
+
+def test_window_is_clipped_at_both_ends():
+    progression = "C - F - G - C"
+    policy = ContextPolicy(window=2)
+    assert "(bars 1-3): C - F - G\n" in build_bar_prompt(progression, 0, "s", "", "i", policy)
+    assert "(bars 2-4): F - G - C\n" in build_bar_prompt(progression, 3, "s", "", "i", policy)
+
+
+def test_form_summary():
+    chords = ["C"] * 8 + ["F"] * 4 + ["C"] * 4 + ["G", "C"]
+    assert phrase_labels(chords) == ["A", "A", "B", "A", "C"]
+    assert summarize_form(chords) == "18 bars, 4-bar phrases: A x2 B A C"
+
+
+@pytest.mark.parametrize(
+    "spec, expected",
+    [
+        ("full", ContextPolicy()),
+        ("", ContextPolicy()),
+        ("window=2", ContextPolicy(window=2)),
+        ("window=3, min_bars=16,phrase_bars=8", ContextPolicy(3, 16, 8)),
+    ],
+)
+def test_parse(spec, expected):
+    policy = ContextPolicy.parse(spec)
+    assert policy == expected
+    assert ContextPolicy.parse(str(policy)) == policy
+
+
+@pytest.mark.parametrize("spec", ["window", "min_bars=4", "window=2,foo=1", "window=-1"])
+def test_parse_rejects_invalid_specs(spec):
+    with pytest.raises(ValueError):
+        ContextPolicy.parse(spec)
+
+
+def test_window_prompt_length_does_not_grow_with_progression():
+    def count_words(prompt):
+        return len(prompt.split())
+
+    full = [measure(repeat_progression("C - F", n), ContextPolicy(), count_words) for n in (8, 64)]
+    window = [
+        measure(repeat_progression("C - F", n), ContextPolicy(window=2), count_words)
+        for n in (8, 64)
+    ]
+    # full は1小節あたりのプロンプトも伸びるが、window は構成の要約の分しか伸びない
+    assert full[1].max_prompt_tokens - full[0].max_prompt_tokens > 100
+    assert window[1].max_prompt_tokens - window[0].max_prompt_tokens <= 3
+    # 全小節の合計は、full では O(N²)、window では O(N)
+    assert window[1].total_prompt_tokens / 64 - window[0].total_prompt_tokens / 8 <= 3
+    assert full[1].total_prompt_tokens / 64 - full[0].total_prompt_tokens / 8 > 100
@@ -0,0 +1,113 @@
+import random
+
+import pytest
+from src.model.prompt_context import ContextPolicy, build_bar_prompt
+from src.model.prompt_tokens import PromptEncoder, split_prompt, template_literals
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, processors, trainers
+from transformers import PreTrainedTokenizerFast
+
+CHORDS = ["Dm7", "G7", "Cmaj7", "A7", "F#m7b5", "B7", "Em7", "Bbmaj7"]
+
+
+def random_prompts(rng, count):
+    prompts = []
+    for _ in range(count):
+        progression = " - ".join(rng.choice(CHORDS) for _ in range(rng.randint(1, 12)))
+        bars = len(progression.split(" - "))
+        prev_bar_notes = " ".join(str(rng.randint(50, 80)) for _ in range(rng.randint(0, 5)))
+        policy = ContextPolicy(window=1) if rng.random() < 0.3 else ContextPolicy()
+        prompts.append(
+            build_bar_prompt(
+                progression,
+                rng.randrange(bars),
+                rng.choice(["JAZZ風", "ボサノバ風", "Swing"]),
+                prev_bar_notes,
+                rng.choice(["Alto Saxophone", "Piano"]),
+                policy,
+            )
+        )
+    return prompts
+
+
+def train_tokenizer(use_regex):
+    """
+    プロンプトで学習した小さな byte-level BPE。use_regex=False では空白や改行をまたいで
+    トークンがまとまる (境界の確認で全体のトークン化に戻ることを確かめる)。
+    """
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False, use_regex=use_regex)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=800,
+        special_tokens=["<s>", "</s>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tokenizer.train_from_iterator(random_prompts(random.Random(0), 300), trainer)
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="<s> $A", special_tokens=[("<s>", 0)]
+    )
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>")
+
+
+@pytest.fixture(scope="module")
+def bpe_tokenizer():
+    return train_tokenizer(use_regex=True)
+
+
+def test_split_prompt_moves_spaces_to_fields():
+    template = "- Style: {style}\n- Notes: {notes}\n- Bar: {bar}\nend\n"
+    literals = template_literals(template)
+    assert literals == ["- Style: ", "\n- Notes: ", "\n- Bar: ", "\nend\n"]
+
+    prompt = template.format(style="JAZZ風", notes="", bar=3)
+    segments = split_prompt(prompt, literals)
+    assert "".join(text for text, _ in segments) == prompt
+    # 値が空の "Notes" は前後の固定部分とつながる
+    assert segments == [
+        ("- Style:", True),
+        (" JAZZ風", False),
+        ("\n- Notes: \n- Bar:", True),
+        (" 3", False),
+        ("\nend\n", True),
+    ]
+    assert split_prompt("- Style: x\nend\n", literals) is None
+
+
+def test_encode_matches_full_tokenization(bpe_tokenizer):
+    encoder = PromptEncoder(bpe_tokenizer)
+    prompts = random_prompts(random.Random(1), 200)
+    for prompt in prompts:
+        assert encoder.encode(prompt) == bpe_tokenizer(prompt)["input_ids"]
+    assert encoder.hits == len(prompts)
+    assert encoder.fallbacks == 0
+
+
+def test_boundary_merges_fall_back_to_full_tokenization():
+    tokenizer = train_tokenizer(use_regex=False)
+    encoder = PromptEncoder(tokenizer)
+    prompts = random_prompts(random.Random(2), 50)
+    for prompt in prompts:
+        assert encoder.encode(prompt) == tokenizer(prompt)["input_ids"]
+    assert encoder.fallbacks > 0
+
+
+def test_prompt_outside_templates_is_tokenized_as_a_whole(bpe_tokenizer):
+    encoder = PromptEncoder(bpe_tokenizer)
+    prompt = "60 50 \n 62 50 \n"
+    assert encoder.encode(prompt) == bpe_tokenizer(prompt)["input_ids"]
+    assert (encoder.hits, encoder.fallbacks) == (0, 1)
+
+
+def test_model_inputs_match_tokenizer_tensors(bpe_tokenizer):
+    encoder = PromptEncoder(bpe_tokenizer)
+    prompts = random_prompts(random.Random(3), 4)
+    inputs = encoder.model_inputs(prompts[0], "cpu")
+    expected = bpe_tokenizer(prompts[0], return_tensors="pt")
+    assert inputs["input_ids"].tolist() == expected["input_ids"].tolist()
+    assert inputs["attention_mask"].tolist() == expected["attention_mask"].tolist()
+
+    bpe_tokenizer.pad_token = bpe_tokenizer.eos_token
+    batch = encoder.batch_model_inputs(prompts, "cpu", bpe_tokenizer.pad_token_id)
+    expected = bpe_tokenizer(prompts, return_tensors="pt", padding=True, padding_side="left")
+    assert batch["input_ids"].tolist() == expected["input_ids"].tolist()
+    assert batch["attention_mask"].tolist() == expected["attention_mask"].tolist()
@@ -0,0 +1,131 @@
+import base64
+import json
+import threading
+import time
+
+import pytest
+from src.api.inference_worker import BarJob, InferenceWorker
+from src.api.replay import (
+    TOKENS_PER_NOTE,
+    BarTraceRecorder,
+    ReplayBar,
+    ReplayBarGenerator,
+    load_replay_bars,
+)
+
+DM7_NOTES = "62 250 250 80 0\n65 250 250 80 0\n69 250 250 80 0\n72 250 250 80 0"
+G7_NOTES = "67 500 500 90 0\n71 500 500 90 0"
+
+
+def _write_static_cache(root):
+    path = root / "0123456789abcdef0123456789abcdef" / "JAZZ風" / "1.json"
+    path.parent.mkdir(parents=True)
+    melodies = {
+        "Dm7": base64.b64encode(DM7_NOTES.encode()).decode(),
+        "G7": base64.b64encode(G7_NOTES.encode()).decode(),
+        "Dm7_2": base64.b64encode(G7_NOTES.encode()).decode(),
+    }
+    path.write_text(json.dumps({"chord_melodies": melodies}), encoding="utf-8")
+
+
+def test_load_static_cache_bars(tmp_path):
+    _write_static_cache(tmp_path)
+    bars = load_replay_bars(tmp_path)
+    assert [bar.chord for bar in bars] == ["Dm7", "G7", "Dm7"]
+    assert bars[0].text == DM7_NOTES
+    assert bars[0].new_tokens == 4 * TOKENS_PER_NOTE
+
+
+def test_trace_roundtrip(tmp_path):
+    recorder = BarTraceRecorder(tmp_path / "traces" / "bars.jsonl")
+    job = BarJob(prompt="p", chord="Dm7", seed=1)
+    recorder.record(
+        job, f"prompt\npitch duration wait velocity instrument\n{DM7_NOTES}", {"new_tokens": 40}
+    )
+    recorder.record(job, G7_NOTES)
+    bars = load_replay_bars(recorder.path)
+    assert bars == [
+        ReplayBar("Dm7", DM7_NOTES, 40),
+        ReplayBar("Dm7", G7_NOTES, 2 * TOKENS_PER_NOTE),
+    ]
+
+
+def test_missing_or_empty_source_fails(tmp_path):
+    with pytest.raises(ValueError):
+        load_replay_bars(tmp_path / "missing")
+    with pytest.raises(ValueError):
+        load_replay_bars(tmp_path)
+
+
+def test_replay_is_deterministic_and_prefers_the_jobs_chord():
+    bars = [ReplayBar("Dm7", f"{60 + i} 250 250 80 0", 16) for i in range(8)]
+    bars.append(ReplayBar("G7", G7_NOTES, 32))
+    generator = ReplayBarGenerator(bars)
+    job = BarJob(prompt="prompt", chord="Dm7", seed=3)
+    assert generator(job).text == ReplayBarGenerator(bars)(job).text
+    texts = {generator(BarJob(prompt="prompt", chord="Dm7", seed=seed)).text for seed in range(20)}
+    assert len(texts) > 1
+    assert G7_NOTES not in texts
+    # 記録にないコードは、記録全体から選ぶ
+    assert generator(BarJob(prompt="prompt", chord="C#m7b5", seed=0)).text
+
+
+def test_synthetic_latency_and_truncation():
+    sleeps = []
+    generator = ReplayBarGenerator(
+        [ReplayBar("Dm7", DM7_NOTES, 64)], token_ms=10, prefill_ms=50, sleep=sleeps.append
+    )
+    result = generator(BarJob(prompt="p", chord="Dm7", seed=0))
+    assert result.text == DM7_NOTES
+    assert result.stats == {
+        "new_tokens": 64,
+        "prefill_sec": 0.05,
+        "decode_sec": pytest.approx(0.63),
+    }
+    assert sleeps == [pytest.approx(0.68)]
+
+    # max_new_tokens で打ち切られた場合は、トークン数に応じて音を減らす
+    result = generator(BarJob(prompt="p", chord="Dm7", seed=0, max_new_tokens=32))
+    assert result.text == "\n".join(DM7_NOTES.splitlines()[:2])
+    assert result.stats["new_tokens"] == 32
+
+
+def test_batch_waits_for_the_longest_row():
+    sleeps = []
+    generator = ReplayBarGenerator(
+        [ReplayBar("Dm7", DM7_NOTES, 64), ReplayBar("G7", G7_NOTES, 32)],
+        token_ms=10,
+        sleep=sleeps.append,
+    )
+    batch = generator.generate_batch(
+        [BarJob(prompt="a", chord="Dm7", seed=0), BarJob(prompt="b", chord="G7", seed=0)]
+    )
+    assert batch.texts == [DM7_NOTES, G7_NOTES]
+    assert batch.stats["new_tokens"] == 96
+    assert sleeps == [pytest.approx(0.63)]
+
+
+def test_concurrency_limits_parallel_generation():
+    generator = ReplayBarGenerator([ReplayBar("Dm7", DM7_NOTES, 11)], token_ms=5, concurrency=1)
+    threads = [
+        threading.Thread(target=generator, args=(BarJob(prompt="p", chord="Dm7", seed=i),))
+        for i in range(4)
+    ]
+    started_at = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # 1本ずつ 50ms かかるため、4件で 200ms 以上
+    assert time.perf_counter() - started_at >= 0.19
+
+
+def test_worker_serves_replayed_bars(tmp_path):
+    _write_static_cache(tmp_path)
+    worker = InferenceWorker(loader=lambda: ReplayBarGenerator.from_env(str(tmp_path)))
+    worker.start(wait=True)
+    assert worker.status == "ready"
+    result = worker.submit(BarJob(prompt="p", chord="G7", seed=0)).result(timeout=5)
+    assert result.text == G7_NOTES
+    batch = worker.submit_batch([BarJob(prompt="p", chord="G7", seed=0)]).result(timeout=5)
+    assert batch.texts == [G7_NOTES]
@@ -0,0 +1,33 @@
+from src.api import metrics
+from src.api.response_cache import ResponseCache
+
+
+def test_lru_evicts_least_recently_used():
+    cache = ResponseCache("test-lru", max_entries=2)
+    cache.put("a", {"v": 1})
+    cache.put("b", {"v": 2})
+    assert cache.get("a") == {"v": 1}
+    cache.put("c", {"v": 3})
+    assert "a" in cache
+    assert "b" not in cache
+    assert len(cache) == 2
+
+
+def test_lookups_are_recorded_in_metrics():
+    cache = ResponseCache("test-metrics")
+    cache.put("key", {"v": 1})
+    cache.get("key")
+    cache.get("missing")
+    assert metrics.CACHE_REQUESTS.get(cache="test-metrics", result="hit") == 1
+    assert metrics.CACHE_REQUESTS.get(cache="test-metrics", result="miss") == 1
+    # 引き直す前提の参照では、ミスを記録しない
+    cache.get("missing", record_miss=False)
+    cache.get("key", record_miss=False)
+    assert metrics.CACHE_REQUESTS.get(cache="test-metrics", result="miss") == 1
+    assert metrics.CACHE_REQUESTS.get(cache="test-metrics", result="hit") == 2
+
+
+def test_zero_size_disables_cache():
+    cache = ResponseCache("test-disabled", max_entries=0)
+    cache.put("key", {"v": 1})
+    assert cache.get("key") is None
@@ -0,0 +1,147 @@
+import pytest
+from src.model.generation_stats import GenerationStats
+from src.model.melody_processor import MelodyControlLogitsProcessor, NoteTokenizer
+from src.model.sampling import SeededSamplingLogitsProcessor
+from src.model.speculative import NgramDrafter, load_drafter, speculative_generate
+from src.model.utils import generate_midi_from_model
+import torch
+from transformers import LogitsProcessorList
+
+from tests.conftest import VOCAB_SIZE
+from tests.test_melody_processor import MockTokenizer
+
+EOS = VOCAB_SIZE - 2
+
+
+class LlamaMockTokenizer(MockTokenizer):
+    # Llama のトークナイザーと同じく token_type_ids を返さない
+    model_input_names = ["input_ids", "attention_mask"]
+
+
+class OracleDrafter:
+    """正解の続きを提案する (すべて受理される)。"""
+
+    def __init__(self, expected):
+        self.expected = expected
+
+    def propose(self, token_ids, k):
+        return self.expected[len(token_ids) : len(token_ids) + k]
+
+
+class WrongDrafter:
+    """常に同じトークンを提案する (ほとんど受理されない)。"""
+
+    def propose(self, token_ids, k):
+        return [VOCAB_SIZE - 1] * k
+
+
+def reference(model, input_ids, seed, max_new_tokens=30, eos_token_id=EOS):
+    return model.generate(
+        input_ids=input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        max_new_tokens=max_new_tokens,
+        do_sample=False,
+        pad_token_id=eos_token_id,
+        eos_token_id=eos_token_id,
+        logits_processor=LogitsProcessorList([SeededSamplingLogitsProcessor(seed)]),
+    )
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+@pytest.mark.parametrize("drafter_name", ["oracle", "wrong", "ngram"])
+def test_output_matches_generate(tiny_model, seed, drafter_name):
+    input_ids = torch.tensor([[5, 9, 13, 5, 9, 13, 5]])
+    expected = reference(tiny_model, input_ids, seed)
+    drafter = {
+        "oracle": OracleDrafter(expected[0].tolist()),
+        "wrong": WrongDrafter(),
+        "ngram": NgramDrafter(n=3),
+    }[drafter_name]
+    stats = GenerationStats()
+    output = speculative_generate(
+        tiny_model,
+        input_ids,
+        LogitsProcessorList([SeededSamplingLogitsProcessor(seed)]),
+        drafter,
+        max_new_tokens=30,
+        eos_token_id=EOS,
+        stats=stats,
+    )
+    assert output.tolist() == expected.tolist()
+    assert output.shape[1] > input_ids.shape[1] + 5
+    assert stats.accepted_draft_tokens <= stats.draft_tokens
+    if drafter_name == "oracle":
+        assert stats.draft_tokens > 0
+        assert stats.acceptance_rate == 1.0
+
+
+@pytest.mark.parametrize("drafter_name", ["oracle", "wrong"])
+def test_stops_at_eos(tiny_model, drafter_name):
+    input_ids = torch.tensor([[5, 9, 13, 5, 9, 13, 5]])
+    # 途中で出力されるトークンを EOS とみなして、そこで止まることを確かめる
+    eos = reference(tiny_model, input_ids, seed=1)[0, 15].item()
+    expected = reference(tiny_model, input_ids, seed=1, eos_token_id=eos)
+    assert expected.shape[1] <= 16
+    drafter = OracleDrafter(expected[0].tolist()) if drafter_name == "oracle" else WrongDrafter()
+    output = speculative_generate(
+        tiny_model,
+        input_ids,
+        LogitsProcessorList([SeededSamplingLogitsProcessor(1)]),
+        drafter,
+        max_new_tokens=30,
+        eos_token_id=eos,
+    )
+    assert output.tolist() == expected.tolist()
+
+
+def test_melody_processor_applies_during_verification(tiny_model):
+    tokenizer = LlamaMockTokenizer()
+    note_tokenizer = NoteTokenizer(tokenizer)
+    prompt = "60 50 \n 62 50 \n 64 50 \n 60 50 \n 62 50 \n"
+
+    def generate(drafter):
+        processor = MelodyControlLogitsProcessor("C", note_tokenizer)
+        stats = GenerationStats()
+        text = generate_midi_from_model(
+            tiny_model,
+            tokenizer,
+            "cpu",
+            prompt,
+            processor,
+            seed=7,
+            max_new_tokens=24,
+            stats=stats,
+            drafter=drafter,
+        )
+        return text, processor.steps, stats
+
+    expected, expected_steps, _ = generate(None)
+    text, steps, stats = generate(NgramDrafter(n=3))
+    assert text == expected
+    # プロセッサは出力した1トークンにつき1回だけ呼ばれる
+    assert steps == expected_steps == stats.new_tokens
+    assert stats.draft_tokens > 0
+
+
+def test_ngram_fit_keeps_frequent_continuations():
+    drafter = NgramDrafter.fit([[1, 2, 3, 4], [1, 2, 3, 5], [1, 2, 3, 4], [7, 8]], n=3)
+    assert drafter.table[(2, 3)] == 4
+    assert drafter.table[(1,)] == 2
+    # 1回しか現れない続きは使わない
+    assert (7,) not in drafter.table
+    assert drafter.propose([9, 1], 3) == [2, 3, 4]
+
+
+def test_ngram_prefers_repetition_in_sequence(tmp_path):
+    drafter = NgramDrafter(n=3, table={(2, 3): 4})
+    assert drafter.propose([2, 3, 9, 1, 2, 3], 2) == [9, 1]
+    path = tmp_path / "draft.json"
+    drafter.save(path)
+    loaded = load_drafter(f"ngram:{path}", "cpu")
+    assert (loaded.n, loaded.table) == (3, {(2, 3): 4})
+
+
+def test_load_drafter_specs():
+    assert load_drafter("", "cpu") is None
+    with pytest.raises(ValueError):
+        load_drafter("lookup:foo", "cpu")
@@ -0,0 +1,70 @@
+import hashlib
+import json
+
+from src.api import metrics
+from src.api.static_cache import StaticCacheIndex
+
+PROG_HASH = hashlib.md5(b"Dm7 - G7").hexdigest()
+
+
+def write_entry(root, variation, payload=None, style="JAZZ風"):
+    path = root / PROG_HASH / style / f"{variation}.json"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(payload or {"chord_melodies": {"Dm7": "", "G7": ""}}))
+    return path
+
+
+def test_lookup_serves_indexed_files(tmp_path):
+    write_entry(tmp_path, 1)
+    (tmp_path / PROG_HASH / "JAZZ風" / "1.png").write_bytes(b"png")
+    (tmp_path / "not-a-hash" / "JAZZ風").mkdir(parents=True)
+    (tmp_path / "not-a-hash" / "JAZZ風" / "1.json").write_text("{}")
+    index = StaticCacheIndex(tmp_path)
+
+    assert len(index) == 1
+    hit = index.lookup(PROG_HASH, "JAZZ風", 1)
+    assert json.loads(hit.payload) == {"chord_melodies": {"Dm7": "", "G7": ""}}
+    assert hit.fingerprint.startswith("static:")
+    assert index.lookup(PROG_HASH, "JAZZ風", 2) is None
+    assert index.lookup(PROG_HASH, "POP風", 1) is None
+
+
+def test_lookups_are_recorded_in_metrics(tmp_path):
+    write_entry(tmp_path, 1)
+    index = StaticCacheIndex(tmp_path)
+    before_hits = metrics.CACHE_REQUESTS.get(cache="static", result="hit")
+    before_misses = metrics.CACHE_REQUESTS.get(cache="static", result="miss")
+    index.lookup(PROG_HASH, "JAZZ風", 1)
+    index.lookup(PROG_HASH, "JAZZ風", 9)
+    assert metrics.CACHE_REQUESTS.get(cache="static", result="hit") == before_hits + 1
+    assert metrics.CACHE_REQUESTS.get(cache="static", result="miss") == before_misses + 1
+
+
+def test_reloads_when_directory_changes(tmp_path):
+    index = StaticCacheIndex(tmp_path, reload_interval_sec=1e-9)
+    assert index.lookup(PROG_HASH, "JAZZ風", 1) is None
+    write_entry(tmp_path, 1)
+    assert index.lookup(PROG_HASH, "JAZZ風", 1) is not None
+    write_entry(tmp_path, 2)
+    assert index.lookup(PROG_HASH, "JAZZ風", 2) is not None
+
+
+def test_reload_disabled_keeps_startup_index(tmp_path):
+    index = StaticCacheIndex(tmp_path, reload_interval_sec=0)
+    write_entry(tmp_path, 1)
+    assert index.lookup(PROG_HASH, "JAZZ風", 1) is None
+    assert index.reload() == 1
+    assert index.lookup(PROG_HASH, "JAZZ風", 1) is not None
+
+
+def test_deleted_file_is_a_miss(tmp_path):
+    path = write_entry(tmp_path, 1)
+    index = StaticCacheIndex(tmp_path, reload_interval_sec=0)
+    path.unlink()
+    assert index.lookup(PROG_HASH, "JAZZ風", 1) is None
+
+
+def test_missing_root_is_empty(tmp_path):
+    index = StaticCacheIndex(tmp_path / "dist")
+    assert len(index) == 0
+    assert index.lookup(PROG_HASH, "JAZZ風", 1) is None
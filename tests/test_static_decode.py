@@ -0,0 +1,146 @@
+import random
+
+import pytest
+from src.model.generation_stats import GenerationStats
+from src.model.melody_processor import (
+    MelodyControlLogitsProcessor,
+    NoteTokenizer,
+    TensorMelodyControlLogitsProcessor,
+)
+from src.model.sampling import SeededSamplingLogitsProcessor
+from src.model.static_decode import StaticDecoder, cache_length, validate_decode_mode
+from src.model.utils import generate_midi_from_model
+import torch
+from transformers import LogitsProcessorList
+
+from tests.test_melody_processor import MockTokenizer
+from tests.test_speculative import EOS, LlamaMockTokenizer, reference
+
+
+@pytest.fixture(scope="module")
+def note_tokenizer():
+    return NoteTokenizer(MockTokenizer())
+
+
+def random_sequence(rng, length):
+    # ピッチ (2〜129) と改行 (1) だけの列。行の長さはまちまちにする
+    return [
+        1 if rng.random() < 0.3 else rng.choice([rng.randint(2, 129), 62, 64])
+        for _ in range(length)
+    ]
+
+
+@pytest.mark.parametrize("chord", ["C", "Dm7", "G7"])
+@pytest.mark.parametrize("lightweight", [False, True])
+def test_tensor_processor_matches_reference(note_tokenizer, chord, lightweight):
+    rng = random.Random(chord)
+    reference_processor = MelodyControlLogitsProcessor(
+        chord, note_tokenizer, lightweight=lightweight
+    )
+    tensor_processor = TensorMelodyControlLogitsProcessor(
+        chord, note_tokenizer, lightweight=lightweight
+    )
+    rows = [random_sequence(rng, 80) for _ in range(2)]
+    prompt_length = 10
+    torch.manual_seed(0)
+    for length in range(prompt_length, 80):
+        input_ids = torch.tensor([row[:length] for row in rows])
+        scores = torch.randn(2, 130)
+        expected = reference_processor(input_ids, scores.clone())
+        actual = tensor_processor(input_ids, scores.clone())
+        torch.testing.assert_close(actual, expected, atol=1e-4, rtol=1e-4)
+    assert tensor_processor.steps == reference_processor.steps
+    assert tensor_processor.interventions == reference_processor.interventions > 0
+
+
+def test_tensor_processor_reinitializes_on_new_sequence(note_tokenizer):
+    processor = TensorMelodyControlLogitsProcessor("C", note_tokenizer)
+    reference_processor = MelodyControlLogitsProcessor("C", note_tokenizer)
+    for input_ids in ([[62, 1, 66, 1, 62, 1]], [[64, 1, 68, 1, 64, 1, 68, 1]]):
+        scores = torch.randn(1, 130)
+        expected = reference_processor(torch.tensor(input_ids), scores.clone())
+        actual = processor(torch.tensor(input_ids), scores.clone())
+        torch.testing.assert_close(actual, expected, atol=1e-4, rtol=1e-4)
+    assert processor.interventions == 2
+
+
+def test_tensor_processor_caches_scale_mask_and_accepts_interventions(note_tokenizer):
+    processor = TensorMelodyControlLogitsProcessor("C", note_tokenizer)
+    device = torch.device("cpu")
+    assert processor._scale_allowed_pitches(device) is processor._scale_allowed_pitches(device)
+
+    processor.interventions = 5
+    assert processor.interventions == 5
+    processor(torch.tensor([[62, 1, 66, 1, 62, 1]]), torch.randn(1, 130))
+    assert processor.interventions == 6
+    processor.interventions = 0
+    assert processor.interventions == 0
+
+
+def test_cache_length_rounds_up_to_bucket():
+    assert cache_length(200, 128, bucket=256) == 512
+    assert cache_length(100, 28, bucket=64) == 128
+    assert cache_length(1, 0, bucket=64) == 64
+    assert validate_decode_mode("static") == "static"
+    with pytest.raises(ValueError):
+        validate_decode_mode("compiled")
+
+
+@pytest.mark.parametrize("seed", [1, 2])
+def test_static_decoder_matches_generate(tiny_model, seed):
+    decoder = StaticDecoder(tiny_model, compile_step=False, bucket=64, sync_interval=4)
+    for input_ids in (torch.tensor([[5, 9, 13, 5, 9, 13, 5]]), torch.tensor([[7] * 20])):
+        expected = reference(tiny_model, input_ids, seed)
+        output = decoder.generate(
+            input_ids,
+            LogitsProcessorList([SeededSamplingLogitsProcessor(seed)]),
+            max_new_tokens=30,
+            eos_token_id=EOS,
+        )
+        assert output.tolist() == expected.tolist()
+    # プロンプト長 + 30 トークンは 64 に収まるので、キャッシュは1つだけ作られる
+    assert list(decoder._caches) == [64]
+
+
+def test_static_decoder_stops_at_eos(tiny_model):
+    input_ids = torch.tensor([[5, 9, 13, 5, 9, 13, 5]])
+    # 途中で出力されるトークンを EOS とみなして、同期の間隔の途中でも止まることを確かめる
+    eos = reference(tiny_model, input_ids, seed=1)[0, 13].item()
+    expected = reference(tiny_model, input_ids, seed=1, eos_token_id=eos)
+    decoder = StaticDecoder(tiny_model, compile_step=False, sync_interval=4)
+    output = decoder.generate(
+        input_ids,
+        LogitsProcessorList([SeededSamplingLogitsProcessor(1)]),
+        max_new_tokens=30,
+        eos_token_id=eos,
+    )
+    assert output.tolist() == expected.tolist()
+
+
+def test_generate_midi_from_model_with_compiled_decoder(tiny_model):
+    tokenizer = LlamaMockTokenizer()
+    note_helper = NoteTokenizer(tokenizer)
+    prompt = "60 50 \n 62 50 \n 64 50 \n 60 50 \n 62 50 \n"
+
+    def generate(processor, decoder):
+        stats = GenerationStats()
+        text = generate_midi_from_model(
+            tiny_model,
+            tokenizer,
+            "cpu",
+            prompt,
+            processor,
+            seed=7,
+            max_new_tokens=24,
+            stats=stats,
+            decoder=decoder,
+        )
+        return text, stats
+
+    expected, _ = generate(MelodyControlLogitsProcessor("C", note_helper), None)
+    decoder = StaticDecoder(tiny_model, compile_step=True, bucket=64)
+    text, stats = generate(TensorMelodyControlLogitsProcessor("C", note_helper), decoder)
+    assert text == expected
+    # EOS の判定は sync_interval ステップごとなので、EOS の後も最大でその分だけ処理が進む
+    assert stats.new_tokens <= stats.processor_steps < stats.new_tokens + decoder.sync_interval
+    assert stats.processor_interventions > 0
@@ -0,0 +1,67 @@
+import threading
+
+from src.model.telemetry import AsyncBatchExporter
+
+
+def test_events_are_exported_in_batches():
+    batches = []
+    exporter = AsyncBatchExporter(batches.append, batch_size=4, flush_interval_sec=0.05)
+    for event in range(10):
+        assert exporter.submit(event)
+    assert exporter.flush(timeout=5)
+    assert sorted(e for batch in batches for e in batch) == list(range(10))
+    assert all(len(batch) <= 4 for batch in batches)
+    assert exporter.stats()["exported"] == 10
+
+
+def test_full_queue_drops_events_without_blocking():
+    release = threading.Event()
+    started = threading.Event()
+
+    def slow_handler(batch):
+        started.set()
+        release.wait(timeout=5)
+
+    exporter = AsyncBatchExporter(slow_handler, max_queue=2, batch_size=1)
+    exporter.submit("running")
+    started.wait(timeout=5)
+    assert exporter.submit("queued-1")
+    assert exporter.submit("queued-2")
+    assert not exporter.submit("overflow")
+    assert exporter.stats()["dropped"] == 1
+
+    release.set()
+    assert exporter.flush(timeout=5)
+    assert exporter.stats()["exported"] == 3
+
+
+def test_sampling_rate_zero_skips_all_events():
+    batches = []
+    exporter = AsyncBatchExporter(batches.append, sample_rate=0.0)
+    assert not exporter.submit("event")
+    assert exporter.flush(timeout=1)
+    assert batches == []
+    assert exporter.stats()["sampled_out"] == 1
+
+
+def test_handler_failure_is_counted_and_does_not_stop_exporter():
+    calls = []
+
+    def flaky_handler(batch):
+        calls.append(batch)
+        if len(calls) == 1:
+            raise ConnectionError("offline")
+
+    exporter = AsyncBatchExporter(flaky_handler, batch_size=1)
+    exporter.submit("lost")
+    assert exporter.flush(timeout=5)
+    exporter.submit("sent")
+    assert exporter.flush(timeout=5)
+    stats = exporter.stats()
+    assert (stats["failed"], stats["exported"]) == (1, 1)
+
+
+def test_closed_exporter_rejects_events():
+    exporter = AsyncBatchExporter(lambda batch: None)
+    assert exporter.close(timeout=1)
+    assert not exporter.submit("late")
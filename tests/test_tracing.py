@@ -0,0 +1,108 @@
+import json
+import time
+
+import pytest
+from src.model import tracing
+from src.model.tracing import FileExporter, SpanExporter, span, traced
+
+
+class ListExporter(SpanExporter):
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span.to_dict())
+
+
+@pytest.fixture(autouse=True)
+def restore_tracer(monkeypatch):
+    # テストごとに configure() した内容を元に戻す
+    monkeypatch.setattr(tracing, "_TRACER", tracing.get_tracer())
+
+
+@pytest.fixture
+def exporter():
+    exporter = ListExporter()
+    tracing.configure(exporter, sample_rate=1.0)
+    return exporter
+
+
+def test_nested_spans_share_trace(exporter):
+    with span("bar", chord="Dm7") as root:
+        with span("parse") as child:
+            child.set("notes", 4)
+        tracing.record_span("decode", time.perf_counter() - 0.5, time.perf_counter())
+
+    parse, decode, bar = exporter.spans
+    assert bar["parent_id"] is None
+    assert bar["attributes"] == {"chord": "Dm7"}
+    assert parse["parent_id"] == bar["span_id"] == decode["parent_id"]
+    assert {parse["trace_id"], decode["trace_id"]} == {root.trace_id}
+    assert parse["attributes"] == {"notes": 4}
+    assert decode["duration_ms"] >= 500
+
+
+def test_unsampled_trace_records_nothing(exporter):
+    tracing.configure(exporter, sample_rate=0.0)
+    with span("bar") as root:
+        with span("parse") as child:
+            child.set("notes", 4)
+        tracing.record_span("decode", 0.0, 1.0)
+    assert not root.recording
+    assert exporter.spans == []
+
+
+def test_record_span_outside_trace_is_ignored(exporter):
+    tracing.record_span("decode", 0.0, 1.0)
+    assert exporter.spans == []
+
+
+def test_traced_captures_io_and_errors(exporter):
+    @traced(capture_io=True)
+    def encode(text: str, repeat: int = 1) -> str:
+        if repeat < 0:
+            raise ValueError("negative")
+        return text * repeat
+
+    assert encode("ab", repeat=2) == "abab"
+    with pytest.raises(ValueError):
+        encode("ab", repeat=-1)
+
+    ok, failed = exporter.spans
+    assert ok["attributes"] == {"inputs": {"text": "ab", "repeat": 2}, "output": "abab"}
+    assert failed["error"] == "ValueError: negative"
+
+
+def test_export_failure_does_not_break_caller():
+    class BrokenExporter(SpanExporter):
+        def export(self, span):
+            raise OSError("disk full")
+
+    tracing.configure(BrokenExporter())
+    with span("bar"):
+        result = 1
+    assert result == 1
+
+
+def test_file_exporter_writes_json_lines(tmp_path):
+    path = tmp_path / "traces" / "spans.jsonl"
+    tracing.configure(FileExporter(path))
+    with span("tokenize"):
+        pass
+    (line,) = path.read_text(encoding="utf-8").splitlines()
+    assert json.loads(line)["name"] == "tokenize"
+
+
+def test_invalid_sample_rate():
+    with pytest.raises(ValueError):
+        tracing.Tracer(ListExporter(), sample_rate=1.5)
+
+
+def test_async_exporter_delivers_spans_in_background():
+    inner = ListExporter()
+    async_exporter = tracing.AsyncExporter(inner)
+    tracing.configure(async_exporter)
+    with span("bar"), span("parse"):
+        pass
+    assert async_exporter.flush(timeout=5)
+    assert [s["name"] for s in inner.spans] == ["parse", "bar"]